@@ -2,10 +2,10 @@ import logging
 import time
 from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
-from typing import Callable, Dict, Optional, Sequence, Tuple, Type, Union
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Type, Union
 
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import F
 from psycopg2.sql import SQL, Composable, Identifier, Literal
 
@@ -20,6 +20,7 @@ from analytics.models import (
     last_successful_fill,
 )
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.parallel import run_parallel_queue
 from zerver.lib.timestamp import ceiling_to_day, ceiling_to_hour, floor_to_hour, verify_UTC
 from zerver.models import (
     Message,
@@ -82,6 +83,11 @@ class DataCollector:
 
 ## CountStat-level operations ##
 
+# When catching up, we fill this many of a stat's end_times (a day of
+# an hourly stat) in each transaction, and aggregate them into
+# RealmCount and InstallationCount with a single query each.
+FILL_BATCH_SIZE = 24
+
 def process_count_stat(stat: CountStat, fill_to_time: datetime,
                        realm: Optional[Realm]=None) -> None:
     # TODO: The realm argument is not yet supported, in that we don't
@@ -93,6 +99,31 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime,
     # the CountStat object passed in needs to have come from
     # E.g. get_count_stats(realm), i.e. have the realm_id already
     # entered into the SQL query defined by the CountState object.
+    process_count_stats([stat], fill_to_time, realm)
+
+def process_count_stats(stats: Sequence[CountStat], fill_to_time: datetime,
+                        realm: Optional[Realm]=None, processes: int=1) -> Dict[str, float]:
+    """Fills each of stats through fill_to_time, returning how many
+    seconds each spent filling.
+
+    With more than one process, independent stats, and stretches of
+    the same stat's missing end_times, are filled in parallel.  A
+    DependentCountStat is only filled once any of its dependencies
+    which are also in stats are done."""
+    fill_times: Dict[str, float] = {}
+    remaining = list(stats)
+    while remaining:
+        pending = {stat.property for stat in remaining}
+        ready = [stat for stat in remaining
+                 if not isinstance(stat, DependentCountStat) or
+                 pending.isdisjoint(stat.dependencies)]
+        if not ready:
+            raise AssertionError(f"Circular dependencies between CountStats: {sorted(pending)}")
+        fill_times.update(fill_count_stats(ready, fill_to_time, realm, processes))
+        remaining = [stat for stat in remaining if stat not in ready]
+    return fill_times
+
+def get_end_times_to_fill(stat: CountStat, fill_to_time: datetime) -> Tuple[FillState, List[datetime]]:
     if stat.frequency == CountStat.HOUR:
         time_increment = timedelta(hours=1)
     elif stat.frequency == CountStat.DAY:
@@ -113,7 +144,7 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime,
         logger.info("INITIALIZED %s %s", stat.property, currently_filled)
     elif fill_state.state == FillState.STARTED:
         logger.info("UNDO START %s %s", stat.property, fill_state.end_time)
-        do_delete_counts_at_hour(stat, fill_state.end_time)
+        do_delete_counts_from_hour(stat, fill_state.end_time)
         currently_filled = fill_state.end_time - time_increment
         do_update_fill_state(fill_state, currently_filled, FillState.DONE)
         logger.info("UNDO DONE %s", stat.property)
@@ -128,19 +159,72 @@ def process_count_stat(stat: CountStat, fill_to_time: datetime,
             if dependency_fill_time is None:
                 logger.warning("DependentCountStat %s run before dependency %s.",
                                stat.property, dependency)
-                return
+                return fill_state, []
             fill_to_time = min(fill_to_time, dependency_fill_time)
 
+    end_times = []
     currently_filled = currently_filled + time_increment
     while currently_filled <= fill_to_time:
-        logger.info("START %s %s", stat.property, currently_filled)
-        start = time.time()
-        do_update_fill_state(fill_state, currently_filled, FillState.STARTED)
-        do_fill_count_stat_at_hour(stat, currently_filled, realm)
-        do_update_fill_state(fill_state, currently_filled, FillState.DONE)
-        end = time.time()
+        end_times.append(currently_filled)
         currently_filled = currently_filled + time_increment
-        logger.info("DONE %s (%dms)", stat.property, (end-start)*1000)
+    return fill_state, end_times
+
+class FillProgress:
+    """A stat's end_times to fill, in batches which may be filled out of
+    order.  Its FillState keeps up with the batches filled in order:
+    STARTED at an end_time means that everything before it has been
+    filled, but there may be partial counts from it on."""
+
+    def __init__(self, stat: CountStat, fill_to_time: datetime) -> None:
+        self.stat = stat
+        self.fill_state, end_times = get_end_times_to_fill(stat, fill_to_time)
+        self.batches = [end_times[i:i + FILL_BATCH_SIZE]
+                        for i in range(0, len(end_times), FILL_BATCH_SIZE)]
+        self.filled = [False] * len(self.batches)
+        self.next_batch = 0
+        self.seconds = 0.0
+
+    def start(self) -> None:
+        if self.batches:
+            do_update_fill_state(self.fill_state, self.batches[0][0], FillState.STARTED)
+
+    def finish_batch(self, index: int, seconds: float) -> None:
+        self.filled[index] = True
+        self.seconds += seconds
+        if index != self.next_batch:
+            return
+        while self.next_batch < len(self.batches) and self.filled[self.next_batch]:
+            self.next_batch += 1
+        if self.next_batch < len(self.batches):
+            do_update_fill_state(self.fill_state, self.batches[self.next_batch][0], FillState.STARTED)
+        else:
+            do_update_fill_state(self.fill_state, self.batches[-1][-1], FillState.DONE)
+            logger.info("DONE %s (%dms)", self.stat.property, self.seconds*1000)
+
+def fill_count_stats(stats: Sequence[CountStat], fill_to_time: datetime,
+                     realm: Optional[Realm], processes: int) -> Dict[str, float]:
+    progress = {stat.property: FillProgress(stat, fill_to_time) for stat in stats}
+    for stat_progress in progress.values():
+        stat_progress.start()
+
+    def fill_batch(item: Tuple[str, int]) -> float:
+        property, index = item
+        end_times = progress[property].batches[index]
+        logger.info("START %s %s", property, end_times[0])
+        start = time.time()
+        do_fill_count_stat_at_hours(progress[property].stat, end_times, realm)
+        return time.time() - start
+
+    # Each stat's first batch comes before any stat's second, so that
+    # the stats' FillStates advance together.
+    max_batches = max(len(stat_progress.batches) for stat_progress in progress.values())
+    items = [(property, index) for index in range(max_batches)
+             for property, stat_progress in progress.items()
+             if index < len(stat_progress.batches)]
+    for (property, index), seconds in run_parallel_queue(fill_batch, items, processes, retries=0):
+        progress[property].finish_batch(index, seconds)
+
+    return {property: stat_progress.seconds for property, stat_progress in progress.items()}
 
 def do_update_fill_state(fill_state: FillState, end_time: datetime, state: int) -> None:
     fill_state.end_time = end_time
@@ -150,28 +234,43 @@ def do_update_fill_state(fill_state: FillState, end_time: datetime, state: int)
 # We assume end_time is valid (e.g. is on a day or hour boundary as appropriate)
 # and is timezone aware. It is the caller's responsibility to enforce this!
 def do_fill_count_stat_at_hour(stat: CountStat, end_time: datetime, realm: Optional[Realm]=None) -> None:
-    start_time = end_time - stat.interval
-    if not isinstance(stat, LoggingCountStat):
-        timer = time.time()
-        assert(stat.data_collector.pull_function is not None)
-        rows_added = stat.data_collector.pull_function(stat.property, start_time, end_time, realm)
-        logger.info("%s run pull_function (%dms/%sr)",
-                    stat.property, (time.time()-timer)*1000, rows_added)
-    do_aggregate_to_summary_table(stat, end_time, realm)
-
-def do_delete_counts_at_hour(stat: CountStat, end_time: datetime) -> None:
+    do_fill_count_stat_at_hours(stat, [end_time], realm)
+
+# end_times must be consecutive end_times of the stat, which are all
+# filled in one transaction.
+def do_fill_count_stat_at_hours(stat: CountStat, end_times: List[datetime],
+                                realm: Optional[Realm]=None) -> None:
+    with transaction.atomic():
+        if not isinstance(stat, LoggingCountStat):
+            assert(stat.data_collector.pull_function is not None)
+            for end_time in end_times:
+                timer = time.time()
+                rows_added = stat.data_collector.pull_function(
+                    stat.property, end_time - stat.interval, end_time, realm)
+                logger.info("%s run pull_function (%dms/%sr)",
+                            stat.property, (time.time()-timer)*1000, rows_added)
+        do_aggregate_to_summary_table(stat, end_times[-1], realm, first_end_time=end_times[0])
+
+# Deletes the counts at end_time, and any after it, which an
+# interrupted fill may have left behind.
+def do_delete_counts_from_hour(stat: CountStat, end_time: datetime) -> None:
     if isinstance(stat, LoggingCountStat):
-        InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
+        InstallationCount.objects.filter(property=stat.property, end_time__gte=end_time).delete()
         if stat.data_collector.output_table in [UserCount, StreamCount]:
-            RealmCount.objects.filter(property=stat.property, end_time=end_time).delete()
+            RealmCount.objects.filter(property=stat.property, end_time__gte=end_time).delete()
     else:
-        UserCount.objects.filter(property=stat.property, end_time=end_time).delete()
-        StreamCount.objects.filter(property=stat.property, end_time=end_time).delete()
-        RealmCount.objects.filter(property=stat.property, end_time=end_time).delete()
-        InstallationCount.objects.filter(property=stat.property, end_time=end_time).delete()
+        UserCount.objects.filter(property=stat.property, end_time__gte=end_time).delete()
+        StreamCount.objects.filter(property=stat.property, end_time__gte=end_time).delete()
+        RealmCount.objects.filter(property=stat.property, end_time__gte=end_time).delete()
+        InstallationCount.objects.filter(property=stat.property, end_time__gte=end_time).delete()
 
+# Aggregates the counts at each end_time from first_end_time (by
+# default, just end_time) through end_time.
 def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
-                                  realm: Optional[Realm]=None) -> None:
+                                  realm: Optional[Realm]=None,
+                                  first_end_time: Optional[datetime]=None) -> None:
+    if first_end_time is None:
+        first_end_time = end_time
     cursor = connection.cursor()
 
     # Aggregate into RealmCount
@@ -187,16 +286,17 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
                 (realm_id, value, property, subgroup, end_time)
             SELECT
                 zerver_realm.id, COALESCE(sum({output_table}.value), 0), %(property)s,
-                {output_table}.subgroup, %(end_time)s
+                {output_table}.subgroup, {output_table}.end_time
             FROM zerver_realm
             JOIN {output_table}
             ON
                 zerver_realm.id = {output_table}.realm_id
             WHERE
                 {output_table}.property = %(property)s AND
-                {output_table}.end_time = %(end_time)s
+                {output_table}.end_time >= %(first_end_time)s AND
+                {output_table}.end_time <= %(end_time)s
                 {realm_clause}
-            GROUP BY zerver_realm.id, {output_table}.subgroup
+            GROUP BY zerver_realm.id, {output_table}.subgroup, {output_table}.end_time
         """).format(
             output_table=Identifier(output_table._meta.db_table),
             realm_clause=realm_clause,
@@ -204,6 +304,7 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
         start = time.time()
         cursor.execute(realmcount_query, {
             'property': stat.property,
+            'first_end_time': first_end_time,
             'end_time': end_time,
         })
         end = time.time()
@@ -222,16 +323,18 @@ def do_aggregate_to_summary_table(stat: CountStat, end_time: datetime,
             INSERT INTO analytics_installationcount
                 (value, property, subgroup, end_time)
             SELECT
-                sum(value), %(property)s, analytics_realmcount.subgroup, %(end_time)s
+                sum(value), %(property)s, analytics_realmcount.subgroup, analytics_realmcount.end_time
             FROM analytics_realmcount
             WHERE
                 property = %(property)s AND
-                end_time = %(end_time)s
-            GROUP BY analytics_realmcount.subgroup
+                end_time >= %(first_end_time)s AND
+                end_time <= %(end_time)s
+            GROUP BY analytics_realmcount.subgroup, analytics_realmcount.end_time
         """)
         start = time.time()
         cursor.execute(installationcount_query, {
             'property': stat.property,
+            'first_end_time': first_end_time,
             'end_time': end_time,
         })
         end = time.time()
@@ -9,7 +9,7 @@ from django.core.management.base import BaseCommand
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import now as timezone_now
 
-from analytics.lib.counts import COUNT_STATS, logger, process_count_stat
+from analytics.lib.counts import COUNT_STATS, logger, process_count_stats
 from scripts.lib.zulip_tools import ENDC, WARNING
 from zerver.lib.remote_server import send_analytics_to_remote_server
 from zerver.lib.timestamp import floor_to_hour
@@ -38,6 +38,11 @@ class Command(BaseCommand):
                             action='store_true',
                             help="Print timing information to stdout.",
                             default=False)
+        parser.add_argument('--processes',
+                            type=int,
+                            help="Number of stats, or stretches of a stat's missing hours, "
+                                 "to fill at once; defaults to settings.ANALYTICS_FILL_PROCESSES.",
+                            default=settings.ANALYTICS_FILL_PROCESSES)
 
     def handle(self, *args: Any, **options: Any) -> None:
         try:
@@ -72,17 +77,12 @@ class Command(BaseCommand):
             stats = list(COUNT_STATS.values())
 
         logger.info("Starting updating analytics counts through %s", fill_to_time)
-        if options['verbose']:
-            start = time.time()
-            last = start
-
-        for stat in stats:
-            process_count_stat(stat, fill_to_time)
-            if options['verbose']:
-                print(f"Updated {stat.property} in {time.time() - last:.3f}s")
-                last = time.time()
+        start = time.time()
+        fill_times = process_count_stats(stats, fill_to_time, processes=options['processes'])
 
         if options['verbose']:
+            for property, seconds in fill_times.items():
+                print(f"Updated {property} in {seconds:.3f}s")
             print(f"Finished updating analytics counts through {fill_to_time} in {time.time() - start:.3f}s")
         logger.info("Finished updating analytics counts through %s", fill_to_time)
 
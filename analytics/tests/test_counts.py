@@ -1,3 +1,4 @@
+import random
 from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, List, Optional, Tuple, Type
 from unittest import mock
@@ -13,14 +14,17 @@ from analytics.lib.counts import (
     COUNT_STATS,
     CountStat,
     DependentCountStat,
+    FillProgress,
     LoggingCountStat,
     do_aggregate_to_summary_table,
     do_drop_all_analytics_tables,
     do_drop_single_stat,
     do_fill_count_stat_at_hour,
+    do_fill_count_stat_at_hours,
     do_increment_logging_stat,
     get_count_stats,
     process_count_stat,
+    process_count_stats,
     sql_data_collector,
 )
 from analytics.models import (
@@ -256,8 +260,8 @@ class TestProcessCountStat(AnalyticsTestCase):
         with self.assertRaises(TimezoneNotUTCException):
             process_count_stat(stat, installation_epoch().replace(tzinfo=None))
 
-    # This tests the LoggingCountStat branch of the code in do_delete_counts_at_hour.
-    # It is important that do_delete_counts_at_hour not delete any of the collected
+    # This tests the LoggingCountStat branch of the code in do_delete_counts_from_hour.
+    # It is important that do_delete_counts_from_hour not delete any of the collected
     # logging data!
     def test_process_logging_stat(self) -> None:
         end_time = self.TIME_ZERO
@@ -369,6 +373,137 @@ class TestProcessCountStat(AnalyticsTestCase):
         self.assertEqual(InstallationCount.objects.filter(property='stat4').count(), 1)
         self.assertFillStateEquals(stat4, hour24)
 
+    @mock.patch('analytics.lib.counts.FILL_BATCH_SIZE', 2)
+    def test_process_stat_in_batches(self) -> None:
+        stat = self.make_dummy_count_stat('test stat')
+        hour = [installation_epoch() + i*self.HOUR for i in range(6)]
+
+        # The third batch fails, leaving the first two filled.
+        with mock.patch('analytics.lib.counts.do_fill_count_stat_at_hours',
+                        side_effect=[None, None, Exception("failed")]) as mock_fill, \
+                self.assertLogs(level='WARNING'), self.assertRaises(Exception):
+            process_count_stat(stat, hour[5])
+        self.assertEqual([call[0][1] for call in mock_fill.call_args_list],
+                         [hour[1:3], hour[3:5], hour[5:6]])
+        self.assertFillStateEquals(stat, hour[5], FillState.STARTED)
+
+        process_count_stat(stat, hour[5])
+        self.assertFillStateEquals(stat, hour[5])
+        self.assertTableState(InstallationCount, ['property', 'end_time'],
+                              [['test stat', hour[5]]])
+
+    @mock.patch('analytics.lib.counts.FILL_BATCH_SIZE', 2)
+    def test_fill_progress_out_of_order(self) -> None:
+        hour = [installation_epoch() + i*self.HOUR for i in range(6)]
+        stat = self.make_dummy_count_stat('test stat')
+        progress = FillProgress(stat, hour[5])
+        self.assertEqual(progress.batches, [hour[1:3], hour[3:5], hour[5:6]])
+        progress.start()
+        self.assertFillStateEquals(stat, hour[1], FillState.STARTED)
+
+        # Later batches can finish first, but the FillState only moves
+        # past the batches filled in order.
+        progress.finish_batch(1, 1.0)
+        self.assertFillStateEquals(stat, hour[1], FillState.STARTED)
+        progress.finish_batch(0, 1.0)
+        self.assertFillStateEquals(stat, hour[5], FillState.STARTED)
+        progress.finish_batch(2, 1.0)
+        self.assertFillStateEquals(stat, hour[5])
+        self.assertEqual(progress.seconds, 3.0)
+
+        # If we're interrupted after filling a batch out of order, the
+        # next run throws it away, and fills it again.
+        stat = self.make_dummy_count_stat('other stat')
+        progress = FillProgress(stat, hour[5])
+        progress.start()
+        do_fill_count_stat_at_hours(stat, hour[3:5])
+        progress.finish_batch(1, 1.0)
+        process_count_stat(stat, hour[5])
+        self.assertFillStateEquals(stat, hour[5])
+        self.assertTableState(InstallationCount, ['property', 'end_time'],
+                              [['other stat', end_time] for end_time in hour[1:]])
+
+    def test_process_stats_with_dependencies(self) -> None:
+        stat1 = self.make_dummy_count_stat('stat1')
+        stat2 = self.make_dummy_count_stat('stat2')
+        query = lambda kwargs: SQL("""
+            INSERT INTO analytics_realmcount (realm_id, value, property, end_time)
+            VALUES ({default_realm_id}, 1, {property}, %(time_end)s)
+        """).format(
+            default_realm_id=Literal(self.default_realm.id),
+            property=Literal('stat3'),
+        )
+        stat3 = DependentCountStat('stat3', sql_data_collector(RealmCount, query, None),
+                                   CountStat.HOUR,
+                                   dependencies=['stat1', 'stat2'])
+        hour = [installation_epoch() + i*self.HOUR for i in range(3)]
+
+        # stat3 waits for its dependencies, even when listed first.
+        fill_times = process_count_stats([stat3, stat1, stat2], hour[2])
+        self.assertEqual(set(fill_times), {'stat1', 'stat2', 'stat3'})
+        for stat in [stat1, stat2, stat3]:
+            self.assertFillStateEquals(stat, hour[2])
+        self.assertEqual(InstallationCount.objects.filter(property='stat3').count(), 2)
+
+        stat4 = DependentCountStat('stat4', sql_data_collector(RealmCount, query, None),
+                                   CountStat.HOUR, dependencies=['stat5'])
+        stat5 = DependentCountStat('stat5', sql_data_collector(RealmCount, query, None),
+                                   CountStat.HOUR, dependencies=['stat4'])
+        with self.assertRaisesRegex(AssertionError, "Circular dependencies"):
+            process_count_stats([stat4, stat5], hour[2])
+
+    def test_process_stats_on_generated_data(self) -> None:
+        # Fills a few stats, several days behind, over a generated set
+        # of messages, and checks that filling in batches counts them
+        # just as filling an hour at a time does.
+        stats = [COUNT_STATS[property] for property in [
+            'messages_sent:is_bot:hour', 'messages_sent:message_type:day',
+            'messages_in_stream:is_bot:day']]
+        start_time = self.TIME_ZERO - 3*self.DAY
+
+        rng = random.Random(42)
+        second_realm = Realm.objects.create(
+            string_id='second-realm', name='Second Realm', date_created=start_time - self.DAY)
+        users = []
+        recipients = []
+        for realm in [self.default_realm, second_realm]:
+            for is_bot in [False, False, True]:
+                users.append(self.create_user(realm=realm, is_bot=is_bot,
+                                              date_joined=start_time - self.DAY))
+            for i in range(2):
+                recipients.append((realm, self.create_stream_with_recipient(
+                    realm=realm, date_created=start_time - self.DAY)[1]))
+        for i in range(200):
+            sender = rng.choice(users)
+            recipient = rng.choice([recipient for realm, recipient in recipients
+                                    if realm == sender.realm])
+            self.create_message(sender, recipient,
+                                date_sent=start_time + rng.random() * 3*self.DAY)
+
+        def get_counts() -> Dict[Type[BaseCount], List[Tuple[object, ...]]]:
+            return {table: sorted(
+                (table.objects.values_list('property', 'subgroup', 'end_time', 'value',
+                                           *([] if table is InstallationCount else ['realm_id']))),
+                key=str) for table in [UserCount, StreamCount, RealmCount, InstallationCount]}
+
+        for stat in stats:
+            FillState.objects.create(property=stat.property, state=FillState.DONE,
+                                     end_time=start_time)
+        fill_times = process_count_stats(stats, self.TIME_ZERO)
+        self.assertEqual(set(fill_times), {stat.property for stat in stats})
+        batch_counts = get_counts()
+        self.assertEqual(sum(value for property, subgroup, end_time, value in
+                             batch_counts[InstallationCount]
+                             if property == 'messages_sent:is_bot:hour'), 200)
+
+        do_drop_all_analytics_tables()
+        for stat in stats:
+            end_time = start_time + stat.interval
+            while end_time <= self.TIME_ZERO:
+                do_fill_count_stat_at_hour(stat, end_time)
+                end_time += stat.interval
+        self.assertEqual(get_counts(), batch_counts)
+
 class TestCountStats(AnalyticsTestCase):
     def setUp(self) -> None:
         super().setUp()
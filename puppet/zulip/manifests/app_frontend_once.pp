@@ -34,6 +34,14 @@ class zulip::app_frontend_once {
     source => 'puppet:///modules/zulip/cron.d/soft-deactivate-users',
   }
 
+  file { '/etc/cron.d/fill-memcached-caches':
+    ensure => file,
+    owner  => 'root',
+    group  => 'root',
+    mode   => '0644',
+    source => 'puppet:///modules/zulip/cron.d/fill-memcached-caches',
+  }
+
   file { '/etc/cron.d/archive-messages':
     ensure => file,
     owner  => 'root',
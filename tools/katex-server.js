@@ -0,0 +1,34 @@
+"use strict";
+
+// A long-lived KaTeX renderer, used by zerver/lib/tex.py so that the
+// backend doesn't have to start a new node process for every formula
+// it renders.
+//
+// Each request is a line of JSON on stdin, {"tex": ..., "display": ...},
+// and each response a line of JSON on stdout, either {"html": ...} or
+// {"error": ...} if the TeX is invalid.  Responses are written in the
+// order the requests were received.  The server exits when stdin is
+// closed, i.e. when the process that started it goes away.
+
+const readline = require("readline");
+
+const katex = require("katex");
+
+const input = readline.createInterface({input: process.stdin, terminal: false});
+
+input.on("line", (line) => {
+    let response;
+    try {
+        const request = JSON.parse(line);
+        response = {
+            html: katex.renderToString(request.tex, {displayMode: Boolean(request.display)}),
+        };
+    } catch (error) {
+        response = {error: String(error.message)};
+    }
+    process.stdout.write(JSON.stringify(response) + "\n");
+});
+
+input.on("close", () => {
+    process.exit(0);
+});
@@ -278,6 +278,7 @@ export default (env?: string): webpack.Configuration[] => {
         context: resolve(__dirname, "../"),
         entry: {
             "katex-cli": "shebang-loader!katex/cli",
+            "katex-server": "./tools/katex-server.js",
         },
         output: {
             path: resolve(__dirname, "../static/webpack-bundles"),
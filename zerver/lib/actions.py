@@ -68,6 +68,7 @@ from zerver.lib.cache import (
     cache_with_key,
     delete_user_profile_caches,
     display_recipient_cache_key,
+    flush_realm_mention_index,
     flush_user_profile,
     to_dict_cache_key_id,
     user_profile_by_api_key_cache_key,
@@ -5894,6 +5895,8 @@ def bulk_add_members_to_user_group(user_group: UserGroup,
                                        user_profile=user_profile)
                    for user_profile in user_profiles]
     UserGroupMembership.objects.bulk_create(memberships)
+    # Django bulk_create operations don't flush caches, so we need to do this ourselves.
+    flush_realm_mention_index(user_group.realm_id)
 
     user_ids = [up.id for up in user_profiles]
     do_send_user_group_members_update_event('add_members', user_group, user_ids)
@@ -5903,6 +5906,7 @@ def remove_members_from_user_group(user_group: UserGroup,
     UserGroupMembership.objects.filter(
         user_group_id=user_group.id,
         user_profile__in=user_profiles).delete()
+    flush_realm_mention_index(user_group.realm_id)
 
     user_ids = [up.id for up in user_profiles]
     do_send_user_group_members_update_event('remove_members', user_group, user_ids)
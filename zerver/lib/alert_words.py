@@ -1,12 +1,15 @@
-from typing import Dict, Iterable, List
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
 
 import ahocorasick
 from django.db import transaction
 
 from zerver.lib.cache import (
+    LRUCache,
     cache_with_key,
-    realm_alert_words_automaton_cache_key,
+    get_or_create_version_token,
     realm_alert_words_cache_key,
+    realm_alert_words_version_cache_key,
 )
 from zerver.models import AlertWord, Realm, UserProfile, flush_realm_alert_words
 
@@ -21,26 +24,79 @@ def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
         user_ids_with_words[id_and_word["user_profile_id"]].append(id_and_word["word"])
     return user_ids_with_words
 
-@cache_with_key(realm_alert_words_automaton_cache_key, timeout=3600*24)
-def get_alert_word_automaton(realm: Realm) -> ahocorasick.Automaton:
-    user_id_with_words = alert_words_in_realm(realm)
-    alert_word_automaton  = ahocorasick.Automaton()
-    for (user_id, alert_words) in user_id_with_words.items():
-        for alert_word in alert_words:
-            alert_word_lower = alert_word.lower()
-            if alert_word_automaton.exists(alert_word_lower):
-                (key, user_ids_for_alert_word) = alert_word_automaton.get(alert_word_lower)
-                user_ids_for_alert_word.add(user_id)
-            else:
-                alert_word_automaton.add_word(alert_word_lower, (alert_word_lower, {user_id}))
-    alert_word_automaton.make_automaton()
-    # If the kind is not AHOCORASICK after calling make_automaton, it means there is no key present
-    # and hence we cannot call items on the automaton yet. To avoid it we return None for such cases
-    # where there is no alert-words in the realm.
+# How long a realm's alert word version is kept; this bounds how long
+# a process's automaton can be stale if a change somehow isn't flushed.
+ALERT_WORDS_VERSION_TIMEOUT = 3600 * 24
+
+# The number of realms whose alert word automatons each process keeps.
+MAX_CACHED_ALERT_WORD_REALMS = 100
+
+class RealmAlertWordAutomaton:
+    """A process's alert word automaton for a realm, along with the
+    words it was built from.
+
+    When the realm's alert words change, we update the automaton with
+    just the words that were added, removed, or gained or lost users,
+    rather than building (or fetching a pickled copy of) the whole
+    automaton; in a large realm, a change typically touches only a
+    handful of its words."""
+
+    def __init__(self) -> None:
+        self.version: Optional[str] = None
+        self.user_ids_by_word: Dict[str, Set[int]] = {}
+        self.automaton = ahocorasick.Automaton()
+
+    def update(self, user_id_with_words: Dict[int, List[str]]) -> None:
+        user_ids_by_word: Dict[str, Set[int]] = defaultdict(set)
+        for (user_id, alert_words) in user_id_with_words.items():
+            for alert_word in alert_words:
+                user_ids_by_word[alert_word.lower()].add(user_id)
+
+        for word in self.user_ids_by_word.keys() - user_ids_by_word.keys():
+            self.automaton.remove_word(word)
+        for (word, user_ids) in user_ids_by_word.items():
+            if self.user_ids_by_word.get(word) != user_ids:
+                self.automaton.add_word(word, (word, user_ids))
+        self.user_ids_by_word = dict(user_ids_by_word)
+
+        # Adding or removing words turns the automaton back into a
+        # trie, which has to be converted again before it can be
+        # searched.
+        if self.automaton.kind == ahocorasick.TRIE:
+            self.automaton.make_automaton()
+
+realm_alert_word_automatons: LRUCache[int, RealmAlertWordAutomaton] = LRUCache(
+    MAX_CACHED_ALERT_WORD_REALMS)
+
+def get_alert_word_automaton(realm: Realm) -> Optional[ahocorasick.Automaton]:
+    # We fetch the version before the words, so that a change made in
+    # between replaces the version we record.
+    version = get_or_create_version_token(realm_alert_words_version_cache_key(realm),
+                                          ALERT_WORDS_VERSION_TIMEOUT)
+    realm_automaton = realm_alert_word_automatons.get(realm.id)
+    if realm_automaton is None:
+        realm_automaton = RealmAlertWordAutomaton()
+        realm_alert_word_automatons.set(realm.id, realm_automaton)
+    if version is None or realm_automaton.version != version:
+        realm_automaton.update(alert_words_in_realm(realm))
+        realm_automaton.version = version
+
+    # If the kind is not AHOCORASICK, there are no alert words in the
+    # realm, and hence we cannot call items on the automaton.  To avoid
+    # that, we return None in that case.
     # https://pyahocorasick.readthedocs.io/en/latest/index.html?highlight=Automaton.kind#module-constants
-    if alert_word_automaton.kind != ahocorasick.AHOCORASICK:
+    if realm_automaton.automaton.kind != ahocorasick.AHOCORASICK:
+        return None
+    return realm_automaton.automaton
+
+def get_alert_word_automaton_version(realm_id: int,
+                                     automaton: ahocorasick.Automaton) -> Optional[str]:
+    """Returns the version of automaton, if it is this process's
+    automaton for the realm, as returned by get_alert_word_automaton."""
+    realm_automaton = realm_alert_word_automatons.get(realm_id)
+    if realm_automaton is None or realm_automaton.automaton is not automaton:
         return None
-    return alert_word_automaton
+    return realm_automaton.version
 
 def user_alert_words(user_profile: UserProfile) -> List[str]:
     return list(AlertWord.objects.filter(user_profile=user_profile).values_list("word", flat=True))
@@ -2,6 +2,7 @@ from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from django.db.models import Model
 
+from zerver.lib.cache import flush_realm_mention_index
 from zerver.lib.create_user import create_user_profile, get_display_email_address
 from zerver.lib.initial_password import initial_password
 from zerver.lib.streams import render_stream_description
@@ -43,6 +44,8 @@ def bulk_create_users(realm: Realm,
         for user_profile in profiles_to_create:
             user_profile.email = get_display_email_address(user_profile, realm)
         UserProfile.objects.bulk_update(profiles_to_create, ['email'])
+    # Django bulk_create operations don't flush caches, so we need to do this ourselves.
+    flush_realm_mention_index(realm.id)
 
     user_ids = {user.id for user in profiles_to_create}
 
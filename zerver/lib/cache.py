@@ -8,12 +8,14 @@ import re
 import sys
 import time
 import traceback
+from collections import OrderedDict
 from functools import wraps
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     Dict,
+    Generic,
     Iterable,
     List,
     Optional,
@@ -27,11 +29,13 @@ from django.conf import settings
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 from django.utils.lru_cache import lru_cache
 
-from zerver.lib.utils import make_safe_digest, statsd, statsd_key
+from zerver.lib import request_profiling
+from zerver.lib.utils import generate_random_token, make_safe_digest, statsd, statsd_key
 
 if TYPE_CHECKING:
     # These modules have to be imported for type annotations but
@@ -41,6 +45,8 @@ if TYPE_CHECKING:
 MEMCACHED_MAX_KEY_LENGTH = 250
 
 FuncT = TypeVar('FuncT', bound=Callable[..., object])
+KeyT = TypeVar('KeyT')
+ValueT = TypeVar('ValueT')
 
 logger = logging.getLogger()
 
@@ -62,12 +68,15 @@ def remote_cache_stats_start() -> None:
     global remote_cache_time_start
     remote_cache_time_start = time.time()
 
-def remote_cache_stats_finish() -> None:
+def remote_cache_stats_finish(operation: str="", keys: Iterable[str]=()) -> None:
     global remote_cache_total_time
     global remote_cache_total_requests
     global remote_cache_time_start
     remote_cache_total_requests += 1
-    remote_cache_total_time += (time.time() - remote_cache_time_start)
+    duration = time.time() - remote_cache_time_start
+    remote_cache_total_time += duration
+    if request_profiling.current_profile is not None:
+        request_profiling.record_cache_call(operation, keys, duration)
 
 def get_or_create_key_prefix() -> str:
     if settings.CASPER_TESTS:
@@ -235,7 +244,20 @@ def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optio
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(final_key, (val,), timeout=timeout)
-    remote_cache_stats_finish()
+    remote_cache_stats_finish("set", [key])
+
+def cache_add(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None) -> bool:
+    """Like cache_set, but only stores the value if the key is not
+    already present.  Returns whether the value was stored, which makes
+    this usable as a lock shared between processes."""
+    final_key = KEY_PREFIX + key
+    validate_cache_key(final_key)
+
+    remote_cache_stats_start()
+    cache_backend = get_cache_backend(cache_name)
+    ret = cache_backend.add(final_key, (val,), timeout=timeout)
+    remote_cache_stats_finish("add", [key])
+    return ret
 
 def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
     final_key = KEY_PREFIX + key
@@ -244,16 +266,63 @@ def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(final_key)
-    remote_cache_stats_finish()
+    remote_cache_stats_finish("get", [key])
     return ret
 
+class LRUCache(Generic[KeyT, ValueT]):
+    """A dictionary holding at most max_size items, which evicts the
+    least recently used item when full.  Used for the per-realm data
+    that each process keeps in memory, where lru_cache won't do because
+    entries have to be replaced when the realm's data changes."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.items: "OrderedDict[KeyT, ValueT]" = OrderedDict()
+
+    def get(self, key: KeyT) -> Optional[ValueT]:
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def set(self, key: KeyT, value: ValueT) -> None:
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def __contains__(self, key: KeyT) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def clear(self) -> None:
+        self.items.clear()
+
+def get_or_create_version_token(key: str, timeout: int) -> Optional[str]:
+    """Returns the random token stored at key, storing a new one if
+    there is none.  Processes that keep data in memory store it with
+    the token, and rebuild it when the token changes; deleting the key
+    thus invalidates that data in every process.  Returns None if the
+    token can't be stored, e.g. if the cache is unavailable."""
+    version = cache_get(key)
+    if version is None:
+        # If another process stores a token first, we use theirs.
+        cache_add(key, generate_random_token(32), timeout=timeout)
+        version = cache_get(key)
+        if version is None:
+            return None
+    return version[0]
+
 def cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:
+    requested_keys = keys
     keys = [KEY_PREFIX + key for key in keys]
     for key in keys:
         validate_cache_key(key)
     remote_cache_stats_start()
     ret = get_cache_backend(cache_name).get_many(keys)
-    remote_cache_stats_finish()
+    remote_cache_stats_finish("get_many", requested_keys)
     return {key[len(KEY_PREFIX):]: value for key, value in ret.items()}
 
 def safe_cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:
@@ -279,10 +348,9 @@ def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
         new_key = KEY_PREFIX + key
         validate_cache_key(new_key)
         new_items[new_key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
-    remote_cache_stats_finish()
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
+    remote_cache_stats_finish("set_many", items.keys())
 
 def safe_cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
                         timeout: Optional[int]=None) -> None:
@@ -309,15 +377,16 @@ def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
 
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(final_key)
-    remote_cache_stats_finish()
+    remote_cache_stats_finish("delete", [key])
 
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> None:
+    items = list(items)
     keys = [KEY_PREFIX + item for item in items]
     for key in keys:
         validate_cache_key(key)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(keys)
-    remote_cache_stats_finish()
+    remote_cache_stats_finish("delete_many", items)
 
 def filter_good_and_bad_keys(keys: List[str]) -> Tuple[List[str], List[str]]:
     good_keys = []
@@ -348,6 +417,12 @@ CacheItemT = TypeVar('CacheItemT')
 # serializable objects, will be the object; if encoded, bytes.
 CompressedItemT = TypeVar('CompressedItemT')
 
+# The database queries made by generic_bulk_cached_fetch for missing
+# keys are split into batches of this size, so that fetching a very
+# large number of cold objects doesn't construct one enormous
+# `id IN (...)` query and cache_set_many payload.
+BULK_FETCH_BATCH_SIZE = 1000
+
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
 # * cache_key_function: object_id => cache key
@@ -389,20 +464,17 @@ def generic_bulk_cached_fetch(
     needed_ids = [object_id for object_id in object_ids if
                   cache_keys[object_id] not in cached_objects]
 
-    # Only call query_function if there are some ids to fetch from the database:
-    if len(needed_ids) > 0:
-        db_objects = query_function(needed_ids)
-    else:
-        db_objects = []
-
-    items_for_remote_cache: Dict[str, Tuple[CompressedItemT]] = {}
-    for obj in db_objects:
-        key = cache_keys[id_fetcher(obj)]
-        item = cache_transformer(obj)
-        items_for_remote_cache[key] = (setter(item),)
-        cached_objects[key] = item
-    if len(items_for_remote_cache) > 0:
-        safe_cache_set_many(items_for_remote_cache)
+    # Fetch whatever is missing from the database, in batches:
+    for i in range(0, len(needed_ids), BULK_FETCH_BATCH_SIZE):
+        items_for_remote_cache: Dict[str, Tuple[CompressedItemT]] = {}
+        for obj in query_function(needed_ids[i:i + BULK_FETCH_BATCH_SIZE]):
+            key = cache_keys[id_fetcher(obj)]
+            item = cache_transformer(obj)
+            items_for_remote_cache[key] = (setter(item),)
+            cached_objects[key] = item
+        if len(items_for_remote_cache) > 0:
+            safe_cache_set_many(items_for_remote_cache)
+
     return {object_id: cached_objects[cache_keys[object_id]] for object_id in object_ids
             if cache_keys[object_id] in cached_objects}
 
@@ -482,6 +554,19 @@ realm_user_dict_fields: List[str] = [
 def realm_user_dicts_cache_key(realm_id: int) -> str:
     return f"realm_user_dicts:{realm_id}"
 
+def realm_mention_index_version_cache_key(realm_id: int) -> str:
+    return f"realm_mention_index_version:{realm_id}"
+
+def flush_realm_mention_index(realm_id: int) -> None:
+    # Processes rebuild their MentionIndex for the realm when they see
+    # that its version has changed.  We replace the version now, so
+    # that this transaction sees its own changes, and again once it
+    # commits, since another process may rebuild the index from the
+    # old data (and store it under a new version) in the meantime.
+    key = realm_mention_index_version_cache_key(realm_id)
+    cache_delete(key)
+    transaction.on_commit(lambda: cache_delete(key))
+
 def get_realm_used_upload_space_cache_key(realm: 'Realm') -> str:
     return f'realm_used_upload_space:{realm.id}'
 
@@ -571,6 +656,9 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(kwargs, ['email', 'full_name', 'id', 'is_mirror_dummy']):
         delete_display_recipient_cache(user_profile)
 
+    if changed(kwargs, ['email', 'full_name', 'is_active']):
+        flush_realm_mention_index(user_profile.realm_id)
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(kwargs, bot_dict_fields):
@@ -590,7 +678,7 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
-        cache_delete(realm_alert_words_automaton_cache_key(realm))
+        cache_delete(realm_alert_words_version_cache_key(realm))
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
         cache_delete(realm_rendered_description_cache_key(realm))
         cache_delete(realm_text_description_cache_key(realm))
@@ -602,8 +690,8 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
 def realm_alert_words_cache_key(realm: 'Realm') -> str:
     return f"realm_alert_words:{realm.string_id}"
 
-def realm_alert_words_automaton_cache_key(realm: 'Realm') -> str:
-    return f"realm_alert_words_automaton:{realm.string_id}"
+def realm_alert_words_version_cache_key(realm: 'Realm') -> str:
+    return f"realm_alert_words_version:{realm.string_id}"
 
 def realm_rendered_description_cache_key(realm: 'Realm') -> str:
     return f"realm_rendered_description:{realm.string_id}"
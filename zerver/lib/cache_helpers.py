@@ -1,11 +1,12 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/caching.html for docs
 import datetime
 import logging
-from typing import Any, Callable, Dict, List, Tuple
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from django.conf import settings
 from django.contrib.sessions.models import Session
-from django.db.models import Q
+from django.db.models import Count
 from django.utils.timezone import now as timezone_now
 
 # This file needs to be different from cache.py because cache.py
@@ -13,6 +14,8 @@ from django.utils.timezone import now as timezone_now
 # loop
 from analytics.models import RealmCount
 from zerver.lib.cache import (
+    cache_get,
+    cache_set,
     cache_set_many,
     get_remote_cache_requests,
     get_remote_cache_time,
@@ -20,9 +23,11 @@ from zerver.lib.cache import (
     user_profile_by_api_key_cache_key,
     user_profile_cache_key,
 )
-from zerver.lib.message import MessageDict
+from zerver.lib.message import MessageDict, stringify_message_dict
+from zerver.lib.parallel import run_parallel_queue
 from zerver.lib.sessions import session_engine
 from zerver.lib.users import get_all_api_keys
+from zerver.lib.utils import statsd
 from zerver.models import (
     Client,
     Huddle,
@@ -35,23 +40,38 @@ from zerver.models import (
 )
 
 MESSAGE_CACHE_SIZE = 75000
+# When warming the message cache, we fetch the most recent messages in
+# each active realm's busiest streams.
+HOT_STREAMS_PER_REALM = 20
+MESSAGES_PER_HOT_STREAM = 100
 
-def message_fetch_objects() -> List[Any]:
+def message_fetch_objects(realm_id: Optional[int]=None) -> Iterator[Dict[str, Any]]:
+    """Returns raw message rows, in the format used by messages_for_ids,
+    for the recent messages in the hottest streams of the realm (or of
+    every active realm)."""
     try:
         max_id = Message.objects.only('id').order_by("-id")[0].id
     except IndexError:
-        return []
-    return Message.objects.select_related().filter(~Q(sender__email='tabbott/extra@mit.edu'),
-                                                   id__gt=max_id - MESSAGE_CACHE_SIZE)
+        return
+    realm_ids = [realm_id] if realm_id is not None else get_active_realm_ids()
+    for rid in realm_ids:
+        recipient_ids = Stream.objects.filter(realm_id=rid, deactivated=False).values('recipient_id')
+        hot_recipient_ids = Message.objects.filter(
+            recipient_id__in=recipient_ids,
+            id__gt=max_id - MESSAGE_CACHE_SIZE,
+        ).values('recipient_id').annotate(
+            message_count=Count('id'),
+        ).order_by('-message_count').values_list('recipient_id', flat=True)[:HOT_STREAMS_PER_REALM]
+        for recipient_id in hot_recipient_ids:
+            message_ids = list(Message.objects.filter(
+                recipient_id=recipient_id,
+            ).order_by('-id').values_list('id', flat=True)[:MESSAGES_PER_HOT_STREAM])
+            yield from MessageDict.get_raw_db_rows(message_ids)
 
 def message_cache_items(items_for_remote_cache: Dict[str, Tuple[bytes]],
-                        message: Message) -> None:
-    '''
-    Note: this code is untested, and the caller has been
-    commented out for a while.
-    '''
-    key = to_dict_cache_key_id(message.id)
-    value = MessageDict.to_dict_uncached([message])[message.id]
+                        row: Dict[str, Any]) -> None:
+    key = to_dict_cache_key_id(row['id'])
+    value = stringify_message_dict(MessageDict.build_dict_from_raw_db_row(row))
     items_for_remote_cache[key] = (value,)
 
 def user_cache_items(items_for_remote_cache: Dict[str, Tuple[UserProfile]],
@@ -92,56 +112,162 @@ def get_active_realm_ids() -> List[int]:
     trial organization that has ever been created costing us N streams
     worth of cache work (where N is the number of default streams for
     a new organization).
+
+    The realms are returned with those with the most active users
+    first, so that cache warming helps the most users soonest.
     """
     date = timezone_now() - datetime.timedelta(days=2)
-    return RealmCount.objects.filter(
-        end_time__gte=date,
-        property="1day_actives::day",
-        value__gt=0).distinct("realm_id").values_list("realm_id", flat=True)
+    active_users: Dict[int, int] = {}
+    for realm_id, value in RealmCount.objects.filter(
+            end_time__gte=date,
+            property="1day_actives::day",
+            value__gt=0).values_list("realm_id", "value"):
+        active_users[realm_id] = max(value, active_users.get(realm_id, 0))
+    return sorted(active_users, key=lambda realm_id: -active_users[realm_id])
 
-def get_streams() -> List[Stream]:
+def get_streams(realm_id: Optional[int]=None) -> Iterable[Stream]:
+    realm_ids = [realm_id] if realm_id is not None else get_active_realm_ids()
     return Stream.objects.select_related().filter(
-        realm__in=get_active_realm_ids()).exclude(
+        realm__in=realm_ids).exclude(
             # We filter out Zephyr realms, because they can easily
             # have 10,000s of streams with only 1 subscriber.
             is_in_zephyr_realm=True)
 
-def get_users() -> List[UserProfile]:
+def get_users(realm_id: Optional[int]=None) -> Iterable[UserProfile]:
+    realm_ids = [realm_id] if realm_id is not None else get_active_realm_ids()
     return UserProfile.objects.select_related().filter(
         long_term_idle=False,
-        realm__in=get_active_realm_ids())
+        realm__in=realm_ids)
+
+def get_sessions(realm_id: Optional[int]=None) -> Iterable[Session]:
+    # Sessions don't record their realm.  Sessions are created (and
+    # their expiry pushed back) when users log in, so those expiring
+    # last are generally those of the most recently active users.
+    return Session.objects.filter(expire_date__gt=timezone_now()).order_by('-expire_date')
 
 # Format is (objects query, items filler function, timeout, batch size)
 #
-# The objects queries are put inside lambdas to prevent Django from
-# doing any setup for things we're unlikely to use (without the lambda
-# wrapper the below adds an extra 3ms or so to startup time for
-# anything importing this file).
-cache_fillers: Dict[str, Tuple[Callable[[], List[Any]], Callable[[Dict[str, Any], Any], None], int, int]] = {
+# The objects queries are functions taking an optional realm ID,
+# which limits the objects to that realm where that makes sense.
+# They're functions to prevent Django from doing any setup for
+# things we're unlikely to use (without the function wrapper the
+# below adds an extra 3ms or so to startup time for anything
+# importing this file).
+cache_fillers: Dict[str, Tuple[Callable[[Optional[int]], Iterable[Any]], Callable[[Dict[str, Any], Any], None], int, int]] = {
     'user': (get_users, user_cache_items, 3600*24*7, 10000),
-    'client': (lambda: Client.objects.select_related().all(), client_cache_items, 3600*24*7, 10000),
+    'client': (lambda realm_id: Client.objects.select_related().all(), client_cache_items, 3600*24*7, 10000),
     'stream': (get_streams, stream_cache_items, 3600*24*7, 10000),
-    # Message cache fetching disabled until we can fix the fact that it
-    # does a bunch of inefficient memcached queries as part of filling
-    # the display_recipient cache
-    #    'message': (message_fetch_objects, message_cache_items, 3600 * 24, 1000),
-    'huddle': (lambda: Huddle.objects.select_related().all(), huddle_cache_items, 3600*24*7, 10000),
-    'session': (lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
+    'message': (message_fetch_objects, message_cache_items, 3600*24, 1000),
+    'huddle': (lambda realm_id: Huddle.objects.select_related().all(), huddle_cache_items, 3600*24*7, 10000),
+    'session': (get_sessions, session_cache_items, 3600*24*7, 10000),
 }
 
-def fill_remote_cache(cache: str) -> None:
+def fill_remote_cache(cache: str, realm_id: Optional[int]=None,
+                      db_load_budget: float=1.0) -> int:
+    """Fills the remote cache with the objects for the cache filler
+    `cache`, optionally limited to one realm, returning the number of
+    keys set.
+
+    db_load_budget is the fraction of the time this is allowed to
+    spend fetching and preparing objects; after each batch, we sleep
+    long enough to stay within that budget, so that warming caches on
+    a busy server doesn't starve real requests of database capacity.
+    """
     remote_cache_time_start = get_remote_cache_time()
     remote_cache_requests_start = get_remote_cache_requests()
     items_for_remote_cache: Dict[str, Any] = {}
     (objects, items_filler, timeout, batch_size) = cache_fillers[cache]
     count = 0
-    for obj in objects():
+    keys = 0
+    batch_start = time.time()
+    for obj in objects(realm_id):
         items_filler(items_for_remote_cache, obj)
         count += 1
         if (count % batch_size == 0):
-            cache_set_many(items_for_remote_cache, timeout=3600*24)
+            batch_time = time.time() - batch_start
+            cache_set_many(items_for_remote_cache, timeout=timeout)
+            keys += len(items_for_remote_cache)
             items_for_remote_cache = {}
-    cache_set_many(items_for_remote_cache, timeout=3600*24*7)
-    logging.info("Successfully populated %s cache!  Consumed %s remote cache queries (%s time)",
-                 cache, get_remote_cache_requests() - remote_cache_requests_start,
+            if db_load_budget < 1:
+                time.sleep(batch_time * (1 / db_load_budget - 1))
+            batch_start = time.time()
+    cache_set_many(items_for_remote_cache, timeout=timeout)
+    keys += len(items_for_remote_cache)
+    logging.info("Successfully populated %s cache%s!  Consumed %s remote cache queries (%s time)",
+                 cache, f" for realm {realm_id}" if realm_id is not None else "",
+                 get_remote_cache_requests() - remote_cache_requests_start,
                  round(get_remote_cache_time() - remote_cache_time_start, 2))
+    return keys
+
+# Caches that are filled one realm at a time, most active realm first.
+PER_REALM_CACHES = ['user', 'stream', 'message']
+
+def get_cache_warming_plan(caches: Optional[List[str]]=None) -> List[Tuple[str, Optional[int]]]:
+    """Returns the (cache, realm ID) tasks for warming the remote cache,
+    in priority order: the small global caches, then users and streams
+    in the realms with the most active users first, then recently
+    active users' sessions, and finally the hot streams' recent
+    messages, again with the most active realms first."""
+    if caches is None:
+        caches = list(cache_fillers.keys())
+    realm_ids = get_active_realm_ids()
+
+    plan: List[Tuple[str, Optional[int]]] = []
+    for cache in ['client', 'huddle']:
+        if cache in caches:
+            plan.append((cache, None))
+    for realm_id in realm_ids:
+        for cache in ['user', 'stream']:
+            if cache in caches:
+                plan.append((cache, realm_id))
+    if 'session' in caches:
+        plan.append(('session', None))
+    if 'message' in caches:
+        for realm_id in realm_ids:
+            plan.append(('message', realm_id))
+    return plan
+
+# Set once the whole remote cache has been warmed.  Since it never
+# expires, it's only missing if memcached has been restarted or
+# flushed since then, or the last warm-up didn't finish, which is when
+# a cache warm-up is worthwhile.
+CACHE_WARMING_SENTINEL_KEY = 'cache_warming:warmed'
+
+def remote_cache_is_cold() -> bool:
+    return cache_get(CACHE_WARMING_SENTINEL_KEY) is None
+
+def warm_remote_caches(processes: int=1, db_load_budget: float=1.0,
+                       caches: Optional[List[str]]=None) -> Dict[str, Dict[str, int]]:
+    """Runs the cache warming plan, in parallel across `processes`
+    worker processes, and returns coverage statistics for each cache:
+    how many of its planned tasks completed, and the number of keys
+    filled."""
+    plan = get_cache_warming_plan(caches)
+    stats: Dict[str, Dict[str, int]] = {}
+    for cache, realm_id in plan:
+        cache_stats = stats.setdefault(cache, {'tasks': 0, 'completed_tasks': 0, 'keys': 0})
+        cache_stats['tasks'] += 1
+
+    # A task which fails is logged, and doesn't stop the others.
+    def warm_task(task: Tuple[str, Optional[int]]) -> Optional[int]:
+        (cache, realm_id) = task
+        try:
+            return fill_remote_cache(cache, realm_id, db_load_budget=db_load_budget)
+        except Exception:
+            logging.exception("Failed to warm %s cache for realm %s", cache, realm_id)
+            return None
+
+    for (cache, realm_id), keys in run_parallel_queue(warm_task, plan, processes, retries=0):
+        if keys is not None:
+            stats[cache]['completed_tasks'] += 1
+            stats[cache]['keys'] += keys
+
+    for cache, cache_stats in stats.items():
+        statsd.gauge(f'cache_warming.{cache}.keys', cache_stats['keys'])
+        logging.info("Warmed %s cache: %s/%s tasks completed, %s keys",
+                     cache, cache_stats['completed_tasks'], cache_stats['tasks'], cache_stats['keys'])
+
+    if caches is None and all(cache_stats['completed_tasks'] == cache_stats['tasks']
+                              for cache_stats in stats.values()):
+        cache_set(CACHE_WARMING_SENTINEL_KEY, True)
+    return stats
@@ -4,6 +4,8 @@ from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Seque
 from psycopg2.extensions import connection, cursor
 from psycopg2.sql import Composable
 
+from zerver.lib import duplicate_queries, request_profiling
+
 CursorObj = TypeVar('CursorObj', bound=cursor)
 Query = Union[str, Composable]
 Params = Union[Sequence[object], Mapping[str, object]]
@@ -24,6 +26,12 @@ def wrapper_execute(self: CursorObj,
         self.connection.queries.append({
             'time': f"{duration:.3f}",
         })
+        if request_profiling.current_profile is not None:
+            request_profiling.record_query(
+                sql if isinstance(sql, str) else sql.as_string(self), duration)
+        if duplicate_queries.current_detector is not None:
+            duplicate_queries.current_detector.record(
+                sql if isinstance(sql, str) else sql.as_string(self))
 
 class TimeTrackingCursor(cursor):
     """A psycopg2 cursor class that tracks the time spent executing queries."""
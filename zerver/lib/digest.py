@@ -1,7 +1,7 @@
 import datetime
 import logging
 from collections import defaultdict
-from typing import Any, Dict, List, Set, Tuple, Union
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
 
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
@@ -18,8 +18,8 @@ from zerver.models import (
     Realm,
     RealmAuditLog,
     Recipient,
+    Stream,
     Subscription,
-    UserActivity,
     UserProfile,
     get_active_streams,
     get_user_profile_by_id,
@@ -29,24 +29,24 @@ logger = logging.getLogger(__name__)
 log_to_file(logger, settings.DIGEST_LOG_PATH)
 
 DIGEST_CUTOFF = 5
+DIGEST_QUEUE_BATCH_SIZE = 100
 
 # Digests accumulate 2 types of interesting traffic for a user:
 # 1. New streams
 # 2. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
-
-def inactive_since(user_profile: UserProfile, cutoff: datetime.datetime) -> bool:
-    # Hasn't used the app in the last DIGEST_CUTOFF (5) days.
-    most_recent_visit = [row.last_visit for row in
-                         UserActivity.objects.filter(
-                             user_profile=user_profile)]
-
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+#
+# Both are gathered once per realm (see RealmDigest), and shared by
+# the digests of the realm's users.
+
+def get_inactive_user_ids(realm: Realm, cutoff: datetime.datetime) -> List[int]:
+    # Users who want digests, and haven't used the app in the last
+    # DIGEST_CUTOFF (5) days, including those who never have.
+    return list(UserProfile.objects.filter(
+        realm=realm, is_active=True, is_bot=False, enable_digest_emails=True,
+    ).exclude(
+        useractivity__last_visit__gte=cutoff,
+    ).order_by('id').values_list('id', flat=True))
 
 def should_process_digest(realm_str: str) -> bool:
     if realm_str in settings.SYSTEM_ONLY_REALMS:
@@ -56,9 +56,9 @@ def should_process_digest(realm_str: str) -> bool:
 
 # Changes to this should also be reflected in
 # zerver/worker/queue_processors.py:DigestWorker.consume()
-def queue_digest_recipient(user_profile: UserProfile, cutoff: datetime.datetime) -> None:
+def queue_digest_user_ids(user_ids: List[int], cutoff: datetime.datetime) -> None:
     # Convert cutoff to epoch seconds for transit.
-    event = {"user_profile_id": user_profile.id,
+    event = {"user_ids": user_ids,
              "cutoff": cutoff.strftime('%s')}
     queue_json_publish("digest_emails", event)
 
@@ -71,90 +71,133 @@ def enqueue_emails(cutoff: datetime.datetime) -> None:
         if not should_process_digest(realm.string_id):
             continue
 
-        user_profiles = UserProfile.objects.filter(
-            realm=realm, is_active=True, is_bot=False, enable_digest_emails=True)
-
-        for user_profile in user_profiles:
-            if inactive_since(user_profile, cutoff):
-                queue_digest_recipient(user_profile, cutoff)
-                logger.info(
-                    "User %s is inactive, queuing for potential digest",
-                    user_profile.id,
-                )
-
-def gather_hot_conversations(user_profile: UserProfile, messages: List[Message]) -> List[Dict[str, Any]]:
-    # Gather stream conversations of 2 types:
-    # 1. long conversations
-    # 2. conversations where many different people participated
-    #
-    # Returns a list of dictionaries containing the templating
-    # information for each hot conversation.
-
-    conversation_length: Dict[Tuple[int, str], int] = defaultdict(int)
-    conversation_messages: Dict[Tuple[int, str], List[Message]] = defaultdict(list)
-    conversation_diversity: Dict[Tuple[int, str], Set[str]] = defaultdict(set)
-    for message in messages:
-        key = (message.recipient.type_id,
-               message.topic_name())
-
-        conversation_messages[key].append(message)
+        # Users are queued in batches, so that DigestWorker can gather
+        # their streams' traffic once per batch; see RealmDigest.
+        user_ids = get_inactive_user_ids(realm, cutoff)
+        for i in range(0, len(user_ids), DIGEST_QUEUE_BATCH_SIZE):
+            batch_user_ids = user_ids[i:i + DIGEST_QUEUE_BATCH_SIZE]
+            queue_digest_user_ids(batch_user_ids, cutoff)
+            logger.info(
+                "Users %s are inactive, queuing for potential digest",
+                ",".join(str(user_id) for user_id in batch_user_ids),
+            )
+
+class DigestTopic:
+    """A stream topic's traffic since the digest cutoff: who took part,
+    how much they said, and the first few messages, for the teaser."""
+
+    def __init__(self, first_message: Message) -> None:
+        self.stream_id = first_message.recipient.type_id
+        self.topic_name = first_message.topic_name()
+        self.first_message_id = first_message.id
+        self.sample_messages: List[Message] = []
+        self.human_senders: Set[str] = set()
+        self.num_human_messages = 0
+
+    def add_message(self, message: Message) -> None:
+        # We'll display up to 2 messages from the conversation.
+        if len(self.sample_messages) < 2:
+            self.sample_messages.append(message)
 
         if not message.sent_by_human():
             # Don't include automated messages in the count.
-            continue
-
-        conversation_diversity[key].add(
-            message.sender.full_name)
-        conversation_length[key] += 1
-
-    diversity_list = list(conversation_diversity.items())
-    diversity_list.sort(key=lambda entry: len(entry[1]), reverse=True)
-
-    length_list = list(conversation_length.items())
-    length_list.sort(key=lambda entry: entry[1], reverse=True)
-
-    # Get up to the 4 best conversations from the diversity list
-    # and length list, filtering out overlapping conversations.
-    hot_conversations = [elt[0] for elt in diversity_list[:2]]
-    for candidate, _ in length_list:
-        if candidate not in hot_conversations:
-            hot_conversations.append(candidate)
-        if len(hot_conversations) >= 4:
-            break
-
-    # There was so much overlap between the diversity and length lists that we
-    # still have < 4 conversations. Try to use remaining diversity items to pad
-    # out the hot conversations.
-    num_convos = len(hot_conversations)
-    if num_convos < 4:
-        hot_conversations.extend([elt[0] for elt in diversity_list[num_convos:4]])
-
-    hot_conversation_render_payloads = []
-    for h in hot_conversations:
-        users = list(conversation_diversity[h])
-        count = conversation_length[h]
-        messages = conversation_messages[h]
-
-        # We'll display up to 2 messages from the conversation.
-        first_few_messages = messages[:2]
-
-        teaser_data = {"participants": users,
-                       "count": count - len(first_few_messages),
-                       "first_few_messages": build_message_list(
-                           user_profile, first_few_messages)}
-
-        hot_conversation_render_payloads.append(teaser_data)
-    return hot_conversation_render_payloads
-
-def gather_new_streams(user_profile: UserProfile,
-                       threshold: datetime.datetime) -> Tuple[int, Dict[str, List[str]]]:
-    if user_profile.can_access_public_streams():
-        new_streams = list(get_active_streams(user_profile.realm).filter(
-            invite_only=False, date_created__gt=threshold))
-    else:
-        new_streams = []
-
-    base_url = f"{user_profile.realm.uri}/#narrow/stream/"
+            return
+        self.human_senders.add(message.sender.full_name)
+        self.num_human_messages += 1
+
+    # Ties go to the conversation which started first.
+    def diversity_key(self) -> Tuple[int, int]:
+        return (-len(self.human_senders), self.first_message_id)
+
+    def length_key(self) -> Tuple[int, int]:
+        return (-self.num_human_messages, self.first_message_id)
+
+class RealmDigest:
+    """The traffic since the digest cutoff in a set of a realm's
+    streams, gathered once, and shared by the digests of all of the
+    realm's users subscribed to them: most users share most of their
+    streams with many others, so gathering each user's traffic
+    separately would read the same messages over and over."""
+
+    def __init__(self, realm: Realm, cutoff: datetime.datetime, stream_ids: Iterable[int]) -> None:
+        self.realm = realm
+        messages = Message.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id__in=list(stream_ids),
+            date_sent__gt=cutoff).select_related('recipient', 'sender', 'sending_client')
+
+        topics: Dict[Tuple[int, str], DigestTopic] = {}
+        for message in messages.order_by('id').iterator():
+            key = (message.recipient.type_id, message.topic_name())
+            if key not in topics:
+                topics[key] = DigestTopic(message)
+            topics[key].add_message(message)
+
+        topics_by_stream: Dict[int, List[DigestTopic]] = defaultdict(list)
+        for topic in topics.values():
+            if topic.num_human_messages > 0:
+                topics_by_stream[topic.stream_id].append(topic)
+
+        # A user's 2 most diverse conversations are among the 2 most
+        # diverse of each of their streams, and the 4 longest among
+        # each stream's 4 longest, so those are all we need to keep.
+        self.most_diverse_topics: Dict[int, List[DigestTopic]] = {}
+        self.longest_topics: Dict[int, List[DigestTopic]] = {}
+        for stream_id, stream_topics in topics_by_stream.items():
+            self.most_diverse_topics[stream_id] = sorted(stream_topics, key=DigestTopic.diversity_key)[:2]
+            self.longest_topics[stream_id] = sorted(stream_topics, key=DigestTopic.length_key)[:4]
+
+        self.new_streams = render_new_streams(realm, get_new_streams(realm, cutoff))
+        self.rendered_messages: Dict[Tuple[int, str, str, str], List[Dict[str, Any]]] = {}
+
+    def gather_hot_conversations(self, user_profile: UserProfile,
+                                 stream_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        # Gather stream conversations of 2 types:
+        # 1. long conversations
+        # 2. conversations where many different people participated
+        #
+        # Returns a list of dictionaries containing the templating
+        # information for each hot conversation.
+        stream_ids = list(stream_ids)
+        most_diverse = sorted((topic for stream_id in stream_ids
+                               for topic in self.most_diverse_topics.get(stream_id, [])),
+                              key=DigestTopic.diversity_key)
+        longest = sorted((topic for stream_id in stream_ids
+                          for topic in self.longest_topics.get(stream_id, [])),
+                         key=DigestTopic.length_key)
+
+        # Get up to the 4 best conversations from the diversity list
+        # and length list, filtering out overlapping conversations.
+        hot_conversations = most_diverse[:2]
+        for topic in longest:
+            if len(hot_conversations) >= 4:
+                break
+            if topic not in hot_conversations:
+                hot_conversations.append(topic)
+
+        return [self.render_hot_conversation(user_profile, topic) for topic in hot_conversations]
+
+    def render_hot_conversation(self, user_profile: UserProfile, topic: DigestTopic) -> Dict[str, Any]:
+        # How messages are rendered for an email depends only on the
+        # user's realm, emojiset, and language.
+        key = (topic.stream_id, topic.topic_name, user_profile.emojiset, user_profile.default_language)
+        if key not in self.rendered_messages:
+            self.rendered_messages[key] = build_message_list(user_profile, list(topic.sample_messages))
+        return {"participants": list(topic.human_senders),
+                "count": topic.num_human_messages - len(topic.sample_messages),
+                "first_few_messages": self.rendered_messages[key]}
+
+    def gather_new_streams(self, user_profile: UserProfile) -> Tuple[int, Dict[str, List[str]]]:
+        if not user_profile.can_access_public_streams():
+            return 0, {"html": [], "plain": []}
+        return len(self.new_streams["plain"]), self.new_streams
+
+def get_new_streams(realm: Realm, threshold: datetime.datetime) -> List[Stream]:
+    return list(get_active_streams(realm).filter(
+        invite_only=False, date_created__gt=threshold))
+
+def render_new_streams(realm: Realm, new_streams: List[Stream]) -> Dict[str, List[str]]:
+    base_url = f"{realm.uri}/#narrow/stream/"
 
     streams_html = []
     streams_plain = []
@@ -165,18 +208,44 @@ def gather_new_streams(user_profile: UserProfile,
         streams_html.append(stream_link)
         streams_plain.append(stream.name)
 
-    return len(new_streams), {"html": streams_html, "plain": streams_plain}
+    return {"html": streams_html, "plain": streams_plain}
 
-def enough_traffic(hot_conversations: str, new_streams: int) -> bool:
-    return bool(hot_conversations or new_streams)
+def gather_new_streams(user_profile: UserProfile,
+                       threshold: datetime.datetime) -> Tuple[int, Dict[str, List[str]]]:
+    if user_profile.can_access_public_streams():
+        new_streams = get_new_streams(user_profile.realm, threshold)
+    else:
+        new_streams = []
 
-def handle_digest_email(user_profile_id: int, cutoff: float,
-                        render_to_web: bool = False) -> Union[None, Dict[str, Any]]:
-    user_profile = get_user_profile_by_id(user_profile_id)
+    return len(new_streams), render_new_streams(user_profile.realm, new_streams)
 
-    # Convert from epoch seconds to a datetime object.
-    cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=datetime.timezone.utc)
+def enough_traffic(hot_conversations: str, new_streams: int) -> bool:
+    return bool(hot_conversations or new_streams)
 
+def get_digest_stream_ids(user_profiles: List[UserProfile],
+                          cutoff_date: datetime.datetime) -> Dict[int, Set[int]]:
+    """The streams whose traffic goes in each user's digest: those
+    they're subscribed to, and haven't muted.  For a long-term idle
+    user, we leave out those whose subscription changed since the
+    cutoff; see exclude_subscription_modified_streams."""
+    stream_ids: Dict[int, Set[int]] = {user_profile.id: set() for user_profile in user_profiles}
+    for user_profile_id, stream_id in Subscription.objects.filter(
+            user_profile__in=user_profiles,
+            recipient__type=Recipient.STREAM,
+            active=True,
+            is_muted=False).values_list('user_profile_id', 'recipient__type_id'):
+        stream_ids[user_profile_id].add(stream_id)
+
+    long_term_idle_users = [user_profile for user_profile in user_profiles
+                            if user_profile.long_term_idle]
+    if long_term_idle_users:
+        modified_stream_ids = get_subscription_modified_stream_ids(long_term_idle_users, cutoff_date)
+        for user_profile_id, modified in modified_stream_ids.items():
+            stream_ids[user_profile_id] -= modified
+    return stream_ids
+
+def build_digest_context(user_profile: UserProfile, realm_digest: RealmDigest,
+                         stream_ids: Iterable[int]) -> Dict[str, Any]:
     context = common_context(user_profile)
 
     # Start building email template data.
@@ -184,63 +253,87 @@ def handle_digest_email(user_profile_id: int, cutoff: float,
         'unsubscribe_link': one_click_unsubscribe_link(user_profile, "digest"),
     })
 
-    home_view_streams = Subscription.objects.filter(
-        user_profile=user_profile,
-        recipient__type=Recipient.STREAM,
-        active=True,
-        is_muted=False).values_list('recipient__type_id', flat=True)
-
-    if not user_profile.long_term_idle:
-        stream_ids = home_view_streams
-    else:
-        stream_ids = exclude_subscription_modified_streams(user_profile, home_view_streams, cutoff_date)
-
-    # Fetch list of all messages sent after cutoff_date where the user is subscribed
-    messages = Message.objects.filter(
-        recipient__type=Recipient.STREAM,
-        recipient__type_id__in=stream_ids,
-        date_sent__gt=cutoff_date).select_related('recipient', 'sender', 'sending_client')
-
     # Gather hot conversations.
-    context["hot_conversations"] = gather_hot_conversations(
-        user_profile, messages)
+    context["hot_conversations"] = realm_digest.gather_hot_conversations(user_profile, stream_ids)
 
     # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
+    new_streams_count, new_streams = realm_digest.gather_new_streams(user_profile)
     context["new_streams"] = new_streams
     context["new_streams_count"] = new_streams_count
 
     # TODO: Set has_preheader if we want to include a preheader.
+    return context
 
-    if render_to_web:
-        return context
-
+def send_digest_email(user_profile: UserProfile, context: Dict[str, Any]) -> None:
     # We don't want to send emails containing almost no information.
-    if enough_traffic(context["hot_conversations"], new_streams_count):
+    if enough_traffic(context["hot_conversations"], context["new_streams_count"]):
         logger.info("Sending digest email for user %s", user_profile.id)
         # Send now, as a ScheduledEmail
         send_future_email('zerver/emails/digest', user_profile.realm, to_user_ids=[user_profile.id],
                           from_name="Zulip Digest", from_address=FromAddress.no_reply_placeholder,
                           context=context)
+
+def handle_digest_email(user_profile_id: int, cutoff: float,
+                        render_to_web: bool = False) -> Union[None, Dict[str, Any]]:
+    user_profile = get_user_profile_by_id(user_profile_id)
+
+    # Convert from epoch seconds to a datetime object.
+    cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=datetime.timezone.utc)
+
+    stream_ids = get_digest_stream_ids([user_profile], cutoff_date)[user_profile.id]
+    realm_digest = RealmDigest(user_profile.realm, cutoff_date, stream_ids)
+    context = build_digest_context(user_profile, realm_digest, stream_ids)
+
+    if render_to_web:
+        return context
+
+    send_digest_email(user_profile, context)
     return None
 
-def exclude_subscription_modified_streams(user_profile: UserProfile,
-                                          stream_ids: List[int],
-                                          cutoff_date: datetime.datetime) -> List[int]:
-    """Exclude streams from given list where users' subscription was modified."""
+def handle_digest_emails(user_profile_ids: List[int], cutoff: float) -> None:
+    """Like handle_digest_email, for many users at once: the traffic in
+    each realm's streams is gathered once for all of its users."""
+    cutoff_date = datetime.datetime.fromtimestamp(int(cutoff), tz=datetime.timezone.utc)
 
+    users_by_realm: Dict[int, List[UserProfile]] = defaultdict(list)
+    for user_profile in UserProfile.objects.filter(id__in=user_profile_ids).select_related('realm'):
+        users_by_realm[user_profile.realm_id].append(user_profile)
+
+    for realm_users in users_by_realm.values():
+        stream_ids = get_digest_stream_ids(realm_users, cutoff_date)
+        realm_digest = RealmDigest(realm_users[0].realm, cutoff_date,
+                                   set().union(*stream_ids.values()))
+        for user_profile in realm_users:
+            # One user's failure shouldn't cost the rest of the batch
+            # their digests.
+            try:
+                context = build_digest_context(user_profile, realm_digest,
+                                               stream_ids[user_profile.id])
+                send_digest_email(user_profile, context)
+            except Exception:
+                logger.exception("Failed to send digest email to user %s", user_profile.id)
+
+def get_subscription_modified_stream_ids(user_profiles: List[UserProfile],
+                                         cutoff_date: datetime.datetime) -> Dict[int, Set[int]]:
     events = [
         RealmAuditLog.SUBSCRIPTION_CREATED,
         RealmAuditLog.SUBSCRIPTION_ACTIVATED,
         RealmAuditLog.SUBSCRIPTION_DEACTIVATED,
     ]
 
-    # Streams where the user's subscription was changed
-    modified_streams = RealmAuditLog.objects.filter(
-        realm=user_profile.realm,
-        modified_user=user_profile,
-        event_time__gt=cutoff_date,
-        event_type__in=events).values_list('modified_stream_id', flat=True)
+    # Streams where the users' subscriptions were changed
+    modified_stream_ids: Dict[int, Set[int]] = defaultdict(set)
+    for user_profile_id, stream_id in RealmAuditLog.objects.filter(
+            realm=user_profiles[0].realm,
+            modified_user__in=user_profiles,
+            event_time__gt=cutoff_date,
+            event_type__in=events).values_list('modified_user_id', 'modified_stream_id'):
+        modified_stream_ids[user_profile_id].add(stream_id)
+    return modified_stream_ids
 
-    return list(set(stream_ids) - set(modified_streams))
+def exclude_subscription_modified_streams(user_profile: UserProfile,
+                                          stream_ids: List[int],
+                                          cutoff_date: datetime.datetime) -> List[int]:
+    """Exclude streams from given list where users' subscription was modified."""
+    modified_stream_ids = get_subscription_modified_stream_ids([user_profile], cutoff_date)
+    return list(set(stream_ids) - modified_stream_ids[user_profile.id])
@@ -0,0 +1,62 @@
+"""Detection of N+1 query patterns.
+
+Every database query passes through TimeTrackingCursor, so while a
+request or a queue worker's do_consume call is being processed, we
+can count how many times each SQL fingerprint (see
+zerver.lib.request_profiling.fingerprint_sql) is executed.  A query
+run DUPLICATE_QUERY_THRESHOLD or more times is almost always a loop
+that should be a single bulk query, so when DETECT_DUPLICATE_QUERIES
+is enabled, we log it together with the stack trace of the code that
+ran it.
+"""
+import logging
+import traceback
+from collections import defaultdict
+from typing import Dict, Optional
+
+from django.conf import settings
+
+from zerver.lib.request_profiling import fingerprint_sql
+
+logger = logging.getLogger('zulip.duplicate_queries')
+
+class DuplicateQueryDetector:
+    def __init__(self) -> None:
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.stack_traces: Dict[str, str] = {}
+
+    def record(self, sql: str) -> None:
+        fingerprint = fingerprint_sql(sql)
+        self.counts[fingerprint] += 1
+        if self.counts[fingerprint] == settings.DUPLICATE_QUERY_THRESHOLD:
+            # Skip the frames for this function and the cursor wrapper.
+            self.stack_traces[fingerprint] = ''.join(traceback.format_stack()[:-3])
+
+    def duplicates(self) -> Dict[str, int]:
+        return {fingerprint: count for fingerprint, count in self.counts.items()
+                if count >= settings.DUPLICATE_QUERY_THRESHOLD}
+
+    def report(self, context: str) -> None:
+        for fingerprint, count in self.duplicates().items():
+            logger.warning("Possible N+1 query in %s: %d executions of %s\n%s",
+                           context, count, fingerprint, self.stack_traces[fingerprint])
+
+# The detector for the request or queue event currently being handled
+# by this process, if DETECT_DUPLICATE_QUERIES is enabled.
+current_detector: Optional[DuplicateQueryDetector] = None
+
+def start_duplicate_query_detection() -> None:
+    global current_detector
+    if settings.DETECT_DUPLICATE_QUERIES:
+        current_detector = DuplicateQueryDetector()
+    else:
+        current_detector = None
+
+def finish_duplicate_query_detection(context: Optional[str]) -> None:
+    """Stops detection, logging any duplicates found unless context is
+    None, which is used to abandon detection for a suspended request."""
+    global current_detector
+    detector = current_detector
+    current_detector = None
+    if detector is not None and context is not None:
+        detector.report(context)
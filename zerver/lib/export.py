@@ -8,18 +8,20 @@
 # it to get_realm_config.
 import datetime
 import glob
+import gzip
+import hashlib
 import logging
 import os
 import shutil
 import subprocess
 import tempfile
-from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import boto3
 import ujson
-from boto3.resources.base import ServiceResource
 from django.apps import apps
 from django.conf import settings
+from django.db.models import Q
 from django.forms.models import model_to_dict
 from django.utils.timezone import is_naive as timezone_is_naive
 from django.utils.timezone import make_aware as timezone_make_aware
@@ -28,7 +30,9 @@ import zerver.lib.upload
 from analytics.models import RealmCount, StreamCount, UserCount
 from scripts.lib.zulip_tools import overwrite_symlink
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
+from zerver.lib.parallel import run_parallel_queue
 from zerver.lib.pysa import mark_sanitized
+from zerver.lib.upload import S3Transfer, download_files_from_s3
 from zerver.models import (
     AlertWord,
     Attachment,
@@ -91,6 +95,22 @@ MessageOutput = Dict[str, Union[List[Record], List[int], int]]
 
 MESSAGE_BATCH_CHUNK_SIZE = 1000
 
+# The streaming export format (`./manage.py export --streaming`)
+# writes messages to gzipped JSON-lines shards, messages-NNNNNN.jsonl.gz,
+# rather than to JSON documents.  Each line is a [table, row] pair; a
+# shard has its zerver_message rows first, then the zerver_usermessage
+# and zerver_reaction rows for those messages.  Rows are read from the
+# database with server-side cursors and written out as they are read,
+# so neither exporting nor importing a shard needs the whole shard in
+# memory, and MESSAGE_SHARD_SIZE can be much larger than
+# MESSAGE_BATCH_CHUNK_SIZE.  MESSAGE_SHARD_MANIFEST lists the finished
+# shards, with their row counts and checksums.
+MESSAGE_SHARD_SIZE = 10000
+MESSAGE_SHARD_MANIFEST = 'messages-manifest.json'
+MESSAGE_SHARD_FORMAT_VERSION = 1
+# Server-side cursors fetch rows from the database this many at a time.
+STREAMING_FETCH_SIZE = 2000
+
 ALL_ZULIP_TABLES = {
     'analytics_fillstate',
     'analytics_installationcount',
@@ -341,36 +361,96 @@ def make_raw(query: Any, exclude: Optional[List[Field]]=None) -> List[Record]:
     Takes a Django query and returns a JSONable list
     of dictionaries corresponding to the database rows.
     '''
-    rows = []
-    for instance in query:
-        data = model_to_dict(instance, exclude=exclude)
-        """
-        In Django 1.11.5, model_to_dict evaluates the QuerySet of
-        many-to-many field to give us a list of instances. We require
-        a list of primary keys, so we get the primary keys from the
-        instances below.
-        """
-        for field in instance._meta.many_to_many:
-            value = data[field.name]
-            data[field.name] = [row.id for row in value]
-
-        rows.append(data)
-
-    return rows
+    return [make_raw_row(instance, exclude) for instance in query]
+
+def make_raw_iterator(query: Any, exclude: Optional[List[Field]]=None) -> Iterator[Record]:
+    '''
+    Like make_raw, but reads the rows through a server-side cursor and
+    yields them one at a time, for tables too large to hold in memory.
+    '''
+    for instance in query.iterator(chunk_size=STREAMING_FETCH_SIZE):
+        yield make_raw_row(instance, exclude)
+
+def make_raw_row(instance: Any, exclude: Optional[List[Field]]=None) -> Record:
+    data = model_to_dict(instance, exclude=exclude)
+    """
+    In Django 1.11.5, model_to_dict evaluates the QuerySet of
+    many-to-many field to give us a list of instances. We require
+    a list of primary keys, so we get the primary keys from the
+    instances below.
+    """
+    for field in instance._meta.many_to_many:
+        value = data[field.name]
+        data[field.name] = [row.id for row in value]
+    return data
 
 def floatify_datetime_fields(data: TableData, table: TableName) -> None:
     for item in data[table]:
-        for field in DATE_FIELDS[table]:
-            orig_dt = item[field]
-            if orig_dt is None:
-                continue
-            if timezone_is_naive(orig_dt):
-                logging.warning("Naive datetime:", item)
-                dt = timezone_make_aware(orig_dt)
-            else:
-                dt = orig_dt
-            utc_naive  = dt.replace(tzinfo=None) - dt.utcoffset()
-            item[field] = (utc_naive - datetime.datetime(1970, 1, 1)).total_seconds()
+        floatify_datetime_record(item, table)
+
+def floatify_datetime_record(item: Record, table: TableName) -> None:
+    for field in DATE_FIELDS[table]:
+        orig_dt = item[field]
+        if orig_dt is None:
+            continue
+        if timezone_is_naive(orig_dt):
+            logging.warning("Naive datetime:", item)
+            dt = timezone_make_aware(orig_dt)
+        else:
+            dt = orig_dt
+        utc_naive  = dt.replace(tzinfo=None) - dt.utcoffset()
+        item[field] = (utc_naive - datetime.datetime(1970, 1, 1)).total_seconds()
+
+def write_shard_rows(shard_file: IO[str], table: TableName, rows: Iterable[Record]) -> None:
+    for row in rows:
+        shard_file.write(ujson.dumps([table, row]) + '\n')
+
+def read_message_shard(shard_path: Path) -> Iterator[Tuple[TableName, Record]]:
+    with gzip.open(shard_path, 'rt') as shard_file:
+        for line in shard_file:
+            table, row = ujson.loads(line)
+            yield table, row
+
+def file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def write_message_shard_manifest(output_dir: Path) -> None:
+    shards = []
+    for shard_path in sorted(glob.glob(os.path.join(output_dir, 'messages-*.jsonl.gz'))):
+        rows: Dict[TableName, int] = {}
+        for table, row in read_message_shard(shard_path):
+            rows[table] = rows.get(table, 0) + 1
+        shards.append({
+            'file': os.path.basename(shard_path),
+            'sha256': file_sha256(shard_path),
+            'rows': rows,
+        })
+    manifest = {'format_version': MESSAGE_SHARD_FORMAT_VERSION, 'shards': shards}
+    write_data_to_file(os.path.join(output_dir, MESSAGE_SHARD_MANIFEST), manifest)
+
+def read_message_shard_manifest(import_dir: Path) -> Optional[Dict[str, Any]]:
+    """Returns the manifest of a streaming export, or None if the
+    export's messages are in JSON files."""
+    manifest_path = os.path.join(import_dir, MESSAGE_SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = ujson.load(f)
+    if manifest['format_version'] != MESSAGE_SHARD_FORMAT_VERSION:
+        raise Exception(f"Unsupported message shard format version {manifest['format_version']}")
+    return manifest
+
+def get_message_shard_paths(import_dir: Path, manifest: Dict[str, Any],
+                            verify: bool=False) -> Iterator[Path]:
+    for shard in manifest['shards']:
+        shard_path = os.path.join(import_dir, shard['file'])
+        if verify and file_sha256(shard_path) != shard['sha256']:
+            raise Exception(f"Checksum mismatch for {shard_path}; the export is corrupt")
+        yield shard_path
 
 class Config:
     '''A Config object configures a single table for exporting (and, maybe
@@ -884,6 +964,25 @@ def fetch_attachment_data(response: TableData, realm_id: int, message_ids: Set[i
         row for row in response['zerver_attachment']
         if row['messages']]
 
+def fetch_streamed_attachment_data(response: TableData, realm_id: int,
+                                   message_queries: List[Any]) -> None:
+    """Like fetch_attachment_data, but for messages given as queries;
+    the filtering is done by the database."""
+    exported_messages = Q()
+    for message_query in message_queries:
+        exported_messages |= Q(message_id__in=message_query.values('id'))
+    attachment_messages: Dict[int, List[int]] = {}
+    for attachment_id, message_id in Attachment.messages.through.objects.filter(
+            exported_messages, attachment__realm_id=realm_id).values_list(
+                'attachment_id', 'message_id').order_by('message_id'):
+        attachment_messages.setdefault(attachment_id, []).append(message_id)
+
+    query = Attachment.objects.filter(id__in=list(attachment_messages)).order_by('id')
+    response['zerver_attachment'] = make_raw(list(query))
+    floatify_datetime_fields(response, 'zerver_attachment')
+    for row in response['zerver_attachment']:
+        row['messages'] = attachment_messages[row['id']]
+
 def fetch_reaction_data(response: TableData, message_ids: Set[int]) -> None:
     query = Reaction.objects.filter(message_id__in=list(message_ids))
     response['zerver_reaction'] = make_raw(list(query))
@@ -929,6 +1028,15 @@ def fetch_usermessages(realm: Realm,
                        user_profile_ids: Set[int],
                        message_filename: Path,
                        consent_message_id: Optional[int]=None) -> List[Record]:
+    user_message_chunk = list(iter_usermessages(realm, message_ids, user_profile_ids,
+                                                consent_message_id))
+    logging.info("Fetched UserMessages for %s", message_filename)
+    return user_message_chunk
+
+def iter_usermessages(realm: Realm,
+                      message_ids: Iterable[int],
+                      user_profile_ids: Set[int],
+                      consent_message_id: Optional[int]=None) -> Iterator[Record]:
     # UserMessage export security rule: You can export UserMessages
     # for the messages you exported for the users in your realm.
     user_message_query = UserMessage.objects.filter(user_profile__realm=realm,
@@ -936,23 +1044,20 @@ def fetch_usermessages(realm: Realm,
     if consent_message_id is not None:
         consented_user_ids = get_consented_user_ids(consent_message_id)
         user_profile_ids = user_profile_ids & consented_user_ids
-    user_message_chunk = []
-    for user_message in user_message_query:
+    for user_message in user_message_query.iterator(chunk_size=STREAMING_FETCH_SIZE):
         if user_message.user_profile_id not in user_profile_ids:
             continue
         user_message_obj = model_to_dict(user_message)
         user_message_obj['flags_mask'] = user_message.flags.mask
         del user_message_obj['flags']
-        user_message_chunk.append(user_message_obj)
-    logging.info("Fetched UserMessages for %s", message_filename)
-    return user_message_chunk
+        yield user_message_obj
 
 def export_usermessages_batch(input_path: Path, output_path: Path,
                               consent_message_id: Optional[int]=None) -> None:
     """As part of the system for doing parallel exports, this runs on one
     batch of Message objects and adds the corresponding UserMessage
-    objects. (This is called by the export_usermessage_batch
-    management command)."""
+    objects. (This is called by export_usermessages_in_parallel, and
+    the export_usermessage_batch management command)."""
     with open(input_path) as input_file:
         output = ujson.load(input_file)
     message_ids = [item['id'] for item in output['zerver_message']]
@@ -965,6 +1070,28 @@ def export_usermessages_batch(input_path: Path, output_path: Path,
     write_message_export(output_path, output)
     os.unlink(input_path)
 
+def export_usermessages_shard(input_path: Path, output_path: Path,
+                              consent_message_id: Optional[int]=None) -> None:
+    """The streaming export's equivalent of export_usermessages_batch:
+    copies a .partial message shard, adding the UserMessage and
+    Reaction rows for its messages."""
+    message_ids: List[int] = []
+    with gzip.open(output_path, 'wt') as output:
+        for table, row in read_message_shard(input_path):
+            if table == '_partial':
+                realm = Realm.objects.get(id=row['realm_id'])
+                user_profile_ids = set(row['zerver_userprofile_ids'])
+                continue
+            message_ids.append(row['id'])
+            write_shard_rows(output, table, [row])
+        write_shard_rows(output, 'zerver_usermessage',
+                         iter_usermessages(realm, message_ids, user_profile_ids,
+                                           consent_message_id))
+        write_shard_rows(output, 'zerver_reaction',
+                         make_raw_iterator(Reaction.objects.filter(message_id__in=message_ids)))
+    logging.info("Dumped to %s", output_path)
+    os.unlink(input_path)
+
 def write_message_export(message_filename: Path, output: MessageOutput) -> None:
     write_data_to_file(output_file=message_filename, data=output)
     logging.info("Dumped to %s", message_filename)
@@ -978,6 +1105,52 @@ def export_partial_message_files(realm: Realm,
     if output_dir is None:
         output_dir = tempfile.mkdtemp(prefix="zulip-export")
 
+    message_queries, user_ids_for_us = get_message_queries(realm, response, public_only,
+                                                           consent_message_id)
+
+    all_message_ids: Set[int] = set()
+    dump_file_id = 1
+
+    for message_query in message_queries:
+        dump_file_id = write_message_partial_for_query(
+            realm=realm,
+            message_query=message_query,
+            dump_file_id=dump_file_id,
+            all_message_ids=all_message_ids,
+            output_dir=output_dir,
+            user_profile_ids=user_ids_for_us,
+            chunk_size=chunk_size,
+        )
+
+    return all_message_ids
+
+def export_partial_message_shards(realm: Realm,
+                                  response: TableData,
+                                  output_dir: Path,
+                                  shard_size: int=MESSAGE_SHARD_SIZE,
+                                  public_only: bool=False,
+                                  consent_message_id: Optional[int]=None) -> List[Any]:
+    """The streaming export's equivalent of export_partial_message_files.
+    Returns the queries for the exported messages, since their IDs may
+    be too many to hold in memory."""
+    message_queries, user_ids_for_us = get_message_queries(realm, response, public_only,
+                                                           consent_message_id)
+    dump_file_id = 1
+    for message_query in message_queries:
+        dump_file_id = write_message_shards_for_query(
+            realm=realm,
+            message_query=message_query,
+            dump_file_id=dump_file_id,
+            output_dir=output_dir,
+            user_profile_ids=user_ids_for_us,
+            shard_size=shard_size,
+        )
+    return message_queries
+
+def get_message_queries(realm: Realm,
+                        response: TableData,
+                        public_only: bool=False,
+                        consent_message_id: Optional[int]=None) -> Tuple[List[Any], Set[int]]:
     def get_ids(records: List[Record]) -> Set[int]:
         return {x['id'] for x in records}
 
@@ -1070,21 +1243,7 @@ def export_partial_message_files(realm: Realm,
             messages_we_sent_to_them,
         ]
 
-    all_message_ids: Set[int] = set()
-    dump_file_id = 1
-
-    for message_query in message_queries:
-        dump_file_id = write_message_partial_for_query(
-            realm=realm,
-            message_query=message_query,
-            dump_file_id=dump_file_id,
-            all_message_ids=all_message_ids,
-            output_dir=output_dir,
-            user_profile_ids=user_ids_for_us,
-            chunk_size=chunk_size,
-        )
-
-    return all_message_ids
+    return message_queries, user_ids_for_us
 
 def write_message_partial_for_query(realm: Realm, message_query: Any, dump_file_id: int,
                                     all_message_ids: Set[int], output_dir: Path,
@@ -1128,7 +1287,40 @@ def write_message_partial_for_query(realm: Realm, message_query: Any, dump_file_
 
     return dump_file_id
 
-def export_uploads_and_avatars(realm: Realm, output_dir: Path) -> None:
+def write_message_shards_for_query(realm: Realm, message_query: Any, dump_file_id: int,
+                                   output_dir: Path, user_profile_ids: Set[int],
+                                   shard_size: int=MESSAGE_SHARD_SIZE) -> int:
+    shard_file: Optional[IO[str]] = None
+    shard_rows = 0
+    for message in make_raw_iterator(message_query):
+        if shard_file is None:
+            message_filename = os.path.join(output_dir, f"messages-{dump_file_id:06}.jsonl.gz")
+            message_filename += '.partial'
+            shard_file = gzip.open(message_filename, 'wt')
+            # Like the JSON .partial files, the shard starts with what
+            # export_usermessages_shard needs to find its UserMessages.
+            write_shard_rows(shard_file, '_partial', [{
+                'realm_id': realm.id,
+                'zerver_userprofile_ids': sorted(user_profile_ids),
+            }])
+        floatify_datetime_record(message, 'zerver_message')
+        write_shard_rows(shard_file, 'zerver_message', [message])
+        shard_rows += 1
+
+        if shard_rows == shard_size:
+            shard_file.close()
+            logging.info("Dumped to %s", message_filename)
+            shard_file = None
+            shard_rows = 0
+            dump_file_id += 1
+
+    if shard_file is not None:
+        shard_file.close()
+        logging.info("Dumped to %s", message_filename)
+        dump_file_id += 1
+    return dump_file_id
+
+def export_uploads_and_avatars(realm: Realm, output_dir: Path, processes: int=1) -> None:
     uploads_output_dir = os.path.join(output_dir, 'uploads')
     avatars_output_dir = os.path.join(output_dir, 'avatars')
     realm_icons_output_dir = os.path.join(output_dir, 'realm_icons')
@@ -1142,7 +1334,8 @@ def export_uploads_and_avatars(realm: Realm, output_dir: Path) -> None:
         # Small installations and developers will usually just store files locally.
         export_uploads_from_local(realm,
                                   local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "files"),
-                                  output_dir=uploads_output_dir)
+                                  output_dir=uploads_output_dir,
+                                  processes=processes)
         export_avatars_from_local(realm,
                                   local_dir=os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars"),
                                   output_dir=avatars_output_dir)
@@ -1171,34 +1364,35 @@ def export_uploads_and_avatars(realm: Realm, output_dir: Path) -> None:
                              processing_realm_icon_and_logo=True)
 
 def _check_key_metadata(email_gateway_bot: Optional[UserProfile],
-                        key: ServiceResource, processing_avatars: bool,
+                        key_name: str, metadata: Dict[str, str], processing_avatars: bool,
                         realm: Realm, user_ids: Set[int]) -> None:
     # Helper function for export_files_from_s3
-    if 'realm_id' in key.metadata and key.metadata['realm_id'] != str(realm.id):
-        if email_gateway_bot is None or key.metadata['user_profile_id'] != str(email_gateway_bot.id):
-            raise AssertionError(f"Key metadata problem: {key.name} {key.metadata} / {realm.id}")
+    if 'realm_id' in metadata and metadata['realm_id'] != str(realm.id):
+        if email_gateway_bot is None or metadata['user_profile_id'] != str(email_gateway_bot.id):
+            raise AssertionError(f"Key metadata problem: {key_name} {metadata} / {realm.id}")
         # Email gateway bot sends messages, potentially including attachments, cross-realm.
-        print(f"File uploaded by email gateway bot: {key.key} / {key.metadata}")
+        print(f"File uploaded by email gateway bot: {key_name} / {metadata}")
     elif processing_avatars:
-        if 'user_profile_id' not in key.metadata:
-            raise AssertionError(f"Missing user_profile_id in key metadata: {key.metadata}")
-        if int(key.metadata['user_profile_id']) not in user_ids:
-            raise AssertionError(f"Wrong user_profile_id in key metadata: {key.metadata}")
-    elif 'realm_id' not in key.metadata:
-        raise AssertionError(f"Missing realm_id in key metadata: {key.metadata}")
+        if 'user_profile_id' not in metadata:
+            raise AssertionError(f"Missing user_profile_id in key metadata: {metadata}")
+        if int(metadata['user_profile_id']) not in user_ids:
+            raise AssertionError(f"Wrong user_profile_id in key metadata: {metadata}")
+    elif 'realm_id' not in metadata:
+        raise AssertionError(f"Missing realm_id in key metadata: {metadata}")
 
 def _get_exported_s3_record(
         bucket_name: str,
-        key: ServiceResource,
+        key_name: str,
+        head: Dict[str, Any],
         processing_emoji: bool) -> Dict[str, Union[str, int]]:
     # Helper function for export_files_from_s3
-    record = dict(s3_path=key.key, bucket=bucket_name,
-                  size=key.content_length, last_modified=key.last_modified,
-                  content_type=key.content_type, md5=key.e_tag)
-    record.update(key.metadata)
+    record = dict(s3_path=key_name, bucket=bucket_name,
+                  size=head['ContentLength'], last_modified=head['LastModified'],
+                  content_type=head.get('ContentType'), md5=head['ETag'])
+    record.update(head['Metadata'])
 
     if processing_emoji:
-        record['file_name'] = os.path.basename(key.key)
+        record['file_name'] = os.path.basename(key_name)
 
     if "user_profile_id" in record:
         user_profile = get_user_profile_by_id(record['user_profile_id'])
@@ -1224,16 +1418,16 @@ def _get_exported_s3_record(
 
     return record
 
-def _save_s3_object_to_file(key: ServiceResource, output_dir: str, processing_avatars: bool,
-                            processing_emoji: bool, processing_realm_icon_and_logo: bool) -> None:
+def _get_s3_object_filename(key_name: str, output_dir: str, processing_avatars: bool,
+                            processing_emoji: bool, processing_realm_icon_and_logo: bool) -> str:
     # Helper function for export_files_from_s3
     if processing_avatars or processing_emoji or processing_realm_icon_and_logo:
-        filename = os.path.join(output_dir, key.key)
+        filename = os.path.join(output_dir, key_name)
     else:
-        fields = key.key.split('/')
+        fields = key_name.split('/')
         if len(fields) != 3:
-            raise AssertionError(f"Suspicious key with invalid format {key.key}")
-        filename = os.path.join(output_dir, key.key)
+            raise AssertionError(f"Suspicious key with invalid format {key_name}")
+        filename = os.path.join(output_dir, key_name)
 
     if "../" in filename:
         raise AssertionError(f"Suspicious file with invalid format {filename}")
@@ -1241,11 +1435,7 @@ def _save_s3_object_to_file(key: ServiceResource, output_dir: str, processing_av
     # Use 'mark_sanitized' to cause Pysa to ignore the flow of user controlled
     # data into the filesystem sink, because we've already prevented directory
     # traversal with our assertion above.
-    dirname = mark_sanitized(os.path.dirname(filename))
-
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    key.download_file(filename)
+    return mark_sanitized(filename)
 
 def export_files_from_s3(realm: Realm, bucket_name: str, output_dir: Path,
                          processing_avatars: bool=False, processing_emoji: bool=False,
@@ -1253,7 +1443,6 @@ def export_files_from_s3(realm: Realm, bucket_name: str, output_dir: Path,
     session = boto3.Session(settings.S3_KEY, settings.S3_SECRET_KEY)
     s3 = session.resource('s3')
     bucket = s3.Bucket(bucket_name)
-    records = []
 
     logging.info("Downloading uploaded files from %s", bucket_name)
 
@@ -1278,59 +1467,73 @@ def export_files_from_s3(realm: Realm, bucket_name: str, output_dir: Path,
     else:
         email_gateway_bot = None
 
-    count = 0
-    for bkey in bucket.objects.filter(Prefix=object_prefix):
-        if processing_avatars and bkey.Object().key not in avatar_hash_values:
-            continue
+    transfers = (
+        S3Transfer(key=bkey.key,
+                   filename=_get_s3_object_filename(bkey.key, output_dir, processing_avatars,
+                                                    processing_emoji,
+                                                    processing_realm_icon_and_logo))
+        for bkey in bucket.objects.filter(Prefix=object_prefix)
+        if not processing_avatars or bkey.key in avatar_hash_values
+    )
 
-        key = bucket.Object(bkey.key)
+    def check_head(transfer: S3Transfer, head: Dict[str, Any]) -> None:
         # This can happen if an email address has moved realms
-        _check_key_metadata(email_gateway_bot, key, processing_avatars, realm, user_ids)
-        record = _get_exported_s3_record(bucket_name, key, processing_emoji)
+        _check_key_metadata(email_gateway_bot, transfer.key, head['Metadata'],
+                            processing_avatars, realm, user_ids)
 
-        record['path'] = key.key
-        _save_s3_object_to_file(key, output_dir, processing_avatars, processing_emoji,
-                                processing_realm_icon_and_logo)
+    records = []
+    for count, (transfer, head) in enumerate(
+            download_files_from_s3(bucket_name, transfers, check_head=check_head), start=1):
+        record = _get_exported_s3_record(bucket_name, transfer.key, head, processing_emoji)
 
+        record['path'] = transfer.key
         records.append(record)
-        count += 1
 
         if (count % 100 == 0):
             logging.info("Finished %s", count)
 
+    # The downloads finish in no particular order.
+    records.sort(key=lambda record: record['path'])
     with open(os.path.join(output_dir, "records.json"), "w") as records_file:
         ujson.dump(records, records_file, indent=4)
 
-def export_uploads_from_local(realm: Realm, local_dir: Path, output_dir: Path) -> None:
-
-    count = 0
-    records = []
-    for attachment in Attachment.objects.filter(realm_id=realm.id):
-        # Use 'mark_sanitized' to work around false positive caused by Pysa
-        # thinking that 'realm' (and thus 'attachment' and 'attachment.path_id')
-        # are user controlled
-        path_id = mark_sanitized(attachment.path_id)
+def export_uploads_from_local(realm: Realm, local_dir: Path, output_dir: Path,
+                              processes: int=1) -> None:
+    # Use 'mark_sanitized' to work around false positive caused by Pysa
+    # thinking that 'realm' (and thus 'attachment' and 'attachment.path_id')
+    # are user controlled
+    attachments = [
+        (mark_sanitized(attachment.path_id), attachment.owner.id, attachment.owner.email)
+        for attachment in Attachment.objects.filter(realm_id=realm.id).select_related('owner')
+    ]
 
+    def export_upload(attachment: Tuple[str, int, str]) -> Dict[str, Any]:
+        path_id, user_profile_id, user_profile_email = attachment
         local_path = os.path.join(local_dir, path_id)
         output_path = os.path.join(output_dir, path_id)
 
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         shutil.copy2(local_path, output_path)
         stat = os.stat(local_path)
-        record = dict(realm_id=attachment.realm_id,
-                      user_profile_id=attachment.owner.id,
-                      user_profile_email=attachment.owner.email,
-                      s3_path=path_id,
-                      path=path_id,
-                      size=stat.st_size,
-                      last_modified=stat.st_mtime,
-                      content_type=None)
-        records.append(record)
+        return dict(realm_id=realm.id,
+                    user_profile_id=user_profile_id,
+                    user_profile_email=user_profile_email,
+                    s3_path=path_id,
+                    path=path_id,
+                    size=stat.st_size,
+                    last_modified=stat.st_mtime,
+                    content_type=None)
 
-        count += 1
+    records = []
+    for count, (attachment, record) in enumerate(
+            run_parallel_queue(export_upload, attachments, processes), start=1):
+        records.append(record)
 
         if (count % 100 == 0):
             logging.info("Finished %s", count)
+
+    # The workers finish in no particular order.
+    records.sort(key=lambda record: record['path'])
     with open(os.path.join(output_dir, "records.json"), "w") as records_file:
         ujson.dump(records, records_file, indent=4)
 
@@ -1456,6 +1659,14 @@ def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
                 f.write(f'{len(data[k]):5} {k}\n')
             f.write('\n')
 
+        manifest = read_message_shard_manifest(output_dir)
+        if manifest is not None:
+            for shard in manifest['shards']:
+                f.write(shard['file'] + '\n')
+                for table in sorted(shard['rows']):
+                    f.write(f"{shard['rows'][table]:5} {table}\n")
+                f.write('\n')
+
         avatar_file = os.path.join(output_dir, 'avatars/records.json')
         uploads_file = os.path.join(output_dir, 'uploads/records.json')
 
@@ -1469,7 +1680,8 @@ def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
 def do_export_realm(realm: Realm, output_dir: Path, threads: int,
                     exportable_user_ids: Optional[Set[int]]=None,
                     public_only: bool=False,
-                    consent_message_id: Optional[int]=None) -> str:
+                    consent_message_id: Optional[int]=None,
+                    streaming: bool=False) -> str:
     response: TableData = {}
 
     # We need at least one thread running to export
@@ -1494,23 +1706,33 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     sanity_check_output(response)
 
     logging.info("Exporting uploaded files and avatars")
-    export_uploads_and_avatars(realm, output_dir)
+    export_uploads_and_avatars(realm, output_dir, processes=threads)
 
     # We (sort of) export zerver_message rows here.  We write
     # them to .partial files that are subsequently fleshed out
     # by parallel processes to add in zerver_usermessage data.
     # This is for performance reasons, of course.  Some installations
     # have millions of messages.
-    logging.info("Exporting .partial files messages")
-    message_ids = export_partial_message_files(realm, response, output_dir=output_dir,
-                                               public_only=public_only,
-                                               consent_message_id=consent_message_id)
-    logging.info('%d messages were exported', len(message_ids))
+    if streaming:
+        logging.info("Exporting .partial message shards")
+        message_queries = export_partial_message_shards(realm, response, output_dir=output_dir,
+                                                        shard_size=MESSAGE_SHARD_SIZE,
+                                                        public_only=public_only,
+                                                        consent_message_id=consent_message_id)
+        # Reactions are exported in the message shards, alongside
+        # their messages.
+        response['zerver_reaction'] = []
+    else:
+        logging.info("Exporting .partial files messages")
+        message_ids = export_partial_message_files(realm, response, output_dir=output_dir,
+                                                   public_only=public_only,
+                                                   consent_message_id=consent_message_id)
+        logging.info('%d messages were exported', len(message_ids))
 
-    # zerver_reaction
-    zerver_reaction: TableData = {}
-    fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
-    response.update(zerver_reaction)
+        # zerver_reaction
+        zerver_reaction: TableData = {}
+        fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
+        response.update(zerver_reaction)
 
     # Write realm data
     export_file = os.path.join(output_dir, "realm.json")
@@ -1521,11 +1743,17 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     export_analytics_tables(realm=realm, output_dir=output_dir)
 
     # zerver_attachment
-    export_attachment_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
+    if streaming:
+        export_streamed_attachment_table(realm=realm, output_dir=output_dir,
+                                         message_queries=message_queries)
+    else:
+        export_attachment_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
 
-    # Start parallel jobs to export the UserMessage objects.
-    launch_user_message_subprocesses(threads=threads, output_dir=output_dir,
-                                     consent_message_id=consent_message_id)
+    # Export the UserMessage objects in parallel.
+    export_usermessages_in_parallel(processes=threads, output_dir=output_dir,
+                                    consent_message_id=consent_message_id)
+    if streaming:
+        write_message_shard_manifest(output_dir)
 
     logging.info("Finished exporting %s", realm.string_id)
     create_soft_link(source=output_dir, in_progress=False)
@@ -1549,6 +1777,15 @@ def export_attachment_table(realm: Realm, output_dir: Path, message_ids: Set[int
     logging.info('Writing attachment table data to %s', output_file)
     write_data_to_file(output_file=output_file, data=response)
 
+def export_streamed_attachment_table(realm: Realm, output_dir: Path,
+                                     message_queries: List[Any]) -> None:
+    response: TableData = {}
+    fetch_streamed_attachment_data(response=response, realm_id=realm.id,
+                                   message_queries=message_queries)
+    output_file = os.path.join(output_dir, "attachment.json")
+    logging.info('Writing attachment table data to %s', output_file)
+    write_data_to_file(output_file=output_file, data=response)
+
 def create_soft_link(source: Path, in_progress: bool=True) -> None:
     is_done = not in_progress
     if settings.DEVELOPMENT:
@@ -1571,28 +1808,26 @@ def create_soft_link(source: Path, in_progress: bool=True) -> None:
     if is_done:
         logging.info('See %s for output files', new_target)
 
-def launch_user_message_subprocesses(threads: int, output_dir: Path,
-                                     consent_message_id: Optional[int]=None) -> None:
-    logging.info('Launching %d PARALLEL subprocesses to export UserMessage rows', threads)
-    pids = {}
-
-    for shard_id in range(threads):
-        arguments = [
-            os.path.join(settings.DEPLOY_ROOT, "manage.py"),
-            'export_usermessage_batch',
-            '--path', str(output_dir),
-            '--thread', str(shard_id),
-        ]
-        if consent_message_id is not None:
-            arguments.extend(['--consent-message-id', str(consent_message_id)])
-
-        process = subprocess.Popen(arguments)
-        pids[process.pid] = shard_id
+def export_usermessages_in_parallel(processes: int, output_dir: Path,
+                                    consent_message_id: Optional[int]=None) -> None:
+    """Fleshes out the .partial message files (or shards) with their
+    UserMessage rows, in a pool of worker processes that each take the
+    next file as soon as they finish the last."""
+    partial_paths = sorted(glob.glob(os.path.join(output_dir, 'messages-*.json.partial')) +
+                           glob.glob(os.path.join(output_dir, 'messages-*.jsonl.gz.partial')))
+    logging.info('Exporting UserMessage rows for %d message files in %d processes',
+                 len(partial_paths), processes)
+
+    def export_partial_file(partial_path: Path) -> None:
+        output_path = partial_path[:-len(".partial")]
+        if output_path.endswith(".jsonl.gz"):
+            export_usermessages_shard(partial_path, output_path, consent_message_id)
+        else:
+            export_usermessages_batch(partial_path, output_path, consent_message_id)
 
-    while pids:
-        pid, status = os.wait()
-        shard = pids.pop(pid)
-        print(f'Shard {shard} finished, status {status}')
+    for count, (partial_path, _) in enumerate(
+            run_parallel_queue(export_partial_file, partial_paths, processes), start=1):
+        logging.info('Finished %s (%d/%d)', partial_path, count, len(partial_paths))
 
 def do_export_user(user_profile: UserProfile, output_dir: Path) -> None:
     response: TableData = {}
@@ -1753,10 +1988,12 @@ def export_realm_wrapper(realm: Realm, output_dir: str,
                          threads: int, upload: bool,
                          public_only: bool,
                          delete_after_upload: bool,
-                         consent_message_id: Optional[int]=None) -> Optional[str]:
+                         consent_message_id: Optional[int]=None,
+                         streaming: bool=False) -> Optional[str]:
     tarball_path = do_export_realm(realm=realm, output_dir=output_dir,
                                    threads=threads, public_only=public_only,
-                                   consent_message_id=consent_message_id)
+                                   consent_message_id=consent_message_id,
+                                   streaming=streaming)
     print(f"Finished exporting to {output_dir}")
     print(f"Tarball written to {tarball_path}")
 
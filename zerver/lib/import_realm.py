@@ -1,37 +1,55 @@
 import datetime
+import io
 import logging
 import os
 import shutil
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from array import array
+from operator import itemgetter
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-import boto3
 import ujson
 from bs4 import BeautifulSoup
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Max
 from django.utils.timezone import now as timezone_now
 from psycopg2.extras import execute_values
 from psycopg2.sql import SQL, Identifier
 
 from analytics.models import RealmCount, StreamCount, UserCount
-from zerver.lib.actions import (
-    UserMessageLite,
-    bulk_insert_ums,
-    do_change_avatar_fields,
-    do_change_plan_type,
-)
+from zerver.lib.actions import do_change_avatar_fields, do_change_plan_type
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_create_users, bulk_set_users_or_streams_recipient_fields
-from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
-from zerver.lib.markdown import markdown_convert
+from zerver.lib.export import (
+    DATE_FIELDS,
+    Field,
+    Path,
+    Record,
+    TableData,
+    TableName,
+    get_message_shard_paths,
+    read_message_shard,
+    read_message_shard_manifest,
+)
+from zerver.lib.markdown import (
+    MarkdownRenderRequest,
+    bulk_markdown_convert,
+    prepare_markdown_render,
+)
 from zerver.lib.markdown import version as markdown_version
-from zerver.lib.parallel import run_parallel
+from zerver.lib.parallel import run_parallel, run_parallel_queue
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
 from zerver.lib.timestamp import datetime_to_timestamp
-from zerver.lib.upload import BadImageError, guess_type, random_name, sanitize_name
-from zerver.lib.utils import generate_api_key, process_list_in_batches
+from zerver.lib.upload import (
+    BadImageError,
+    S3Transfer,
+    guess_type,
+    random_name,
+    sanitize_name,
+    upload_files_to_s3,
+)
+from zerver.lib.utils import generate_api_key, write_json_atomically
 from zerver.models import (
     AlertWord,
     Attachment,
@@ -126,6 +144,17 @@ path_maps: Dict[str, Dict[str, str]] = {
     'attachment_path': {},
 }
 
+# The number of rows from a streaming export's message shard that we
+# import at a time.
+MESSAGE_SHARD_IMPORT_CHUNK_SIZE = 10000
+
+# Files that import_message_data keeps in the import directory, so
+# that resume_import_realm can pick up an import that died while
+# importing the messages: what the message import needs from the rest
+# of the import, and which message files have been imported.
+MESSAGE_IMPORT_STATE = 'message-import-state.json'
+MESSAGE_IMPORT_CHECKPOINT = 'message-import-checkpoint.json'
+
 def update_id_map(table: TableName, old_id: int, new_id: int) -> None:
     if table not in ID_MAP:
         raise Exception(f'''
@@ -256,6 +285,8 @@ def fix_message_rendered_content(realm: Realm,
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    messages_to_render: List[Record] = []
+    render_requests: List[MarkdownRenderRequest] = []
     for message in messages:
         if message['rendered_content'] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -317,24 +348,28 @@ def fix_message_rendered_content(realm: Realm,
             # words" type feature, and notifications aren't important anyway.
             realm_alert_words_automaton = None
 
-            rendered_content = markdown_convert(
+            render_requests.append(prepare_markdown_render(
                 content=content,
                 realm_alert_words_automaton=realm_alert_words_automaton,
                 message_realm=realm,
                 sent_by_bot=sent_by_bot,
                 translate_emoticons=translate_emoticons,
-            )
-
-            message['rendered_content'] = rendered_content
-            message['rendered_content_version'] = markdown_version
+            ))
+            messages_to_render.append(message)
         except Exception:
-            # This generally happens with two possible causes:
-            # * rendering markdown throwing an uncaught exception
-            # * rendering markdown failing with the exception being
-            #   caught in markdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
             logging.warning("Error in markdown rendering for message ID %s; continuing", message['id'])
 
+    # This renders the messages in parallel if MARKDOWN_RENDER_PROCESSES is set.
+    rendered = bulk_markdown_convert(render_requests)
+    for message, rendered_content in zip(messages_to_render, rendered):
+        if rendered_content is None:
+            # Rendering markdown threw an exception, which
+            # bulk_markdown_convert has logged.
+            logging.warning("Error in markdown rendering for message ID %s; continuing", message['id'])
+            continue
+        message['rendered_content'] = rendered_content
+        message['rendered_content_version'] = markdown_version
+
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
     """
     Returns the ids present in the current table
@@ -419,6 +454,20 @@ def re_map_foreign_keys_internal(data_table: List[Record],
     the re-mapping.  (It also appends `_id` to the field.)
     '''
     lookup_table = ID_MAP[related_table]
+    if not (verbose or recipient_field or reaction_field):
+        # The common case, where we look up every row's ID: do the
+        # lookups for the whole column at once, with loops that run in C.
+        old_ids = list(map(itemgetter(field_name), data_table))
+        new_ids = map(lookup_table.get, old_ids, old_ids)
+        if id_field:
+            for item, new_id in zip(data_table, new_ids):
+                item[field_name] = new_id
+        else:
+            for item, new_id in zip(data_table, new_ids):
+                item[field_name + "_id"] = new_id
+                del item[field_name]
+        return
+
     for item in data_table:
         old_id = item[field_name]
         if recipient_field:
@@ -487,6 +536,9 @@ def re_map_foreign_keys_many_to_many_internal(table: TableName,
     new updated ID list.
     """
     lookup_table = ID_MAP[related_table]
+    if not verbose:
+        return list(map(lookup_table.get, old_id_list, old_id_list))
+
     new_id_list = []
     for old_id in old_id_list:
         if old_id in lookup_table:
@@ -499,10 +551,35 @@ def re_map_foreign_keys_many_to_many_internal(table: TableName,
         new_id_list.append(new_id)
     return new_id_list
 
-def fix_bitfield_keys(data: TableData, table: TableName, field_name: Field) -> None:
-    for item in data[table]:
-        item[field_name] = item[field_name + '_mask']
-        del item[field_name + '_mask']
+def re_map_column(column: 'array[int]', related_table: TableName) -> 'array[int]':
+    lookup_table = ID_MAP[related_table]
+    return array('q', map(lookup_table.get, column, column))
+
+class UserMessageColumns:
+    """UserMessage rows, held as an array of integers per column rather
+    than as a dict per row.  There are far more UserMessage rows than
+    any others, so we remap and load them a column at a time, with
+    loops that run in C rather than Python."""
+
+    def __init__(self, rows: List[Record]) -> None:
+        self.user_profile_id = array('q', map(itemgetter('user_profile'), rows))
+        self.message_id = array('q', map(itemgetter('message'), rows))
+        # Exports have the flags as their integer bitmask, which is
+        # what we store.
+        self.flags = array('q', map(itemgetter('flags_mask'), rows))
+
+    def __len__(self) -> int:
+        return len(self.message_id)
+
+    def re_map_foreign_keys(self) -> None:
+        # Every message has a new ID, from update_message_foreign_keys,
+        # so a missing one is a bug; this raises a KeyError for it.
+        self.message_id = array('q', map(ID_MAP['message'].__getitem__, self.message_id))
+        self.user_profile_id = re_map_column(self.user_profile_id, 'user_profile')
+
+    def write_copy_text(self, buf: IO[str]) -> None:
+        buf.writelines(map('%d\t%d\t%d\n'.__mod__,
+                           zip(self.user_profile_id, self.message_id, self.flags)))
 
 def fix_realm_authentication_bitfield(data: TableData, table: TableName, field_name: Field) -> None:
     """Used to fixup the authentication_methods bitfield to be a string"""
@@ -547,37 +624,19 @@ def update_model_ids(model: Any, data: TableData, related_table: TableName) -> N
         update_id_map(related_table, old_id_list[item], allocated_id_list[item])
     re_map_foreign_keys(data, table, 'id', related_table=related_table, id_field=True)
 
-def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
-    model = UserMessage
-    table = 'zerver_usermessage'
-    lst = data[table]
-
+def bulk_import_user_message_data(columns: UserMessageColumns, dump_file_id: int) -> None:
     # IMPORTANT NOTE: We do not use any primary id
     # data from either the import itself or ID_MAP.
     # We let the DB itself generate ids.  Note that
     # no tables use user_message.id as a foreign key,
     # so we can safely avoid all re-mapping complexity.
+    buf = io.StringIO()
+    columns.write_copy_text(buf)
+    buf.seek(0)
+    copy_from_buffer('zerver_usermessage', ['user_profile_id', 'message_id', 'flags'], buf)
 
-    def process_batch(items: List[Dict[str, Any]]) -> None:
-        ums = [
-            UserMessageLite(
-                user_profile_id = item['user_profile_id'],
-                message_id = item['message_id'],
-                flags=item['flags'],
-            )
-            for item in items
-        ]
-        bulk_insert_ums(ums)
-
-    chunk_size = 10000
-
-    process_list_in_batches(
-        lst=lst,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
-    )
-
-    logging.info("Successfully imported %s from %s[%s].", model, table, dump_file_id)
+    logging.info("Successfully imported %s from %s[%s].", UserMessage, 'zerver_usermessage',
+                 dump_file_id)
 
 def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=None) -> None:
     table = get_db_table(model)
@@ -588,6 +647,49 @@ def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=N
     else:
         logging.info("Successfully imported %s from %s[%s].", model, table, dump_file_id)
 
+def bulk_copy_model(data: TableData, model: Any) -> None:
+    """Like bulk_import_model, but loads the rows with COPY, which is
+    several times faster than INSERT for the millions of rows in the
+    message tables of a large realm."""
+    table = get_db_table(model)
+    fields = model._meta.concrete_fields
+    copy_rows(
+        table,
+        [field.column for field in fields],
+        ([field.get_db_prep_save(getattr(instance, field.attname), connection)
+          for field in fields]
+         for instance in (model(**item) for item in data[table])),
+    )
+    logging.info("Successfully imported %s from %s.", model, table)
+
+# Backslash escapes for the characters that are special in COPY's text format.
+COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_text(value: Any) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+def copy_rows(table: str, columns: List[str], rows: Iterable[Iterable[Any]]) -> None:
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_text(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    copy_from_buffer(table, columns, buf)
+
+def copy_from_buffer(table: str, columns: List[str], buf: IO[str]) -> None:
+    with connection.cursor() as cursor:
+        query = SQL('COPY {table} ({columns}) FROM STDIN').format(
+            table=Identifier(table),
+            columns=SQL(', ').join(Identifier(column) for column in columns),
+        )
+        cursor.cursor.copy_expert(query, buf)
+
 # Client is a table shared by multiple realms, so in order to
 # correctly import multiple realms into the same server, we need to
 # check if a Client object already exists, and so we need to support
@@ -631,8 +733,7 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
             bucket_name = settings.S3_AVATAR_BUCKET
         else:
             bucket_name = settings.S3_AUTH_UPLOADS_BUCKET
-        session = boto3.Session(settings.S3_KEY, settings.S3_SECRET_KEY)
-        bucket = session.resource('s3').Bucket(bucket_name)
+        s3_transfers: List[S3Transfer] = []
 
     count = 0
     for record in records:
@@ -674,7 +775,6 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
             path_maps['attachment_path'][record['s3_path']] = relative_path
 
         if s3_uploads:
-            key = bucket.Object(relative_path)
             metadata = {}
             if processing_emojis and "user_profile_id" not in record:
                 # Exported custom emoji from tools like Slack don't have
@@ -708,10 +808,12 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
                     # directly anyway.
                     content_type = 'application/octet-stream'
 
-            key.upload_file(os.path.join(import_dir, record['path']),
-                            ExtraArgs={
-                                'ContentType': content_type,
-                                'Metadata': metadata})
+            s3_transfers.append(S3Transfer(
+                key=relative_path,
+                filename=os.path.join(import_dir, record['path']),
+                extra_args={
+                    'ContentType': content_type,
+                    'Metadata': metadata}))
         else:
             if processing_avatars or processing_emojis or processing_realm_icons:
                 file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, "avatars", relative_path)
@@ -721,6 +823,9 @@ def import_uploads(realm: Realm, import_dir: Path, processes: int, processing_av
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             shutil.copy(orig_file_path, file_path)
 
+    if s3_uploads:
+        upload_files_to_s3(bucket_name, s3_transfers)
+
     if processing_avatars:
         from zerver.lib.upload import upload_backend
 
@@ -1047,14 +1152,26 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     }
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    write_message_import_state(import_dir, realm, sender_map)
+    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir,
+                        processes=processes)
 
-    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
-    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
-    re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
-                        reaction_field=True)
-    update_model_ids(Reaction, data, 'reaction')
-    bulk_import_model(data, Reaction)
+    return finish_import_realm(realm, import_dir, data)
+
+def resume_import_realm(import_dir: Path, processes: int=1) -> Realm:
+    """Resumes an import that died while importing the realm's
+    messages, skipping the message files it had already imported."""
+    logging.info("Resuming import of realm dump %s", import_dir)
+    realm, sender_map = read_message_import_state(import_dir)
+    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir,
+                        processes=processes)
+
+    with open(os.path.join(import_dir, "realm.json")) as f:
+        data = ujson.load(f)
+    return finish_import_realm(realm, import_dir, data)
+
+def finish_import_realm(realm: Realm, import_dir: Path, data: TableData) -> Realm:
+    import_reaction_rows(data)
 
     # Similarly, we need to recalculate the first_message_id for stream objects.
     for stream in Stream.objects.filter(realm=realm):
@@ -1085,6 +1202,9 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
         do_change_plan_type(realm, Realm.LIMITED)
     else:
         do_change_plan_type(realm, Realm.SELF_HOSTED)
+
+    os.remove(os.path.join(import_dir, MESSAGE_IMPORT_STATE))
+    os.remove(os.path.join(import_dir, MESSAGE_IMPORT_CHECKPOINT))
     return realm
 
 # create_users and do_import_system_bots differ from their equivalent
@@ -1143,6 +1263,46 @@ def get_incoming_message_ids(import_dir: Path,
     else:
         message_ids: List[int] = []
 
+    for row in get_incoming_message_rows(import_dir):
+        # We truncate date_sent to int to theoretically
+        # save memory and speed up the sort.  For
+        # Zulip-to-Zulip imports, the
+        # message_id will generally be a good tiebreaker.
+        # If we occasionally mis-order the ids for two
+        # messages from the same second, it's not the
+        # end of the world, as it's likely those messages
+        # arrived to the original server in somewhat
+        # arbitrary order.
+
+        message_id = row['id']
+
+        if sort_by_date:
+            date_sent = int(row['date_sent'])
+            tup = (date_sent, message_id)
+            tups.append(tup)
+        else:
+            message_ids.append(message_id)
+
+    if sort_by_date:
+        tups.sort()
+        message_ids = [tup[1] for tup in tups]
+
+    return message_ids
+
+def get_incoming_message_rows(import_dir: Path) -> Iterator[Record]:
+    manifest = read_message_shard_manifest(import_dir)
+    if manifest is not None:
+        # Each shard's messages come before its other rows, so we
+        # can skip reading the rest of the shard.  This is the first
+        # time we read the shards, so we check them against the
+        # manifest here.
+        for shard_path in get_message_shard_paths(import_dir, manifest, verify=True):
+            for table, row in read_message_shard(shard_path):
+                if table != 'zerver_message':
+                    break
+                yield row
+        return
+
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
@@ -1155,84 +1315,225 @@ def get_incoming_message_ids(import_dir: Path,
         # Aggressively free up memory.
         del data['zerver_usermessage']
 
-        for row in data['zerver_message']:
-            # We truncate date_sent to int to theoretically
-            # save memory and speed up the sort.  For
-            # Zulip-to-Zulip imports, the
-            # message_id will generally be a good tiebreaker.
-            # If we occasionally mis-order the ids for two
-            # messages from the same second, it's not the
-            # end of the world, as it's likely those messages
-            # arrived to the original server in somewhat
-            # arbitrary order.
-
-            message_id = row['id']
-
-            if sort_by_date:
-                date_sent = int(row['date_sent'])
-                tup = (date_sent, message_id)
-                tups.append(tup)
-            else:
-                message_ids.append(message_id)
-
+        yield from data['zerver_message']
         dump_file_id += 1
 
-    if sort_by_date:
-        tups.sort()
-        message_ids = [tup[1] for tup in tups]
-
-    return message_ids
-
-def import_message_data(realm: Realm,
-                        sender_map: Dict[int, Record],
-                        import_dir: Path) -> None:
+def write_message_import_state(import_dir: Path, realm: Realm,
+                               sender_map: Dict[int, Record]) -> None:
+    state = {
+        'realm_id': realm.id,
+        # JSON objects can only have string keys.
+        'id_map': {table: list(id_map.items()) for table, id_map in ID_MAP.items()},
+        'path_maps': path_maps,
+        # Rendering only needs these fields of the senders.
+        'senders': [
+            {field: user[field] for field in ['id', 'is_bot', 'translate_emoticons']}
+            for user in sender_map.values()
+        ],
+    }
+    write_json_atomically(os.path.join(import_dir, MESSAGE_IMPORT_STATE), state)
+    # This is a fresh import, so any checkpoint is left over from an
+    # earlier one.
+    write_message_import_checkpoint(import_dir, set())
+
+def read_message_import_state(import_dir: Path) -> Tuple[Realm, Dict[int, Record]]:
+    state_filename = os.path.join(import_dir, MESSAGE_IMPORT_STATE)
+    if not os.path.exists(state_filename):
+        raise Exception("No interrupted import to resume in this directory!")
+    with open(state_filename) as f:
+        state = ujson.load(f)
+
+    for table, id_map in state['id_map'].items():
+        ID_MAP[table].update((old_id, new_id) for old_id, new_id in id_map)
+    for path_map_name, path_map in state['path_maps'].items():
+        path_maps[path_map_name].update(path_map)
+
+    realm = Realm.objects.get(id=state['realm_id'])
+    sender_map = {user['id']: user for user in state['senders']}
+    return realm, sender_map
+
+def read_message_import_checkpoint(import_dir: Path) -> Set[str]:
+    checkpoint_filename = os.path.join(import_dir, MESSAGE_IMPORT_CHECKPOINT)
+    if not os.path.exists(checkpoint_filename):
+        return set()
+    with open(checkpoint_filename) as f:
+        return set(ujson.load(f)['imported'])
+
+def write_message_import_checkpoint(import_dir: Path, imported: Set[str]) -> None:
+    write_json_atomically(os.path.join(import_dir, MESSAGE_IMPORT_CHECKPOINT),
+                          {'imported': sorted(imported)})
+
+def get_message_files(import_dir: Path) -> List[Path]:
+    manifest = read_message_shard_manifest(import_dir)
+    if manifest is not None:
+        return list(get_message_shard_paths(import_dir, manifest))
+
+    message_files = []
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
         if not os.path.exists(message_filename):
             break
+        message_files.append(message_filename)
+        dump_file_id += 1
+    return message_files
 
-        with open(message_filename) as f:
-            data = ujson.load(f)
+def import_message_data(realm: Realm,
+                        sender_map: Dict[int, Record],
+                        import_dir: Path,
+                        processes: int=1) -> None:
+    """Imports the message files (or a streaming export's shards), each
+    in its own transaction, and with `processes` files being parsed,
+    remapped, rendered, and loaded at once.  Since the message IDs have
+    all been allocated already, the files are independent of each
+    other, and can be imported in any order.
+
+    Each file is recorded in a checkpoint once it has been committed,
+    so that if the import dies, resume_import_realm only has to import
+    the files that weren't."""
+    imported = read_message_import_checkpoint(import_dir)
+    message_files = [
+        (dump_file_id, message_filename)
+        for dump_file_id, message_filename in enumerate(get_message_files(import_dir), start=1)
+        if os.path.basename(message_filename) not in imported
+    ]
+    if imported:
+        logging.info("Skipping %s message files that were already imported", len(imported))
+
+    def import_file(job: Tuple[int, Path]) -> bool:
+        dump_file_id, message_filename = job
+        with transaction.atomic():
+            if message_filename.endswith('.jsonl.gz'):
+                import_message_shard(realm, sender_map, message_filename, dump_file_id)
+            else:
+                import_message_file(realm, sender_map, message_filename, dump_file_id)
+        return True
+
+    # A file which fails in a worker is logged, and doesn't stop the
+    # others; we report all of the failed files at the end.
+    def import_file_in_worker(job: Tuple[int, Path]) -> bool:  # nocoverage
+        # Our own processes render in parallel; a render pool in each
+        # of them would just multiply the number of processes.
+        settings.MARKDOWN_RENDER_PROCESSES = 0
+        try:
+            return import_file(job)
+        except Exception:
+            logging.exception("Error importing %s", job[1])
+            return False
+
+    results: Iterator[Tuple[Tuple[int, Path], bool]]
+    if processes == 1:
+        results = ((job, import_file(job)) for job in message_files)
+    else:  # nocoverage
+        results = run_parallel_queue(import_file_in_worker, message_files, processes, retries=0)
+
+    failed = []
+    for ((dump_file_id, message_filename), succeeded) in results:
+        if not succeeded:  # nocoverage
+            failed.append(message_filename)
+            continue
+        imported.add(os.path.basename(message_filename))
+        write_message_import_checkpoint(import_dir, imported)
+    if failed:  # nocoverage
+        raise Exception(f"Failed to import {', '.join(failed)}; fix the problem, "
+                        "and resume the import with --resume")
+
+def already_imported(message_rows: List[Record]) -> bool:
+    """Whether a message file was imported by an import that died
+    before it could record that in its checkpoint."""
+    return bool(message_rows) and Message.objects.filter(
+        id=ID_MAP['message'][message_rows[0]['id']]).exists()
+
+def import_message_file(realm: Realm,
+                        sender_map: Dict[int, Record],
+                        message_filename: Path,
+                        dump_file_id: int) -> None:
+    with open(message_filename) as f:
+        data = ujson.load(f)
 
-        logging.info("Importing message dump %s", message_filename)
-        re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
-        re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
-        re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
-        fix_datetime_fields(data, 'zerver_message')
-        # Parser to update message content with the updated attachment urls
-        fix_upload_links(data, 'zerver_message')
-
-        # We already create mappings for zerver_message ids
-        # in update_message_foreign_keys(), so here we simply
-        # apply them.
-        message_id_map = ID_MAP['message']
-        for row in data['zerver_message']:
-            row['id'] = message_id_map[row['id']]
-
-        for row in data['zerver_usermessage']:
-            assert(row['message'] in message_id_map)
-
-        fix_message_rendered_content(
-            realm=realm,
-            sender_map=sender_map,
-            messages=data['zerver_message'],
-        )
-        logging.info("Successfully rendered markdown for message batch")
+    if already_imported(data['zerver_message']):
+        logging.info("Skipping message dump %s, which was already imported", message_filename)
+        return
+
+    logging.info("Importing message dump %s", message_filename)
+    import_message_rows(realm, sender_map, data)
+    import_user_message_rows(data, dump_file_id)
+
+def import_message_shard(realm: Realm,
+                         sender_map: Dict[int, Record],
+                         shard_path: Path,
+                         dump_file_id: int) -> None:
+    """Imports a streaming export's message shard, a chunk of rows at a
+    time.  Since a shard's messages come before its UserMessage and
+    Reaction rows, they are all imported before the rows that refer to
+    them."""
+    def import_chunk(table: TableName, rows: List[Record]) -> None:
+        data: TableData = {table: rows}
+        if table == 'zerver_message':
+            import_message_rows(realm, sender_map, data)
+        elif table == 'zerver_usermessage':
+            import_user_message_rows(data, dump_file_id)
+        elif table == 'zerver_reaction':
+            import_reaction_rows(data)
+
+    rows = read_message_shard(shard_path)
+    first_table, first_row = next(rows)
+    if first_table == 'zerver_message' and already_imported([first_row]):
+        logging.info("Skipping message shard %s, which was already imported", shard_path)
+        return
 
-        # A LOT HAPPENS HERE.
-        # This is where we actually import the message data.
-        bulk_import_model(data, Message)
+    logging.info("Importing message shard %s", shard_path)
+    chunk_table: TableName = first_table
+    chunk: List[Record] = [first_row]
+    for table, row in rows:
+        if table != chunk_table or len(chunk) == MESSAGE_SHARD_IMPORT_CHUNK_SIZE:
+            import_chunk(chunk_table, chunk)
+            chunk = []
+        chunk_table = table
+        chunk.append(row)
+    import_chunk(chunk_table, chunk)
+
+def import_message_rows(realm: Realm, sender_map: Dict[int, Record], data: TableData) -> None:
+    re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
+    re_map_foreign_keys(data, 'zerver_message', 'recipient', related_table="recipient")
+    re_map_foreign_keys(data, 'zerver_message', 'sending_client', related_table='client')
+    fix_datetime_fields(data, 'zerver_message')
+    # Parser to update message content with the updated attachment urls
+    fix_upload_links(data, 'zerver_message')
+
+    # We already create mappings for zerver_message ids
+    # in update_message_foreign_keys(), so here we simply
+    # apply them.
+    message_id_map = ID_MAP['message']
+    for row in data['zerver_message']:
+        row['id'] = message_id_map[row['id']]
+
+    fix_message_rendered_content(
+        realm=realm,
+        sender_map=sender_map,
+        messages=data['zerver_message'],
+    )
+    logging.info("Successfully rendered markdown for message batch")
 
-        # Due to the structure of these message chunks, we're
-        # guaranteed to have already imported all the Message objects
-        # for this batch of UserMessage objects.
-        re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
-        re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
-        fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+    # A LOT HAPPENS HERE.
+    # This is where we actually import the message data.
+    bulk_copy_model(data, Message)
 
-        bulk_import_user_message_data(data, dump_file_id)
-        dump_file_id += 1
+def import_user_message_rows(data: TableData, dump_file_id: int) -> None:
+    # Due to the structure of these message chunks, we're
+    # guaranteed to have already imported all the Message objects
+    # for this batch of UserMessage objects.
+    columns = UserMessageColumns(data['zerver_usermessage'])
+    columns.re_map_foreign_keys()
+    bulk_import_user_message_data(columns, dump_file_id)
+
+def import_reaction_rows(data: TableData) -> None:
+    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
+    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
+    re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
+                        reaction_field=True)
+    update_model_ids(Reaction, data, 'reaction')
+    bulk_import_model(data, Reaction)
 
 def import_attachments(data: TableData) -> None:
 
@@ -1,8 +1,11 @@
 # Zulip's main markdown implementation.  See docs/subsystems/markdown.md for
 # detailed documentation on our markdown syntax.
+import copy
 import datetime
 import functools
+import hashlib
 import html
+import itertools
 import logging
 import os
 import re
@@ -18,6 +21,7 @@ from typing import (
     Dict,
     Generic,
     Iterable,
+    Iterator,
     List,
     Optional,
     Set,
@@ -34,6 +38,7 @@ import dateutil.parser
 import dateutil.tz
 import markdown
 import requests
+import ujson
 from django.conf import settings
 from django.db.models import Q
 from hyperlink import parse
@@ -41,7 +46,16 @@ from markdown.extensions import codehilite, nl2br, sane_lists, tables
 from typing_extensions import TypedDict
 
 from zerver.lib import mention as mention
-from zerver.lib.cache import NotFoundInCache, cache_with_key
+from zerver.lib.alert_words import get_alert_word_automaton_version
+from zerver.lib.cache import (
+    LRUCache,
+    NotFoundInCache,
+    cache_get,
+    cache_set,
+    cache_with_key,
+    get_or_create_version_token,
+    realm_mention_index_version_cache_key,
+)
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import (
     codepoint_to_name,
@@ -59,6 +73,7 @@ from zerver.lib.timeout import TimeoutExpired, timeout
 from zerver.lib.timezone import get_common_timezones
 from zerver.lib.url_encoding import encode_stream, hash_util_encode
 from zerver.lib.url_preview import preview as link_preview
+from zerver.lib.utils import statsd
 from zerver.models import (
     MAX_MESSAGE_LENGTH,
     Message,
@@ -66,7 +81,6 @@ from zerver.models import (
     UserGroup,
     UserGroupMembership,
     UserProfile,
-    all_realm_filters,
     get_active_streams,
     realm_filters_for_realm,
 )
@@ -1592,34 +1606,153 @@ class MarkdownListPreprocessor(markdown.preprocessors.Preprocessor):
                     inserts += 1
         return copy
 
-# Name for the outer capture group we use to separate whitespace and
-# other delimiters from the actual content.  This value won't be an
+# The number of realms whose markdown engines (and realm filter
+# matchers) each process keeps.  Building an engine takes a few
+# milliseconds, so realms beyond that just pay that on their next
+# render; see the benchmark_markdown_engines command.
+MAX_CACHED_MARKDOWN_REALMS = 100
+
+# Prefix for the capture group around each realm filter in a
+# RealmFilterMatcher, and for the renamed groups within it.  Realm
+# filter groups must be word characters, so this value won't be an
 # option in user-entered capture groups.
-OUTER_CAPTURE_GROUP = "linkifier_actual_match"
+LINKIFIER_GROUP_PREFIX = "linkifier_"
+
+# Numbered backreferences (e.g. \1) and conditionals (e.g. (?(1)...))
+# refer to groups that are renumbered, or renamed, when a realm filter
+# is combined with others; filters using them get a regex of their own.
+GROUP_REFERENCE_RE = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\()')
+
 def prepare_realm_pattern(source: str) -> str:
-    """Augment a realm filter so it only matches after start-of-string,
-    whitespace, or opening delimiters, won't match if there are word
-    characters directly after, and saves what was matched as
-    OUTER_CAPTURE_GROUP."""
-    return fr"""(?<![^\s'"\(,:<])(?P<{OUTER_CAPTURE_GROUP}>{source})(?!\w)"""
-
-# Given a regular expression pattern, linkifies groups that match it
-# using the provided format string to construct the URL.
-class RealmFilterPattern(markdown.inlinepatterns.Pattern):
-    """ Applied a given realm filter to the input """
-
-    def __init__(self, source_pattern: str,
-                 format_string: str,
-                 markdown_instance: Optional[markdown.Markdown]=None) -> None:
-        self.pattern = prepare_realm_pattern(source_pattern)
-        self.format_string = format_string
-        markdown.inlinepatterns.Pattern.__init__(self, self.pattern, markdown_instance)
-
-    def handleMatch(self, m: Match[str]) -> Union[Element, str]:
+    """Augment a realm filter (or an alternation of them) so it only
+    matches after start-of-string, whitespace, or opening delimiters,
+    and won't match if there are word characters directly after."""
+    return fr"""(?<![^\s'"\(,:<])(?:{source})(?!\w)"""
+
+def realm_filter_literal_prefix(source: str) -> str:
+    """The literal text that every match of a realm filter starts with,
+    which may be empty."""
+    if '|' in source:
+        # The prefix may only apply to one side of an alternation.
+        return ''
+    end = 0
+    while end < len(source) and source[end] not in '\\.^$*+?{}[]|()':
+        end += 1
+    if end < len(source) and source[end] in '*+?{':
+        # A quantifier applies to the character before it.
+        end = max(end - 1, 0)
+    return source[:end]
+
+def realm_filter_trie_pattern(alternatives: List[Tuple[str, str]], depth: int=0) -> str:
+    """Builds a regular expression matching any of the alternatives,
+    each of which is a literal prefix and a pattern for the rest of the
+    match, with the shared prefixes factored out, so that at each
+    position in the text only the alternatives whose prefixes match
+    are tried."""
+    branches = []
+    longer = sorted((alternative for alternative in alternatives if len(alternative[0]) > depth),
+                    key=lambda alternative: alternative[0][depth])
+    for char, group in itertools.groupby(longer, key=lambda alternative: alternative[0][depth]):
+        branches.append(re.escape(char) + realm_filter_trie_pattern(list(group), depth + 1))
+    # Alternatives with longer literal prefixes are more specific, and
+    # so are tried first.
+    branches += [rest for prefix, rest in alternatives if len(prefix) == depth]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+class RealmFilterMatcher:
+    """A realm's filters, compiled into a single regular expression, so
+    that finding linkifiers in a piece of text is one pass over it
+    rather than one per filter.
+
+    The filters' literal prefixes (e.g. `#` or `JIRA-`) are combined
+    into a trie, so the cost of that pass barely depends on the number
+    of filters.  Each filter's pattern after its prefix is wrapped in a
+    group named LINKIFIER_GROUP_PREFIX plus its index, and its own
+    named groups are renamed to be unique within the expression.
+    Where filters' matches overlap, the leftmost match wins, then the
+    filter with the longest literal prefix, then the earliest filter.
+
+    Filters that refer to their groups by number (see
+    GROUP_REFERENCE_RE) can't be combined, and are matched with a regex
+    each, after the combined one."""
+
+    def __init__(self, realm_filters: List[Tuple[str, str, int]]) -> None:
+        self.realm_filters = realm_filters
+        self.group_names: List[Dict[str, str]] = []
+        self.regexes: List[Pattern[str]] = []
+        # The filter that each of the separate regexes matches.
+        self.separate_filter_indexes: Dict[Pattern[str], int] = {}
+        alternatives = []
+        for index, (source_pattern, format_string, id) in enumerate(realm_filters):
+            if GROUP_REFERENCE_RE.search(source_pattern):
+                regex = re.compile(prepare_realm_pattern(source_pattern), re.DOTALL)
+                self.regexes.append(regex)
+                self.separate_filter_indexes[regex] = index
+                self.group_names.append({name: name for name in regex.groupindex})
+                continue
+
+            group_names: Dict[str, str] = {}
+
+            def rename_group(m: Match[str]) -> str:
+                name = f'{LINKIFIER_GROUP_PREFIX}{index}_{m.group(2)}'
+                if m.group(1) == '<':
+                    group_names[name] = m.group(2)
+                return f'(?P{m.group(1)}{name}'
+
+            prefix = realm_filter_literal_prefix(source_pattern)
+            rest = re.sub(r'\(\?P([<=])(\w+)', rename_group, source_pattern[len(prefix):])
+            alternatives.append((prefix, f'(?P<{LINKIFIER_GROUP_PREFIX}{index}>{rest})'))
+            self.group_names.append(group_names)
+        if alternatives:
+            self.regexes.insert(0, re.compile(
+                prepare_realm_pattern(realm_filter_trie_pattern(alternatives)), re.DOTALL))
+
+    def finditer(self, text: str) -> Iterator[Match[str]]:
+        return itertools.chain.from_iterable(regex.finditer(text) for regex in self.regexes)
+
+    def filter_index(self, m: Match[str]) -> int:
+        if m.re in self.separate_filter_indexes:
+            return self.separate_filter_indexes[m.re]
+        # In the combined regex, the filter's own group always closes
+        # last.
+        assert m.lastgroup is not None
+        return int(m.lastgroup[len(LINKIFIER_GROUP_PREFIX):])
+
+    def url(self, m: Match[str]) -> str:
+        index = self.filter_index(m)
+        format_string = self.realm_filters[index][1]
+        return format_string % {name: m.group(group)
+                                for group, name in self.group_names[index].items()}
+
+realm_filter_matchers: LRUCache[int, RealmFilterMatcher] = LRUCache(MAX_CACHED_MARKDOWN_REALMS)
+
+def get_realm_filter_matcher(realm_filters_key: int,
+                             realm_filters: List[Tuple[str, str, int]]) -> RealmFilterMatcher:
+    """Returns the matcher for a realm's current filters, shared by its
+    markdown engines and topic_links."""
+    matcher = realm_filter_matchers.get(realm_filters_key)
+    if matcher is None or matcher.realm_filters != realm_filters:
+        matcher = RealmFilterMatcher(realm_filters)
+        realm_filter_matchers.set(realm_filters_key, matcher)
+    return matcher
+
+class RealmFilterPattern(markdown.inlinepatterns.InlineProcessor):
+    """ Applies one of a realm's filter matcher's regexes to the input """
+
+    def __init__(self, matcher: RealmFilterMatcher, regex: Pattern[str],
+                 md: markdown.Markdown) -> None:
+        # We skip the superclass's compilation step, since the
+        # matcher has already compiled the pattern.
+        self.matcher = matcher
+        self.compiled_re = regex
+        self.md = md
+        self.safe_mode = False
+
+    def handleMatch(self, m: Match[str], data: str) -> Tuple[Union[Element, str], int, int]:
         db_data = self.md.zulip_db_data
-        return url_to_a(db_data,
-                        self.format_string % m.groupdict(),
-                        m.group(OUTER_CAPTURE_GROUP))
+        return url_to_a(db_data, self.matcher.url(m), m.group(0)), m.start(), m.end()
 
 class UserMentionPattern(markdown.inlinepatterns.Pattern):
     def handleMatch(self, m: Match[str]) -> Optional[Element]:
@@ -1960,9 +2093,12 @@ class Markdown(markdown.Markdown):
         return reg
 
     def register_realm_filters(self, inlinePatterns: markdown.util.Registry) -> markdown.util.Registry:
-        for (pattern, format_string, id) in self.getConfig("realm_filters"):
-            inlinePatterns.register(RealmFilterPattern(pattern, format_string, self),
-                                    f'realm_filters/{pattern}', 45)
+        realm_filters = self.getConfig("realm_filters")
+        if realm_filters:
+            matcher = get_realm_filter_matcher(self.getConfig("realm"), realm_filters)
+            for i, regex in enumerate(matcher.regexes):
+                inlinePatterns.register(RealmFilterPattern(matcher, regex, self),
+                                        f'realm_filters/{i}', 45)
         return inlinePatterns
 
     def build_treeprocessors(self) -> markdown.util.Registry:
@@ -2006,20 +2142,26 @@ class Markdown(markdown.Markdown):
             self.preprocessors = get_sub_registry(self.preprocessors, ['custom_text_notifications'])
             self.parser.blockprocessors = get_sub_registry(self.parser.blockprocessors, ['paragraph'])
 
-md_engines: Dict[Tuple[int, bool], markdown.Markdown] = {}
-realm_filter_data: Dict[int, List[Tuple[str, str, int]]] = {}
+# Markdown engines are built on first use for a realm, and the least
+# recently used are evicted, so that a process serving many realms
+# neither builds an engine for each at startup nor keeps them all.
+md_engines: LRUCache[Tuple[int, bool], markdown.Markdown] = LRUCache(2 * MAX_CACHED_MARKDOWN_REALMS)
 
-def make_md_engine(realm_filters_key: int, email_gateway: bool) -> None:
+def get_md_engine(realm_filters_key: int, email_gateway: bool,
+                  realm_filters: List[Tuple[str, str, int]]) -> markdown.Markdown:
+    """Returns the engine for rendering with the given realm filters,
+    building it if we don't have one, or if the realm's filters have
+    changed since we built it."""
     md_engine_key = (realm_filters_key, email_gateway)
-    if md_engine_key in md_engines:
-        del md_engines[md_engine_key]
-
-    realm_filters = realm_filter_data[realm_filters_key]
-    md_engines[md_engine_key] = build_engine(
-        realm_filters=realm_filters,
-        realm_filters_key=realm_filters_key,
-        email_gateway=email_gateway,
-    )
+    engine = md_engines.get(md_engine_key)
+    if engine is None or engine.getConfig("realm_filters") != realm_filters:
+        engine = build_engine(
+            realm_filters=realm_filters,
+            realm_filters_key=realm_filters_key,
+            email_gateway=email_gateway,
+        )
+        md_engines.set(md_engine_key, engine)
+    return engine
 
 def build_engine(realm_filters: List[Tuple[str, str, int]],
                  realm_filters_key: int,
@@ -2050,11 +2192,12 @@ def topic_links(realm_filters_key: int, topic_name: str) -> List[str]:
     matches: List[str] = []
 
     realm_filters = realm_filters_for_realm(realm_filters_key)
-
-    for realm_filter in realm_filters:
-        pattern = prepare_realm_pattern(realm_filter[0])
-        for m in re.finditer(pattern, topic_name):
-            matches += [realm_filter[1] % m.groupdict()]
+    if realm_filters:
+        matcher = get_realm_filter_matcher(realm_filters_key, realm_filters)
+        # Matches are listed in the order of the filters that matched.
+        filter_matches = sorted(matcher.finditer(topic_name),
+                                key=lambda m: (matcher.filter_index(m), m.start()))
+        matches += [matcher.url(m) for m in filter_matches]
 
     # Also make raw urls navigable.
     for sub_string in basic_link_splitter.split(topic_name):
@@ -2068,33 +2211,15 @@ def topic_links(realm_filters_key: int, topic_name: str) -> List[str]:
 
     return matches
 
-def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gateway: bool) -> None:
-    # If realm_filters_key is None, load all filters
-    global realm_filter_data
-    if realm_filters_key is None:
-        all_filters = all_realm_filters()
-        all_filters[DEFAULT_MARKDOWN_KEY] = []
-        for realm_filters_key, filters in all_filters.items():
-            realm_filter_data[realm_filters_key] = filters
-            make_md_engine(realm_filters_key, email_gateway)
-        # Hack to ensure that getConfig("realm") is right for mirrored Zephyrs
-        realm_filter_data[ZEPHYR_MIRROR_MARKDOWN_KEY] = []
-        make_md_engine(ZEPHYR_MIRROR_MARKDOWN_KEY, False)
-    else:
-        realm_filters = realm_filters_for_realm(realm_filters_key)
-        if realm_filters_key not in realm_filter_data or    \
-                realm_filter_data[realm_filters_key] != realm_filters:
-            # Realm filters data has changed, update `realm_filter_data` and any
-            # of the existing markdown engines using this set of realm filters.
-            realm_filter_data[realm_filters_key] = realm_filters
-            for email_gateway_flag in [True, False]:
-                if (realm_filters_key, email_gateway_flag) in md_engines:
-                    # Update only existing engines(if any), don't create new one.
-                    make_md_engine(realm_filters_key, email_gateway_flag)
-
-        if (realm_filters_key, email_gateway) not in md_engines:
-            # Markdown engine corresponding to this key doesn't exists so create one.
-            make_md_engine(realm_filters_key, email_gateway)
+def get_realm_filters(realm_filters_key: int) -> List[Tuple[str, str, int]]:
+    if realm_filters_key in [DEFAULT_MARKDOWN_KEY, ZEPHYR_MIRROR_MARKDOWN_KEY]:
+        return []
+    # This is cached per request, and in the remote cache until the
+    # realm's filters change.
+    return realm_filters_for_realm(realm_filters_key)
+
+def maybe_update_markdown_engines(realm_filters_key: int, email_gateway: bool) -> None:
+    get_md_engine(realm_filters_key, email_gateway, get_realm_filters(realm_filters_key))
 
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
@@ -2106,42 +2231,98 @@ _privacy_re = re.compile('\\w', flags=re.UNICODE)
 def privacy_clean_markdown(content: str) -> str:
     return repr(_privacy_re.sub('x', content))
 
+# How long a realm's mention index version is kept; this bounds how
+# long a mention index can be stale if a change somehow isn't flushed.
+MENTION_INDEX_VERSION_TIMEOUT = 3600 * 24
+
+class MentionIndex:
+    """The names that can be mentioned in a realm: its active users, by
+    lowercased full name, and its user groups, with their members.
+
+    Building this costs a couple of queries over the whole realm, but
+    saves querying for the mentioned names in every message that
+    mentions someone.  Each process keeps the indexes for the realms it
+    has recently rendered for; see get_mention_index."""
+
+    def __init__(self, realm_id: int) -> None:
+        self.users_by_name: Dict[str, List[FullNameInfo]] = defaultdict(list)
+        rows = UserProfile.objects.filter(
+            realm_id=realm_id,
+            is_active=True,
+        ).values(
+            'id',
+            'full_name',
+            'email',
+        )
+        for row in rows:
+            self.users_by_name[row['full_name'].lower()].append(row)
+
+        self.user_groups_by_name: Dict[str, UserGroup] = {
+            group.name: group for group in UserGroup.objects.filter(realm_id=realm_id)
+        }
+        self.user_group_members: Dict[int, List[int]] = defaultdict(list)
+        membership = UserGroupMembership.objects.filter(user_group__realm_id=realm_id)
+        for info in membership.values('user_group_id', 'user_profile_id'):
+            self.user_group_members[info['user_group_id']].append(info['user_profile_id'])
+
+    def possible_mentions_info(self, mention_texts: Set[str]) -> List[FullNameInfo]:
+        # Remove the trailing part of the `name|id` mention syntax,
+        # thus storing only full names in full_names.
+        full_names = set()
+        name_re = r'(?P<full_name>.+)\|\d+$'
+        for mention_text in mention_texts:
+            name_syntax_match = re.match(name_re, mention_text)
+            if name_syntax_match:
+                full_names.add(name_syntax_match.group("full_name").lower())
+            else:
+                full_names.add(mention_text.lower())
+
+        return [row for full_name in full_names
+                for row in self.users_by_name.get(full_name, [])]
+
+    def user_group_name_info(self, user_group_names: Set[str]) -> Dict[str, UserGroup]:
+        return {name.lower(): self.user_groups_by_name[name]
+                for name in user_group_names if name in self.user_groups_by_name}
+
+mention_indexes: LRUCache[int, Tuple[str, MentionIndex]] = LRUCache(MAX_CACHED_MARKDOWN_REALMS)
+
+def get_mention_index_version(realm_id: int) -> Optional[str]:
+    """Returns the realm's current mention index version, which is
+    replaced whenever the realm's users' names or its user groups
+    change (see flush_realm_mention_index)."""
+    return get_or_create_version_token(realm_mention_index_version_cache_key(realm_id),
+                                       MENTION_INDEX_VERSION_TIMEOUT)
+
+def get_mention_index(realm_id: int) -> MentionIndex:
+    # We fetch the version before building the index, so that a change
+    # made while we build it replaces the version we store it under.
+    version = get_mention_index_version(realm_id)
+    cached = mention_indexes.get(realm_id)
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1]
+    index = MentionIndex(realm_id)
+    if version is not None:
+        mention_indexes.set(realm_id, (version, index))
+    return index
+
 def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[FullNameInfo]:
     if not mention_texts:
         return list()
-
-    # Remove the trailing part of the `name|id` mention syntax,
-    # thus storing only full names in full_names.
-    full_names = set()
-    name_re = r'(?P<full_name>.+)\|\d+$'
-    for mention_text in mention_texts:
-        name_syntax_match = re.match(name_re, mention_text)
-        if name_syntax_match:
-            full_names.add(name_syntax_match.group("full_name"))
-        else:
-            full_names.add(mention_text)
-
-    q_list = {
-        Q(full_name__iexact=full_name)
-        for full_name in full_names
-    }
-
-    rows = UserProfile.objects.filter(
-        realm_id=realm_id,
-        is_active=True,
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'full_name',
-        'email',
-    )
-    return list(rows)
+    return get_mention_index(realm_id).possible_mentions_info(mention_texts)
 
 class MentionData:
     def __init__(self, realm_id: int, content: str) -> None:
         mention_texts, has_wildcards = possible_mentions(content)
-        possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
+        user_group_names = possible_user_group_mentions(content)
+        possible_mentions_info: List[FullNameInfo] = []
+        self.user_group_name_info: Dict[str, UserGroup] = {}
+        self.user_group_members: Dict[int, List[int]] = {}
+        # Only messages that might mention someone need the index.
+        if mention_texts or user_group_names:
+            index = get_mention_index(realm_id)
+            possible_mentions_info = index.possible_mentions_info(mention_texts)
+            self.user_group_name_info = index.user_group_name_info(user_group_names)
+            self.user_group_members = index.user_group_members
         self.full_name_info = {
             row['full_name'].lower(): row
             for row in possible_mentions_info
@@ -2150,31 +2331,11 @@ class MentionData:
             row['id']: row
             for row in possible_mentions_info
         }
-        self.init_user_group_data(realm_id=realm_id, content=content)
         self.has_wildcards = has_wildcards
 
     def message_has_wildcards(self) -> bool:
         return self.has_wildcards
 
-    def init_user_group_data(self,
-                             realm_id: int,
-                             content: str) -> None:
-        user_group_names = possible_user_group_mentions(content)
-        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
-        self.user_group_members: Dict[int, List[int]] = defaultdict(list)
-        group_ids = [group.id for group in self.user_group_name_info.values()]
-
-        if not group_ids:
-            # Early-return to avoid the cost of hitting the ORM,
-            # which shows up in profiles.
-            return
-
-        membership = UserGroupMembership.objects.filter(user_group_id__in=group_ids)
-        for info in membership.values('user_group_id', 'user_profile_id'):
-            group_id = info['user_group_id']
-            user_profile_id = info['user_profile_id']
-            self.user_group_members[group_id].append(user_profile_id)
-
     def get_user_by_name(self, name: str) -> Optional[FullNameInfo]:
         # warning: get_user_by_name is not dependable if two
         # users of the same full name are mentioned. Use
@@ -2199,15 +2360,6 @@ class MentionData:
     def get_group_members(self, user_group_id: int) -> List[int]:
         return self.user_group_members.get(user_group_id, [])
 
-def get_user_group_name_info(realm_id: int, user_group_names: Set[str]) -> Dict[str, UserGroup]:
-    if not user_group_names:
-        return dict()
-
-    rows = UserGroup.objects.filter(realm_id=realm_id,
-                                    name__in=user_group_names)
-    dct = {row.name.lower(): row for row in rows}
-    return dct
-
 def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, FullNameInfo]:
     if not stream_names:
         return dict()
@@ -2233,16 +2385,132 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
     return dct
 
 
-def do_convert(content: str,
-               realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
-               message: Optional[Message]=None,
-               message_realm: Optional[Realm]=None,
-               sent_by_bot: bool=False,
-               translate_emoticons: bool=False,
-               mention_data: Optional[MentionData]=None,
-               email_gateway: bool=False,
-               no_previews: bool=False) -> str:
-    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+# Rendered content is cached (see do_convert) for at most this long,
+# since entries are keyed by content and so never invalidated.
+MARKDOWN_RENDER_CACHE_TIMEOUT = 3600 * 24
+
+def render_cache_possible(content: str,
+                          realm_alert_words_automaton: Optional[ahocorasick.Automaton]) -> bool:
+    """Whether rendering content can only depend on the inputs that are
+    part of markdown_render_cache_key, and not on users, user groups,
+    streams or alert words, which are looked up while rendering."""
+    mention_texts, mentions_wildcard = possible_mentions(content)
+    if mention_texts or mentions_wildcard or possible_user_group_mentions(content):
+        return False
+    if possible_linked_stream_names(content):
+        return False
+    if realm_alert_words_automaton is not None:
+        # The alert words found don't change the rendered content, but
+        # need to be recorded on the message, so we just render
+        # content containing anything that may be an alert word.
+        for _ in realm_alert_words_automaton.iter(content.lower()):
+            return False
+    return True
+
+def render_has_data_dependent_output(message: Message) -> bool:
+    if not hasattr(message, 'mentions_user_ids'):
+        # Not rendered via do_render_markdown, which sets these.
+        return True
+    return bool(message.mentions_wildcard or
+                message.mentions_user_ids or
+                message.mentions_user_group_ids or
+                message.user_ids_with_alert_words or
+                message.links_for_preview)
+
+def markdown_render_cache_key(content: str, for_message: bool,
+                              realm_filters_key: int,
+                              realm_filters: List[Tuple[str, str, int]], realm_uri: str,
+                              active_realm_emoji: Dict[str, Dict[str, Any]],
+                              email_gateway: bool, sent_by_bot: bool,
+                              translate_emoticons: bool, image_preview_enabled: bool,
+                              url_embed_preview_enabled: bool) -> str:
+    key_data = [
+        version,
+        content,
+        # Mentions and stream links are only rendered for messages.
+        for_message,
+        realm_filters_key,
+        realm_uri,
+        realm_filters,
+        # Only includes the emoji actually used by content, since we
+        # only fetch the realm's emoji when content has emoji syntax.
+        active_realm_emoji,
+        email_gateway,
+        sent_by_bot,
+        translate_emoticons,
+        image_preview_enabled,
+        url_embed_preview_enabled,
+    ]
+    digest = hashlib.sha1(ujson.dumps(key_data, sort_keys=True).encode()).hexdigest()
+    return f'rendered_markdown:{digest}'
+
+render_cache_hits = 0
+render_cache_misses = 0
+render_cache_time_saved = 0.0
+
+def get_render_cache_stats() -> Dict[str, Any]:
+    return {
+        'hits': render_cache_hits,
+        'misses': render_cache_misses,
+        'time_saved': render_cache_time_saved,
+    }
+
+def record_render_cache_hit(render_time: float) -> None:
+    global render_cache_hits
+    global render_cache_time_saved
+    render_cache_hits += 1
+    render_cache_time_saved += render_time
+    statsd.incr('markdown.render_cache.hit')
+    statsd.timing('markdown.render_cache.time_saved', render_time * 1000)
+
+def record_render_cache_miss() -> None:
+    global render_cache_misses
+    render_cache_misses += 1
+    statsd.incr('markdown.render_cache.miss')
+
+@dataclass
+class MarkdownRenderRequest:
+    """Everything needed to render some content with one of md_engines,
+    gathered (including any data from the database) by
+    prepare_markdown_render.  Requests can be pickled, so that they can
+    be rendered by a MarkdownRenderPool worker process."""
+    content: str
+    realm_filters_key: int
+    email_gateway: bool
+    realm_filters: List[Tuple[str, str, int]]
+    realm: Optional[Realm]
+    db_data: Optional[DbData]
+    image_preview_enabled: bool
+    url_embed_preview_enabled: bool
+    logging_message_id: str
+    render_cache_key: Optional[str] = None
+    # The version of the realm's alert word automaton in db_data, if
+    # known; see request_for_render_worker.
+    alert_words_version: Optional[str] = None
+    alert_words_automaton_omitted: bool = False
+
+# Spend at most this many seconds rendering a message; this protects
+# the backend from being overloaded by bugs (e.g. markdown logic that
+# is extremely inefficient in corner cases) as well as user errors
+# (e.g. a realm filter that makes some syntax infinite-loop).
+MARKDOWN_RENDER_TIMEOUT = 5
+
+# The attributes that rendering may set on the message being rendered.
+RENDERED_MESSAGE_ATTRIBUTES = [
+    'has_link', 'has_image', 'potential_attachment_path_ids', 'links_for_preview',
+    'mentions_wildcard', 'mentions_user_ids', 'mentions_user_group_ids',
+    'alert_words', 'user_ids_with_alert_words',
+]
+
+def prepare_markdown_render(content: str,
+                            realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
+                            message: Optional[Message]=None,
+                            message_realm: Optional[Realm]=None,
+                            sent_by_bot: bool=False,
+                            translate_emoticons: bool=False,
+                            mention_data: Optional[MentionData]=None,
+                            email_gateway: bool=False,
+                            no_previews: bool=False) -> MarkdownRenderRequest:
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
     # * message is passed, but no realm is -> look up realm from message
@@ -2267,28 +2535,7 @@ def do_convert(content: str,
                 # delivered via zephyr_mirror
                 realm_filters_key = ZEPHYR_MIRROR_MARKDOWN_KEY
 
-    maybe_update_markdown_engines(realm_filters_key, email_gateway)
-    md_engine_key = (realm_filters_key, email_gateway)
-
-    if md_engine_key in md_engines:
-        _md_engine = md_engines[md_engine_key]
-    else:
-        if DEFAULT_MARKDOWN_KEY not in md_engines:
-            maybe_update_markdown_engines(realm_filters_key=None, email_gateway=False)
-
-        _md_engine = md_engines[(DEFAULT_MARKDOWN_KEY, email_gateway)]
-    # Reset the parser; otherwise it will get slower over time.
-    _md_engine.reset()
-
-    # Filters such as UserMentionPattern need a message.
-    _md_engine.zulip_message = message
-    _md_engine.zulip_realm = message_realm
-    _md_engine.zulip_db_data = None  # for now
-    _md_engine.image_preview_enabled = image_preview_enabled(
-        message, message_realm, no_previews)
-    _md_engine.url_embed_preview_enabled = url_embed_preview_enabled(
-        message, message_realm, no_previews)
-
+    db_data: Optional[DbData] = None
     # Pre-fetch data from the DB that is used in the markdown thread
     if message_realm is not None:
 
@@ -2309,7 +2556,7 @@ def do_convert(content: str,
         else:
             active_realm_emoji = dict()
 
-        _md_engine.zulip_db_data = {
+        db_data = {
             'realm_alert_words_automaton': realm_alert_words_automaton,
             'mention_data': mention_data,
             'active_realm_emoji': active_realm_emoji,
@@ -2319,34 +2566,52 @@ def do_convert(content: str,
             'translate_emoticons': translate_emoticons,
         }
 
-    try:
-        # Spend at most 5 seconds rendering; this protects the backend
-        # from being overloaded by bugs (e.g. markdown logic that is
-        # extremely inefficient in corner cases) as well as user
-        # errors (e.g. a realm filter that makes some syntax
-        # infinite-loop).
-        rendered_content = timeout(5, _md_engine.convert, content)
-
-        # Throw an exception if the content is huge; this protects the
-        # rest of the codebase from any bugs where we end up rendering
-        # something huge.
-        if len(rendered_content) > MAX_MESSAGE_LENGTH * 10:
-            raise MarkdownRenderingException(
-                f'Rendered content exceeds {MAX_MESSAGE_LENGTH * 10} characters (message {logging_message_id})'
-            )
-        return rendered_content
-    except Exception:
-        cleaned = privacy_clean_markdown(content)
-        # NOTE: Don't change this message without also changing the
-        # logic in logging_handlers.py or we can create recursive
-        # exceptions.
-        markdown_logger.exception(
-            'Exception in Markdown parser; input (sanitized) was: %s\n (message %s)',
-            cleaned,
-            logging_message_id,
-        )
+    request = MarkdownRenderRequest(
+        content=content,
+        realm_filters_key=realm_filters_key,
+        email_gateway=email_gateway,
+        realm_filters=get_realm_filters(realm_filters_key),
+        realm=message_realm,
+        db_data=db_data,
+        image_preview_enabled=image_preview_enabled(message, message_realm, no_previews),
+        url_embed_preview_enabled=url_embed_preview_enabled(message, message_realm, no_previews),
+        logging_message_id=logging_message_id,
+    )
+    if message_realm is not None and realm_alert_words_automaton is not None:
+        request.alert_words_version = get_alert_word_automaton_version(
+            message_realm.id, realm_alert_words_automaton)
+
+    # Bots and integrations often send identical content over and
+    # over, and re-rendering a realm renders most messages again
+    # unchanged, so we cache content whose rendering doesn't depend on
+    # any of the realm's data beyond what's in the key.
+    if (settings.MARKDOWN_RENDER_CACHE and db_data is not None and
+            render_cache_possible(content, realm_alert_words_automaton)):
+        request.render_cache_key = markdown_render_cache_key(
+            content, message is not None, realm_filters_key, request.realm_filters,
+            db_data['realm_uri'],
+            db_data['active_realm_emoji'], email_gateway, sent_by_bot,
+            translate_emoticons, request.image_preview_enabled,
+            request.url_embed_preview_enabled)
+    return request
+
+def run_md_engine(request: MarkdownRenderRequest, message: Optional[Message],
+                  render_timeout: Optional[float]) -> str:
+    _md_engine = get_md_engine(request.realm_filters_key, request.email_gateway,
+                               request.realm_filters)
+    # Reset the parser; otherwise it will get slower over time.
+    _md_engine.reset()
 
-        raise MarkdownRenderingException()
+    # Filters such as UserMentionPattern need a message.
+    _md_engine.zulip_message = message
+    _md_engine.zulip_realm = request.realm
+    _md_engine.zulip_db_data = request.db_data
+    _md_engine.image_preview_enabled = request.image_preview_enabled
+    _md_engine.url_embed_preview_enabled = request.url_embed_preview_enabled
+    try:
+        if render_timeout is None:
+            return _md_engine.convert(request.content)
+        return timeout(render_timeout, _md_engine.convert, request.content)
     finally:
         # These next three lines are slightly paranoid, since
         # we always set these right before actually using the
@@ -2355,6 +2620,207 @@ def do_convert(content: str,
         _md_engine.zulip_realm = None
         _md_engine.zulip_db_data = None
 
+def request_for_render_worker(request: MarkdownRenderRequest,
+                              omit_alert_words_automaton: bool=True) -> MarkdownRenderRequest:
+    """Returns a copy of the request to send to a MarkdownRenderPool
+    worker, leaving out data that can be large: the realm's user group
+    memberships, which are only used after rendering, and its alert
+    word automaton, which the worker keeps by version (see
+    fill_in_render_worker_request)."""
+    if request.db_data is None:
+        return request
+    request = copy.copy(request)
+    assert request.db_data is not None
+    request.db_data = dict(request.db_data)
+    mention_data = copy.copy(request.db_data['mention_data'])
+    mention_data.user_group_members = {}
+    request.db_data['mention_data'] = mention_data
+    if omit_alert_words_automaton and request.alert_words_version is not None:
+        request.db_data['realm_alert_words_automaton'] = None
+        request.alert_words_automaton_omitted = True
+    return request
+
+class WorkerCachedDataMissing(Exception):
+    """Raised in a MarkdownRenderPool worker that was sent a request
+    without the realm's alert word automaton, when it doesn't have the
+    automaton's current version cached."""
+
+# In a MarkdownRenderPool worker, the alert word automatons of the
+# realms it has rendered for, by realm ID, with their versions.
+worker_alert_word_automatons: LRUCache[int, Tuple[str, ahocorasick.Automaton]] = LRUCache(
+    MAX_CACHED_MARKDOWN_REALMS)
+
+def fill_in_render_worker_request(request: MarkdownRenderRequest) -> None:
+    """In a MarkdownRenderPool worker, fills in the alert word automaton
+    that request_for_render_worker left out of the request from the
+    worker's cache, or caches the automaton the request was sent with."""
+    if request.db_data is None or request.alert_words_version is None:
+        return
+    assert request.realm is not None
+    if not request.alert_words_automaton_omitted:
+        worker_alert_word_automatons.set(request.realm.id, (
+            request.alert_words_version, request.db_data['realm_alert_words_automaton']))
+        return
+    cached = worker_alert_word_automatons.get(request.realm.id)
+    if cached is None or cached[0] != request.alert_words_version:
+        raise WorkerCachedDataMissing()
+    request.db_data['realm_alert_words_automaton'] = cached[1]
+
+def render_in_worker_process(request: MarkdownRenderRequest,
+                             message_attributes: Optional[Dict[str, Any]],
+                             ) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Renders a request in a MarkdownRenderPool worker, which can't
+    use the database, and so is sent the realm's filters and the
+    message's attributes by the process that prepared the request.
+    Returns the rendered content and the message's attributes after
+    rendering."""
+    fill_in_render_worker_request(request)
+    message = None
+    if message_attributes is not None:
+        message = Message()
+        for attribute, value in message_attributes.items():
+            setattr(message, attribute, value)
+    rendered_content = run_md_engine(request, message, None)
+    if message is None:
+        return rendered_content, None
+    return rendered_content, {attribute: getattr(message, attribute)
+                              for attribute in RENDERED_MESSAGE_ATTRIBUTES
+                              if hasattr(message, attribute)}
+
+def render_markdown_request(request: MarkdownRenderRequest, message: Optional[Message],
+                            render_processes: Optional[int]=None) -> str:
+    if render_processes is None:
+        render_processes = settings.MARKDOWN_RENDER_PROCESSES
+    if not render_processes:
+        return run_md_engine(request, message, MARKDOWN_RENDER_TIMEOUT)
+
+    from zerver.lib.markdown.render_pool import get_render_pool
+    message_attributes = None
+    if message is not None:
+        message_attributes = {attribute: getattr(message, attribute)
+                              for attribute in RENDERED_MESSAGE_ATTRIBUTES
+                              if hasattr(message, attribute)}
+    rendered_content, rendered_attributes = get_render_pool(render_processes).render(
+        request, message_attributes)
+    if message is not None:
+        assert rendered_attributes is not None
+        for attribute, value in rendered_attributes.items():
+            setattr(message, attribute, value)
+    return rendered_content
+
+def get_cached_render(request: MarkdownRenderRequest, message: Optional[Message]) -> Optional[str]:
+    if request.render_cache_key is None:
+        return None
+    cached = cache_get(request.render_cache_key)
+    if cached is None:
+        record_render_cache_miss()
+        return None
+    render = cached[0]
+    if message is not None:
+        message.has_link = render['has_link']
+        message.has_image = render['has_image']
+        message.potential_attachment_path_ids = render['potential_attachment_path_ids']
+    record_render_cache_hit(render['render_time'])
+    return render['rendered_content']
+
+def check_rendered_content(request: MarkdownRenderRequest, message: Optional[Message],
+                           rendered_content: str, render_time: float) -> None:
+    # Throw an exception if the content is huge; this protects the
+    # rest of the codebase from any bugs where we end up rendering
+    # something huge.
+    if len(rendered_content) > MAX_MESSAGE_LENGTH * 10:
+        raise MarkdownRenderingException(
+            f'Rendered content exceeds {MAX_MESSAGE_LENGTH * 10} characters (message {request.logging_message_id})'
+        )
+
+    if request.render_cache_key is not None and (message is None or
+                                                 not render_has_data_dependent_output(message)):
+        cache_set(request.render_cache_key, {
+            'rendered_content': rendered_content,
+            'render_time': render_time,
+            'has_link': getattr(message, 'has_link', False),
+            'has_image': getattr(message, 'has_image', False),
+            'potential_attachment_path_ids': getattr(message, 'potential_attachment_path_ids', []),
+        }, timeout=MARKDOWN_RENDER_CACHE_TIMEOUT)
+
+def log_markdown_exception(request: MarkdownRenderRequest) -> None:
+    cleaned = privacy_clean_markdown(request.content)
+    # NOTE: Don't change this message without also changing the
+    # logic in logging_handlers.py or we can create recursive
+    # exceptions.
+    markdown_logger.exception(
+        'Exception in Markdown parser; input (sanitized) was: %s\n (message %s)',
+        cleaned,
+        request.logging_message_id,
+    )
+
+def do_convert(content: str,
+               realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
+               message: Optional[Message]=None,
+               message_realm: Optional[Realm]=None,
+               sent_by_bot: bool=False,
+               translate_emoticons: bool=False,
+               mention_data: Optional[MentionData]=None,
+               email_gateway: bool=False,
+               no_previews: bool=False,
+               render_processes: Optional[int]=None) -> str:
+    """Convert Markdown to HTML, with Zulip-specific settings and hacks.
+    render_processes overrides MARKDOWN_RENDER_PROCESSES."""
+    request = prepare_markdown_render(content, realm_alert_words_automaton, message,
+                                      message_realm, sent_by_bot, translate_emoticons,
+                                      mention_data, email_gateway, no_previews)
+    return convert_markdown_request(request, message, render_processes)
+
+def convert_markdown_request(request: MarkdownRenderRequest, message: Optional[Message],
+                             render_processes: Optional[int]=None) -> str:
+    cached_content = get_cached_render(request, message)
+    if cached_content is not None:
+        return cached_content
+
+    try:
+        render_start = time.time()
+        rendered_content = render_markdown_request(request, message, render_processes)
+        check_rendered_content(request, message, rendered_content, time.time() - render_start)
+        return rendered_content
+    except Exception:
+        log_markdown_exception(request)
+        raise MarkdownRenderingException()
+
+def bulk_markdown_convert(requests: List[MarkdownRenderRequest]) -> List[Optional[str]]:
+    """Renders requests prepared (by prepare_markdown_render) without
+    a message, in parallel if MARKDOWN_RENDER_PROCESSES is set.  The
+    result for a request that failed to render is None."""
+    results: List[Optional[str]] = []
+    if not settings.MARKDOWN_RENDER_PROCESSES:
+        for request in requests:
+            try:
+                results.append(convert_markdown_request(request, None))
+            except MarkdownRenderingException:
+                results.append(None)
+        return results
+
+    from zerver.lib.markdown.render_pool import get_render_pool
+    uncached_requests = []
+    for request in requests:
+        results.append(get_cached_render(request, None))
+        if results[-1] is None:
+            uncached_requests.append((len(results) - 1, request))
+
+    render_start = time.time()
+    rendered = get_render_pool().render_many([(request, None) for _, request in uncached_requests])
+    # The requests were rendered in parallel, so we don't know how
+    # long each took; we charge each the average.
+    render_time = (time.time() - render_start) / max(len(uncached_requests), 1)
+    for (index, request), result in zip(uncached_requests, rendered):
+        try:
+            if isinstance(result, BaseException):
+                raise result
+            check_rendered_content(request, None, result[0], render_time)
+            results[index] = result[0]
+        except Exception:
+            log_markdown_exception(request)
+    return results
+
 markdown_time_start = 0.0
 markdown_total_time = 0.0
 markdown_total_requests = 0
@@ -2384,11 +2850,12 @@ def markdown_convert(content: str,
                      translate_emoticons: bool=False,
                      mention_data: Optional[MentionData]=None,
                      email_gateway: bool=False,
-                     no_previews: bool=False) -> str:
+                     no_previews: bool=False,
+                     render_processes: Optional[int]=None) -> str:
     markdown_stats_start()
     ret = do_convert(content, realm_alert_words_automaton,
                      message, message_realm, sent_by_bot,
                      translate_emoticons, mention_data, email_gateway,
-                     no_previews=no_previews)
+                     no_previews=no_previews, render_processes=render_processes)
     markdown_stats_finish()
     return ret
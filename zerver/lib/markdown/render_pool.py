@@ -0,0 +1,188 @@
+"""A pool of worker processes for rendering markdown.
+
+By default, do_convert renders in the calling process, with a thread
+per message so that zerver.lib.timeout can interrupt a runaway render
+by raising an exception asynchronously in that thread.  That can leave
+the shared markdown engine in an undefined state, and fails to
+interrupt code stuck in C (e.g. a pathological regular expression).
+
+When MARKDOWN_RENDER_PROCESSES is set, rendering is instead done by a
+pool of that many worker processes, each of which keeps its own
+md_engines for the realms it has rendered for.  A render that takes
+longer than MARKDOWN_RENDER_TIMEOUT is stopped by killing its worker,
+which is replaced when its slot in the pool is next used.  Bulk jobs
+can use render_many to render on every worker at once.
+
+Workers are started with the "spawn" method, so that they share no
+database or memcached connections with the process that started them;
+everything they need is sent to them in a MarkdownRenderRequest.  The
+realm's alert word automaton, which can be large, is sent only when the
+worker doesn't already have its current version (see
+request_for_render_worker).
+"""
+import multiprocessing
+import os
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+from django.conf import settings
+
+from zerver.lib.exceptions import MarkdownRenderingException
+from zerver.lib.timeout import TimeoutExpired
+
+if TYPE_CHECKING:
+    from zerver.lib.markdown import MarkdownRenderRequest
+
+RenderResult = Tuple[str, Optional[Dict[str, Any]]]
+RenderJob = Tuple['MarkdownRenderRequest', Optional[Dict[str, Any]]]
+
+# How long a newly started worker has to set up Django and be ready.
+WORKER_STARTUP_TIMEOUT = 60
+
+def render_worker(connection: Connection) -> None:  # nocoverage # runs in the worker
+    import django
+    django.setup()
+
+    from zerver.lib.markdown import (
+        DEFAULT_MARKDOWN_KEY,
+        WorkerCachedDataMissing,
+        get_md_engine,
+        render_in_worker_process,
+    )
+
+    # Pre-warm the worker by building the default engine, which
+    # imports and compiles everything rendering needs.
+    get_md_engine(DEFAULT_MARKDOWN_KEY, False, [])
+    connection.send('ready')
+
+    while True:
+        try:
+            request, message_attributes = connection.recv()
+        except EOFError:
+            # The process that started us has gone away.
+            return
+        try:
+            connection.send(('ok', render_in_worker_process(request, message_attributes)))
+        except WorkerCachedDataMissing:
+            connection.send(('missing', None))
+        except Exception as e:
+            connection.send(('error', f'{type(e).__name__}: {e}'))
+
+class RenderWorker:
+    def __init__(self) -> None:
+        context = multiprocessing.get_context('spawn')
+        # Under uwsgi, sys.executable is uwsgi itself.
+        context.set_executable(os.path.join(sys.prefix, 'bin', 'python3'))
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=render_worker, args=(child_connection,),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        if not self.connection.poll(WORKER_STARTUP_TIMEOUT):
+            self.stop()
+            raise MarkdownRenderingException('Markdown render worker failed to start')
+        self.connection.recv()
+
+    def send(self, job: RenderJob, timeout: float) -> Tuple[str, Any]:
+        self.connection.send(job)
+        if not self.connection.poll(timeout):
+            raise TimeoutExpired()
+        return self.connection.recv()
+
+    def render(self, job: RenderJob, timeout: float) -> Tuple[str, Any]:
+        from zerver.lib.markdown import request_for_render_worker
+        request, message_attributes = job
+        status, result = self.send((request_for_render_worker(request), message_attributes),
+                                   timeout)
+        if status == 'missing':
+            # The worker doesn't have the realm's current alert word
+            # automaton yet; send the request with it.
+            status, result = self.send(
+                (request_for_render_worker(request, omit_alert_words_automaton=False),
+                 message_attributes),
+                timeout)
+        return status, result
+
+    def stop(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+class MarkdownRenderPool:
+    def __init__(self, processes: int, timeout: float) -> None:
+        self.processes = processes
+        self.timeout = timeout
+        # Each of the pool's slots holds a worker, or None if its worker
+        # was stopped and has yet to be replaced.
+        self.idle_workers: "queue.Queue[Optional[RenderWorker]]" = queue.Queue()
+        for i in range(processes):
+            self.idle_workers.put(RenderWorker())
+
+    def render(self, request: 'MarkdownRenderRequest',
+               message_attributes: Optional[Dict[str, Any]]) -> RenderResult:
+        """Renders the request in the next idle worker, raising
+        TimeoutExpired if it takes too long.  Safe to call from several
+        threads at once."""
+        worker = self.idle_workers.get()
+        if worker is None:
+            try:
+                worker = RenderWorker()
+            except BaseException:
+                self.idle_workers.put(None)
+                raise
+        try:
+            status, result = worker.render((request, message_attributes), self.timeout)
+        except BaseException:
+            # The worker is wedged, dead, or has a response to this
+            # request still pending; in any case, it's replaced the
+            # next time its slot is used.
+            worker.stop()
+            self.idle_workers.put(None)
+            raise
+        self.idle_workers.put(worker)
+        if status == 'error':
+            raise MarkdownRenderingException(result)
+        return result
+
+    def render_or_exception(self, job: RenderJob) -> Union[RenderResult, Exception]:
+        try:
+            return self.render(*job)
+        except Exception as e:
+            return e
+
+    def render_many(self, jobs: List[RenderJob]) -> List[Union[RenderResult, Exception]]:
+        """Renders the jobs on all the workers at once, returning the
+        result, or the exception raised, for each job in order."""
+        with ThreadPoolExecutor(max_workers=self.processes) as executor:
+            return list(executor.map(self.render_or_exception, jobs))
+
+    def stop(self) -> None:
+        for i in range(self.processes):
+            worker = self.idle_workers.get()
+            if worker is not None:
+                worker.stop()
+
+render_pool: Optional[MarkdownRenderPool] = None
+render_pool_pid: Optional[int] = None
+
+def get_render_pool(processes: Optional[int]=None) -> MarkdownRenderPool:
+    """Returns this process's render pool of `processes` workers
+    (by default, MARKDOWN_RENDER_PROCESSES), starting it if needed.  A
+    forked child starts its own pool, since the workers' pipes belong
+    to its parent."""
+    global render_pool
+    global render_pool_pid
+    if processes is None:
+        processes = settings.MARKDOWN_RENDER_PROCESSES
+    if render_pool is not None and render_pool_pid == os.getpid() and \
+            render_pool.processes != processes:
+        render_pool.stop()
+        render_pool = None
+    if render_pool is None or render_pool_pid != os.getpid():
+        from zerver.lib.markdown import MARKDOWN_RENDER_TIMEOUT
+        render_pool = MarkdownRenderPool(processes, MARKDOWN_RENDER_TIMEOUT)
+        render_pool_pid = os.getpid()
+    return render_pool
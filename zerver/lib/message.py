@@ -1,12 +1,13 @@
 import copy
 import datetime
 import zlib
-from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
 
 import ahocorasick
 import ujson
-from django.db import connection
-from django.db.models import Sum
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import ugettext as _
 from psycopg2.sql import SQL
@@ -15,6 +16,8 @@ from typing_extensions import TypedDict
 from analytics.lib.counts import COUNT_STATS, RealmCount
 from zerver.lib.avatar import get_avatar_field
 from zerver.lib.cache import (
+    cache_get_many,
+    cache_set_many,
     cache_with_key,
     generic_bulk_cached_fetch,
     to_dict_cache_key,
@@ -25,6 +28,7 @@ from zerver.lib.display_recipient import (
     UserDisplayRecipient,
     bulk_fetch_display_recipients,
 )
+from zerver.lib.exceptions import MarkdownRenderingException
 from zerver.lib.markdown import MentionData, markdown_convert, topic_links
 from zerver.lib.markdown import version as markdown_version
 from zerver.lib.request import JsonableError
@@ -153,11 +157,58 @@ def sew_messages_and_submessages(messages: List[Dict[str, Any]],
             message = message_dict[message_id]
             message['submessages'].append(submessage)
 
+class MessageCacheCodec:
+    """A serialization format for the message to_dict cache.
+
+    Each encoded message starts with the codec's one-byte tag, so that
+    we can change the codec used for new cache entries without
+    invalidating the entries already in memcached."""
+    def __init__(self, name: str, tag: bytes,
+                 compress: Callable[[bytes], bytes],
+                 decompress: Callable[[bytes], bytes]) -> None:
+        assert len(tag) == 1
+        self.name = name
+        self.tag = tag
+        self.compress = compress
+        self.decompress = decompress
+
+    def encode(self, data: bytes) -> bytes:
+        return self.tag + self.compress(data)
+
+    def decode(self, data: bytes) -> bytes:
+        return self.decompress(data[1:])
+
+MESSAGE_CACHE_CODECS: Dict[str, MessageCacheCodec] = {
+    codec.name: codec for codec in [
+        MessageCacheCodec('json', b'\x01', lambda data: data, lambda data: data),
+        MessageCacheCodec('zlib', b'\x02',
+                          lambda data: zlib.compress(data, settings.MESSAGE_CACHE_COMPRESSION_LEVEL),
+                          zlib.decompress),
+    ]
+}
+MESSAGE_CACHE_CODECS_BY_TAG: Dict[bytes, MessageCacheCodec] = {
+    codec.tag: codec for codec in MESSAGE_CACHE_CODECS.values()
+}
+
+def get_message_cache_codec(payload_size: int) -> MessageCacheCodec:
+    # Compressing small messages costs CPU time but saves very little
+    # memcached space, since most of a short message dictionary is
+    # field names and IDs that zlib can't do much with.
+    if payload_size < settings.MESSAGE_CACHE_COMPRESSION_THRESHOLD:
+        return MESSAGE_CACHE_CODECS['json']
+    return MESSAGE_CACHE_CODECS[settings.MESSAGE_CACHE_CODEC]
+
 def extract_message_dict(message_bytes: bytes) -> Dict[str, Any]:
-    return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+    codec = MESSAGE_CACHE_CODECS_BY_TAG.get(message_bytes[:1])
+    if codec is None:
+        # Entries written before we tagged cache entries with their
+        # codec are untagged zlib streams.
+        return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+    return ujson.loads(codec.decode(message_bytes).decode("utf-8"))
 
 def stringify_message_dict(message_dict: Dict[str, Any]) -> bytes:
-    return zlib.compress(ujson.dumps(message_dict).encode())
+    data = ujson.dumps(message_dict).encode()
+    return get_message_cache_codec(len(data)).encode(data)
 
 @cache_with_key(to_dict_cache_key, timeout=3600*24)
 def message_to_dict_json(message: Message, realm_id: Optional[int]=None) -> bytes:
@@ -170,6 +221,70 @@ def save_message_rendered_content(message: Message, content: str) -> str:
     message.save_rendered_content()
     return rendered_content
 
+def stale_rendered_content_query() -> Q:
+    return (Q(rendered_content__isnull=True) |
+            Q(rendered_content_version__isnull=True) |
+            Q(rendered_content_version__lt=markdown_version))
+
+def rerender_stale_messages(min_id: int, max_id: int,
+                            render_processes: Optional[int]=None) -> Tuple[int, int]:
+    """Re-renders the messages with IDs from min_id to max_id whose
+    rendered content is older than the current markdown version, as
+    build_message_dict would when fetching them, and updates any copies
+    in the to_dict cache.  Returns the number of messages re-rendered
+    and the number that failed to render.  render_processes is passed
+    on to render_markdown.
+
+    Used by the rerender_messages management command to re-render
+    historical messages after a markdown version bump."""
+    messages = Message.objects.filter(
+        id__gte=min_id,
+        id__lte=max_id,
+    ).filter(stale_rendered_content_query()).select_related('sender__realm', 'sending_client')
+
+    rendered_messages = []
+    failures = 0
+    for message in messages:
+        try:
+            message.rendered_content = render_markdown(message, message.content,
+                                                       realm=message.get_realm(),
+                                                       render_processes=render_processes)
+        except MarkdownRenderingException:
+            failures += 1
+            continue
+        message.rendered_content_version = markdown_version
+        rendered_messages.append(message)
+
+    # A message edited while we were rendering already has a fresh
+    # rendering, which we mustn't overwrite with one of its old
+    # content; so we lock the batch, and only save the messages which
+    # are unchanged.
+    with transaction.atomic():
+        current = {
+            message_id: (content, last_edit_time)
+            for message_id, content, last_edit_time in Message.objects.select_for_update().filter(
+                id__in=[message.id for message in rendered_messages],
+            ).values_list('id', 'content', 'last_edit_time')
+        }
+        rendered_messages = [message for message in rendered_messages
+                             if current.get(message.id) == (message.content, message.last_edit_time)]
+        Message.objects.bulk_update(rendered_messages,
+                                    ['rendered_content', 'rendered_content_version'])
+
+    # We only refresh the messages that are already cached; caching
+    # the rest would just evict messages that are actually being read.
+    cached = cache_get_many([to_dict_cache_key_id(message.id) for message in rendered_messages])
+    cached_ids = [message.id for message in rendered_messages
+                  if to_dict_cache_key_id(message.id) in cached]
+    if cached_ids:
+        cache_set_many({
+            to_dict_cache_key_id(row['id']): (
+                stringify_message_dict(MessageDict.build_dict_from_raw_db_row(row)),
+            )
+            for row in MessageDict.get_raw_db_rows(cached_ids)
+        }, timeout=3600*24)
+    return len(rendered_messages), failures
+
 class MessageDict:
     @staticmethod
     def wide_dict(message: Message, realm_id: Optional[int]=None) -> Dict[str, Any]:
@@ -656,7 +771,8 @@ def render_markdown(message: Message,
                     realm: Optional[Realm]=None,
                     realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                     mention_data: Optional[MentionData]=None,
-                    email_gateway: bool=False) -> str:
+                    email_gateway: bool=False,
+                    render_processes: Optional[int]=None) -> str:
     '''
     This is basically just a wrapper for do_render_markdown.
     '''
@@ -677,6 +793,7 @@ def render_markdown(message: Message,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        render_processes=render_processes,
     )
 
     return rendered_content
@@ -688,7 +805,8 @@ def do_render_markdown(message: Message,
                        translate_emoticons: bool,
                        realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                        mention_data: Optional[MentionData]=None,
-                       email_gateway: bool=False) -> str:
+                       email_gateway: bool=False,
+                       render_processes: Optional[int]=None) -> str:
     """Return HTML for given markdown. Markdown may add properties to the
     message object such as `mentions_user_ids`, `mentions_user_group_ids`, and
     `mentions_wildcard`.  These are only on this Django object and are not
@@ -712,6 +830,7 @@ def do_render_markdown(message: Message,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        render_processes=render_processes,
     )
     return rendered_content
 
@@ -1,10 +1,18 @@
 import errno
+import itertools
+import logging
 import os
 import pty
 import sys
-from typing import Callable, Dict, Iterable, Iterator, Tuple, TypeVar
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, TypeVar, cast
+
+import pylibmc
+from django.core.cache import cache
+from django.db import connection
 
 JobData = TypeVar('JobData')
+JobResult = TypeVar('JobResult')
 
 def run_parallel(job: Callable[[JobData], int],
                  data: Iterable[JobData],
@@ -52,6 +60,98 @@ def run_parallel(job: Callable[[JobData], int],
             else:
                 raise
 
+def run_with_retries(job: Callable[[JobData], JobResult], item: JobData,
+                     retries: int) -> Tuple[JobData, Optional[JobResult], Optional[str]]:
+    for attempt in range(1, retries + 2):
+        try:
+            return item, job(item), None
+        except Exception as e:
+            logging.warning("Attempt %s at %s failed", attempt, item, exc_info=True)
+            error = f"{type(e).__name__}: {e}"
+    return item, None, error
+
+# The job of the run_parallel_queue call whose pool this process is a
+# worker in.  The workers are forked after it is set, so they inherit
+# it, and jobs needn't be picklable.
+queue_job: Optional[Callable[[Any], Any]] = None
+queue_job_retries = 0
+
+def run_queue_job(item: Any) -> Tuple[Any, Any, Optional[str]]:  # nocoverage # runs in the workers
+    assert queue_job is not None
+    return run_with_retries(queue_job, item, queue_job_retries)
+
+def close_connections_before_fork() -> None:
+    # Close our database and memcached connections, so that the
+    # forked workers open their own rather than sharing our sockets;
+    # Django and pylibmc transparently reopen them as needed.
+    connection.close()
+    client = cache._cache  # type: ignore[attr-defined] # not in stubs
+    if isinstance(client, pylibmc.Client):  # nocoverage # tests use the local-memory cache
+        client.disconnect_all()
+
+def run_parallel_queue(job: Callable[[JobData], JobResult],
+                       data: Iterable[JobData],
+                       processes: int,
+                       retries: int=2) -> Iterator[Tuple[JobData, JobResult]]:
+    """Runs job on each item of data in a pool of forked worker
+    processes, yielding (item, result) as each one finishes.  Unlike
+    run_parallel, the workers stay up, and each takes the next item from
+    a shared queue as soon as it is done with the last one, so a few
+    slow items can't hold up the rest.
+
+    A job that raises is retried up to `retries` more times; after
+    that, we raise, stopping the pool.  If a worker process dies, we
+    raise BrokenProcessPool.  The items and results are
+    pickled, but the job isn't, so it can be a closure.  With one
+    process, the jobs are just run in this one."""
+    global queue_job, queue_job_retries
+
+    if processes == 1:
+        results: Iterator[Tuple[JobData, Optional[JobResult], Optional[str]]] = (
+            run_with_retries(job, item, retries) for item in data)
+        yield from check_queue_results(results, retries)
+        return
+
+    close_connections_before_fork()
+    queue_job, queue_job_retries = job, retries
+    try:
+        # On Linux, ProcessPoolExecutor forks its workers (Python 3.6
+        # has no mp_context argument to ask for that explicitly).
+        # Unlike multiprocessing.Pool, if a worker dies, say because
+        # it was OOM-killed, it raises BrokenProcessPool, rather than
+        # waiting forever for the lost result.
+        with ProcessPoolExecutor(processes) as executor:  # nocoverage
+            yield from check_queue_results(run_in_executor(executor, data, processes), retries)
+    finally:
+        queue_job = None
+
+def run_in_executor(executor: ProcessPoolExecutor, data: Iterable[Any],
+                    processes: int) -> Iterator[Tuple[Any, Any, Optional[str]]]:  # nocoverage
+    # Only a few items per worker are queued at a time, so that the
+    # workers can start before all of data has been read.
+    pending: Dict[Future[Tuple[Any, Any, Optional[str]]], Any] = {}
+    items = iter(data)
+    try:
+        while True:
+            for item in itertools.islice(items, 2 * processes - len(pending)):
+                pending[executor.submit(run_queue_job, item)] = item
+            if not pending:
+                break
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                del pending[future]
+                yield future.result()
+    finally:
+        # If we're stopping early, don't wait for the queued items.
+        for future in pending:
+            future.cancel()
+
+def check_queue_results(results: Iterator[Tuple[JobData, Optional[JobResult], Optional[str]]],
+                        retries: int) -> Iterator[Tuple[JobData, JobResult]]:
+    for item, result, error in results:
+        if error is not None:
+            raise Exception(f"Failed to process {item} after {retries + 1} attempts: {error}")
+        yield item, cast(JobResult, result)
+
 if __name__ == "__main__":
     # run some unit tests
     import time
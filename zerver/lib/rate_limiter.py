@@ -1,10 +1,14 @@
-import logging
+import fcntl
+import hashlib
+import mmap
 import os
+import struct
+import threading
 import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Tuple, Type
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Type, Union
 
-import redis
 from django.conf import settings
 from django.http import HttpRequest
 
@@ -13,25 +17,17 @@ from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.utils import statsd
 from zerver.models import UserProfile
 
-# Implement a rate-limiting scheme inspired by the one described here, but heavily modified
-# https://www.domaintools.com/resources/blog/rate-limiting-with-redis
-
 client = get_redis_client()
 rules: Dict[str, List[Tuple[int, int]]] = settings.RATE_LIMITING_RULES
 
 KEY_PREFIX = ''
 
-logger = logging.getLogger(__name__)
-
-class RateLimiterLockingException(Exception):
-    pass
-
 class RateLimitedObject(ABC):
     def __init__(self, backend: Optional['Type[RateLimiterBackend]']=None) -> None:
         if backend is not None:
             self.backend: Type[RateLimiterBackend] = backend
         else:
-            self.backend = RedisRateLimiterBackend
+            self.backend = default_backend()
 
     def rate_limit(self) -> Tuple[bool, float]:
         # Returns (ratelimited, secs_to_freedom)
@@ -289,16 +285,69 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
 
         return ratelimited, time_till_free
 
+# The Redis backend applies the same rules as the Tornado backend: for
+# each (time_window, max_count) rule, an entity's "theoretical arrival
+# time" (TAT) advances by time_window / max_count with every request it
+# makes, and requests are refused while that would put it more than
+# time_window in the future (the generic cell rate algorithm).  This
+# script checks every rule, and records the request if none of them
+# refuse it, in one atomic call.  Times are integer microseconds, on
+# the clock of the process making the request, so that they are exact
+# in Lua's floating-point numbers.
+#
+# KEYS: the entity's TAT hash, and its manual block key.
+# ARGV: now, then (field, time_window, interval) for each rule.
+# Returns {ratelimited, time until free (microseconds, as a string)}.
+RATE_LIMIT_SCRIPT = """
+local block_ttl = redis.call('PTTL', KEYS[2])
+if block_ttl ~= -2 then
+    if block_ttl == -1 then
+        -- A block key without an expiry; this should never happen.
+        block_ttl = 500
+    end
+    return {1, string.format('%.0f', block_ttl * 1000)}
+end
+
+local now = tonumber(ARGV[1])
+local updates = {}
+local max_tat = now
+for i = 2, #ARGV, 3 do
+    local tat = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+    local time_window = tonumber(ARGV[i + 1])
+    local new_tat = math.max(tat, now) + tonumber(ARGV[i + 2])
+    if new_tat > now + time_window then
+        return {1, string.format('%.0f', new_tat - time_window - now)}
+    end
+    table.insert(updates, ARGV[i])
+    table.insert(updates, string.format('%.0f', new_tat))
+    max_tat = math.max(max_tat, new_tat)
+end
+
+redis.call('HSET', KEYS[1], unpack(updates))
+-- Once every rule's TAT has passed, the entity is back to a clean slate.
+redis.call('PEXPIRE', KEYS[1], string.format('%.0f', math.ceil((max_tat - now) / 1000)))
+return {0, '0'}
+"""
+
+def to_microseconds(seconds: float) -> int:
+    return int(seconds * 1000000)
+
 class RedisRateLimiterBackend(RateLimiterBackend):
+    rate_limit_script = client.register_script(RATE_LIMIT_SCRIPT)
+
     @classmethod
     def get_keys(cls, entity_key: str) -> List[str]:
         return [f"{KEY_PREFIX}ratelimit:{entity_key}:{keytype}"
-                for keytype in ['list', 'zset', 'block']]
+                for keytype in ['tat', 'block']]
+
+    @classmethod
+    def rule_field(cls, time_window: int, max_count: int) -> str:
+        return f"{time_window}:{max_count}"
 
     @classmethod
     def block_access(cls, entity_key: str, seconds: int) -> None:
         "Manually blocks an entity for the desired number of seconds"
-        _, _, blocking_key = cls.get_keys(entity_key)
+        _, blocking_key = cls.get_keys(entity_key)
         with client.pipeline() as pipe:
             pipe.set(blocking_key, 1)
             pipe.expire(blocking_key, seconds)
@@ -306,159 +355,216 @@ class RedisRateLimiterBackend(RateLimiterBackend):
 
     @classmethod
     def unblock_access(cls, entity_key: str) -> None:
-        _, _, blocking_key = cls.get_keys(entity_key)
+        _, blocking_key = cls.get_keys(entity_key)
         client.delete(blocking_key)
 
     @classmethod
     def clear_history(cls, entity_key: str) -> None:
-        for key in cls.get_keys(entity_key):
-            client.delete(key)
+        client.delete(*cls.get_keys(entity_key))
 
     @classmethod
     def get_api_calls_left(cls, entity_key: str, range_seconds: int,
                            max_calls: int) -> Tuple[int, float]:
-        list_key, set_key, _ = cls.get_keys(entity_key)
-        # Count the number of values in our sorted set
-        # that are between now and the cutoff
-        now = time.time()
-        boundary = now - range_seconds
-
-        with client.pipeline() as pipe:
-            # Count how many API calls in our range have already been made
-            pipe.zcount(set_key, boundary, now)
-            # Get the newest call so we can calculate when the ratelimit
-            # will reset to 0
-            pipe.lindex(list_key, 0)
-
-            results = pipe.execute()
-
-        count: int = results[0]
-        newest_call: Optional[bytes] = results[1]
-
-        calls_left = max_calls - count
-        if newest_call is not None:
-            time_reset = now + (range_seconds - (now - float(newest_call)))
-        else:
-            time_reset = now
+        tat_key, _ = cls.get_keys(entity_key)
+        now = to_microseconds(time.time())
+        tat_b: Optional[bytes] = client.hget(tat_key, cls.rule_field(range_seconds, max_calls))
+        if tat_b is None or int(tat_b) <= now:
+            return max_calls, 0
 
-        return calls_left, time_reset - now
+        tat = int(tat_b)
+        time_window = to_microseconds(range_seconds)
+        calls_left = (now + time_window - tat) * max_calls // time_window
+        return calls_left, (tat - now) / 1000000
 
     @classmethod
-    def is_ratelimited(cls, entity_key: str, rules: List[Tuple[int, int]]) -> Tuple[bool, float]:
-        "Returns a tuple of (rate_limited, time_till_free)"
+    def rate_limit_entity(cls, entity_key: str, rules: List[Tuple[int, int]],
+                          max_api_calls: int, max_api_window: int) -> Tuple[bool, float]:
         assert rules
-        list_key, set_key, blocking_key = cls.get_keys(entity_key)
-
-        # Go through the rules from shortest to longest,
-        # seeing if this user has violated any of them. First
-        # get the timestamps for each nth items
-        with client.pipeline() as pipe:
-            for _, request_count in rules:
-                pipe.lindex(list_key, request_count - 1)  # 0-indexed list
-
-            # Get blocking info
-            pipe.get(blocking_key)
-            pipe.ttl(blocking_key)
-
-            rule_timestamps: List[Optional[bytes]] = pipe.execute()
-
-        # Check if there is a manual block on this API key
-        blocking_ttl_b = rule_timestamps.pop()
-        key_blocked = rule_timestamps.pop()
-
-        if key_blocked is not None:
-            # We are manually blocked. Report for how much longer we will be
-            if blocking_ttl_b is None:  # nocoverage # defensive code, this should never happen
-                blocking_ttl = 0.5
-            else:
-                blocking_ttl = int(blocking_ttl_b)
-            return True, blocking_ttl
-
-        now = time.time()
-        for timestamp, (range_seconds, num_requests) in zip(rule_timestamps, rules):
-            # Check if the nth timestamp is newer than the associated rule. If so,
-            # it means we've hit our limit for this rule
-            if timestamp is None:
-                continue
-
-            boundary = float(timestamp) + range_seconds
-            if boundary >= now:
-                free = boundary - now
-                return True, free
+        args: List[Union[str, int]] = [to_microseconds(time.time())]
+        for time_window, max_count in rules:
+            args.extend([cls.rule_field(time_window, max_count),
+                         to_microseconds(time_window),
+                         to_microseconds(time_window) // max_count])
+        ratelimited, time_till_free = cls.rate_limit_script(keys=cls.get_keys(entity_key),
+                                                            args=args)
 
-        return False, 0.0
+        if ratelimited:
+            statsd.incr(f"ratelimiter.limited.{entity_key}")
+        return bool(ratelimited), int(time_till_free) / 1000000
+
+# SharedMemoryRateLimiterBackend keeps the same state as the Redis
+# backend, a theoretical arrival time per (entity, rule), in a file
+# that every process on the host maps into memory.  The file is a hash
+# table of SHARED_MEMORY_BUCKETS buckets of SHARED_MEMORY_BUCKET_SLOTS
+# slots; an entity's state (for all of its rules, and whether it is
+# blocked) lives in the bucket its key hashes to.
+#
+# Python has no atomic compare-and-swap on shared memory, so a
+# decision is made atomic by taking an fcntl lock on the entity's
+# bucket, which only contends with requests for entities in the same
+# bucket.  Locks are released by the kernel if a process dies holding
+# one.
+SHARED_MEMORY_BUCKETS = 16384
+SHARED_MEMORY_BUCKET_SLOTS = 16
+# Entity key hash (0 for an empty slot), time_window, max_count (both
+# 0 for a manual block), theoretical arrival time in microseconds.
+SHARED_MEMORY_SLOT = struct.Struct('<QiiQ')
+SHARED_MEMORY_BUCKET_SIZE = SHARED_MEMORY_SLOT.size * SHARED_MEMORY_BUCKET_SLOTS
+
+Slot = List[int]
+
+class SharedMemoryRateLimiterBackend(RateLimiterBackend):
+    """Rate limits in memory shared by all the processes on this host,
+    for deployments with a single application server, so that rate
+    limiting doesn't need a round trip to Redis."""
+
+    path: Optional[str] = None
+    buckets: Optional[mmap.mmap] = None
+    fd = -1
+    # fcntl locks are held by processes, so they don't keep the
+    # threads of one process apart.
+    thread_lock = threading.Lock()
 
     @classmethod
-    def incr_ratelimit(cls, entity_key: str, max_api_calls: int, max_api_window: int) -> None:
-        """Increases the rate-limit for the specified entity"""
-        list_key, set_key, _ = cls.get_keys(entity_key)
-        now = time.time()
+    def get_buckets(cls) -> mmap.mmap:
+        path = settings.RATE_LIMITING_SHARED_MEMORY_PATH
+        assert path is not None
+        if cls.buckets is None or cls.path != path:
+            if cls.buckets is not None:
+                cls.buckets.close()
+                os.close(cls.fd)
+            size = SHARED_MEMORY_BUCKETS * SHARED_MEMORY_BUCKET_SIZE
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < size:
+                # A new file is all zeroes, i.e. empty slots.
+                os.ftruncate(fd, size)
+            cls.buckets = mmap.mmap(fd, size)
+            cls.fd = fd
+            cls.path = path
+        return cls.buckets
 
-        # Start redis transaction
-        with client.pipeline() as pipe:
-            count = 0
-            while True:
-                try:
-                    # To avoid a race condition between getting the element we might trim from our list
-                    # and removing it from our associated set, we abort this whole transaction if
-                    # another agent manages to change our list out from under us
-                    # When watching a value, the pipeline is set to Immediate mode
-                    pipe.watch(list_key)
-
-                    # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                    last_val = pipe.lindex(list_key, max_api_calls - 1)
-
-                    # Restart buffered execution
-                    pipe.multi()
+    @classmethod
+    def entity_hash(cls, entity_key: str) -> int:
+        digest = hashlib.blake2b((KEY_PREFIX + entity_key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
 
-                    # Add this timestamp to our list
-                    pipe.lpush(list_key, now)
+    @classmethod
+    @contextmanager
+    def locked_bucket(cls, entity_hash: int) -> Iterator[List[Slot]]:
+        """Yields the slots of the entity's bucket, with the bucket
+        locked, and writes them back afterwards."""
+        buckets = cls.get_buckets()
+        offset = (entity_hash % SHARED_MEMORY_BUCKETS) * SHARED_MEMORY_BUCKET_SIZE
+        with cls.thread_lock:
+            fcntl.lockf(cls.fd, fcntl.LOCK_EX, SHARED_MEMORY_BUCKET_SIZE, offset)
+            try:
+                slots = [list(slot) for slot in SHARED_MEMORY_SLOT.iter_unpack(
+                    buckets[offset:offset + SHARED_MEMORY_BUCKET_SIZE])]
+                yield slots
+                buckets[offset:offset + SHARED_MEMORY_BUCKET_SIZE] = b''.join(
+                    SHARED_MEMORY_SLOT.pack(*slot) for slot in slots)
+            finally:
+                fcntl.lockf(cls.fd, fcntl.LOCK_UN, SHARED_MEMORY_BUCKET_SIZE, offset)
 
-                    # Trim our list to the oldest rule we have
-                    pipe.ltrim(list_key, 0, max_api_calls - 1)
+    @classmethod
+    def find_slot(cls, slots: List[Slot], entity_hash: int, time_window: int,
+                  max_count: int) -> Optional[Slot]:
+        for slot in slots:
+            if slot[:3] == [entity_hash, time_window, max_count]:
+                return slot
+        return None
 
-                    # Add our new value to the sorted set that we keep
-                    # We need to put the score and val both as timestamp,
-                    # as we sort by score but remove by value
-                    pipe.zadd(set_key, {str(now): now})
+    @classmethod
+    def claim_slot(cls, slots: List[Slot], entity_hash: int, time_window: int,
+                   max_count: int) -> Slot:
+        slot = cls.find_slot(slots, entity_hash, time_window, max_count)
+        if slot is None:
+            # Reuse an empty or expired slot if there is one; otherwise
+            # evict the entry that will expire soonest, which can only
+            # make that entity's limits more lenient.
+            slot = min(slots, key=lambda slot: slot[3])
+            slot[:] = [entity_hash, time_window, max_count, 0]
+        return slot
 
-                    # Remove the trimmed value from our sorted set, if there was one
-                    if last_val is not None:
-                        pipe.zrem(set_key, last_val)
+    @classmethod
+    def block_access(cls, entity_key: str, seconds: int) -> None:
+        "Manually blocks an entity for the desired number of seconds"
+        entity_hash = cls.entity_hash(entity_key)
+        now = to_microseconds(time.time())
+        with cls.locked_bucket(entity_hash) as slots:
+            slot = cls.claim_slot(slots, entity_hash, 0, 0)
+            slot[3] = now + to_microseconds(seconds)
 
-                    # Set the TTL for our keys as well
-                    api_window = max_api_window
-                    pipe.expire(list_key, api_window)
-                    pipe.expire(set_key, api_window)
+    @classmethod
+    def unblock_access(cls, entity_key: str) -> None:
+        entity_hash = cls.entity_hash(entity_key)
+        with cls.locked_bucket(entity_hash) as slots:
+            slot = cls.find_slot(slots, entity_hash, 0, 0)
+            if slot is not None:
+                slot[:] = [0, 0, 0, 0]
 
-                    pipe.execute()
+    @classmethod
+    def clear_history(cls, entity_key: str) -> None:
+        entity_hash = cls.entity_hash(entity_key)
+        with cls.locked_bucket(entity_hash) as slots:
+            for slot in slots:
+                if slot[0] == entity_hash:
+                    slot[:] = [0, 0, 0, 0]
 
-                    # If no exception was raised in the execution, there were no transaction conflicts
-                    break
-                except redis.WatchError:  # nocoverage # Ideally we'd have a test for this.
-                    if count > 10:
-                        raise RateLimiterLockingException()
-                    count += 1
+    @classmethod
+    def get_api_calls_left(cls, entity_key: str, range_seconds: int,
+                           max_calls: int) -> Tuple[int, float]:
+        entity_hash = cls.entity_hash(entity_key)
+        now = to_microseconds(time.time())
+        with cls.locked_bucket(entity_hash) as slots:
+            slot = cls.find_slot(slots, entity_hash, range_seconds, max_calls)
+            tat = slot[3] if slot is not None else 0
+        if tat <= now:
+            return max_calls, 0
 
-                    continue
+        time_window = to_microseconds(range_seconds)
+        calls_left = (now + time_window - tat) * max_calls // time_window
+        return calls_left, (tat - now) / 1000000
 
     @classmethod
     def rate_limit_entity(cls, entity_key: str, rules: List[Tuple[int, int]],
                           max_api_calls: int, max_api_window: int) -> Tuple[bool, float]:
-        ratelimited, time = cls.is_ratelimited(entity_key, rules)
+        assert rules
+        entity_hash = cls.entity_hash(entity_key)
+        now = to_microseconds(time.time())
+        with cls.locked_bucket(entity_hash) as slots:
+            ratelimited, time_till_free = cls.need_to_limit(slots, entity_hash, rules, now)
 
         if ratelimited:
             statsd.incr(f"ratelimiter.limited.{entity_key}")
+        return ratelimited, time_till_free / 1000000
 
-        else:
-            try:
-                cls.incr_ratelimit(entity_key, max_api_calls, max_api_window)
-            except RateLimiterLockingException:
-                logger.warning("Deadlock trying to incr_ratelimit for %s", entity_key)
-                # rate-limit users who are hitting the API so hard we can't update our stats.
-                ratelimited = True
-
-        return ratelimited, time
+    @classmethod
+    def need_to_limit(cls, slots: List[Slot], entity_hash: int,
+                      rules: List[Tuple[int, int]], now: int) -> Tuple[bool, int]:
+        """The same algorithm as RATE_LIMIT_SCRIPT, on a locked bucket."""
+        block = cls.find_slot(slots, entity_hash, 0, 0)
+        if block is not None and block[3] > now:
+            return True, block[3] - now
+
+        new_tats = []
+        for time_window, max_count in rules:
+            slot = cls.find_slot(slots, entity_hash, time_window, max_count)
+            tat = slot[3] if slot is not None else 0
+            time_window_us = to_microseconds(time_window)
+            new_tat = max(tat, now) + time_window_us // max_count
+            if new_tat > now + time_window_us:
+                return True, new_tat - time_window_us - now
+            new_tats.append(new_tat)
+
+        for (time_window, max_count), new_tat in zip(rules, new_tats):
+            cls.claim_slot(slots, entity_hash, time_window, max_count)[3] = new_tat
+        return False, 0
+
+def default_backend() -> Type[RateLimiterBackend]:
+    if settings.RATE_LIMITING_SHARED_MEMORY_PATH is not None:
+        return SharedMemoryRateLimiterBackend
+    return RedisRateLimiterBackend
 
 class RateLimitResult:
     def __init__(self, entity: RateLimitedObject, secs_to_freedom: float, over_limit: bool,
@@ -0,0 +1,152 @@
+"""Opt-in, sampled profiling of the individual database queries and
+remote cache calls made while handling a request.
+
+LogRequests only logs the total time spent in the database and
+memcached for each request, which doesn't tell you which query or
+cache key made a slow request slow.  When REQUEST_PROFILING_SAMPLE_RATE
+is set, a random sample of requests record every query (as a
+fingerprint of its SQL) and every cache call (by key prefix), with
+their timings and the Zulip code that made them.  Sampled requests
+slower than REQUEST_PROFILING_LOG_THRESHOLD have their slowest calls
+logged as a JSON line to the zulip.request_profiles logger, which
+zerver/middleware.py writes to REQUEST_PROFILING_LOG_PATH, and which
+the `request_profiles` management command summarizes.
+
+When a request isn't sampled, the only cost is checking whether
+`current_profile` is None on each query and cache call.
+"""
+import logging
+import os
+import random
+import re
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import ujson
+from django.conf import settings
+
+logger = logging.getLogger('zulip.request_profiles')
+
+# The number of slowest calls logged for each slow request.
+LOGGED_CALLS_PER_REQUEST = 20
+
+class CallProfile:
+    def __init__(self) -> None:
+        self.calls: List[Dict[str, Any]] = []
+
+    def record(self, kind: str, name: str, duration: float) -> None:
+        self.calls.append({
+            'kind': kind,
+            'name': name,
+            'time': duration,
+            'call_site': get_call_site(),
+        })
+
+    def slowest_calls(self, count: int=LOGGED_CALLS_PER_REQUEST) -> List[Dict[str, Any]]:
+        return sorted(self.calls, key=lambda call: -call['time'])[:count]
+
+# The profile for the request currently being handled by this
+# process, if it was sampled for profiling.
+current_profile: Optional[CallProfile] = None
+
+def start_call_profile() -> None:
+    global current_profile
+    sample_rate = settings.REQUEST_PROFILING_SAMPLE_RATE
+    if sample_rate > 0 and random.random() < sample_rate:
+        current_profile = CallProfile()
+    else:
+        current_profile = None
+
+def finish_call_profile() -> Optional[CallProfile]:
+    global current_profile
+    profile = current_profile
+    current_profile = None
+    return profile
+
+# Files whose frames are never interesting as a call site, since
+# every query or cache call passes through them.
+PROFILING_INTERNAL_FILES = {
+    os.path.join('zerver', 'lib', name) for name in [
+        'request_profiling.py', 'duplicate_queries.py', 'db.py', 'cache.py',
+    ]
+}
+
+def get_call_site() -> str:
+    """Returns the innermost frame in Zulip's own code, outside of the
+    database and cache wrappers, as file:line (function)."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(settings.DEPLOY_ROOT) and 'site-packages' not in filename:
+            relative_filename = filename[len(settings.DEPLOY_ROOT) + 1:]
+            if relative_filename not in PROFILING_INTERNAL_FILES:
+                return f'{relative_filename}:{frame.f_lineno} ({frame.f_code.co_name})'
+        frame = frame.f_back
+    return 'unknown'
+
+def fingerprint_sql(sql: str) -> str:
+    """Reduces a SQL query to a fingerprint that is the same for all
+    queries that differ only in their parameters."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    sql = re.sub(r'%\(\w+\)s|%s', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def cache_key_prefix(key: str) -> str:
+    # Our cache keys are all of the form `name:ID...`.
+    return key.split(':', 1)[0]
+
+def record_query(sql: str, duration: float) -> None:
+    if current_profile is not None:
+        current_profile.record('db', fingerprint_sql(sql), duration)
+
+def record_cache_call(operation: str, keys: Iterable[str], duration: float) -> None:
+    if current_profile is not None:
+        prefixes = sorted({cache_key_prefix(key) for key in keys})
+        current_profile.record('cache', f"{operation} {','.join(prefixes)}", duration)
+
+def log_call_profile(profile: CallProfile, path: str, method: str, time_delta: float) -> None:
+    if time_delta < settings.REQUEST_PROFILING_LOG_THRESHOLD:
+        return
+    record = {
+        'timestamp': time.time(),
+        'method': method,
+        'path': path,
+        'time': time_delta,
+        'calls': len(profile.calls),
+        'slowest_calls': profile.slowest_calls(),
+    }
+    logger.info(ujson.dumps(record))
+
+def read_call_profiles(log_paths: List[str]) -> List[Dict[str, Any]]:
+    records = []
+    for log_path in log_paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path) as log:
+            for line in log:
+                records.append(ujson.loads(line))
+    return records
+
+def summarize_call_profiles(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Aggregates the logged slow calls by what they did (SQL
+    fingerprint or cache operation) and where they were made,
+    slowest total time first."""
+    summary: Dict[Any, Dict[str, Any]] = {}
+    for record in records:
+        for call in record['slowest_calls']:
+            key = (call['kind'], call['name'], call['call_site'])
+            entry = summary.setdefault(key, {
+                'kind': call['kind'],
+                'name': call['name'],
+                'call_site': call['call_site'],
+                'count': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+            })
+            entry['count'] += 1
+            entry['total_time'] += call['time']
+            entry['max_time'] = max(entry['max_time'], call['time'])
+    return sorted(summary.values(), key=lambda entry: -entry['total_time'])
@@ -27,10 +27,12 @@
 # message or group of messages) as we use for message retention policy
 # deletions.
 import logging
+import os
 import time
 from datetime import timedelta
 from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
+import ujson
 from django.conf import settings
 from django.db import connection, transaction
 from django.db.models import Model
@@ -38,7 +40,9 @@ from django.utils.timezone import now as timezone_now
 from psycopg2.sql import SQL, Composable, Identifier, Literal
 
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.parallel import run_parallel_queue
 from zerver.lib.request import RequestVariableConversionError
+from zerver.lib.utils import write_json_atomically
 from zerver.models import (
     ArchivedAttachment,
     ArchivedReaction,
@@ -63,6 +67,13 @@ MESSAGE_BATCH_SIZE = 1000
 STREAM_MESSAGE_BATCH_SIZE = 100
 TRANSACTION_DELETION_BATCH_SIZE = 100
 
+# Bounds on the chunk size when it's adapted to the time taken by each
+# transaction; see next_chunk_size.
+MIN_ADAPTIVE_BATCH_SIZE = 10
+MAX_ADAPTIVE_BATCH_SIZE = 50000
+
+REPLICATION_LAG_POLL_SECONDS = 5
+
 # This data structure declares the details of all database tables that
 # hang off the Message table (with a foreign key to Message being part
 # of its primary lookup key).  This structure allows us to share the
@@ -121,11 +132,88 @@ def move_rows(
         else:
             return []
 
+class ArchivingProgress:
+    """The ID of the last message archived by each of a realm's
+    retention queries (one per stream recipient, plus those for its
+    personal and huddle messages) in a run that hasn't finished yet,
+    saved after every chunk.
+
+    Archived messages are deleted, but their rows linger as dead
+    tuples until Postgres vacuums the table, and on a realm with years
+    of history to archive, a query which started from the beginning
+    of a recipient's messages every time would wade through more of
+    them with every chunk.  These queries instead take the messages
+    after the last one archived, in ID order; and if a run is
+    interrupted, the next one picks up where it left off.
+
+    Each realm has its own file, since realms are archived in
+    parallel.  A query's entry is removed once it has archived
+    everything it can, so the next run starts from the beginning
+    again, catching any messages which only expired during this one."""
+
+    def __init__(self, realm: Realm) -> None:
+        self.path = os.path.join(settings.RETENTION_PROGRESS_DIR, f'{realm.id}.json')
+        self.last_message_ids: Dict[str, int] = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.last_message_ids = ujson.load(f)
+
+    def get(self, key: str) -> int:
+        return self.last_message_ids.get(key, 0)
+
+    def update(self, key: str, last_message_id: int) -> None:
+        self.last_message_ids[key] = last_message_id
+        self.save()
+
+    def finish(self, key: str) -> None:
+        if self.last_message_ids.pop(key, None) is not None:
+            self.save()
+
+    def save(self) -> None:
+        if not self.last_message_ids:
+            os.remove(self.path)
+            return
+        os.makedirs(settings.RETENTION_PROGRESS_DIR, exist_ok=True)
+        write_json_atomically(self.path, self.last_message_ids)
+
+def next_chunk_size(chunk_size: int, elapsed: float) -> int:
+    """Scales chunk_size towards the size which would have taken
+    settings.RETENTION_TARGET_TRANSACTION_SECONDS to archive: big
+    enough that the per-transaction overhead doesn't dominate, small
+    enough that no transaction holds its locks, or writes WAL, for
+    long.  It changes by at most a factor of 2 per chunk, so that one
+    unusually slow or fast chunk doesn't throw it off."""
+    scale = settings.RETENTION_TARGET_TRANSACTION_SECONDS / max(elapsed, 0.001)
+    new_chunk_size = int(chunk_size * min(max(scale, 0.5), 2))
+    return min(max(new_chunk_size, MIN_ADAPTIVE_BATCH_SIZE), MAX_ADAPTIVE_BATCH_SIZE)
+
+def get_replication_lag() -> float:
+    # replay_lag is NULL for an idle replica, and for every replica if
+    # our database user isn't a superuser or a member of pg_monitor.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(EXTRACT(EPOCH FROM MAX(replay_lag)), 0) FROM pg_stat_replication")
+        return float(cursor.fetchone()[0])
+
+def wait_for_replicas() -> None:
+    max_lag = settings.RETENTION_MAX_REPLICATION_LAG_SECONDS
+    if max_lag is None:
+        return
+    while True:
+        lag = get_replication_lag()
+        if lag <= max_lag:
+            return
+        logger.info("Replication lag is %.1fs; pausing archiving.", lag)
+        time.sleep(REPLICATION_LAG_POLL_SECONDS)
+
 def run_archiving_in_chunks(
     query: Composable,
     type: int,
     realm: Optional[Realm]=None,
     chunk_size: int=MESSAGE_BATCH_SIZE,
+    adaptive: bool=False,
+    progress: Optional[ArchivingProgress]=None,
+    progress_key: str='',
     **kwargs: Composable,
 ) -> int:
     # This function is carefully designed to achieve our
@@ -134,9 +222,15 @@ def run_archiving_in_chunks(
     #
     # We implement this design by executing queries that archive messages and their related objects
     # (such as UserMessage, Reaction, and Attachment) inside the same transaction.atomic() block.
+    #
+    # Queries which take their chunks in ID order can use {min_id} to
+    # skip the messages already archived; see ArchivingProgress.
+    # With adaptive, chunk_size is just the size of the first chunk;
+    # see next_chunk_size.
     assert type in (ArchiveTransaction.MANUAL, ArchiveTransaction.RETENTION_POLICY_BASED)
 
     message_count = 0
+    min_id = progress.get(progress_key) if progress is not None else 0
     while True:
         start_time = time.time()
         with transaction.atomic():
@@ -147,6 +241,7 @@ def run_archiving_in_chunks(
                 chunk_size=Literal(chunk_size),
                 returning_id=Literal(True),
                 archive_transaction_id=Literal(archive_transaction.id),
+                min_id=Literal(min_id),
                 **kwargs,
             )
             if new_chunk:
@@ -163,22 +258,39 @@ def run_archiving_in_chunks(
         if len(new_chunk) > 0:
             logger.info("Archived %s messages in %.2fs in transaction %s.",
                         len(new_chunk), total_time, archive_transaction.id)
+            min_id = max(new_chunk)
+            if progress is not None:
+                progress.update(progress_key, min_id)
 
         # We run the loop, until the query returns fewer results than chunk_size,
         # which means we are done:
         if len(new_chunk) < chunk_size:
             break
 
+        if adaptive:
+            chunk_size = next_chunk_size(chunk_size, total_time)
+        # Deleting messages a user asked to delete can't wait for the
+        # replicas, but retention can.
+        if type == ArchiveTransaction.RETENTION_POLICY_BASED:
+            wait_for_replicas()
+
+    if progress is not None:
+        progress.finish(progress_key)
     return message_count
 
 # Note about batching these Message archiving queries:
-# We can simply use LIMIT without worrying about OFFSETs and ordering
-# while executing batches, because any Message already archived (in the previous batch)
+# We can simply use LIMIT without worrying about OFFSETs while
+# executing batches, because any Message already archived (in the previous batch)
 # will not show up in the "SELECT ... FROM zerver_message ..." query for the next batches.
+# The retention queries take their batches in ID order anyway, so that
+# they can start after the last message archived; see ArchivingProgress.
 
 def move_expired_messages_to_archive_by_recipient(recipient: Recipient,
                                                   message_retention_days: int, realm: Realm,
-                                                  chunk_size: int=MESSAGE_BATCH_SIZE) -> int:
+                                                  chunk_size: int=MESSAGE_BATCH_SIZE,
+                                                  adaptive: bool=False,
+                                                  progress: Optional[ArchivingProgress]=None,
+                                                  ) -> int:
     assert message_retention_days != -1
 
     # This function will archive appropriate messages and their related objects.
@@ -188,6 +300,8 @@ def move_expired_messages_to_archive_by_recipient(recipient: Recipient,
         FROM zerver_message
         WHERE zerver_message.recipient_id = {recipient_id}
             AND zerver_message.date_sent < {check_date}
+            AND zerver_message.id > {min_id}
+        ORDER BY zerver_message.id
         LIMIT {chunk_size}
     ON CONFLICT (id) DO UPDATE SET archive_transaction_id = {archive_transaction_id}
     RETURNING id
@@ -201,10 +315,15 @@ def move_expired_messages_to_archive_by_recipient(recipient: Recipient,
         recipient_id=Literal(recipient.id),
         check_date=Literal(check_date.isoformat()),
         chunk_size=chunk_size,
+        adaptive=adaptive,
+        progress=progress,
+        progress_key=f'recipient:{recipient.id}',
     )
 
 def move_expired_personal_and_huddle_messages_to_archive(realm: Realm,
                                                          chunk_size: int=MESSAGE_BATCH_SIZE,
+                                                         adaptive: bool=False,
+                                                         progress: Optional[ArchivingProgress]=None,
                                                          ) -> int:
     message_retention_days = realm.message_retention_days
     assert message_retention_days != -1
@@ -229,6 +348,8 @@ def move_expired_personal_and_huddle_messages_to_archive(realm: Realm,
         WHERE zerver_userprofile.realm_id = {realm_id}
             AND zerver_recipient.type in {recipient_types}
             AND zerver_message.date_sent < {check_date}
+            AND zerver_message.id > {min_id}
+        ORDER BY zerver_message.id
         LIMIT {chunk_size}
     ON CONFLICT (id) DO UPDATE SET archive_transaction_id = {archive_transaction_id}
     RETURNING id
@@ -243,6 +364,9 @@ def move_expired_personal_and_huddle_messages_to_archive(realm: Realm,
         recipient_types=Literal(recipient_types),
         check_date=Literal(check_date.isoformat()),
         chunk_size=chunk_size,
+        adaptive=adaptive,
+        progress=progress,
+        progress_key='personal_and_huddle',
     )
 
     # Archive cross-realm personal messages to users in the realm.  We
@@ -261,6 +385,8 @@ def move_expired_personal_and_huddle_messages_to_archive(realm: Realm,
             AND recipient_profile.realm_id = {realm_id}
             AND zerver_recipient.type = {recipient_personal}
             AND zerver_message.date_sent < {check_date}
+            AND zerver_message.id > {min_id}
+        ORDER BY zerver_message.id
         LIMIT {chunk_size}
     ON CONFLICT (id) DO UPDATE SET archive_transaction_id = {archive_transaction_id}
     RETURNING id
@@ -274,6 +400,9 @@ def move_expired_personal_and_huddle_messages_to_archive(realm: Realm,
         recipient_personal=Literal(Recipient.PERSONAL),
         check_date=Literal(check_date.isoformat()),
         chunk_size=chunk_size,
+        adaptive=adaptive,
+        progress=progress,
+        progress_key='cross_realm_personal',
     )
 
     return message_count
@@ -354,16 +483,23 @@ def move_related_objects_to_archive(msg_ids: List[int]) -> None:
     move_attachment_messages_to_archive(msg_ids)
 
 def archive_messages_by_recipient(recipient: Recipient, message_retention_days: int,
-                                  realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) -> int:
+                                  realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE,
+                                  adaptive: bool=False,
+                                  progress: Optional[ArchivingProgress]=None) -> int:
     return move_expired_messages_to_archive_by_recipient(recipient, message_retention_days,
-                                                         realm, chunk_size)
+                                                         realm, chunk_size, adaptive, progress)
 
-def archive_personal_and_huddle_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
+def archive_personal_and_huddle_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE,
+                                         adaptive: bool=False,
+                                         progress: Optional[ArchivingProgress]=None) -> None:
     logger.info("Archiving personal and huddle messages for realm %s", realm.string_id)
-    message_count = move_expired_personal_and_huddle_messages_to_archive(realm, chunk_size)
+    message_count = move_expired_personal_and_huddle_messages_to_archive(realm, chunk_size,
+                                                                         adaptive, progress)
     logger.info("Done. Archived %s messages", message_count)
 
-def archive_stream_messages(realm: Realm, streams: List[Stream], chunk_size: int=STREAM_MESSAGE_BATCH_SIZE) -> None:
+def archive_stream_messages(realm: Realm, streams: List[Stream], chunk_size: int=STREAM_MESSAGE_BATCH_SIZE,
+                            adaptive: bool=False,
+                            progress: Optional[ArchivingProgress]=None) -> None:
     if not streams:
         return
 
@@ -382,20 +518,65 @@ def archive_stream_messages(realm: Realm, streams: List[Stream], chunk_size: int
     for recipient in recipients:
         message_count += archive_messages_by_recipient(
             recipient, retention_policy_dict[recipient.type_id], realm, chunk_size,
+            adaptive, progress,
         )
 
     logger.info("Done. Archived %s messages.", message_count)
 
-def archive_messages(chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
-    logger.info("Starting the archiving process with chunk_size %s", chunk_size)
-
-    for realm, streams in get_realms_and_streams_for_archiving():
-        archive_stream_messages(realm, streams, chunk_size=STREAM_MESSAGE_BATCH_SIZE)
-        if realm.message_retention_days != -1:
-            archive_personal_and_huddle_messages(realm, chunk_size)
+def archive_realm(realm: Realm, streams: List[Stream], chunk_size: Optional[int]=None) -> None:
+    # Without a chunk_size, the chunks' sizes are adapted to the time
+    # each one takes to archive; see next_chunk_size.
+    adaptive = chunk_size is None
+    progress = ArchivingProgress(realm)
+    archive_stream_messages(realm, streams, chunk_size=STREAM_MESSAGE_BATCH_SIZE,
+                            adaptive=adaptive, progress=progress)
+    if realm.message_retention_days != -1:
+        archive_personal_and_huddle_messages(realm, chunk_size or MESSAGE_BATCH_SIZE,
+                                             adaptive=adaptive, progress=progress)
+
+    # Messages have been archived for the realm, now we can clean up attachments:
+    delete_expired_attachments(realm)
+
+def archive_messages(chunk_size: Optional[int]=None, processes: Optional[int]=None) -> None:
+    if processes is None:
+        processes = settings.RETENTION_ARCHIVING_PROCESSES
+    logger.info("Starting the archiving process with chunk_size %s",
+                chunk_size or "adapted to RETENTION_TARGET_TRANSACTION_SECONDS")
+
+    realms_and_streams = get_realms_and_streams_for_archiving()
+    if processes == 1:
+        for realm, streams in realms_and_streams:
+            archive_realm(realm, streams, chunk_size)
+        return
 
-        # Messages have been archived for the realm, now we can clean up attachments:
-        delete_expired_attachments(realm)
+    # Realms are independent of each other, so we can archive several
+    # at once, each in its own transactions.  Those with the most
+    # streams, likely the biggest, go first, so that they don't hold
+    # up the end of the run.
+    realms_and_streams.sort(key=lambda realm_and_streams: len(realm_and_streams[1]), reverse=True)
+    streams_by_realm_id = {realm.id: (realm, streams) for realm, streams in realms_and_streams}
+
+    # A realm which fails is logged, and doesn't stop the others; the
+    # next run resumes it where it left off (see ArchivingProgress).
+    def archive_realm_by_id(realm_id: int) -> bool:  # nocoverage # runs in the workers
+        realm, streams = streams_by_realm_id[realm_id]
+        try:
+            archive_realm(realm, streams, chunk_size)
+        except Exception:
+            logger.exception("Failed archiving realm %s", realm.string_id)
+            return False
+        return True
+
+    failed_realms = []
+    for realm_id, archived in run_parallel_queue(archive_realm_by_id, list(streams_by_realm_id),
+                                                 processes, retries=0):  # nocoverage
+        string_id = streams_by_realm_id[realm_id][0].string_id
+        if archived:
+            logger.info("Finished archiving realm %s", string_id)
+        else:
+            failed_realms.append(string_id)
+    if failed_realms:  # nocoverage
+        raise Exception(f"Failed archiving realms: {', '.join(sorted(failed_realms))}")
 
 def get_realms_and_streams_for_archiving() -> List[Tuple[Realm, List[Stream]]]:
     """
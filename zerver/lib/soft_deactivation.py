@@ -1,10 +1,9 @@
 # Documented in https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
 import logging
-from collections import defaultdict
-from typing import Any, DefaultDict, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models import Max
 from django.utils.timezone import now as timezone_now
 
@@ -13,8 +12,6 @@ from zerver.models import (
     Message,
     Realm,
     RealmAuditLog,
-    Recipient,
-    Subscription,
     UserActivity,
     UserMessage,
     UserProfile,
@@ -22,188 +19,178 @@ from zerver.models import (
 
 logger = logging.getLogger("zulip.soft_deactivation")
 log_to_file(logger, settings.SOFT_DEACTIVATION_LOG_PATH)
-BULK_CREATE_BATCH_SIZE = 10000
-
-def filter_by_subscription_history(user_profile: UserProfile,
-                                   all_stream_messages: DefaultDict[int, List[Message]],
-                                   all_stream_subscription_logs: DefaultDict[int, List[RealmAuditLog]],
-                                   ) -> List[UserMessage]:
-    user_messages_to_insert: List[UserMessage] = []
-
-    def store_user_message_to_insert(message: Message) -> None:
-        message = UserMessage(user_profile=user_profile,
-                              message_id=message['id'], flags=0)
-        user_messages_to_insert.append(message)
-
-    for (stream_id, stream_messages_raw) in all_stream_messages.items():
-        stream_subscription_logs = all_stream_subscription_logs[stream_id]
-        # Make a copy of the original list of messages, which we will
-        # mutate in the loop below.
-        stream_messages = list(stream_messages_raw)
-
-        for log_entry in stream_subscription_logs:
-            # For each stream, we iterate through all of the changes
-            # to the user's subscription to that stream, ordered by
-            # event_last_message_id, to determine whether the user was
-            # subscribed to the target stream at that time.
-            #
-            # For each message, we're looking for the first event for
-            # the user's subscription to the target stream after the
-            # message was sent.
-            # * If it's an unsubscribe, we know the user was subscribed
-            #   when the message was sent, and create a UserMessage
-            # * If it's a subscribe, we know the user was not, and we
-            #   skip the message by mutating the stream_messages list
-            #   to skip that message.
-
-            if len(stream_messages) == 0:
-                # Because stream_messages gets mutated below, this
-                # check belongs in this inner loop, not the outer loop.
-                break
-
-            if log_entry.event_type == RealmAuditLog.SUBSCRIPTION_DEACTIVATED:
-                # If the event shows the user was unsubscribed after
-                # event_last_message_id, we know they must have been
-                # subscribed immediately before the event.
-                for stream_message in stream_messages:
-                    if stream_message['id'] <= log_entry.event_last_message_id:
-                        store_user_message_to_insert(stream_message)
-                    else:
-                        break
-            elif log_entry.event_type in (RealmAuditLog.SUBSCRIPTION_ACTIVATED,
-                                          RealmAuditLog.SUBSCRIPTION_CREATED):
-                initial_msg_count = len(stream_messages)
-                for i, stream_message in enumerate(stream_messages):
-                    if stream_message['id'] > log_entry.event_last_message_id:
-                        stream_messages = stream_messages[i:]
-                        break
-                final_msg_count = len(stream_messages)
-                if initial_msg_count == final_msg_count:
-                    if stream_messages[-1]['id'] <= log_entry.event_last_message_id:
-                        stream_messages = []
-            else:
-                raise AssertionError(f'{log_entry.event_type} is not a Subscription Event.')
-
-        if len(stream_messages) > 0:
-            # We do this check for last event since if the last subscription
-            # event was a subscription_deactivated then we don't want to create
-            # UserMessage rows for any of the remaining messages.
-            if stream_subscription_logs[-1].event_type in (
-                    RealmAuditLog.SUBSCRIPTION_ACTIVATED,
-                    RealmAuditLog.SUBSCRIPTION_CREATED):
-                for stream_message in stream_messages:
-                    store_user_message_to_insert(stream_message)
-    return user_messages_to_insert
-
-def add_missing_messages(user_profile: UserProfile) -> None:
-    """This function takes a soft-deactivated user, and computes and adds
-    to the database any UserMessage rows that were not created while
-    the user was soft-deactivated.  The end result is that from the
-    perspective of the message database, it should be impossible to
-    tell that the user was soft-deactivated at all.
-
-    At a high level, the algorithm is as follows:
-
-    * Find all the streams that the user was at any time a subscriber
-      of when or after they were soft-deactivated (`recipient_ids`
-      below).
-
-    * Find all the messages sent to those streams since the user was
-      soft-deactivated.  This will be a superset of the target
-      UserMessages we need to create in two ways: (1) some UserMessage
-      rows will have already been created in do_send_messages because
-      the user had a nonzero set of flags (the fact that we do so in
-      do_send_messages simplifies things considerably, since it means
-      we don't need to inspect message content to look for things like
-      mentions here), and (2) the user might not have been subscribed
-      to all of the streams in recipient_ids for the entire time
-      window.
-
-    * Correct the list from the previous state by excluding those with
-      existing UserMessage rows.
-
-    * Correct the list from the previous state by excluding those
-      where the user wasn't subscribed at the time, using the
-      RealmAuditLog data to determine exactly when the user was
-      subscribed/unsubscribed.
-
-    * Create the UserMessage rows.
+CATCH_UP_USER_BATCH_SIZE = 1000
+CATCH_UP_MESSAGES_PER_ROUND = 1000
+
+# Each user's subscription history for a stream is a sequence of
+# subscription events, ordered by event_last_message_id (the ID of the
+# last message sent before the event), tiebroken by event ID in case
+# a user was subscribed and unsubscribed with no messages sent in the
+# meantime.  Each subscribe event opens a range of message IDs, which
+# the next event, if any, closes: the user received the messages after
+# the subscribe event's event_last_message_id, up to and including the
+# next event's.  This computes those ranges, cut down to the messages
+# after each user's last_active_message_id.  When catching up many
+# users, add_missing_messages_for_users stores them in
+# SUBSCRIPTION_RANGES_TABLE, so that each round can reuse them.
+SUBSCRIPTION_RANGES_TABLE = "soft_deactivation_subscription_ranges"
+SUBSCRIPTION_RANGES_QUERY = """
+SELECT user_profile_id, recipient_id, start_message_id, end_message_id
+FROM (
+    SELECT
+        zerver_realmauditlog.modified_user_id AS user_profile_id,
+        zerver_stream.recipient_id,
+        zerver_realmauditlog.event_type,
+        GREATEST(zerver_realmauditlog.event_last_message_id,
+                 zerver_userprofile.last_active_message_id) AS start_message_id,
+        LEAD(zerver_realmauditlog.event_last_message_id) OVER (
+            PARTITION BY zerver_realmauditlog.modified_user_id, zerver_realmauditlog.modified_stream_id
+            ORDER BY zerver_realmauditlog.event_last_message_id, zerver_realmauditlog.id
+        ) AS end_message_id
+    FROM zerver_realmauditlog
+    INNER JOIN zerver_stream ON zerver_stream.id = zerver_realmauditlog.modified_stream_id
+    INNER JOIN zerver_userprofile ON zerver_userprofile.id = zerver_realmauditlog.modified_user_id
+    WHERE zerver_realmauditlog.modified_user_id IN %(user_ids)s
+        AND zerver_realmauditlog.event_type IN %(subscription_event_types)s
+) AS subscription_events
+WHERE event_type IN %(subscribe_event_types)s
+    AND (end_message_id IS NULL OR end_message_id > start_message_id)
+"""
+
+# The remaining queries take the subscription ranges from `ranges`,
+# either SUBSCRIPTION_RANGES_QUERY itself or a query on
+# SUBSCRIPTION_RANGES_TABLE.
+
+# The ID of the last message in the next round: the
+# CATCH_UP_MESSAGES_PER_ROUND'th message after min_message_id to any
+# of the streams in the subscription ranges.
+ROUND_END_QUERY = """
+WITH subscription_ranges AS ({ranges})
+SELECT zerver_message.id
+FROM zerver_message
+WHERE zerver_message.recipient_id IN (SELECT recipient_id FROM subscription_ranges)
+    AND zerver_message.id > %(min_message_id)s
+ORDER BY zerver_message.id
+LIMIT 1 OFFSET %(offset)s
+"""
+
+# Creates the UserMessage rows the users are missing for the stream
+# messages with IDs in (min_message_id, max_message_id], and moves
+# their last_active_message_id up to the last one created for each.
+MISSING_MESSAGES_QUERY = """
+WITH subscription_ranges AS ({ranges}),
+inserted AS (
+    INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+    SELECT subscription_ranges.user_profile_id, zerver_message.id, 0
+    FROM subscription_ranges
+    INNER JOIN zerver_message ON zerver_message.recipient_id = subscription_ranges.recipient_id
+    WHERE zerver_message.id > subscription_ranges.start_message_id
+        AND (subscription_ranges.end_message_id IS NULL
+             OR zerver_message.id <= subscription_ranges.end_message_id)
+        AND zerver_message.id > %(min_message_id)s
+        AND (%(max_message_id)s IS NULL OR zerver_message.id <= %(max_message_id)s)
+        -- do_send_messages creates the rows for messages which gave
+        -- the user any flags, like mentions, even while soft-deactivated.
+        AND NOT EXISTS (
+            SELECT 1 FROM zerver_usermessage
+            WHERE zerver_usermessage.user_profile_id = subscription_ranges.user_profile_id
+                AND zerver_usermessage.message_id = zerver_message.id
+        )
+    ON CONFLICT (user_profile_id, message_id) DO NOTHING
+    RETURNING user_profile_id, message_id
+),
+last_inserted AS (
+    SELECT user_profile_id, MAX(message_id) AS message_id
+    FROM inserted
+    GROUP BY user_profile_id
+),
+updated AS (
+    UPDATE zerver_userprofile
+    SET last_active_message_id = last_inserted.message_id
+    FROM last_inserted
+    WHERE zerver_userprofile.id = last_inserted.user_profile_id
+)
+SELECT user_profile_id, message_id FROM last_inserted
+"""
+
+def add_missing_messages_for_users(user_profiles: List[UserProfile]) -> None:
+    """This function takes a set of soft-deactivated users, and computes
+    and adds to the database any UserMessage rows that were not
+    created while they were soft-deactivated.  The end result is that
+    from the perspective of the message database, it should be
+    impossible to tell that the users were soft-deactivated at all.
+
+    Rather than fetching each user's messages and subscription history
+    and filtering them in Python, this computes the missing rows for
+    all of the users at once in the database, inserting them as it
+    goes.  It first works out the ranges of messages each user was
+    subscribed to each stream for (see SUBSCRIPTION_RANGES_QUERY), and
+    then works through the messages in ID order, in rounds of
+    CATCH_UP_MESSAGES_PER_ROUND messages, so that no one statement
+    gets too big, and each user's last_active_message_id keeps up with
+    the rows created for them.  When catching up many users, the
+    ranges are computed once, into a temporary table; for a single
+    user, as when they come back, recomputing them each round is
+    cheaper than creating the table.  UserMessage rows for messages with
+    nonzero flags, like mentions, were already created by
+    do_send_messages.
 
     For further documentation, see:
 
       https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
 
     """
-    assert user_profile.last_active_message_id is not None
-    all_stream_subs = list(Subscription.objects.filter(
-        user_profile=user_profile,
-        recipient__type=Recipient.STREAM).values('recipient_id', 'recipient__type_id'))
-
-    # For Stream messages we need to check messages against data from
-    # RealmAuditLog for visibility to user. So we fetch the subscription logs.
-    stream_ids = [sub['recipient__type_id'] for sub in all_stream_subs]
-    events = [RealmAuditLog.SUBSCRIPTION_CREATED, RealmAuditLog.SUBSCRIPTION_DEACTIVATED,
-              RealmAuditLog.SUBSCRIPTION_ACTIVATED]
-
-    # Important: We order first by event_last_message_id, which is the
-    # official ordering, and then tiebreak by RealmAuditLog event ID.
-    # That second tiebreak is important in case a user is subscribed
-    # and then unsubscribed without any messages being sent in the
-    # meantime.  Without that tiebreak, we could end up incorrectly
-    # processing the ordering of those two subscription changes.
-    subscription_logs = list(RealmAuditLog.objects.select_related(
-        'modified_stream').filter(
-        modified_user=user_profile,
-        modified_stream__id__in=stream_ids,
-        event_type__in=events).order_by('event_last_message_id', 'id'))
-
-    all_stream_subscription_logs: DefaultDict[int, List[RealmAuditLog]] = defaultdict(list)
-    for log in subscription_logs:
-        all_stream_subscription_logs[log.modified_stream_id].append(log)
-
-    recipient_ids = []
-    for sub in all_stream_subs:
-        stream_subscription_logs = all_stream_subscription_logs[sub['recipient__type_id']]
-        if stream_subscription_logs[-1].event_type == RealmAuditLog.SUBSCRIPTION_DEACTIVATED:
-            assert stream_subscription_logs[-1].event_last_message_id is not None
-            if stream_subscription_logs[-1].event_last_message_id <= user_profile.last_active_message_id:
-                # We are going to short circuit this iteration as its no use
-                # iterating since user unsubscribed before soft-deactivation
-                continue
-        recipient_ids.append(sub['recipient_id'])
-
-    all_stream_msgs = list(Message.objects.filter(
-        recipient__id__in=recipient_ids,
-        id__gt=user_profile.last_active_message_id).order_by('id').values(
-        'id', 'recipient__type_id'))
-    already_created_ums = set(UserMessage.objects.filter(
-        user_profile=user_profile,
-        message__recipient__type=Recipient.STREAM,
-        message__id__gt=user_profile.last_active_message_id).values_list('message__id', flat=True))
-
-    # Filter those messages for which UserMessage rows have been already created
-    all_stream_msgs = [msg for msg in all_stream_msgs
-                       if msg['id'] not in already_created_ums]
-
-    stream_messages: DefaultDict[int, List[Message]] = defaultdict(list)
-    for msg in all_stream_msgs:
-        stream_messages[msg['recipient__type_id']].append(msg)
+    users_by_id = {user_profile.id: user_profile for user_profile in user_profiles}
+    if not users_by_id:
+        return
+
+    assert all(user_profile.last_active_message_id is not None for user_profile in user_profiles)
+    min_message_id = min(user_profile.last_active_message_id or 0 for user_profile in user_profiles)
+    query_args = dict(
+        user_ids=tuple(users_by_id),
+        subscription_event_types=(RealmAuditLog.SUBSCRIPTION_CREATED,
+                                  RealmAuditLog.SUBSCRIPTION_ACTIVATED,
+                                  RealmAuditLog.SUBSCRIPTION_DEACTIVATED),
+        subscribe_event_types=(RealmAuditLog.SUBSCRIPTION_CREATED,
+                               RealmAuditLog.SUBSCRIPTION_ACTIVATED),
+    )
+    with connection.cursor() as cursor:
+        use_table = len(users_by_id) > 1
+        if use_table:
+            # In case an earlier call on this connection failed before
+            # dropping it.
+            cursor.execute(f"DROP TABLE IF EXISTS {SUBSCRIPTION_RANGES_TABLE}")
+            cursor.execute(f"CREATE TEMPORARY TABLE {SUBSCRIPTION_RANGES_TABLE} AS "
+                           f"{SUBSCRIPTION_RANGES_QUERY}", query_args)
+            has_ranges = cursor.rowcount > 0
+            ranges = f"SELECT * FROM {SUBSCRIPTION_RANGES_TABLE}"
+        else:
+            has_ranges = True
+            ranges = SUBSCRIPTION_RANGES_QUERY
+
+        while has_ranges:
+            # The round ends after the CATCH_UP_MESSAGES_PER_ROUND'th
+            # message to any of the users' streams, or takes the rest
+            # of them.
+            cursor.execute(ROUND_END_QUERY.format(ranges=ranges), dict(
+                query_args, min_message_id=min_message_id, offset=CATCH_UP_MESSAGES_PER_ROUND - 1))
+            round_end = cursor.fetchone()
+            max_message_id = round_end[0] if round_end else None
+
+            cursor.execute(MISSING_MESSAGES_QUERY.format(ranges=ranges), dict(
+                query_args, min_message_id=min_message_id, max_message_id=max_message_id))
+            for user_profile_id, last_message_id in cursor.fetchall():
+                users_by_id[user_profile_id].last_active_message_id = last_message_id
+
+            if max_message_id is None:
+                break
+            min_message_id = max_message_id
 
-    # Calling this function to filter out stream messages based upon
-    # subscription logs and then store all UserMessage objects for bulk insert
-    # This function does not perform any SQL related task and gets all the data
-    # required for its operation in its params.
-    user_messages_to_insert = filter_by_subscription_history(
-        user_profile, stream_messages, all_stream_subscription_logs)
+        if use_table:
+            cursor.execute(f"DROP TABLE {SUBSCRIPTION_RANGES_TABLE}")
 
-    # Doing a bulk create for all the UserMessage objects stored for creation.
-    while len(user_messages_to_insert) > 0:
-        messages, user_messages_to_insert = (
-            user_messages_to_insert[0:BULK_CREATE_BATCH_SIZE],
-            user_messages_to_insert[BULK_CREATE_BATCH_SIZE:])
-        UserMessage.objects.bulk_create(messages)
-        user_profile.last_active_message_id = messages[-1].message_id
-        user_profile.save(update_fields=['last_active_message_id'])
+def add_missing_messages(user_profile: UserProfile) -> None:
+    add_missing_messages_for_users([user_profile])
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     try:
@@ -304,11 +291,9 @@ def do_soft_activate_users(users: List[UserProfile]) -> List[UserProfile]:
     return users_soft_activated
 
 def do_catch_up_soft_deactivated_users(users: List[UserProfile]) -> List[UserProfile]:
-    users_caught_up = []
-    for user_profile in users:
-        if user_profile.long_term_idle:
-            add_missing_messages(user_profile)
-            users_caught_up.append(user_profile)
+    users_caught_up = [user_profile for user_profile in users if user_profile.long_term_idle]
+    for i in range(0, len(users_caught_up), CATCH_UP_USER_BATCH_SIZE):
+        add_missing_messages_for_users(users_caught_up[i:i + CATCH_UP_USER_BATCH_SIZE])
     logger.info("Caught up %d soft-deactivated users", len(users_caught_up))
     return users_caught_up
 
@@ -4,6 +4,7 @@ import re
 import shutil
 import tempfile
 import urllib
+from collections import defaultdict
 from contextlib import contextmanager
 from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 from unittest import mock
@@ -35,6 +36,7 @@ from zerver.lib.actions import (
 from zerver.lib.cache import bounce_key_prefix_for_testing
 from zerver.lib.initial_password import initial_password
 from zerver.lib.rate_limiter import bounce_redis_key_prefix_for_testing
+from zerver.lib.request_profiling import fingerprint_sql
 from zerver.lib.sessions import get_session_dict_user
 from zerver.lib.stream_subscription import get_stream_subscriptions_for_user
 from zerver.lib.streams import (
@@ -68,6 +70,8 @@ from zerver.openapi.openapi import validate_against_openapi_schema
 from zerver.tornado.event_queue import clear_client_event_queues_for_testing
 from zilencer.models import get_remote_server_by_uuid
 
+QUERY_COUNT_BASELINES_PATH = os.path.join(os.path.dirname(__file__),
+                                          '../tests/fixtures/query_count_baselines.json')
 
 class UploadSerializeMixin(SerializeMixin):
     """
@@ -683,6 +687,34 @@ class ZulipTestCase(TestCase):
             print(f"\nexpected length: {count}\nactual length: {actual_count}")
             raise AssertionError('List is unexpected size!')
 
+    def assert_query_count_baseline(self, name: str,
+                                    queries: List[Dict[str, Union[str, bytes]]]) -> None:
+        """Fails if more queries were captured (via queries_captured) than
+        the baseline recorded for `name` in QUERY_COUNT_BASELINES_PATH,
+        so that ORM changes which add queries to a covered code path
+        don't go unnoticed.  Run the tests with
+        ZULIP_UPDATE_QUERY_BASELINES=1 (and --parallel=1) to record new
+        baselines after an intentional change."""
+        with open(QUERY_COUNT_BASELINES_PATH) as f:
+            baselines: Dict[str, int] = ujson.load(f)
+        count = len(queries)
+        if os.environ.get('ZULIP_UPDATE_QUERY_BASELINES'):
+            baselines[name] = count
+            with open(QUERY_COUNT_BASELINES_PATH, 'w') as f:
+                f.write(ujson.dumps(baselines, indent=2, sort_keys=True) + '\n')
+            return
+        if name not in baselines:
+            raise AssertionError(f"No query count baseline recorded for {name}; "
+                                 "run with ZULIP_UPDATE_QUERY_BASELINES=1 to record one.")
+        if count > baselines[name]:
+            fingerprints: Dict[str, int] = defaultdict(int)
+            for query in queries:
+                fingerprints[fingerprint_sql(str(query['sql']))] += 1
+            for fingerprint, fingerprint_count in sorted(fingerprints.items(), key=lambda item: -item[1]):
+                print(f"{fingerprint_count:4} {fingerprint}")
+            raise AssertionError(f"{name} made {count} queries, more than its "
+                                 f"baseline of {baselines[name]}!")
+
     def assert_json_error_contains(self, result: HttpResponse, msg_substring: str,
                                    status_code: int=400) -> None:
         self.assertIn(msg_substring, self.get_json_error(result, status_code=status_code))
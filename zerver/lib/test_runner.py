@@ -250,6 +250,7 @@ def initialize_worker_path(worker_id: int) -> None:
                      os.path.basename(worker_path),
                      "test_uploads"))
     settings.SENDFILE_ROOT = os.path.join(settings.LOCAL_UPLOADS_DIR, "files")
+    settings.RETENTION_PROGRESS_DIR = os.path.join(worker_path, "retention-progress")
 
 class Runner(DiscoverRunner):
     parallel_test_suite = ParallelTestSuite
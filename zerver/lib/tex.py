@@ -1,36 +1,121 @@
 import logging
 import os
+import select
 import subprocess
-from typing import Optional
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 
+import ujson
 from django.conf import settings
 
 from zerver.lib.storage import static_path
 
+# How long we wait for the KaTeX server to render a single formula
+# before deciding it is wedged and restarting it.
+KATEX_SERVER_TIMEOUT = 5
 
-def render_tex(tex: str, is_inline: bool=True) -> Optional[str]:
-    r"""Render a TeX string into HTML using KaTeX
+# The number of rendered formulas cached by each process; classroom
+# realms tend to repeat the same handful of formulas many times.
+TEX_CACHE_SIZE = 1000
 
-    Returns the HTML string, or None if there was some error in the TeX syntax
+class KatexServerError(Exception):
+    pass
 
-    Keyword arguments:
-    tex -- Text string with the TeX to render
-           Don't include delimiters ('$$', '\[ \]', etc.)
-    is_inline -- Boolean setting that indicates whether the render should be
-                 inline (i.e. for embedding it in text) or not. The latter
-                 will show the content centered, and in the "expanded" form
-                 (default True)
-    """
+def katex_cli_path() -> str:
+    if settings.PRODUCTION:
+        return static_path("webpack-bundles/katex-cli.js")
+    return os.path.join(settings.DEPLOY_ROOT, "node_modules/katex/cli.js")
 
-    katex_path = (
-        static_path("webpack-bundles/katex-cli.js")
-        if settings.PRODUCTION
-        else os.path.join(settings.DEPLOY_ROOT, "node_modules/katex/cli.js")
-    )
-    if not os.path.isfile(katex_path):
-        logging.error("Cannot find KaTeX for latex rendering!")
+def katex_server_path() -> str:
+    if settings.PRODUCTION:
+        return static_path("webpack-bundles/katex-server.js")
+    return os.path.join(settings.DEPLOY_ROOT, "tools/katex-server.js")
+
+class KatexServer:
+    """A node process running tools/katex-server.js, which renders
+    formulas sent to it as lines of JSON on its stdin.
+
+    The process is started lazily on the first request, and restarted
+    if it crashes, stops responding, or we find ourselves in a forked
+    child of the process that started it (where the pipes are shared
+    with the parent)."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.process: Optional["subprocess.Popen[bytes]"] = None
+        self.pid: Optional[int] = None
+        self.buffer = b''
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(['node', katex_server_path()],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.pid = os.getpid()
+        self.buffer = b''
+
+    def stop(self) -> None:
+        if self.process is not None and self.pid == os.getpid():
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.pid = None
+        self.buffer = b''
+
+    def read_line(self) -> bytes:
+        assert self.process is not None and self.process.stdout is not None
+        fd = self.process.stdout.fileno()
+        while b'\n' not in self.buffer:
+            ready, _, _ = select.select([fd], [], [], KATEX_SERVER_TIMEOUT)
+            if not ready:
+                raise KatexServerError("KaTeX server timed out")
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise KatexServerError("KaTeX server exited")
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line
+
+    def request(self, tex: str, is_inline: bool) -> Dict[str, Any]:
+        if self.process is None or self.pid != os.getpid() or self.process.poll() is not None:
+            self.stop()
+            self.start()
+        assert self.process is not None and self.process.stdin is not None
+        try:
+            self.process.stdin.write(ujson.dumps({'tex': tex, 'display': not is_inline}).encode() + b'\n')
+            self.process.stdin.flush()
+            return ujson.loads(self.read_line())
+        except BaseException:
+            # Whatever went wrong (including a TimeoutExpired raised
+            # into this thread by zerver.lib.timeout), we can no
+            # longer trust which response is next in the pipe.
+            self.stop()
+            raise
+
+    def render(self, tex: str, is_inline: bool) -> Optional[str]:
+        with self.lock:
+            try:
+                response = self.request(tex, is_inline)
+            except (OSError, ValueError, KatexServerError):
+                # The server crashed; try once more with a fresh one.
+                response = self.request(tex, is_inline)
+        if 'html' in response:
+            return response['html']
         return None
-    command = ['node', katex_path]
+
+katex_server = KatexServer()
+
+@lru_cache(maxsize=TEX_CACHE_SIZE)
+def render_tex_cached(tex: str, is_inline: bool) -> Optional[str]:
+    # Exceptions aren't cached by lru_cache, so a server failure
+    # doesn't cause a valid formula to be treated as invalid later.
+    return katex_server.render(tex, is_inline)
+
+def render_tex_subprocess(tex: str, is_inline: bool=True) -> Optional[str]:
+    """Renders a TeX string by starting a fresh KaTeX process; used
+    when the KaTeX server is unavailable."""
+    command: List[str] = ['node', katex_cli_path()]
     if not is_inline:
         command.extend(['--display-mode'])
     katex = subprocess.Popen(command,
@@ -44,3 +129,26 @@ def render_tex(tex: str, is_inline: bool=True) -> Optional[str]:
         return stdout.decode('utf-8').strip()
     else:
         return None
+
+def render_tex(tex: str, is_inline: bool=True) -> Optional[str]:
+    r"""Render a TeX string into HTML using KaTeX
+
+    Returns the HTML string, or None if there was some error in the TeX syntax
+
+    Keyword arguments:
+    tex -- Text string with the TeX to render
+           Don't include delimiters ('$$', '\[ \]', etc.)
+    is_inline -- Boolean setting that indicates whether the render should be
+                 inline (i.e. for embedding it in text) or not. The latter
+                 will show the content centered, and in the "expanded" form
+                 (default True)
+    """
+
+    if not os.path.isfile(katex_cli_path()) or not os.path.isfile(katex_server_path()):
+        logging.error("Cannot find KaTeX for latex rendering!")
+        return None
+    try:
+        return render_tex_cached(tex, is_inline)
+    except (OSError, ValueError, KatexServerError):
+        logging.warning("KaTeX server failed; rendering in a subprocess", exc_info=True)
+        return render_tex_subprocess(tex, is_inline)
@@ -1,21 +1,27 @@
 import logging
 import os
 from mimetypes import guess_type
+from typing import Iterator, Optional
 
 from django.conf import settings
 from django.db import connection
 
 from zerver.lib.avatar_hash import user_avatar_path
 from zerver.lib.parallel import run_parallel
-from zerver.lib.upload import S3UploadBackend, upload_image_to_s3
+from zerver.lib.upload import (
+    S3Transfer,
+    S3UploadBackend,
+    get_s3_upload_args,
+    upload_files_to_s3,
+)
 from zerver.models import Attachment, RealmEmoji, UserProfile
 
 s3backend = S3UploadBackend()
 
-def transfer_uploads_to_s3(processes: int) -> None:
+def transfer_uploads_to_s3(processes: int, manifest_path: Optional[str]=None) -> None:
     # TODO: Eventually, we'll want to add realm icon and logo
     transfer_avatars_to_s3(processes)
-    transfer_message_files_to_s3(processes)
+    transfer_message_files_to_s3(processes, manifest_path)
     transfer_emoji_to_s3(processes)
 
 def transfer_avatars_to_s3(processes: int) -> None:
@@ -40,27 +46,20 @@ def transfer_avatars_to_s3(processes: int) -> None:
         for (status, job) in run_parallel(_transfer_avatar_to_s3, users, processes):
             output.append(job)
 
-def transfer_message_files_to_s3(processes: int) -> None:
-    def _transfer_message_files_to_s3(attachment: Attachment) -> int:
-        file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, "files", attachment.path_id)
-        try:
-            with open(file_path, 'rb') as f:
-                guessed_type = guess_type(attachment.file_name)[0]
-                upload_image_to_s3(s3backend.uploads_bucket, attachment.path_id, guessed_type, attachment.owner, f.read())
-                logging.info("Uploaded message file in path %s", file_path)
-        except FileNotFoundError:  # nocoverage
-            pass
-        return 0
+def transfer_message_files_to_s3(processes: int, manifest_path: Optional[str]=None) -> None:
+    # Message files are copied as they are, so rather than using
+    # `processes`, we leave them to the bulk S3 transfer engine.
+    def get_transfers() -> Iterator[S3Transfer]:
+        for attachment in Attachment.objects.select_related('owner').iterator():
+            file_path = os.path.join(settings.LOCAL_UPLOADS_DIR, "files", attachment.path_id)
+            if not os.path.exists(file_path):  # nocoverage
+                continue
+            guessed_type = guess_type(attachment.file_name)[0]
+            yield S3Transfer(key=attachment.path_id, filename=file_path,
+                             extra_args=get_s3_upload_args(guessed_type, attachment.owner))
 
-    attachments = list(Attachment.objects.all())
-    if processes == 1:
-        for attachment in attachments:
-            _transfer_message_files_to_s3(attachment)
-    else:  # nocoverage
-        output = []
-        connection.close()
-        for status, job in run_parallel(_transfer_message_files_to_s3, attachments, processes):
-            output.append(job)
+    upload_files_to_s3(settings.S3_AUTH_UPLOADS_BUCKET, get_transfers(), manifest_path=manifest_path)
+    logging.info("Uploaded message files")
 
 def transfer_emoji_to_s3(processes: int) -> None:
     def _transfer_emoji_to_s3(realm_emoji: RealmEmoji) -> int:
@@ -1,21 +1,28 @@
 import base64
 import binascii
+import functools
 import io
+import itertools
 import logging
 import os
 import random
 import re
 import shutil
 import sys
+import time
 import unicodedata
 import urllib
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from datetime import timedelta
 from mimetypes import guess_extension, guess_type
-from typing import Any, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Set, Tuple, TypeVar
 
 import boto3
 import botocore
+from boto3.exceptions import S3TransferFailedError, S3UploadFailedError
 from boto3.resources.base import ServiceResource
+from boto3.s3.transfer import TransferConfig
 from boto3.session import Session
 from botocore.client import Config
 from django.conf import settings
@@ -44,6 +51,8 @@ DEFAULT_EMOJI_SIZE = 64
 MAX_EMOJI_GIF_SIZE = 128
 MAX_EMOJI_GIF_FILE_SIZE_BYTES = 128 * 1024 * 1024  # 128 kb
 
+ResultT = TypeVar('ResultT')
+
 # Duration that the signed upload URLs that we redirect to when
 # accessing uploaded files are available for clients to fetch before
 # they expire.
@@ -281,6 +290,9 @@ def upload_image_to_s3(
         user_profile: UserProfile,
         contents: bytes) -> None:
     key = bucket.Object(file_name)
+    key.put(Body=contents, **get_s3_upload_args(content_type, user_profile))
+
+def get_s3_upload_args(content_type: Optional[str], user_profile: UserProfile) -> Dict[str, Any]:
     metadata = {
         "user_profile_id": str(user_profile.id),
         "realm_id": str(user_profile.realm_id),
@@ -292,8 +304,149 @@ def upload_image_to_s3(
     if content_type not in INLINE_MIME_TYPES:
         content_disposition = "attachment"
 
-    key.put(Body=contents, Metadata=metadata, ContentType=content_type,
-            ContentDisposition=content_disposition)
+    return dict(Metadata=metadata, ContentType=content_type,
+                ContentDisposition=content_disposition)
+
+# The bulk S3 transfers, for moving a realm's files in and out of S3
+# (imports, exports, and transfer_uploads_to_s3), are latency-bound,
+# so we run many of them at once, with one file per thread.  Files
+# larger than the multipart threshold are transferred in parts, with
+# each part retried separately.
+S3_TRANSFER_THREADS = 32
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                                    multipart_chunksize=S3_MULTIPART_THRESHOLD,
+                                    use_threads=False)
+S3_TRANSFER_ATTEMPTS = 5
+S3_TRANSFER_BACKOFF = 0.5
+S3_TRANSFER_ERRORS = (botocore.exceptions.BotoCoreError,
+                      botocore.exceptions.ClientError,
+                      S3TransferFailedError,
+                      S3UploadFailedError)
+# Errors from S3 itself are only worth retrying if they're throttling,
+# or a 5xx; anything else (AccessDenied, NoSuchKey, ...) will just
+# happen again.
+S3_TRANSFER_RETRYABLE_ERROR_CODES = frozenset([
+    'InternalError', 'RequestLimitExceeded', 'RequestThrottled', 'RequestTimeout',
+    'ServiceUnavailable', 'SlowDown', 'Throttling', 'ThrottlingException',
+])
+
+def is_retryable_s3_error(error: Exception) -> bool:
+    # boto3 wraps the ClientError from a failed upload or download.
+    if isinstance(error, (S3TransferFailedError, S3UploadFailedError)) and \
+            isinstance(error.__context__, botocore.exceptions.ClientError):
+        return is_retryable_s3_error(error.__context__)
+    if not isinstance(error, botocore.exceptions.ClientError):
+        # Connection errors and the like.
+        return True
+    if error.response.get('Error', {}).get('Code') in S3_TRANSFER_RETRYABLE_ERROR_CODES:
+        return True
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+@dataclass
+class S3Transfer:
+    """A file to copy between the local disk and an S3 bucket, with
+    the boto3 ExtraArgs (ContentType, Metadata, ...) to upload it with."""
+    key: str
+    filename: str
+    extra_args: Dict[str, Any] = field(default_factory=dict)
+
+def get_s3_transfer_client(threads: int) -> Any:
+    session = boto3.Session(settings.S3_KEY, settings.S3_SECRET_KEY)
+    # Clients, unlike resources, are safe to share between threads.
+    return session.client('s3', config=Config(max_pool_connections=threads))
+
+def with_s3_retries(transfer: S3Transfer, action: Callable[[], ResultT]) -> ResultT:
+    for attempt in range(1, S3_TRANSFER_ATTEMPTS + 1):
+        try:
+            return action()
+        except S3_TRANSFER_ERRORS as e:
+            if attempt == S3_TRANSFER_ATTEMPTS or not is_retryable_s3_error(e):
+                raise
+            logging.warning("Attempt %s to transfer %s failed; retrying", attempt, transfer.key,
+                            exc_info=True)
+            # Exponential backoff, with jitter so the threads don't
+            # all retry at once.
+            time.sleep(S3_TRANSFER_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+    raise AssertionError("unreachable")
+
+def run_s3_transfers(transfers: Iterable[S3Transfer],
+                     transfer_one: Callable[[S3Transfer], ResultT],
+                     threads: int) -> Iterator[Tuple[S3Transfer, ResultT]]:
+    """Runs transfer_one on each transfer in a pool of threads, yielding
+    each transfer and its result as it finishes.  Only a few transfers
+    per thread are queued at a time, so that millions of them don't
+    have to be held in memory at once."""
+    count = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending: Dict[Future[ResultT], S3Transfer] = {}
+        transfer_iterator = iter(transfers)
+        while True:
+            for transfer in itertools.islice(transfer_iterator, 2 * threads - len(pending)):
+                pending[executor.submit(with_s3_retries, transfer,
+                                        functools.partial(transfer_one, transfer))] = transfer
+            if not pending:
+                break
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                transfer = pending.pop(future)
+                yield transfer, future.result()
+                count += 1
+                if count % 1000 == 0:
+                    logging.info("Transferred %s files", count)
+
+def upload_files_to_s3(bucket_name: str, transfers: Iterable[S3Transfer],
+                       manifest_path: Optional[str]=None,
+                       threads: int=S3_TRANSFER_THREADS) -> None:
+    """Uploads the files to the bucket.  With a manifest_path, the key
+    of each file uploaded is recorded there, so that if this dies, it
+    can be re-run, and skip the files that were already uploaded."""
+    client = get_s3_transfer_client(threads)
+
+    uploaded: Set[str] = set()
+    if manifest_path is not None and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            # Skip a line cut short by a crash; that file was still
+            # uploaded, but uploading it again is harmless.
+            uploaded = {line[:-1] for line in f if line.endswith('\n')}
+        logging.info("Skipping %s files that were already uploaded", len(uploaded))
+
+    def upload_one(transfer: S3Transfer) -> None:
+        client.upload_file(transfer.filename, bucket_name, transfer.key,
+                           ExtraArgs=transfer.extra_args, Config=S3_TRANSFER_CONFIG)
+
+    manifest = open(manifest_path, 'a') if manifest_path is not None else None
+    try:
+        for transfer, result in run_s3_transfers(
+                (transfer for transfer in transfers if transfer.key not in uploaded),
+                upload_one, threads):
+            if manifest is not None:
+                manifest.write(transfer.key + '\n')
+                manifest.flush()
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+def download_files_from_s3(bucket_name: str, transfers: Iterable[S3Transfer],
+                           threads: int=S3_TRANSFER_THREADS,
+                           check_head: Optional[Callable[[S3Transfer, Dict[str, Any]], None]]=None,
+                           ) -> Iterator[Tuple[S3Transfer, Dict[str, Any]]]:
+    """Downloads the files from the bucket, yielding each transfer with
+    the HEAD response for its object (its size, metadata, etc.) as it
+    finishes, in no particular order.  check_head, if given, is called
+    with each HEAD response before its file is downloaded, and can
+    raise to keep an object we shouldn't have out of the output."""
+    client = get_s3_transfer_client(threads)
+
+    def download_one(transfer: S3Transfer) -> Dict[str, Any]:
+        head = client.head_object(Bucket=bucket_name, Key=transfer.key)
+        if check_head is not None:
+            check_head(transfer, head)
+        os.makedirs(os.path.dirname(transfer.filename), exist_ok=True)
+        client.download_file(bucket_name, transfer.key, transfer.filename,
+                             Config=S3_TRANSFER_CONFIG)
+        return head
+
+    return run_s3_transfers(transfers, download_one, threads)
 
 def check_upload_within_quota(realm: Realm, uploaded_file_size: int) -> None:
     upload_quota = realm.upload_quota_bytes()
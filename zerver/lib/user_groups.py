@@ -3,6 +3,7 @@ from typing import Any, Dict, List
 from django.db import transaction
 from django.utils.translation import ugettext as _
 
+from zerver.lib.cache import flush_realm_mention_index
 from zerver.lib.exceptions import JsonableError
 from zerver.models import Realm, UserGroup, UserGroupMembership, UserProfile
 
@@ -53,11 +54,13 @@ def get_user_groups(user_profile: UserProfile) -> List[UserGroup]:
 def check_add_user_to_user_group(user_profile: UserProfile, user_group: UserGroup) -> bool:
     member_obj, created = UserGroupMembership.objects.get_or_create(
         user_group=user_group, user_profile=user_profile)
+    flush_realm_mention_index(user_group.realm_id)
     return created
 
 def remove_user_from_user_group(user_profile: UserProfile, user_group: UserGroup) -> int:
     num_deleted, _ = UserGroupMembership.objects.filter(
         user_profile=user_profile, user_group=user_group).delete()
+    flush_realm_mention_index(user_group.realm_id)
     return num_deleted
 
 def check_remove_user_from_user_group(user_profile: UserProfile, user_group: UserGroup) -> bool:
@@ -76,6 +79,8 @@ def create_user_group(name: str, members: List[UserProfile], realm: Realm,
             UserGroupMembership(user_profile=member, user_group=user_group)
             for member in members
         ])
+        # Django bulk_create operations don't flush caches, so we need to do this ourselves.
+        flush_realm_mention_index(realm.id)
         return user_group
 
 def get_user_group_members(user_group: UserGroup) -> List[UserProfile]:
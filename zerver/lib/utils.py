@@ -9,6 +9,7 @@ from itertools import zip_longest
 from time import sleep
 from typing import Any, Callable, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar
 
+import ujson
 from django.conf import settings
 
 T = TypeVar('T')
@@ -196,3 +197,11 @@ def split_by(array: List[Any], group_size: int, filler: Any) -> List[List[Any]]:
     """
     args = [iter(array)] * group_size
     return list(map(list, zip_longest(*args, fillvalue=filler)))
+
+def write_json_atomically(filename: str, data: Any) -> None:
+    # A crash mid-write must not leave a truncated file behind.
+    with open(filename + '.tmp', 'w') as f:
+        ujson.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + '.tmp', filename)
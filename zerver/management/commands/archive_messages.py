@@ -1,12 +1,17 @@
 from typing import Any
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandParser
 
 from zerver.lib.retention import archive_messages, clean_archived_data
 
 
 class Command(BaseCommand):
 
-    def handle(self, *args: Any, **options: str) -> None:
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--processes', type=int,
+                            help='Number of realms to archive at once; '
+                                 'defaults to settings.RETENTION_ARCHIVING_PROCESSES')
+
+    def handle(self, *args: Any, **options: Any) -> None:
         clean_archived_data()
-        archive_messages()
+        archive_messages(processes=options['processes'])
@@ -89,7 +89,8 @@ class Command(ZulipBaseCommand):
                             dest='threads',
                             action="store",
                             default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
-                            help='Threads to use in exporting UserMessage objects in parallel')
+                            help='Processes to use in exporting UserMessage objects and uploaded '
+                                 'files in parallel')
         parser.add_argument('--public-only',
                             action="store_true",
                             help='Export only public stream messages and associated attachments')
@@ -99,6 +100,10 @@ class Command(ZulipBaseCommand):
                             default=None,
                             type=int,
                             help='ID of the message advertising users to react with thumbs up')
+        parser.add_argument('--streaming',
+                            action="store_true",
+                            help='Write messages to compressed shards as they are read, '
+                                 'rather than to JSON files; uses much less memory for large realms')
         parser.add_argument('--upload',
                             action="store_true",
                             help="Whether to upload resulting tarball to s3 or LOCAL_UPLOADS_DIR")
@@ -173,4 +178,5 @@ class Command(ZulipBaseCommand):
                              threads=num_threads, upload=options['upload'],
                              public_only=public_only,
                              delete_after_upload=options["delete_after_upload"],
-                             consent_message_id=consent_message_id)
+                             consent_message_id=consent_message_id,
+                             streaming=options['streaming'])
@@ -7,7 +7,7 @@ from typing import Any
 
 from django.core.management.base import BaseCommand
 
-from zerver.lib.export import export_usermessages_batch
+from zerver.lib.export import export_usermessages_batch, export_usermessages_shard
 
 
 class Command(BaseCommand):
@@ -33,10 +33,11 @@ class Command(BaseCommand):
 
     def handle(self, *args: Any, **options: Any) -> None:
         logging.info("Starting UserMessage batch thread %s", options['thread'])
-        files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')))
+        files = set(glob.glob(os.path.join(options['path'], 'messages-*.json.partial')) +
+                    glob.glob(os.path.join(options['path'], 'messages-*.jsonl.gz.partial')))
         for partial_path in files:
-            locked_path = partial_path.replace(".json.partial", ".json.locked")
-            output_path = partial_path.replace(".json.partial", ".json")
+            output_path = partial_path[:-len(".partial")]
+            locked_path = output_path + ".locked"
             try:
                 shutil.move(partial_path, locked_path)
             except Exception:
@@ -44,7 +45,12 @@ class Command(BaseCommand):
                 continue
             logging.info("Thread %s processing %s", options['thread'], output_path)
             try:
-                export_usermessages_batch(locked_path, output_path, options["consent_message_id"])
+                if output_path.endswith(".jsonl.gz"):
+                    export_usermessages_shard(locked_path, output_path,
+                                              options["consent_message_id"])
+                else:
+                    export_usermessages_batch(locked_path, output_path,
+                                              options["consent_message_id"])
             except Exception:
                 # Put the item back in the free pool when we fail
                 shutil.move(locked_path, partial_path)
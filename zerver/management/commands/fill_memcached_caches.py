@@ -1,20 +1,60 @@
+import os
 from argparse import ArgumentParser
-from typing import Any, Optional
+from typing import Any, Dict
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
-from zerver.lib.cache_helpers import cache_fillers, fill_remote_cache
+from zerver.lib.cache_helpers import cache_fillers, remote_cache_is_cold, warm_remote_caches
+from zerver.lib.context_managers import lockfile
 
 
 class Command(BaseCommand):
+    help = """Warm the memcached caches, most active realms first.
+
+Run with --if-cold from cron to automatically re-warm the caches after
+memcached has been restarted."""
+
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument('--cache', dest="cache", default=None,
-                            help="Populate the memcached cache of messages.")
+                            choices=list(cache_fillers.keys()),
+                            help="Only populate this memcached cache.")
+        parser.add_argument('--processes',
+                            dest='processes',
+                            type=int,
+                            default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
+                            help='Processes to use for filling caches in parallel.')
+        parser.add_argument('--db-load-budget',
+                            dest='db_load_budget',
+                            type=float,
+                            default=1.0,
+                            help='Fraction of the time each process may spend querying '
+                                 'the database, between 0 and 1; lower values go slower '
+                                 'but leave more database capacity for real requests.')
+        parser.add_argument('--if-cold',
+                            dest='if_cold',
+                            action='store_true',
+                            help="Only fill the caches if they haven't been warmed "
+                                 "since memcached was last restarted.")
 
-    def handle(self, *args: Any, **options: Optional[str]) -> None:
-        if options["cache"] is not None:
-            fill_remote_cache(options["cache"])
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options['processes'] < 1:
+            raise CommandError('You must have at least one process.')
+        if not 0 < options['db_load_budget'] <= 1:
+            raise CommandError('--db-load-budget must be between 0 and 1.')
+        if options['if_cold']:
+            # A cron job may start while a previous warm-up is still
+            # running; wait for it, and then only proceed if it failed.
+            with lockfile(os.path.join(settings.DEPLOY_ROOT, "var", "fill_memcached_caches.lock")):
+                if remote_cache_is_cold():
+                    self.warm(options)
             return
+        self.warm(options)
 
-        for cache in cache_fillers.keys():
-            fill_remote_cache(cache)
+    def warm(self, options: Dict[str, Any]) -> None:
+        caches = None
+        if options["cache"] is not None:
+            caches = [options["cache"]]
+        warm_remote_caches(processes=options['processes'],
+                           db_load_budget=options['db_load_budget'],
+                           caches=caches)
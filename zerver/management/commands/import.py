@@ -8,7 +8,7 @@ from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError, CommandParser
 
 from zerver.forms import check_subdomain_available
-from zerver.lib.import_realm import do_import_realm, do_import_system_bots
+from zerver.lib.import_realm import do_import_realm, do_import_system_bots, resume_import_realm
 
 
 class Command(BaseCommand):
@@ -30,6 +30,12 @@ import a database dump from one or more JSON files."""
                             action="store_true",
                             help='Import into an existing nonempty database.')
 
+        parser.add_argument('--resume',
+                            dest='resume',
+                            default=False,
+                            action="store_true",
+                            help='Resume an import that died while importing messages.')
+
         parser.add_argument('subdomain', metavar='<subdomain>',
                             type=str, help="Subdomain")
 
@@ -40,7 +46,8 @@ import a database dump from one or more JSON files."""
                             dest='processes',
                             action="store",
                             default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
-                            help='Number of processes to use for uploading Avatars to S3 in parallel')
+                            help='Number of processes to use for importing messages and uploading\n'
+                                 'Avatars to S3 in parallel')
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def do_destroy_and_rebuild_database(self, db_name: str) -> None:
@@ -54,6 +61,9 @@ import a database dump from one or more JSON files."""
 
         subdomain = options['subdomain']
 
+        if options["resume"] and options["destroy_rebuild_database"]:
+            raise CommandError("Resuming an import requires the database it was importing into.")
+
         if options["destroy_rebuild_database"]:
             print("Rebuilding the database!")
             db_name = settings.DATABASES['default']['NAME']
@@ -61,7 +71,8 @@ import a database dump from one or more JSON files."""
         elif options["import_into_nonempty"]:
             print("NOTE: The argument 'import_into_nonempty' is now the default behavior.")
 
-        check_subdomain_available(subdomain, from_management_command=True)
+        if not options["resume"]:
+            check_subdomain_available(subdomain, from_management_command=True)
 
         paths = []
         for path in options['export_paths']:
@@ -74,7 +85,11 @@ import a database dump from one or more JSON files."""
             paths.append(path)
 
         for path in paths:
-            print(f"Processing dump: {path} ...")
-            realm = do_import_realm(path, subdomain, num_processes)
+            if options["resume"]:
+                print(f"Resuming import of dump: {path} ...")
+                realm = resume_import_realm(path, num_processes)
+            else:
+                print(f"Processing dump: {path} ...")
+                realm = do_import_realm(path, subdomain, num_processes)
             print("Checking the system bots.")
             do_import_system_bots(realm)
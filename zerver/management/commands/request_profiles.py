@@ -0,0 +1,38 @@
+from argparse import ArgumentParser
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from zerver.lib.request_profiling import read_call_profiles, summarize_call_profiles
+
+
+class Command(BaseCommand):
+    help = """Summarize the slowest database queries and remote cache calls
+recorded by request profiling (see REQUEST_PROFILING_SAMPLE_RATE)."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Number of entries to show.')
+        parser.add_argument('--path', dest='path_prefix', default=None,
+                            help='Only include requests whose path starts with this.')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        # Also read the most recently rotated log, which logrotate
+        # leaves uncompressed.
+        log_path = settings.REQUEST_PROFILING_LOG_PATH
+        records = read_call_profiles([log_path + '.1', log_path])
+        if options['path_prefix'] is not None:
+            records = [record for record in records
+                       if record['path'].startswith(options['path_prefix'])]
+        if not records:
+            print("No profiled requests logged.")
+            return
+
+        print(f"{len(records)} slow profiled requests")
+        print(f"{'count':>6} {'total':>9} {'max':>9}  call")
+        for entry in summarize_call_profiles(records)[:options['limit']]:
+            print(f"{entry['count']:>6} {entry['total_time'] * 1000:>7.0f}ms "
+                  f"{entry['max_time'] * 1000:>7.0f}ms  "
+                  f"{entry['kind']}: {entry['name']}")
+            print(f"{'':>26}at {entry['call_site']}")
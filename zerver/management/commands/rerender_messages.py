@@ -0,0 +1,124 @@
+import os
+import time
+from argparse import ArgumentParser
+from typing import Any, Dict, List, Optional, Tuple
+
+import ujson
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from zerver.lib.markdown import version as markdown_version
+from zerver.lib.message import rerender_stale_messages
+from zerver.lib.parallel import run_parallel_queue
+from zerver.lib.utils import write_json_atomically
+from zerver.models import Message
+
+# An inclusive (min_id, max_id) range of message IDs.
+Batch = Tuple[int, int]
+
+class Command(BaseCommand):
+    help = """Re-render messages whose rendered content is from an older
+markdown version, newest first.
+
+Otherwise, such messages are re-rendered when they are fetched, which
+slows down fetching messages for a long time after a markdown version
+bump.  Progress is checkpointed, so the command can be interrupted and
+re-run to pick up where it left off."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('--processes',
+                            dest='processes',
+                            type=int,
+                            default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
+                            help='Processes to use for rendering in parallel.')
+        parser.add_argument('--batch-size',
+                            dest='batch_size',
+                            type=int,
+                            default=1000,
+                            help='Number of message IDs in each batch.')
+        parser.add_argument('--max-rate',
+                            dest='max_rate',
+                            type=float,
+                            default=0,
+                            help='Maximum number of messages to re-render per second, '
+                                 'across all processes; 0 for no limit.')
+        parser.add_argument('--checkpoint-file',
+                            dest='checkpoint_file',
+                            default=os.path.join(settings.DEPLOY_ROOT, 'var',
+                                                 'rerender_messages.checkpoint'),
+                            help='File recording how far we have got.')
+        parser.add_argument('--restart',
+                            dest='restart',
+                            action='store_true',
+                            help='Ignore the checkpoint, and start again from the newest message.')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options['processes'] < 1:
+            raise CommandError('You must have at least one process.')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        checkpoint_file = options['checkpoint_file']
+        max_id = None if options['restart'] else self.read_checkpoint(checkpoint_file)
+        if max_id is None:
+            newest = Message.objects.only('id').order_by('-id').first()
+            if newest is None:
+                self.stdout.write('No messages to re-render.')
+                return
+            max_id = newest.id
+
+        batch_size = options['batch_size']
+        batches: List[Batch] = [(max(batch_max_id - batch_size + 1, 1), batch_max_id)
+                                for batch_max_id in range(max_id, 0, -batch_size)]
+        if not batches:
+            self.stdout.write('No messages left to re-render.')
+            return
+        rate_per_process = options['max_rate'] / options['processes']
+        # With more than one process of our own rendering in parallel,
+        # a render pool in each of them would just multiply the number
+        # of processes.
+        render_processes = 0 if options['processes'] > 1 else None
+
+        def rerender_batch(batch: Batch) -> Tuple[int, int]:
+            start = time.time()
+            rendered, failed = rerender_stale_messages(*batch, render_processes=render_processes)
+            if rate_per_process > 0:
+                time.sleep(max(rendered / rate_per_process - (time.time() - start), 0))
+            return rendered, failed
+
+        # Batches finish out of order; we checkpoint below the newest
+        # batch that hasn't finished yet.
+        finished = set()
+        next_batch = 0
+        rendered = 0
+        failed = 0
+        start = time.time()
+        for batch, (batch_rendered, batch_failed) in run_parallel_queue(
+                rerender_batch, batches, options['processes']):
+            finished.add(batch)
+            rendered += batch_rendered
+            failed += batch_failed
+            checkpoint_batch = next_batch
+            while next_batch < len(batches) and batches[next_batch] in finished:
+                next_batch += 1
+            if next_batch > checkpoint_batch:
+                self.write_checkpoint(checkpoint_file, batches[next_batch - 1][0] - 1)
+            self.stdout.write(
+                f'{len(finished)}/{len(batches)} batches: re-rendered {rendered} messages '
+                f'({rendered / max(time.time() - start, 0.001):.1f}/s), {failed} failed')
+        self.stdout.write('Done.')
+
+    def read_checkpoint(self, checkpoint_file: str) -> Optional[int]:
+        if not os.path.exists(checkpoint_file):
+            return None
+        with open(checkpoint_file) as f:
+            checkpoint: Dict[str, int] = ujson.load(f)
+        # A checkpoint from before another markdown version bump is
+        # no use; the messages above it are stale again.
+        if checkpoint['markdown_version'] != markdown_version:
+            return None
+        self.stdout.write(f'Resuming from message {checkpoint["max_id"]}.')
+        return checkpoint['max_id']
+
+    def write_checkpoint(self, checkpoint_file: str, max_id: int) -> None:
+        write_json_atomically(checkpoint_file, {'markdown_version': markdown_version, 'max_id': max_id})
@@ -14,7 +14,13 @@ class Command(BaseCommand):
                             dest='processes',
                             action="store",
                             default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
-                            help='Processes to use for exporting uploads in parallel')
+                            help='Processes to use for transferring avatars and emoji in parallel; '
+                                 'message files are transferred by a pool of threads.')
+        parser.add_argument('--manifest',
+                            dest='manifest',
+                            default=None,
+                            help='File in which to record the message files transferred, '
+                                 'so that a re-run with the same manifest skips them.')
 
     def handle(self, *args: Any, **options: Any) -> None:
         num_processes = int(options['processes'])
@@ -24,5 +30,5 @@ class Command(BaseCommand):
         if not settings.LOCAL_UPLOADS_DIR:
             raise CommandError('Please set the value of LOCAL_UPLOADS_DIR.')
 
-        transfer_uploads_to_s3(num_processes)
+        transfer_uploads_to_s3(num_processes, options['manifest'])
         print("Transfer to S3 completed successfully.")
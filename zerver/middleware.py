@@ -17,10 +17,16 @@ from django.views.csrf import csrf_failure as html_csrf_failure
 from zerver.lib.cache import get_remote_cache_requests, get_remote_cache_time
 from zerver.lib.db import reset_queries
 from zerver.lib.debug import maybe_tracemalloc_listen
+from zerver.lib.duplicate_queries import (
+    finish_duplicate_query_detection,
+    start_duplicate_query_detection,
+)
 from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
 from zerver.lib.html_to_text import get_content_description
+from zerver.lib.logging_util import log_to_file
 from zerver.lib.markdown import get_markdown_requests, get_markdown_time
 from zerver.lib.rate_limiter import RateLimitResult
+from zerver.lib.request_profiling import finish_call_profile, log_call_profile, start_call_profile
 from zerver.lib.response import json_error, json_response_from_error
 from zerver.lib.subdomains import get_subdomain
 from zerver.lib.types import ViewFuncT
@@ -29,6 +35,10 @@ from zerver.models import Realm, flush_per_request_caches, get_realm
 
 logger = logging.getLogger('zulip.requests')
 slow_query_logger = logging.getLogger('zulip.slow_queries')
+# Each line of the request profiling log is a JSON record, for
+# read_call_profiles.
+log_to_file(logging.getLogger('zulip.request_profiles'), settings.REQUEST_PROFILING_LOG_PATH,
+            log_format='%(message)s')
 
 def record_request_stop_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['time_stopped'] = time.time()
@@ -38,6 +48,10 @@ def record_request_stop_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['markdown_requests_stopped'] = get_markdown_requests()
     if settings.PROFILE_ALL_REQUESTS:
         log_data["prof"].disable()
+    # Other requests will be handled while this one is suspended, so
+    # we can't keep attributing calls to it.
+    finish_call_profile()
+    finish_duplicate_query_detection(None)
 
 def async_request_timer_stop(request: HttpRequest) -> None:
     record_request_stop_data(request._log_data)
@@ -64,6 +78,8 @@ def record_request_start_data(log_data: MutableMapping[str, Any]) -> None:
         log_data["prof"].enable()
 
     reset_queries()
+    start_call_profile()
+    start_duplicate_query_detection()
     log_data['time_started'] = time.time()
     log_data['remote_cache_time_start'] = get_remote_cache_time()
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
@@ -203,6 +219,11 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
     if (is_slow_query(time_delta, path)):
         slow_query_logger.info(logger_line)
 
+    finish_duplicate_query_detection(f"{method} {path}")
+    call_profile = finish_call_profile()
+    if call_profile is not None:
+        log_call_profile(call_profile, path, method, time_delta)
+
     if settings.PROFILE_ALL_REQUESTS:
         log_data["prof"].disable()
         profile_path = "/tmp/profile.data.{}.{}".format(path.split("/")[-1], int(time_delta * 1000))
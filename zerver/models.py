@@ -49,14 +49,15 @@ from zerver.lib.cache import (
     cache_with_key,
     flush_message,
     flush_realm,
+    flush_realm_mention_index,
     flush_stream,
     flush_submessage,
     flush_used_upload_space_cache,
     flush_user_profile,
     get_realm_used_upload_space_cache_key,
     get_stream_cache_key,
-    realm_alert_words_automaton_cache_key,
     realm_alert_words_cache_key,
+    realm_alert_words_version_cache_key,
     realm_user_dict_fields,
     realm_user_dicts_cache_key,
     user_profile_by_api_key_cache_key,
@@ -1313,6 +1314,12 @@ class UserGroupMembership(models.Model):
     class Meta:
         unique_together = (('user_group', 'user_profile'),)
 
+def flush_user_group(sender: Any, **kwargs: Any) -> None:
+    flush_realm_mention_index(kwargs['instance'].realm_id)
+
+post_save.connect(flush_user_group, sender=UserGroup)
+post_delete.connect(flush_user_group, sender=UserGroup)
+
 def receives_offline_push_notifications(user_profile: UserProfile) -> bool:
     return (user_profile.enable_offline_push_notifications and
             not user_profile.is_bot)
@@ -3024,7 +3031,7 @@ class AlertWord(models.Model):
 
 def flush_realm_alert_words(realm: Realm) -> None:
     cache_delete(realm_alert_words_cache_key(realm))
-    cache_delete(realm_alert_words_automaton_cache_key(realm))
+    cache_delete(realm_alert_words_version_cache_key(realm))
 
 def flush_alert_word(sender: Any, **kwargs: Any) -> None:
     realm = kwargs['instance'].realm
@@ -1,7 +1,13 @@
+from unittest import mock
+
 import ujson
 
 from zerver.lib.actions import do_add_alert_words, do_remove_alert_words
-from zerver.lib.alert_words import alert_words_in_realm, user_alert_words
+from zerver.lib.alert_words import (
+    alert_words_in_realm,
+    get_alert_word_automaton,
+    user_alert_words,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, most_recent_usermessage
 from zerver.models import AlertWord, UserProfile
@@ -113,6 +119,33 @@ class AlertWordTests(ZulipTestCase):
                          set(self.interesting_alert_word_list))
         self.assertEqual(set(realm_words[user2.id]), {'another'})
 
+    def test_alert_word_automaton(self) -> None:
+        AlertWord.objects.all().delete()
+        user1 = self.get_user()
+        user2 = self.example_user('othello')
+        realm = user1.realm
+        self.assertIsNone(get_alert_word_automaton(realm))
+
+        do_add_alert_words(user1, ['Alert', 'milk'])
+        automaton = get_alert_word_automaton(realm)
+        assert automaton is not None
+        self.assertEqual(automaton.get('alert'), ('alert', {user1.id}))
+
+        # Changes update this process's automaton in place.
+        with mock.patch('zerver.lib.alert_words.ahocorasick.Automaton') as new_automaton:
+            do_add_alert_words(user2, ['alert', 'cookies'])
+            do_remove_alert_words(user1, ['milk'])
+            self.assertIs(get_alert_word_automaton(realm), automaton)
+        new_automaton.assert_not_called()
+        self.assertEqual(automaton.get('alert'), ('alert', {user1.id, user2.id}))
+        self.assertEqual(automaton.get('cookies'), ('cookies', {user2.id}))
+        self.assertFalse(automaton.exists('milk'))
+
+        # Without changes, we don't even fetch the realm's words.
+        with mock.patch('zerver.lib.alert_words.alert_words_in_realm') as words_in_realm:
+            self.assertIs(get_alert_word_automaton(realm), automaton)
+        words_in_realm.assert_not_called()
+
     def test_json_list_default(self) -> None:
         user = self.get_user()
         self.login_user(user)
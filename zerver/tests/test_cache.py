@@ -2,8 +2,11 @@ from typing import Any, Dict, List, Optional
 from unittest.mock import Mock, patch
 
 from django.conf import settings
+from django.utils.timezone import now as timezone_now
 
+from analytics.models import RealmCount
 from zerver.apps import flush_cache
+from zerver.lib import cache_helpers
 from zerver.lib.cache import (
     MEMCACHED_MAX_KEY_LENGTH,
     InvalidCacheKeyException,
@@ -16,15 +19,23 @@ from zerver.lib.cache import (
     cache_set,
     cache_set_many,
     cache_with_key,
+    generic_bulk_cached_fetch,
     get_cache_with_key,
     safe_cache_get_many,
     safe_cache_set_many,
+    to_dict_cache_key_id,
     user_profile_by_email_cache_key,
+    user_profile_cache_key,
     validate_cache_key,
 )
+from zerver.lib.cache_helpers import (
+    get_cache_warming_plan,
+    remote_cache_is_cold,
+    warm_remote_caches,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import queries_captured
-from zerver.models import UserProfile, get_system_bot, get_user_profile_by_email
+from zerver.models import UserProfile, get_realm, get_system_bot, get_user_profile_by_email
 
 
 class AppsTest(ZulipTestCase):
@@ -325,3 +336,89 @@ class GenericBulkCachedFetchTest(ZulipTestCase):
             id_fetcher=get_user_email,
         )
         self.assertEqual(result, {})
+
+    def test_misses_fetched_in_batches(self) -> None:
+        queried: List[List[int]] = []
+
+        def query_function(ids: List[int]) -> List[Dict[str, int]]:
+            queried.append(ids)
+            return [{'id': object_id} for object_id in ids]
+
+        def fetch() -> Dict[int, Dict[str, int]]:
+            return generic_bulk_cached_fetch(
+                cache_key_function=lambda object_id: f'test_batched_fetch:{object_id}',
+                query_function=query_function,
+                object_ids=[1, 2, 3, 4, 5],
+                extractor=lambda obj: obj,
+                setter=lambda obj: obj,
+                id_fetcher=lambda obj: obj['id'],
+                cache_transformer=lambda obj: obj,
+            )
+
+        with patch('zerver.lib.cache.BULK_FETCH_BATCH_SIZE', 2):
+            result = fetch()
+        self.assertEqual(queried, [[1, 2], [3, 4], [5]])
+        self.assertEqual(sorted(result), [1, 2, 3, 4, 5])
+
+        # Everything is now cached.
+        queried.clear()
+        result = fetch()
+        self.assertEqual(queried, [])
+        self.assertEqual(result[3], {'id': 3})
+
+class CacheWarmingTest(ZulipTestCase):
+    def test_warm_remote_caches(self) -> None:
+        zulip_realm = get_realm('zulip')
+        lear_realm = get_realm('lear')
+        end_time = timezone_now()
+        RealmCount.objects.create(realm=zulip_realm, property='1day_actives::day',
+                                  end_time=end_time, value=5)
+        RealmCount.objects.create(realm=lear_realm, property='1day_actives::day',
+                                  end_time=end_time, value=10)
+
+        self.assertEqual(get_cache_warming_plan(), [
+            ('client', None),
+            ('huddle', None),
+            ('user', lear_realm.id),
+            ('stream', lear_realm.id),
+            ('user', zulip_realm.id),
+            ('stream', zulip_realm.id),
+            ('session', None),
+            ('message', lear_realm.id),
+            ('message', zulip_realm.id),
+        ])
+
+        hamlet = self.example_user('hamlet')
+        message_id = self.send_stream_message(hamlet, 'Denmark', 'warm me up')
+        flush_cache(Mock())
+        self.assertTrue(remote_cache_is_cold())
+        with self.assertLogs(level='INFO'):
+            stats = warm_remote_caches(caches=['user', 'message'])
+        # Only warming some of the caches leaves the cache cold.
+        self.assertTrue(remote_cache_is_cold())
+        self.assertEqual(stats['user']['completed_tasks'], 2)
+        self.assertEqual(stats['message']['tasks'], 2)
+        self.assertGreater(stats['message']['keys'], 0)
+        self.assertIsNotNone(cache_get(to_dict_cache_key_id(message_id)))
+        self.assertIsNotNone(cache_get(user_profile_cache_key(hamlet.email, hamlet.realm)))
+
+        # A task which fails is reported, and doesn't stop the others.
+        flush_cache(Mock())
+        fill_remote_cache = cache_helpers.fill_remote_cache
+
+        def fail_for_lear(cache: str, realm_id: Optional[int], db_load_budget: float) -> int:
+            if realm_id == lear_realm.id and cache == 'user':
+                raise Exception('memcached is down')
+            return fill_remote_cache(cache, realm_id, db_load_budget=db_load_budget)
+
+        with patch('zerver.lib.cache_helpers.fill_remote_cache', side_effect=fail_for_lear), \
+                self.assertLogs(level='INFO') as logs:
+            stats = warm_remote_caches()
+        self.assertIn(f'ERROR:root:Failed to warm user cache for realm {lear_realm.id}', logs.output)
+        self.assertEqual(stats['user'], {'tasks': 2, 'completed_tasks': 1, 'keys': stats['user']['keys']})
+        self.assertEqual(stats['message']['completed_tasks'], 2)
+        self.assertTrue(remote_cache_is_cold())
+
+        with self.assertLogs(level='INFO'):
+            stats = warm_remote_caches()
+        self.assertFalse(remote_cache_is_cold())
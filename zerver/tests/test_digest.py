@@ -1,6 +1,6 @@
 import datetime
 import time
-from typing import List
+from typing import Any, Dict, List, Set
 from unittest import mock
 
 from django.test import override_settings
@@ -13,6 +13,7 @@ from zerver.lib.digest import (
     exclude_subscription_modified_streams,
     gather_new_streams,
     handle_digest_email,
+    handle_digest_emails,
 )
 from zerver.lib.streams import create_stream_if_needed
 from zerver.lib.test_classes import ZulipTestCase
@@ -30,6 +31,10 @@ from zerver.models import (
 )
 
 
+def get_queued_user_ids(mock_queue_digest_user_ids: mock.MagicMock) -> Set[int]:
+    return {user_id for call in mock_queue_digest_user_ids.call_args_list
+            for user_id in call[0][0]}
+
 class TestDigestEmailMessages(ZulipTestCase):
 
     @mock.patch('zerver.lib.digest.enough_traffic')
@@ -60,7 +65,7 @@ class TestDigestEmailMessages(ZulipTestCase):
         with queries_captured() as queries:
             handle_digest_email(othello.id, cutoff)
 
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 7)
 
         self.assertEqual(mock_send_future_email.call_count, 1)
         kwargs = mock_send_future_email.call_args[1]
@@ -143,6 +148,60 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertIn('some content', teaser_messages[0]['content'][0]['plain'])
         self.assertIn(teaser_messages[0]['sender'], expected_participants)
 
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_multiple_users_digests(self, mock_send_future_email: mock.MagicMock) -> None:
+        one_day_ago = timezone_now() - datetime.timedelta(days=1)
+        Message.objects.all().update(date_sent=one_day_ago)
+
+        users = [self.example_user(name) for name in ['othello', 'cordelia', 'hamlet', 'polonius']]
+        for stream in ['Verona', 'Scotland', 'Denmark']:
+            self.subscribe(users[0], stream)
+        self.subscribe(users[1], 'Scotland')
+        self.subscribe(users[3], 'Verona')
+
+        senders = ['hamlet', 'cordelia', 'iago', 'prospero', 'ZOE']
+        self.simulate_stream_conversation('Verona', senders)
+        self.simulate_stream_conversation('Scotland', senders[:3])
+        self.simulate_stream_conversation('Denmark', senders[:2])
+        one_hour_ago = timezone_now() - datetime.timedelta(seconds=3600)
+        cutoff = time.mktime(one_hour_ago.timetuple())
+
+        def get_digest_contexts() -> Dict[int, Dict[str, Any]]:
+            contexts = {}
+            for call in mock_send_future_email.call_args_list:
+                [user_id] = call[1]['to_user_ids']
+                contexts[user_id] = call[1]['context']
+                del contexts[user_id]['unsubscribe_link']
+            mock_send_future_email.reset_mock()
+            return contexts
+
+        for user in users:
+            handle_digest_email(user.id, cutoff)
+        one_at_a_time = get_digest_contexts()
+        self.assertGreater(len(one_at_a_time), 0)
+
+        # The realm's traffic is gathered once for all of the users,
+        # but each gets the same digest as they would on their own.
+        handle_digest_emails([user.id for user in users], cutoff)
+        self.assertEqual(get_digest_contexts(), one_at_a_time)
+
+        # A user whose digest fails is logged and skipped; the rest of
+        # the batch still gets theirs.
+        failing_user_id = min(one_at_a_time)
+
+        def fail_for_one_user(*args: Any, **kwargs: Any) -> None:
+            if kwargs['to_user_ids'] == [failing_user_id]:
+                raise Exception('Failed to send')
+
+        mock_send_future_email.side_effect = fail_for_one_user
+        with self.assertLogs('zerver.lib.digest', level='ERROR') as m:
+            handle_digest_emails([user.id for user in users], cutoff)
+        self.assertEqual(len(m.output), 1)
+        self.assertIn(f'Failed to send digest email to user {failing_user_id}', m.output[0])
+        # The mock records the failed call too, so this checks that
+        # every user in the batch was attempted.
+        self.assertEqual(get_digest_contexts(), one_at_a_time)
+
     def test_exclude_subscription_modified_streams(self) -> None:
         othello = self.example_user('othello')
         for stream in ['Verona', 'Scotland', 'Denmark']:
@@ -168,11 +227,11 @@ class TestDigestEmailMessages(ZulipTestCase):
         self.assertIn(stream_ids['Scotland'], filtered_stream_ids)
         self.assertIn(stream_ids['Denmark'], filtered_stream_ids)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_user_ids')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_inactive_users_queued_for_digest(self, mock_django_timezone: mock.MagicMock,
-                                              mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                              mock_queue_digest_user_ids: mock.MagicMock) -> None:
         # Turn on realm digest emails for all realms
         Realm.objects.update(digest_emails_enabled=True)
         cutoff = timezone_now()
@@ -183,8 +242,9 @@ class TestDigestEmailMessages(ZulipTestCase):
         # Check that all users without an a UserActivity entry are considered
         # inactive users and get enqueued.
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, all_user_profiles.count())
-        mock_queue_digest_recipient.reset_mock()
+        self.assertEqual(get_queued_user_ids(mock_queue_digest_user_ids),
+                         set(all_user_profiles.values_list('id', flat=True)))
+        mock_queue_digest_user_ids.reset_mock()
         for realm in Realm.objects.filter(deactivated=False, digest_emails_enabled=True):
             user_profiles = all_user_profiles.filter(realm=realm)
             for user_profile in user_profiles:
@@ -195,17 +255,18 @@ class TestDigestEmailMessages(ZulipTestCase):
                     client=get_client('test_client'))
         # Check that inactive users are enqueued
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, all_user_profiles.count())
+        self.assertEqual(get_queued_user_ids(mock_queue_digest_user_ids),
+                         set(all_user_profiles.values_list('id', flat=True)))
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_user_ids')
     @mock.patch('zerver.lib.digest.timezone_now')
     def test_disabled(self, mock_django_timezone: mock.MagicMock,
-                      mock_queue_digest_recipient: mock.MagicMock) -> None:
+                      mock_queue_digest_user_ids: mock.MagicMock) -> None:
         cutoff = timezone_now()
         # A Tuesday
         mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=5)
         enqueue_emails(cutoff)
-        mock_queue_digest_recipient.assert_not_called()
+        mock_queue_digest_user_ids.assert_not_called()
 
     @mock.patch('zerver.lib.digest.enough_traffic', return_value=True)
     @mock.patch('zerver.lib.digest.timezone_now')
@@ -227,28 +288,28 @@ class TestDigestEmailMessages(ZulipTestCase):
                     count=0,
                     client=get_client('test_client'))
         # Check that an active user is not enqueued
-        with mock.patch('zerver.lib.digest.queue_digest_recipient') as mock_queue_digest_recipient:
+        with mock.patch('zerver.lib.digest.queue_digest_user_ids') as mock_queue_digest_user_ids:
             enqueue_emails(cutoff)
-            self.assertEqual(mock_queue_digest_recipient.call_count, 0)
+            self.assertEqual(mock_queue_digest_user_ids.call_count, 0)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_user_ids')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_only_enqueue_on_valid_day(self, mock_django_timezone: mock.MagicMock,
-                                       mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                       mock_queue_digest_user_ids: mock.MagicMock) -> None:
         # Not a Tuesday
         mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=6)
 
         # Check that digests are not sent on days other than Tuesday.
         cutoff = timezone_now()
         enqueue_emails(cutoff)
-        self.assertEqual(mock_queue_digest_recipient.call_count, 0)
+        self.assertEqual(mock_queue_digest_user_ids.call_count, 0)
 
-    @mock.patch('zerver.lib.digest.queue_digest_recipient')
+    @mock.patch('zerver.lib.digest.queue_digest_user_ids')
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
     def test_no_email_digest_for_bots(self, mock_django_timezone: mock.MagicMock,
-                                      mock_queue_digest_recipient: mock.MagicMock) -> None:
+                                      mock_queue_digest_user_ids: mock.MagicMock) -> None:
         # Turn on realm digest emails for all realms
         Realm.objects.update(digest_emails_enabled=True)
         cutoff = timezone_now()
@@ -269,9 +330,49 @@ class TestDigestEmailMessages(ZulipTestCase):
 
         # Check that bots are not sent emails
         enqueue_emails(cutoff)
-        for arg in mock_queue_digest_recipient.call_args_list:
-            user = arg[0][0]
-            self.assertNotEqual(user.id, bot.id)
+        self.assertNotIn(bot.id, get_queued_user_ids(mock_queue_digest_user_ids))
+
+    @mock.patch('zerver.lib.digest.queue_digest_user_ids')
+    @mock.patch('zerver.lib.digest.timezone_now')
+    @override_settings(SEND_DIGEST_EMAILS=True)
+    def test_inactive_users_queued_in_batches(self, mock_django_timezone: mock.MagicMock,
+                                              mock_queue_digest_user_ids: mock.MagicMock) -> None:
+        realm = get_realm('zulip')
+        Realm.objects.update(digest_emails_enabled=False)
+        realm.digest_emails_enabled = True
+        realm.save(update_fields=['digest_emails_enabled'])
+        cutoff = timezone_now()
+        # A Tuesday
+        mock_django_timezone.return_value = datetime.datetime(year=2016, month=1, day=5)
+
+        hamlet = self.example_user('hamlet')
+        for last_visit in [cutoff - datetime.timedelta(days=1), cutoff + datetime.timedelta(days=1)]:
+            UserActivity.objects.create(
+                last_visit=last_visit,
+                user_profile=hamlet,
+                count=0,
+                client=get_client(f'test_client_{last_visit.day}'))
+        othello = self.example_user('othello')
+        UserActivity.objects.create(
+            last_visit=cutoff - datetime.timedelta(days=1),
+            user_profile=othello,
+            count=0,
+            client=get_client('test_client'))
+
+        with queries_captured() as queries, \
+                mock.patch('zerver.lib.digest.DIGEST_QUEUE_BATCH_SIZE', 3):
+            enqueue_emails(cutoff)
+        # One query for the realms, and one for each realm's inactive users.
+        self.assert_length(queries, 2)
+
+        # Hamlet has visited since the cutoff, and Othello hasn't.
+        expected_user_ids = set(UserProfile.objects.filter(
+            realm=realm, is_active=True, is_bot=False, enable_digest_emails=True,
+        ).exclude(id=hamlet.id).values_list('id', flat=True))
+        self.assertIn(othello.id, expected_user_ids)
+        self.assertEqual(get_queued_user_ids(mock_queue_digest_user_ids), expected_user_ids)
+        for call in mock_queue_digest_user_ids.call_args_list:
+            self.assertLessEqual(len(call[0][0]), 3)
 
     @mock.patch('zerver.lib.digest.timezone_now')
     @override_settings(SEND_DIGEST_EMAILS=True)
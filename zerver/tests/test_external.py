@@ -9,7 +9,6 @@ from django.http import HttpResponse
 from zerver.forms import email_is_not_mit_mailing_list
 from zerver.lib.rate_limiter import (
     RateLimitedUser,
-    RateLimiterLockingException,
     add_ratelimit_rule,
     remove_ratelimit_rule,
 )
@@ -84,18 +83,19 @@ class RateLimitTests(ZulipTestCase):
         user = self.example_user('cordelia')
         RateLimitedUser(user).clear_history()
 
-        start_time = time.time()
-        for i in range(6):
-            with mock.patch('time.time', return_value=(start_time + i * 0.1)):
+        # A whole number of seconds, so that the times below are exact.
+        start_time = float(int(time.time()))
+        with mock.patch('time.time', return_value=start_time):
+            for i in range(6):
                 result = self.send_api_message(user, f"some stuff {i}")
 
         self.assertEqual(result.status_code, 429)
         json = result.json()
         self.assertEqual(json.get("result"), "error")
         self.assertIn("API usage exceeded rate limit", json.get("msg"))
-        self.assertEqual(json.get('retry-after'), 0.5)
+        self.assertEqual(json.get('retry-after'), 0.2)
         self.assertTrue('Retry-After' in result)
-        self.assertEqual(result['Retry-After'], '0.5')
+        self.assertEqual(result['Retry-After'], '0.2')
 
         # We actually wait a second here, rather than force-clearing our history,
         # to make sure the rate-limiting code automatically forgives a user
@@ -104,17 +104,3 @@ class RateLimitTests(ZulipTestCase):
             result = self.send_api_message(user, "Good message")
 
             self.assert_json_success(result)
-
-    @mock.patch('zerver.lib.rate_limiter.logger.warning')
-    def test_hit_ratelimiterlockingexception(self, mock_warn: mock.MagicMock) -> None:
-        user = self.example_user('cordelia')
-        RateLimitedUser(user).clear_history()
-
-        with mock.patch('zerver.lib.rate_limiter.RedisRateLimiterBackend.incr_ratelimit',
-                        side_effect=RateLimiterLockingException):
-            result = self.send_api_message(user, "some stuff")
-            self.assertEqual(result.status_code, 429)
-            mock_warn.assert_called_with(
-                "Deadlock trying to incr_ratelimit for %s",
-                f"RateLimitedUser:{user.id}:api_by_user",
-            )
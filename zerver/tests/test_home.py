@@ -252,6 +252,7 @@ class HomeTest(ZulipTestCase):
                          {"must-revalidate", "no-store", "no-cache"})
 
         self.assert_length(queries, 42)
+        self.assert_query_count_baseline('home_page', queries)
         self.assert_length(cache_mock.call_args_list, 5)
 
         html = result.content.decode('utf-8')
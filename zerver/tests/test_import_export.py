@@ -1,3 +1,4 @@
+import io
 import os
 from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 from unittest.mock import patch
@@ -19,8 +20,24 @@ from zerver.lib.actions import (
 from zerver.lib.avatar_hash import user_avatar_path
 from zerver.lib.bot_config import set_bot_config
 from zerver.lib.bot_lib import StateHandler
-from zerver.lib.export import do_export_realm, do_export_user, export_usermessages_batch
-from zerver.lib.import_realm import do_import_realm, get_incoming_message_ids
+from zerver.lib.export import (
+    MESSAGE_SHARD_MANIFEST,
+    do_export_realm,
+    do_export_user,
+    export_files_from_s3,
+    export_usermessages_batch,
+    read_message_shard,
+)
+from zerver.lib.import_realm import (
+    ID_MAP,
+    MESSAGE_IMPORT_CHECKPOINT,
+    MESSAGE_IMPORT_STATE,
+    UserMessageColumns,
+    do_import_realm,
+    get_incoming_message_ids,
+    import_message_shard,
+    resume_import_realm,
+)
 from zerver.lib.streams import create_stream_if_needed
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import create_s3_buckets, get_test_image_file, use_s3_backend
@@ -208,24 +225,10 @@ class ImportExportTest(ZulipTestCase):
             do_export_realm(
                 realm=realm,
                 output_dir=output_dir,
-                threads=0,
+                threads=1,
                 exportable_user_ids=exportable_user_ids,
                 consent_message_id=consent_message_id,
             )
-            export_usermessages_batch(
-                input_path=os.path.join(output_dir, 'messages-000001.json.partial'),
-                output_path=os.path.join(output_dir, 'messages-000001.json'),
-                consent_message_id=consent_message_id,
-            )
-
-            try:
-                export_usermessages_batch(
-                    input_path=os.path.join(output_dir, 'messages-000002.json.partial'),
-                    output_path=os.path.join(output_dir, 'messages-000002.json'),
-                    consent_message_id=consent_message_id,
-                )
-            except FileNotFoundError:
-                pass
 
         def read_file(fn: str) -> Any:
             full_fn = os.path.join(output_dir, fn)
@@ -354,6 +357,20 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(original_avatar_path_id, record_path)
         self.assertIn(original_avatar_path_id, record_s3_path)
 
+    @use_s3_backend
+    def test_export_files_from_s3_wrong_realm(self) -> None:
+        (bucket,) = create_s3_buckets(settings.S3_AUTH_UPLOADS_BUCKET)
+        realm = Realm.objects.get(string_id='zulip')
+        # A file under this realm's prefix, which belongs to another.
+        bucket.put_object(Key=f'{realm.id}/ab/cdef/moved.txt', Body=b'secret',
+                          Metadata={'realm_id': str(realm.id + 1),
+                                    'user_profile_id': str(self.example_user('hamlet').id)})
+        output_dir = self._make_output_dir()
+        with self.assertRaisesRegex(AssertionError, 'Key metadata problem'):
+            export_files_from_s3(realm, settings.S3_AUTH_UPLOADS_BUCKET, output_dir)
+        # It was never downloaded.
+        self.assertEqual(os.listdir(output_dir), [])
+
     @use_s3_backend
     def test_export_files_from_s3(self) -> None:
         create_s3_buckets(
@@ -474,6 +491,34 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(pm_b_msg_id, exported_message_ids)
         self.assertIn(pm_c_msg_id, exported_message_ids)
 
+    def test_export_retries_failed_message_files(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        failures = 0
+
+        def fail_once(input_path: str, output_path: str,
+                      consent_message_id: Optional[int]=None) -> None:
+            nonlocal failures
+            if failures == 0:
+                failures += 1
+                raise Exception('Connection reset')
+            export_usermessages_batch(input_path, output_path, consent_message_id)
+
+        with patch('zerver.lib.export.export_usermessages_batch', side_effect=fail_once), \
+                patch('logging.warning') as mock_warning:
+            full_data = self._export_realm(realm)
+        self.assertEqual(failures, 1)
+        mock_warning.assert_called_once()
+        self.assertNotEqual(full_data['message']['zerver_usermessage'], [])
+
+        output_dir = self._make_output_dir()
+        with patch('zerver.lib.export.export_usermessages_batch',
+                   side_effect=Exception('Connection reset')), \
+                patch('logging.info'), patch('logging.warning') as mock_warning, \
+                patch('zerver.lib.export.create_soft_link'), \
+                self.assertRaisesRegex(Exception, 'after 3 attempts: Exception: Connection reset'):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=1)
+        self.assertEqual(mock_warning.call_count, 3)
+
     def test_export_realm_with_exportable_user_ids(self) -> None:
         realm = Realm.objects.get(string_id='zulip')
 
@@ -1015,6 +1060,137 @@ class ImportExportTest(ZulipTestCase):
             self.assertEqual(huddle_object.recipient_id, Recipient.objects.get(type=Recipient.HUDDLE,
                                                                                type_id=huddle_object.id).id)
 
+    def test_streaming_export_and_import(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        RealmEmoji.objects.get(realm=realm).delete()
+        message = Message.objects.filter(sender__realm=realm).order_by('id').first()
+        assert message is not None
+        do_add_reaction(self.example_user("hamlet"), message, "outbox", "1f4e4", Reaction.UNICODE_EMOJI)
+        self._setup_export_files(realm)
+
+        json_export = self._export_realm(realm)
+
+        output_dir = self._make_output_dir()
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'), \
+                patch('zerver.lib.export.MESSAGE_SHARD_SIZE', 100):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=1, streaming=True)
+        shard_filenames = sorted(filename for filename in os.listdir(output_dir)
+                                 if filename.endswith('.jsonl.gz'))
+        self.assertGreater(len(shard_filenames), 1)
+
+        with open(os.path.join(output_dir, MESSAGE_SHARD_MANIFEST)) as f:
+            manifest = ujson.load(f)
+        self.assertEqual([shard['file'] for shard in manifest['shards']], shard_filenames)
+
+        streamed: Dict[str, List[Dict[str, Any]]] = {}
+        for shard in manifest['shards']:
+            for table, row in read_message_shard(os.path.join(output_dir, shard['file'])):
+                streamed.setdefault(table, []).append(row)
+        self.assertEqual(sum(shard['rows']['zerver_message'] for shard in manifest['shards']),
+                         len(streamed['zerver_message']))
+
+        # The shards hold the same rows as the JSON export, with the
+        # reactions moved there from realm.json.
+        for table in ['zerver_message', 'zerver_usermessage']:
+            self.assertEqual(sorted(streamed[table], key=lambda row: row['id']),
+                             sorted(json_export['message'][table], key=lambda row: row['id']))
+        self.assertEqual(sorted(streamed['zerver_reaction'], key=lambda row: row['id']),
+                         sorted(json_export['realm']['zerver_reaction'], key=lambda row: row['id']))
+        with open(os.path.join(output_dir, 'attachment.json')) as f:
+            self.assertEqual(
+                sorted(ujson.load(f)['zerver_attachment'], key=lambda row: row['id']),
+                sorted(json_export['attachment']['zerver_attachment'], key=lambda row: row['id']))
+
+        with patch('logging.info'):
+            with self.settings(BILLING_ENABLED=False):
+                do_import_realm(output_dir, 'test-zulip')
+        imported_realm = Realm.objects.get(string_id='test-zulip')
+        self.assertEqual(Message.objects.filter(sender__realm=imported_realm).count(),
+                         Message.objects.filter(sender__realm=realm).count())
+        self.assertEqual(UserMessage.objects.filter(user_profile__realm=imported_realm).count(),
+                         UserMessage.objects.filter(user_profile__realm=realm).count())
+        self.assertEqual(Reaction.objects.filter(user_profile__realm=imported_realm).count(),
+                         Reaction.objects.filter(user_profile__realm=realm).count())
+
+    def test_streaming_import_checks_checksums(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        output_dir = self._make_output_dir()
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=1, streaming=True)
+
+        with open(os.path.join(output_dir, 'messages-000001.jsonl.gz'), 'ab') as f:
+            f.write(b'corruption')
+        with patch('logging.info'), self.assertRaisesRegex(Exception, 'Checksum mismatch'):
+            get_incoming_message_ids(output_dir, sort_by_date=False)
+
+    def test_resume_import(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        output_dir = self._make_output_dir()
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'), \
+                patch('zerver.lib.export.MESSAGE_SHARD_SIZE', 50):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=1, streaming=True)
+
+        # The import dies while importing the third shard.
+        def import_shard_or_die(realm: Realm, sender_map: Dict[int, Dict[str, Any]],
+                                shard_path: str, dump_file_id: int) -> None:
+            import_message_shard(realm, sender_map, shard_path, dump_file_id)
+            if dump_file_id == 3:
+                raise Exception('Out of disk space')
+
+        with patch('logging.info'), self.settings(BILLING_ENABLED=False), \
+                patch('zerver.lib.import_realm.import_message_shard', side_effect=import_shard_or_die), \
+                self.assertRaisesRegex(Exception, 'Out of disk space'):
+            do_import_realm(output_dir, 'test-zulip')
+        imported_realm = Realm.objects.get(string_id='test-zulip')
+        # The third shard's transaction was rolled back.
+        with open(os.path.join(output_dir, MESSAGE_SHARD_MANIFEST)) as f:
+            shards = ujson.load(f)['shards']
+        self.assertGreater(len(shards), 3)
+        self.assertEqual(Message.objects.filter(sender__realm=imported_realm).count(),
+                         sum(shard['rows']['zerver_message'] for shard in shards[:2]))
+
+        checkpoint_filename = os.path.join(output_dir, MESSAGE_IMPORT_CHECKPOINT)
+        with open(checkpoint_filename) as f:
+            self.assertEqual(ujson.load(f), {'imported': ['messages-000001.jsonl.gz',
+                                                          'messages-000002.jsonl.gz']})
+        # Pretend that we died after committing the second shard, but
+        # before recording it in the checkpoint.
+        with open(checkpoint_filename, 'w') as f:
+            ujson.dump({'imported': ['messages-000001.jsonl.gz']}, f)
+
+        with patch('logging.info'), self.settings(BILLING_ENABLED=False):
+            imported_realm = resume_import_realm(output_dir)
+        self.assertEqual(imported_realm.string_id, 'test-zulip')
+        self.assertEqual(Message.objects.filter(sender__realm=imported_realm).count(),
+                         Message.objects.filter(sender__realm=realm).count())
+        self.assertEqual(UserMessage.objects.filter(user_profile__realm=imported_realm).count(),
+                         UserMessage.objects.filter(user_profile__realm=realm).count())
+        self.assertEqual(imported_realm.plan_type, Realm.SELF_HOSTED)
+        self.assertFalse(os.path.exists(checkpoint_filename))
+        self.assertFalse(os.path.exists(os.path.join(output_dir, MESSAGE_IMPORT_STATE)))
+
+        with self.assertRaisesRegex(Exception, 'No interrupted import to resume'):
+            resume_import_realm(output_dir)
+
+    def test_user_message_columns(self) -> None:
+        rows = [
+            {'id': 1, 'user_profile': 5, 'message': 7, 'flags_mask': 3},
+            # A user who isn't remapped, like a cross-realm bot.
+            {'id': 2, 'user_profile': 6, 'message': 8, 'flags_mask': 0},
+        ]
+        with patch.dict(ID_MAP['message'], {7: 107, 8: 108}), \
+                patch.dict(ID_MAP['user_profile'], {5: 105}):
+            columns = UserMessageColumns(rows)
+            columns.re_map_foreign_keys()
+        self.assertEqual(len(columns), 2)
+        buf = io.StringIO()
+        columns.write_copy_text(buf)
+        self.assertEqual(buf.getvalue(), '105\t107\t3\n6\t108\t0\n')
+
+        # Every message should have been allocated a new ID.
+        with patch.dict(ID_MAP['message'], {7: 107}), self.assertRaises(KeyError):
+            UserMessageColumns(rows).re_map_foreign_keys()
+
     def test_import_files_from_local(self) -> None:
         realm = Realm.objects.get(string_id='zulip')
         self._setup_export_files(realm)
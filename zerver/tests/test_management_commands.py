@@ -6,6 +6,7 @@ from typing import Any, Dict, List, Optional
 from unittest import mock
 from unittest.mock import MagicMock, call, patch
 
+import ujson
 from django.conf import settings
 from django.core.management import call_command
 from django.test import override_settings
@@ -13,7 +14,16 @@ from django.utils.timezone import now as timezone_now
 
 from confirmation.models import RealmCreationKey, generate_realm_creation_url
 from zerver.lib.actions import do_add_reaction, do_create_user
+from zerver.lib.cache import cache_set, to_dict_cache_key_id
 from zerver.lib.management import CommandError, ZulipBaseCommand, check_config
+from zerver.lib.markdown import version as markdown_version
+from zerver.lib.message import (
+    MessageDict,
+    messages_for_ids,
+    render_markdown,
+    rerender_stale_messages,
+    stringify_message_dict,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, stdout_suppressed
 from zerver.models import (
@@ -446,3 +456,64 @@ class TestExport(ZulipTestCase):
         do_add_reaction(self.mit_user("sipbtest"), message, "outbox", "1f4e4",  Reaction.UNICODE_EMOJI)
         with self.assertRaisesRegex(CommandError, "Users from a different realm reacted to message. Aborting..."):
             call_command(self.COMMAND_NAME, "-r=zulip", f"--consent-message-id={message.id}")
+
+class TestRerenderMessages(ZulipTestCase):
+    COMMAND_NAME = 'rerender_messages'
+
+    def test_rerender_stale_messages(self) -> None:
+        hamlet = self.example_user('hamlet')
+        stale_id = self.send_stream_message(hamlet, 'Verona', content='**stale**')
+        fresh_id = self.send_stream_message(hamlet, 'Verona', content='**fresh**')
+        Message.objects.filter(id=stale_id).update(rendered_content='<p>old</p>',
+                                                   rendered_content_version=1)
+        # Put the stale rendering in the to_dict cache, as if it had
+        # been cached before the markdown version changed.
+        row = MessageDict.get_raw_db_rows([stale_id])[0]
+        row['rendered_content_version'] = markdown_version
+        cache_set(to_dict_cache_key_id(stale_id),
+                  stringify_message_dict(MessageDict.build_dict_from_raw_db_row(row)))
+
+        checkpoint_file = os.path.join(settings.TEST_WORKER_DIR, 'rerender_messages.checkpoint')
+        with mock.patch('zerver.lib.message.render_markdown',
+                        wraps=render_markdown) as render_mock, stdout_suppressed():
+            call_command(self.COMMAND_NAME, '--processes=1', '--batch-size=1',
+                         f'--checkpoint-file={checkpoint_file}', '--restart')
+        self.assertEqual(render_mock.call_count, 1)
+
+        message = Message.objects.get(id=stale_id)
+        self.assertEqual(message.rendered_content, '<p><strong>stale</strong></p>')
+        self.assertEqual(message.rendered_content_version, markdown_version)
+        self.assertEqual(Message.objects.get(id=fresh_id).rendered_content,
+                         '<p><strong>fresh</strong></p>')
+        with mock.patch('zerver.lib.message.MessageDict.get_raw_db_rows') as get_rows:
+            message_dict = messages_for_ids([stale_id], {stale_id: []}, {}, apply_markdown=True,
+                                            client_gravatar=False, allow_edit_history=False)[0]
+        get_rows.assert_not_called()
+        self.assertEqual(message_dict['content'], '<p><strong>stale</strong></p>')
+
+        with open(checkpoint_file) as f:
+            self.assertEqual(ujson.load(f), {'markdown_version': markdown_version, 'max_id': 0})
+        # Re-running picks up from the checkpoint, which is the end.
+        with mock.patch('zerver.lib.message.render_markdown') as render_mock, \
+                stdout_suppressed():
+            call_command(self.COMMAND_NAME, f'--checkpoint-file={checkpoint_file}')
+        render_mock.assert_not_called()
+        os.remove(checkpoint_file)
+
+    def test_rerender_skips_edited_messages(self) -> None:
+        hamlet = self.example_user('hamlet')
+        message_id = self.send_stream_message(hamlet, 'Verona', content='**old**')
+        Message.objects.filter(id=message_id).update(rendered_content='<p>old</p>',
+                                                     rendered_content_version=1)
+
+        # The message is edited while we're rendering its old content.
+        def render_and_edit(message: Message, content: str, **kwargs: Any) -> str:
+            Message.objects.filter(id=message_id).update(
+                content='**new**', rendered_content='<p><strong>new</strong></p>',
+                rendered_content_version=markdown_version, last_edit_time=timezone_now())
+            return render_markdown(message, content, **kwargs)
+
+        with mock.patch('zerver.lib.message.render_markdown', side_effect=render_and_edit):
+            self.assertEqual(rerender_stale_messages(message_id, message_id), (0, 0))
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content,
+                         '<p><strong>new</strong></p>')
@@ -1,5 +1,6 @@
 import copy
 import os
+import pickle
 import re
 from textwrap import dedent
 from typing import Any, Dict, List, Optional, Set, Tuple
@@ -10,38 +11,53 @@ from django.conf import settings
 from django.test import override_settings
 
 from zerver.lib.actions import (
+    bulk_add_members_to_user_group,
     do_add_alert_words,
+    do_change_full_name,
     do_remove_realm_emoji,
     do_set_realm_property,
     do_set_user_display_setting,
 )
 from zerver.lib.alert_words import get_alert_word_automaton
+from zerver.lib.cache import LRUCache
 from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.exceptions import MarkdownRenderingException
 from zerver.lib.markdown import (
     MarkdownListPreprocessor,
+    MarkdownRenderRequest,
     MentionData,
+    WorkerCachedDataMissing,
+    bulk_markdown_convert,
     clear_state_for_testing,
     content_has_emoji_syntax,
     fetch_tweet_data,
+    fill_in_render_worker_request,
+    get_mention_index_version,
     get_possible_mentions_info,
+    get_render_cache_stats,
     get_tweet_id,
     image_preview_enabled,
     markdown_convert,
     maybe_update_markdown_engines,
     possible_linked_stream_names,
+    prepare_markdown_render,
+    realm_filter_literal_prefix,
+    request_for_render_worker,
     topic_links,
     url_embed_preview_enabled,
     url_to_a,
+    worker_alert_word_automatons,
 )
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
+from zerver.lib.markdown.render_pool import MarkdownRenderPool
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import possible_mentions, possible_user_group_mentions
 from zerver.lib.message import render_markdown
 from zerver.lib.request import JsonableError
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.tex import render_tex
+from zerver.lib.test_helpers import queries_captured
+from zerver.lib.tex import katex_server, render_tex, render_tex_cached
 from zerver.lib.user_groups import create_user_group
 from zerver.models import (
     MAX_MESSAGE_LENGTH,
@@ -263,12 +279,83 @@ class MarkdownMiscTest(ZulipTestCase):
         mention_data = MentionData(realm.id, content)
         self.assertTrue(mention_data.message_has_wildcards())
 
+    def test_mention_index(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        content = '@**King Hamlet** @*support*'
+        with queries_captured() as queries:
+            MentionData(realm.id, content)
+        self.assertEqual(len(queries), 3)
+
+        # Once built, the index answers mentions without querying.
+        with queries_captured() as queries:
+            mention_data = MentionData(realm.id, content)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id})
+        self.assertIsNone(mention_data.get_user_group('support'))
+
+        # Changes to users and user groups replace the index.
+        do_change_full_name(hamlet, 'Prince Hamlet', hamlet)
+        user_group = create_user_group('support', [othello], realm)
+        mention_data = MentionData(realm.id, '@**Prince Hamlet** @*support*')
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id})
+        self.assertEqual(mention_data.get_user_group('support'), user_group)
+        self.assertEqual(mention_data.get_group_members(user_group.id), [othello.id])
+
+        bulk_add_members_to_user_group(user_group, [hamlet])
+        mention_data = MentionData(realm.id, '@*support*')
+        self.assertEqual(set(mention_data.get_group_members(user_group.id)),
+                         {othello.id, hamlet.id})
+
+        # A process that rebuilds the index before the change commits
+        # builds it from the old data, so the version is replaced again
+        # on commit.
+        with mock.patch('zerver.lib.cache.transaction.on_commit') as on_commit:
+            do_change_full_name(hamlet, 'King Hamlet', hamlet)
+        version = get_mention_index_version(realm.id)
+        self.assertEqual(get_mention_index_version(realm.id), version)
+        for call in on_commit.call_args_list:
+            call[0][0]()
+        self.assertNotEqual(get_mention_index_version(realm.id), version)
+
+        # Messages without mentions don't need the index at all.
+        with mock.patch('zerver.lib.markdown.get_mention_index') as get_index:
+            MentionData(realm.id, 'no mentions here')
+        get_index.assert_not_called()
+
     def test_invalid_katex_path(self) -> None:
         with self.settings(DEPLOY_ROOT="/nonexistent"):
             with mock.patch('logging.error') as mock_logger:
                 render_tex("random text")
                 mock_logger.assert_called_with("Cannot find KaTeX for latex rendering!")
 
+    def test_katex_server(self) -> None:
+        render_tex_cached.cache_clear()
+        html = render_tex("x^2", is_inline=True)
+        assert html is not None
+        self.assertIn('class="katex"', html)
+        self.assertEqual(render_tex("x^2", is_inline=True), html)
+        self.assertEqual(render_tex_cached.cache_info().hits, 1)
+
+        display_html = render_tex("x^2", is_inline=False)
+        assert display_html is not None
+        self.assertIn('katex-display', display_html)
+        self.assertIsNone(render_tex("\\frac{x", is_inline=True))
+
+        # A crashed server is restarted on the next request.
+        assert katex_server.process is not None
+        katex_server.process.kill()
+        katex_server.process.wait()
+        self.assertIsNotNone(render_tex("y^2", is_inline=True))
+
+        # If the server can't be used, we fall back to a subprocess.
+        with mock.patch('zerver.lib.tex.katex_server.render', side_effect=OSError), \
+                mock.patch('zerver.lib.tex.render_tex_subprocess', return_value='html') as mock_subprocess, \
+                mock.patch('logging.warning'):
+            self.assertEqual(render_tex("z^2", is_inline=True), 'html')
+        mock_subprocess.assert_called_once_with("z^2", True)
+
 class MarkdownListPreprocessorTest(ZulipTestCase):
     # We test that the preprocessor inserts blank lines at correct places.
     # We use <> to indicate that we need to insert a blank line here.
@@ -1058,13 +1145,38 @@ class MarkdownTest(ZulipTestCase):
         realm_filter.save()
 
         import zerver.lib.markdown
-        zerver.lib.markdown.realm_filter_data = {}
-        maybe_update_markdown_engines(None, False)
-        all_filters = zerver.lib.markdown.realm_filter_data
-        zulip_filters = all_filters[realm.id]
-        self.assertEqual(len(zulip_filters), 1)
-        self.assertEqual(zulip_filters[0],
-                         ('#(?P<id>[0-9]{2,8})', 'https://trac.example.com/ticket/%(id)s', realm_filter.id))
+        md_engines = zerver.lib.markdown.md_engines
+        md_engines.clear()
+        maybe_update_markdown_engines(realm.id, False)
+        # Engines are only built for the realms that need them.
+        self.assertEqual(len(md_engines), 1)
+        engine = md_engines.get((realm.id, False))
+        assert engine is not None
+        self.assertEqual(engine.getConfig("realm_filters"),
+                         [('#(?P<id>[0-9]{2,8})', 'https://trac.example.com/ticket/%(id)s', realm_filter.id)])
+        maybe_update_markdown_engines(realm.id, False)
+        self.assertIs(md_engines.get((realm.id, False)), engine)
+
+        # Changing the realm's filters rebuilds just its engine.
+        RealmFilter(realm=realm, pattern=r"!(?P<id>[0-9]+)",
+                    url_format_string=url_format_string).save()
+        maybe_update_markdown_engines(realm.id, False)
+        new_engine = md_engines.get((realm.id, False))
+        assert new_engine is not None
+        self.assertIsNot(new_engine, engine)
+        self.assertEqual(len(new_engine.getConfig("realm_filters")), 2)
+
+    def test_markdown_engine_cache_bounded(self) -> None:
+        cache: LRUCache[int, str] = LRUCache(2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.set(3, 'c')
+        # 2 was the least recently used.
+        self.assertNotIn(2, cache)
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(len(cache), 2)
 
     def test_flush_realm_filter(self) -> None:
         realm = get_realm('zulip')
@@ -1112,6 +1224,64 @@ class MarkdownTest(ZulipTestCase):
         converted_boring_topic = topic_links(realm.id, boring_msg.topic_name())
         self.assertEqual(converted_boring_topic, [])
 
+    def test_realm_patterns_combined(self) -> None:
+        realm = get_realm('zulip')
+        for i in range(20):
+            RealmFilter(realm=realm, pattern=fr"PROJ{i}-(?P<id>[0-9]+)",
+                        url_format_string=fr"https://tracker.example.com/proj{i}/%(id)s").save()
+        RealmFilter(realm=realm, pattern=r"(?P<org>[a-z]+)/(?P<repo>[a-z]+)#(?P<id>[0-9]+)",
+                    url_format_string=r"https://github.com/%(org)s/%(repo)s/issues/%(id)s").save()
+        flush_per_request_caches()
+
+        msg = Message(sender=self.example_user('othello'))
+        content = "See PROJ1-12, PROJ12-3 and zulip/zulip#99, but not PROJ1-12x or PROJ99-1."
+        converted = markdown_convert(content, message_realm=realm, message=msg)
+        self.assertEqual(
+            converted,
+            '<p>See <a href="https://tracker.example.com/proj1/12">PROJ1-12</a>, '
+            '<a href="https://tracker.example.com/proj12/3">PROJ12-3</a> and '
+            '<a href="https://github.com/zulip/zulip/issues/99">zulip/zulip#99</a>, '
+            'but not PROJ1-12x or PROJ99-1.</p>',
+        )
+        self.assertEqual(topic_links(realm.id, "zulip/zulip#99 PROJ12-3 PROJ1-12"), [
+            'https://tracker.example.com/proj1/12',
+            'https://tracker.example.com/proj12/3',
+            'https://github.com/zulip/zulip/issues/99',
+        ])
+
+        self.assertEqual(realm_filter_literal_prefix(r"PROJ1-(?P<id>[0-9]+)"), "PROJ1-")
+        self.assertEqual(realm_filter_literal_prefix(r"ab+(?P<id>[0-9]+)"), "a")
+        self.assertEqual(realm_filter_literal_prefix(r"a(?P<id>[0-9]+)|b"), "")
+
+    def test_realm_patterns_group_references(self) -> None:
+        realm = get_realm('zulip')
+        RealmFilter(realm=realm, pattern=r"PROJ-(?P<id>[0-9]+)",
+                    url_format_string=r"https://tracker.example.com/proj/%(id)s").save()
+        # Numbered references to a filter's groups, which would refer
+        # to other groups in the combined regex.
+        RealmFilter(realm=realm, pattern=r"(?P<id>[0-9]+)=\1",
+                    url_format_string=r"https://example.com/same/%(id)s").save()
+        RealmFilter(realm=realm, pattern=r"(?P<q>[(])?v(?P<id>[0-9]+)(?(1)[)])",
+                    url_format_string=r"https://example.com/version/%(id)s").save()
+        flush_per_request_caches()
+
+        msg = Message(sender=self.example_user('othello'))
+        content = "PROJ-1 12=12 12=13 v3 (v4) (v5"
+        converted = markdown_convert(content, message_realm=realm, message=msg)
+        self.assertEqual(
+            converted,
+            '<p><a href="https://tracker.example.com/proj/1">PROJ-1</a> '
+            '<a href="https://example.com/same/12">12=12</a> 12=13 '
+            '<a href="https://example.com/version/3">v3</a> '
+            '<a href="https://example.com/version/4">(v4)</a> '
+            '(<a href="https://example.com/version/5">v5</a></p>',
+        )
+        self.assertEqual(topic_links(realm.id, "12=12 PROJ-1 v3"), [
+            'https://tracker.example.com/proj/1',
+            'https://example.com/same/12',
+            'https://example.com/version/3',
+        ])
+
     def test_is_status_message(self) -> None:
         user_profile = self.example_user('othello')
         msg = Message(sender=user_profile, sending_client=get_client("test"))
@@ -2097,6 +2267,147 @@ class MarkdownTest(ZulipTestCase):
         converted = markdown_convert_wrapper(dedent(msg))
         self.assertEqual(converted, dedent(expected_output))
 
+class MarkdownRenderCacheTest(ZulipTestCase):
+    def render(self, content: str) -> Tuple[str, Message]:
+        msg = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        return render_markdown(msg, content), msg
+
+    @override_settings(MARKDOWN_RENDER_CACHE=True)
+    def test_identical_content_cached(self) -> None:
+        content = "Build **passed**: https://ci.example.com/builds/1"
+        stats = get_render_cache_stats()
+        rendered, msg = self.render(content)
+        self.assertEqual(get_render_cache_stats()['misses'], stats['misses'] + 1)
+        self.assertTrue(msg.has_link)
+
+        with mock.patch('zerver.lib.markdown.timeout') as mock_timeout:
+            cached_rendered, cached_msg = self.render(content)
+        mock_timeout.assert_not_called()
+        self.assertEqual(cached_rendered, rendered)
+        self.assertTrue(cached_msg.has_link)
+        self.assertFalse(cached_msg.has_image)
+        self.assertEqual(get_render_cache_stats()['hits'], stats['hits'] + 1)
+
+        # Realm filters are part of the key.
+        realm = get_realm('zulip')
+        RealmFilter(realm=realm, pattern=r"builds/(?P<id>[0-9]+)",
+                    url_format_string=r"https://trac.example.com/ticket/%(id)s").save()
+        self.render(content)
+        self.assertEqual(get_render_cache_stats()['misses'], stats['misses'] + 2)
+
+    @override_settings(MARKDOWN_RENDER_CACHE=True)
+    def test_data_dependent_content_not_cached(self) -> None:
+        content = "@**King Hamlet** #**Denmark**"
+        for i in range(2):
+            stats = get_render_cache_stats()
+            rendered, msg = self.render(content)
+            self.assertIn('user-mention', rendered)
+            self.assertEqual(msg.mentions_user_ids, {self.example_user('hamlet').id})
+            self.assertEqual(get_render_cache_stats(), stats)
+
+        # Content that may contain alert words isn't cached, since
+        # the alert words found are recorded on the message.
+        user_profile = self.example_user('othello')
+        do_add_alert_words(user_profile, ["scaryword"])
+        automaton = get_alert_word_automaton(user_profile.realm)
+        for i in range(2):
+            msg = Message(sender=user_profile, sending_client=get_client("test"))
+            render_markdown(msg, "A scaryword", realm_alert_words_automaton=automaton)
+            self.assertEqual(msg.user_ids_with_alert_words, {user_profile.id})
+
+class MarkdownRenderPoolTest(ZulipTestCase):
+    @override_settings(MARKDOWN_RENDER_PROCESSES=1)
+    def test_render_pool(self) -> None:
+        pool = MarkdownRenderPool(1, 5)
+        self.addCleanup(pool.stop)
+        hamlet = self.example_user('hamlet')
+        with mock.patch('zerver.lib.markdown.render_pool.get_render_pool', return_value=pool):
+            msg = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+            rendered = render_markdown(msg, "**Hi** @**King Hamlet**, see https://example.com")
+            self.assertIn('<strong>Hi</strong>', rendered)
+            self.assertIn(f'data-user-id="{hamlet.id}"', rendered)
+            self.assertEqual(msg.mentions_user_ids, {hamlet.id})
+            self.assertTrue(msg.has_link)
+
+            requests = [prepare_markdown_render(content, message_realm=hamlet.realm)
+                        for content in ["*a*", "`b`"]]
+            self.assertEqual(bulk_markdown_convert(requests),
+                             ['<p><em>a</em></p>', '<p><code>b</code></p>'])
+
+            # A render that takes too long kills its worker, which is
+            # replaced by a new one.
+            pool.timeout = 0
+            with mock.patch('zerver.lib.markdown.markdown_logger'), \
+                    self.assertRaises(MarkdownRenderingException):
+                render_markdown(msg, "slow")
+            pool.timeout = 5
+            self.assertEqual(render_markdown(msg, "fast"), '<p>fast</p>')
+
+            # A replacement that fails to start leaves its slot empty,
+            # to be filled by the next render that uses it.
+            pool.timeout = 0
+            with mock.patch('zerver.lib.markdown.markdown_logger'):
+                with self.assertRaises(MarkdownRenderingException):
+                    render_markdown(msg, "slow")
+                with mock.patch('zerver.lib.markdown.render_pool.RenderWorker',
+                                side_effect=MarkdownRenderingException('failed to start')), \
+                        self.assertRaises(MarkdownRenderingException):
+                    render_markdown(msg, "fast")
+            pool.timeout = 5
+            self.assertEqual(render_markdown(msg, "fast"), '<p>fast</p>')
+
+            # Workers keep the realm's alert word automaton between
+            # requests, and are sent it again when it changes.
+            cordelia = self.example_user('cordelia')
+            for user, alert_word in [(hamlet, 'alertword'), (cordelia, 'otherword')]:
+                do_add_alert_words(user, [alert_word])
+                for i in range(2):
+                    render_markdown(msg, alert_word,
+                                    realm_alert_words_automaton=get_alert_word_automaton(hamlet.realm))
+                    self.assertEqual(msg.user_ids_with_alert_words, {user.id})
+
+    def test_request_for_render_worker(self) -> None:
+        hamlet = self.example_user('hamlet')
+        realm = hamlet.realm
+        do_add_alert_words(hamlet, ['alertword'])
+        user_group = create_user_group('support', [hamlet], realm)
+        worker_alert_word_automatons.clear()
+
+        def prepare() -> MarkdownRenderRequest:
+            return prepare_markdown_render('@*support* alertword',
+                                           get_alert_word_automaton(realm),
+                                           message_realm=realm)
+
+        def send(request: MarkdownRenderRequest, **kwargs: bool) -> MarkdownRenderRequest:
+            return pickle.loads(pickle.dumps(request_for_render_worker(request, **kwargs)))
+
+        request = prepare()
+        self.assertIsNotNone(request.alert_words_version)
+        sent = send(request)
+        assert sent.db_data is not None and request.db_data is not None
+        self.assertIsNone(sent.db_data['realm_alert_words_automaton'])
+        self.assertEqual(sent.db_data['mention_data'].user_group_members, {})
+        self.assertEqual(sent.db_data['mention_data'].get_user_group('support'), user_group)
+        # The request itself is left alone.
+        self.assertIsNotNone(request.db_data['realm_alert_words_automaton'])
+        self.assertEqual(request.db_data['mention_data'].get_group_members(user_group.id),
+                         [hamlet.id])
+
+        # A worker has to be sent the automaton the first time, and
+        # fills it in from its cache after that.
+        with self.assertRaises(WorkerCachedDataMissing):
+            fill_in_render_worker_request(sent)
+        fill_in_render_worker_request(send(request, omit_alert_words_automaton=False))
+        sent = send(request)
+        fill_in_render_worker_request(sent)
+        assert sent.db_data is not None
+        self.assertEqual(list(sent.db_data['realm_alert_words_automaton'].keys()), ['alertword'])
+
+        # Once the realm's alert words change, so does their version.
+        do_add_alert_words(hamlet, ['otherword'])
+        with self.assertRaises(WorkerCachedDataMissing):
+            fill_in_render_worker_request(send(prepare()))
+
 class MarkdownApiTests(ZulipTestCase):
     def test_render_message_api(self) -> None:
         content = 'That is a **bold** statement'
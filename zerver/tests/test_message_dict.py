@@ -1,12 +1,21 @@
 import time
+import zlib
 from typing import Any, Dict, List, Union
 from unittest import mock
 
+import ujson
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.cache import cache_delete, to_dict_cache_key_id
 from zerver.lib.markdown import version as markdown_version
-from zerver.lib.message import MessageDict, messages_for_ids, sew_messages_and_reactions
+from zerver.lib.message import (
+    MESSAGE_CACHE_CODECS,
+    MessageDict,
+    extract_message_dict,
+    messages_for_ids,
+    sew_messages_and_reactions,
+    stringify_message_dict,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import make_client, queries_captured
 from zerver.lib.topic import TOPIC_LINKS
@@ -630,3 +639,27 @@ class SewMessageAndReactionTest(ZulipTestCase):
                              'simple_smile')
             self.assertTrue(data['id'])
             self.assertTrue(data['content'])
+
+class MessageCacheCodecTest(ZulipTestCase):
+    def test_stringify_and_extract(self) -> None:
+        short_dict = {'id': 1, 'content': 'short'}
+        long_dict = {'id': 2, 'content': 'long ' * 500}
+
+        with self.settings(MESSAGE_CACHE_COMPRESSION_THRESHOLD=512):
+            short_bytes = stringify_message_dict(short_dict)
+            long_bytes = stringify_message_dict(long_dict)
+        self.assertEqual(short_bytes[:1], MESSAGE_CACHE_CODECS['json'].tag)
+        self.assertEqual(long_bytes[:1], MESSAGE_CACHE_CODECS['zlib'].tag)
+        self.assertLess(len(long_bytes), len(ujson.dumps(long_dict)))
+        self.assertEqual(extract_message_dict(short_bytes), short_dict)
+        self.assertEqual(extract_message_dict(long_bytes), long_dict)
+
+        with self.settings(MESSAGE_CACHE_COMPRESSION_THRESHOLD=0):
+            short_bytes = stringify_message_dict(short_dict)
+        self.assertEqual(short_bytes[:1], MESSAGE_CACHE_CODECS['zlib'].tag)
+        self.assertEqual(extract_message_dict(short_bytes), short_dict)
+
+    def test_extract_legacy_format(self) -> None:
+        message_dict = {'id': 1, 'content': 'cached before codecs were tagged'}
+        legacy_bytes = zlib.compress(ujson.dumps(message_dict).encode())
+        self.assertEqual(extract_message_dict(legacy_bytes), message_dict)
@@ -1187,6 +1187,7 @@ class StreamMessagesTest(ZulipTestCase):
             )
 
         self.assert_length(queries, 14)
+        self.assert_query_count_baseline('send_stream_message', queries)
 
     def test_stream_message_dict(self) -> None:
         user_profile = self.example_user('iago')
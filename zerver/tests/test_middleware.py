@@ -1,13 +1,30 @@
+import logging
+import os
+import tempfile
 import time
 from typing import List
 from unittest.mock import patch
 
+import ujson
 from bs4 import BeautifulSoup
+from django.core.management import call_command
 
+from zerver.lib import duplicate_queries, request_profiling
+from zerver.lib.duplicate_queries import (
+    finish_duplicate_query_detection,
+    start_duplicate_query_detection,
+)
 from zerver.lib.realm_icon import get_realm_icon_url
+from zerver.lib.request_profiling import (
+    fingerprint_sql,
+    read_call_profiles,
+    start_call_profile,
+    summarize_call_profiles,
+)
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
 from zerver.middleware import is_slow_query, write_log_line
-from zerver.models import get_realm
+from zerver.models import UserProfile, get_realm
 
 
 class SlowQueryTest(ZulipTestCase):
@@ -185,3 +202,109 @@ class OpenGraphTest(ZulipTestCase):
         open_graph_url = bs.select_one('meta[property="og:url"]').get('content')
 
         self.assertTrue(open_graph_url.endswith('/api/'))
+
+class RequestProfilingTest(ZulipTestCase):
+    def test_fingerprint_sql(self) -> None:
+        self.assertEqual(
+            fingerprint_sql("SELECT * FROM zerver_message\n  WHERE id IN (%s, %s, %s) AND subject = 'x''y'"),
+            "SELECT * FROM zerver_message WHERE id IN (...) AND subject = ?",
+        )
+        self.assertEqual(fingerprint_sql("SELECT 1 LIMIT 21"), "SELECT ? LIMIT ?")
+
+    def test_profiled_request_logged(self) -> None:
+        self.login('hamlet')
+        with self.settings(REQUEST_PROFILING_SAMPLE_RATE=1.0,
+                           REQUEST_PROFILING_LOG_THRESHOLD=0), \
+                self.assertLogs('zulip.request_profiles', level='INFO') as logs:
+            result = self.client_get('/json/users/me')
+            self.assert_json_success(result)
+
+        # The file handler writes each record as just its message, a
+        # line of JSON.
+        [handler] = logging.getLogger('zulip.request_profiles').handlers
+        self.assertEqual(handler.format(logs.records[0]), logs.records[0].getMessage())
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'request_profiles.log')
+            with open(log_path, 'w') as log:
+                for record in logs.records:
+                    log.write(record.getMessage() + '\n')
+            records = read_call_profiles([log_path])
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0]['path'], '/json/users/me')
+            kinds = {call['kind'] for call in records[0]['slowest_calls']}
+            self.assertIn('db', kinds)
+            for call in records[0]['slowest_calls']:
+                self.assertFalse(call['call_site'].startswith('zerver/lib/db.py'))
+
+            summary = summarize_call_profiles(records + records)
+            self.assertEqual(summary[0]['count'], 2)
+
+            with self.settings(REQUEST_PROFILING_LOG_PATH=log_path), \
+                    patch('builtins.print') as mock_print:
+                call_command('request_profiles', '--limit=1')
+            mock_print.assert_any_call('1 slow profiled requests')
+
+        # Unsampled requests aren't profiled.
+        self.assertIsNone(request_profiling.current_profile)
+        with self.settings(REQUEST_PROFILING_SAMPLE_RATE=0.0):
+            start_call_profile()
+        self.assertIsNone(request_profiling.current_profile)
+
+class DuplicateQueryDetectionTest(ZulipTestCase):
+    def test_duplicate_queries_logged(self) -> None:
+        user_ids = [self.example_user(name).id for name in ['hamlet', 'cordelia', 'othello']]
+        with self.settings(DETECT_DUPLICATE_QUERIES=True, DUPLICATE_QUERY_THRESHOLD=3):
+            start_duplicate_query_detection()
+            for user_id in user_ids:
+                UserProfile.objects.get(id=user_id)
+            UserProfile.objects.filter(id__in=user_ids).count()
+            with self.assertLogs('zulip.duplicate_queries', level='WARNING') as logs:
+                finish_duplicate_query_detection('test')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Possible N+1 query in test: 3 executions of SELECT', logs.output[0])
+        self.assertIn('test_duplicate_queries_logged', logs.output[0])
+        self.assertIsNone(duplicate_queries.current_detector)
+
+    def test_detection_disabled(self) -> None:
+        with self.settings(DETECT_DUPLICATE_QUERIES=False):
+            start_duplicate_query_detection()
+        self.assertIsNone(duplicate_queries.current_detector)
+
+        # Abandoned detection (context None) doesn't report anything.
+        with self.settings(DETECT_DUPLICATE_QUERIES=True, DUPLICATE_QUERY_THRESHOLD=1), \
+                patch('zerver.lib.duplicate_queries.logger.warning') as mock_warning:
+            start_duplicate_query_detection()
+            UserProfile.objects.get(id=self.example_user('hamlet').id)
+            finish_duplicate_query_detection(None)
+        mock_warning.assert_not_called()
+
+class QueryCountBaselineTest(ZulipTestCase):
+    def test_assert_query_count_baseline(self) -> None:
+        user_ids = [self.example_user(name).id for name in ['hamlet', 'cordelia', 'othello']]
+        with queries_captured() as queries:
+            for user_id in user_ids:
+                UserProfile.objects.get(id=user_id)
+        self.assert_length(queries, 3)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write('{"example_users": 3}\n')
+            f.flush()
+            with patch('zerver.lib.test_classes.QUERY_COUNT_BASELINES_PATH', f.name):
+                self.assert_query_count_baseline('example_users', queries)
+                self.assert_query_count_baseline('example_users', queries[:2])
+
+                with self.assertRaisesRegex(AssertionError, 'No query count baseline recorded for missing'):
+                    self.assert_query_count_baseline('missing', queries)
+
+                # Going over the baseline prints where the queries came from.
+                with patch('builtins.print') as mock_print, \
+                        self.assertRaisesRegex(AssertionError, 'example_users made 4 queries, more than its baseline'):
+                    self.assert_query_count_baseline('example_users', queries + queries[:1])
+                mock_print.assert_called_once()
+                self.assertIn('   4 SELECT', mock_print.call_args[0][0])
+
+                with patch.dict(os.environ, {'ZULIP_UPDATE_QUERY_BASELINES': '1'}):
+                    self.assert_query_count_baseline('new_baseline', queries[:1])
+                with open(f.name) as baselines:
+                    self.assertEqual(ujson.load(baselines), {'example_users': 3, 'new_baseline': 1})
@@ -12,7 +12,6 @@ from django.test import override_settings
 from zerver.lib.email_mirror import RateLimitedRealmMirror
 from zerver.lib.email_mirror_helpers import encode_email_address
 from zerver.lib.queue import MAX_REQUEST_RETRIES
-from zerver.lib.rate_limiter import RateLimiterLockingException
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import FromAddress
 from zerver.lib.test_classes import ZulipTestCase
@@ -323,11 +322,9 @@ class WorkerTest(ZulipTestCase):
 
         self.assertEqual(mock_mirror_email.call_count, 3)
 
-    @patch('zerver.lib.rate_limiter.logger.warning')
     @patch('zerver.worker.queue_processors.mirror_email')
     @override_settings(RATE_LIMITING_MIRROR_REALM_RULES=[(10, 2)])
-    def test_mirror_worker_rate_limiting(self, mock_mirror_email: MagicMock,
-                                         mock_warn: MagicMock) -> None:
+    def test_mirror_worker_rate_limiting(self, mock_mirror_email: MagicMock) -> None:
         fake_client = self.FakeClient()
         realm = get_realm('zulip')
         RateLimitedRealmMirror(realm).clear_history()
@@ -376,17 +373,6 @@ class WorkerTest(ZulipTestCase):
                 worker.start()
                 self.assertEqual(mock_mirror_email.call_count, 4)
 
-                # If RateLimiterLockingException is thrown, we rate-limit the new message:
-                with patch('zerver.lib.rate_limiter.RedisRateLimiterBackend.incr_ratelimit',
-                           side_effect=RateLimiterLockingException):
-                    fake_client.queue.append(('email_mirror', data[0]))
-                    worker.start()
-                    self.assertEqual(mock_mirror_email.call_count, 4)
-                    mock_warn.assert_called_with(
-                        "Deadlock trying to incr_ratelimit for %s",
-                        f"RateLimitedRealmMirror:{realm.string_id}",
-                    )
-
     def test_email_sending_worker_retries(self) -> None:
         """Tests the retry_send_email_failures decorator to make sure it
         retries sending the email 3 times and then gives up."""
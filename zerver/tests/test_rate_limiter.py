@@ -1,3 +1,6 @@
+import os
+import random
+import tempfile
 import time
 from typing import Dict, List, Tuple, Type
 from unittest import mock
@@ -7,9 +10,12 @@ from zerver.lib.rate_limiter import (
     RateLimitedUser,
     RateLimiterBackend,
     RedisRateLimiterBackend,
+    SharedMemoryRateLimiterBackend,
     TornadoInMemoryRateLimiterBackend,
     add_ratelimit_rule,
+    default_backend,
     remove_ratelimit_rule,
+    to_microseconds,
 )
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.utils import generate_random_token
@@ -30,6 +36,20 @@ class RateLimitedTestObject(RateLimitedObject):
     def rules(self) -> List[Tuple[int, int]]:
         return self._rules
 
+def microsecond_api_calls_left_from_history(history: List[float], max_window: int,
+                                            max_calls: int, now: float) -> Tuple[int, float]:
+    # The same algorithm as the Tornado backend, but in integer
+    # microseconds.
+    window = to_microseconds(max_window)
+    reset_time = 0
+    for timestamp in history:
+        reset_time = max(reset_time, to_microseconds(timestamp)) + window // max_calls
+
+    now_us = to_microseconds(now)
+    if reset_time <= now_us:
+        return max_calls, 0
+    return (now_us + window - reset_time) * max_calls // window, (reset_time - now_us) / 1000000
+
 class RateLimiterBackendBase(ZulipTestCase):
     __unittest_skip__ = True
 
@@ -146,11 +166,28 @@ class RedisRateLimiterBackendTest(RateLimiterBackendBase):
 
     def api_calls_left_from_history(self, history: List[float], max_window: int,
                                     max_calls: int, now: float) -> Tuple[int, float]:
-        latest_timestamp = history[-1]
-        relevant_requests = [t for t in history if (t >= now - max_window)]
-        relevant_requests_amount = len(relevant_requests)
-
-        return max_calls - relevant_requests_amount, latest_timestamp + max_window - now
+        return microsecond_api_calls_left_from_history(history, max_window, max_calls, now)
+
+    def test_same_decisions_as_tornado(self) -> None:
+        rules = [(1, 5), (2, 4), (10, 20)]
+        redis_objects = [RateLimitedTestObject(f'redis{i}', [rule], RedisRateLimiterBackend)
+                         for i, rule in enumerate(rules)]
+        tornado_objects = [RateLimitedTestObject(f'tornado{i}', [rule],
+                                                 TornadoInMemoryRateLimiterBackend)
+                           for i, rule in enumerate(rules)]
+        for obj in redis_objects + tornado_objects:
+            obj.clear_history()
+
+        rng = random.Random(42)
+        now = time.time()
+        for i in range(300):
+            now += rng.expovariate(10)
+            with mock.patch('time.time', return_value=now):
+                for redis_object, tornado_object in zip(redis_objects, tornado_objects):
+                    redis_ratelimited, redis_time_till_free = redis_object.rate_limit()
+                    tornado_ratelimited, tornado_time_till_free = tornado_object.rate_limit()
+                    self.assertEqual(redis_ratelimited, tornado_ratelimited)
+                    self.assertAlmostEqual(redis_time_till_free, tornado_time_till_free, places=5)
 
     def test_block_access(self) -> None:
         """
@@ -200,6 +237,57 @@ class TornadoInMemoryRateLimiterBackendTest(RateLimiterBackendBase):
         with mock.patch('time.time', return_value=(start_time + 1.01)):
             self.make_request(obj, expect_ratelimited=False, verify_api_calls_left=False)
 
+class SharedMemoryRateLimiterBackendTest(RateLimiterBackendBase):
+    __unittest_skip__ = False
+    backend = SharedMemoryRateLimiterBackend
+
+    def setUp(self) -> None:
+        super().setUp()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        settings_override = self.settings(RATE_LIMITING_SHARED_MEMORY_PATH=path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def api_calls_left_from_history(self, history: List[float], max_window: int,
+                                    max_calls: int, now: float) -> Tuple[int, float]:
+        return microsecond_api_calls_left_from_history(history, max_window, max_calls, now)
+
+    def test_default_backend(self) -> None:
+        self.assertEqual(default_backend(), SharedMemoryRateLimiterBackend)
+        self.assertEqual(RateLimitedUser(self.example_user("hamlet")).backend,
+                         SharedMemoryRateLimiterBackend)
+        with self.settings(RATE_LIMITING_SHARED_MEMORY_PATH=None):
+            self.assertEqual(default_backend(), RedisRateLimiterBackend)
+
+    def test_block_access(self) -> None:
+        obj = self.create_object('test', [(2, 5)])
+        start_time = time.time()
+
+        obj.block_access(1)
+        with mock.patch('time.time', return_value=(start_time)):
+            self.make_request(obj, expect_ratelimited=True, verify_api_calls_left=False)
+
+        with mock.patch('time.time', return_value=(start_time + 1.01)):
+            self.make_request(obj, expect_ratelimited=False, verify_api_calls_left=False)
+
+    def test_full_bucket(self) -> None:
+        objects = [self.create_object(f'test{i}', [(10, 1)]) for i in range(17)]
+        start_time = time.time()
+        # With a single bucket, the 17th entity evicts the entry that
+        # expires soonest, i.e. the first entity's.
+        with mock.patch('zerver.lib.rate_limiter.SHARED_MEMORY_BUCKETS', 1):
+            for i, obj in enumerate(objects):
+                with mock.patch('time.time', return_value=(start_time + i * 0.01)):
+                    self.make_request(obj, expect_ratelimited=False, verify_api_calls_left=False)
+
+            with mock.patch('time.time', return_value=(start_time + 1)):
+                self.make_request(objects[0], expect_ratelimited=False,
+                                  verify_api_calls_left=False)
+                self.make_request(objects[2], expect_ratelimited=True,
+                                  verify_api_calls_left=False)
+
 class RateLimitedObjectsTest(ZulipTestCase):
     def test_user_rate_limits(self) -> None:
         user_profile = self.example_user("hamlet")
@@ -1,16 +1,24 @@
+import os
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple
 from unittest import mock
 
+import ujson
 from django.conf import settings
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.actions import do_add_submessage, do_delete_messages, internal_send_private_message
 from zerver.lib.retention import (
+    MAX_ADAPTIVE_BATCH_SIZE,
+    MIN_ADAPTIVE_BATCH_SIZE,
+    REPLICATION_LAG_POLL_SECONDS,
     archive_messages,
     clean_archived_data,
+    delete_messages,
     get_realms_and_streams_for_archiving,
+    get_replication_lag,
     move_messages_to_archive,
+    next_chunk_size,
     restore_all_data_from_archive,
     restore_retention_policy_deletions_for_stream,
 )
@@ -298,6 +306,73 @@ class TestArchiveMessagesGeneral(ArchiveMessagesTestingBase):
                 set(expired_usermsg_ids),
             )
 
+    def test_archiving_resumes_after_interruption(self) -> None:
+        expired_msg_ids = self._make_mit_messages(
+            5,
+            timezone_now() - timedelta(days=MIT_REALM_DAYS+1),
+        )
+        expired_usermsg_ids = self._get_usermessage_ids(expired_msg_ids)
+        first_chunk_usermsg_ids = self._get_usermessage_ids(expired_msg_ids[:2])
+        progress_path = os.path.join(settings.RETENTION_PROGRESS_DIR, f'{self.mit_realm.id}.json')
+
+        chunks = 0
+
+        def fail_second_chunk(msg_ids: List[int]) -> None:
+            nonlocal chunks
+            chunks += 1
+            if chunks == 2:
+                raise Exception('Connection reset')
+            delete_messages(msg_ids)
+
+        with mock.patch("zerver.lib.retention.delete_messages", side_effect=fail_second_chunk), \
+                self.assertRaises(Exception):
+            archive_messages(chunk_size=2)
+
+        # The first chunk was committed, and where it ended saved:
+        self._verify_archive_data(expired_msg_ids[:2], first_chunk_usermsg_ids)
+        with open(progress_path) as f:
+            self.assertEqual(ujson.load(f), {'personal_and_huddle': expired_msg_ids[1]})
+
+        # The next run picks up from there, and forgets it once done.
+        with queries_captured() as queries:
+            archive_messages(chunk_size=2)
+        self._verify_archive_data(expired_msg_ids, expired_usermsg_ids)
+        self.assertTrue(any(f'zerver_message.id > {expired_msg_ids[1]}' in query['sql']
+                            for query in queries))
+        self.assertFalse(os.path.exists(progress_path))
+
+    def test_next_chunk_size(self) -> None:
+        with self.settings(RETENTION_TARGET_TRANSACTION_SECONDS=1.0):
+            self.assertEqual(next_chunk_size(1000, 0.5), 2000)
+            self.assertEqual(next_chunk_size(1000, 1.25), 800)
+            # It changes by at most a factor of 2 at a time...
+            self.assertEqual(next_chunk_size(1000, 0.0), 2000)
+            self.assertEqual(next_chunk_size(1000, 30), 500)
+            # ...and within bounds.
+            self.assertEqual(next_chunk_size(40000, 0.1), MAX_ADAPTIVE_BATCH_SIZE)
+            self.assertEqual(next_chunk_size(15, 5), MIN_ADAPTIVE_BATCH_SIZE)
+
+    def test_archiving_waits_for_replicas(self) -> None:
+        # Without replicas, there's no lag.
+        self.assertEqual(get_replication_lag(), 0)
+
+        expired_msg_ids = self._make_mit_messages(
+            5,
+            timezone_now() - timedelta(days=MIT_REALM_DAYS+1),
+        )
+        expired_usermsg_ids = self._get_usermessage_ids(expired_msg_ids)
+
+        # We check after each of the first two chunks of 2, but not
+        # after the last, and wait for the lag to come down.
+        with self.settings(RETENTION_MAX_REPLICATION_LAG_SECONDS=10), \
+                mock.patch("zerver.lib.retention.get_replication_lag",
+                           side_effect=[30.0, 5.0, 0.0]) as mock_lag, \
+                mock.patch("zerver.lib.retention.time.sleep") as mock_sleep:
+            archive_messages(chunk_size=2)
+        self.assertEqual(mock_lag.call_count, 3)
+        mock_sleep.assert_called_once_with(REPLICATION_LAG_POLL_SECONDS)
+        self._verify_archive_data(expired_msg_ids, expired_usermsg_ids)
+
     def test_archive_message_tool(self) -> None:
         """End-to-end test of the archiving tool, directly calling
         archive_messages."""
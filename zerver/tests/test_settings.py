@@ -243,7 +243,7 @@ class ChangeSettingsTest(ZulipTestCase):
                         old_password=initial_password(self.example_email("hamlet")),
                         new_password="ignored",
                     ))
-                self.assert_json_error(result, "You're making too many attempts! Try again in 10 seconds.")
+                self.assert_json_error(result, "You're making too many attempts! Try again in 5 seconds.")
 
             # After time passes, we should be able to succeed if we give the correct password.
             with mock.patch('time.time', return_value=start_time + 11):
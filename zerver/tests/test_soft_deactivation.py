@@ -5,6 +5,7 @@ from django.utils.timezone import now as timezone_now
 from zerver.lib.actions import do_add_alert_words
 from zerver.lib.soft_deactivation import (
     add_missing_messages,
+    add_missing_messages_for_users,
     do_auto_soft_deactivate_users,
     do_catch_up_soft_deactivated_users,
     do_soft_activate_users,
@@ -267,7 +268,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertNotEqual(idle_user_msg_list[-1].content, message)
         with queries_captured() as queries:
             reactivate_user_if_soft_deactivated(long_term_idle_user)
-        self.assert_length(queries, 8)
+        self.assert_length(queries, 4)
         self.assertFalse(long_term_idle_user.long_term_idle)
         self.assertEqual(last_realm_audit_log_entry(
             RealmAuditLog.USER_SOFT_ACTIVATED).modified_user, long_term_idle_user)
@@ -312,7 +313,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertNotEqual(idle_user_msg_list[-1], sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 2)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 1)
         self.assertEqual(idle_user_msg_list[-1], sent_message)
@@ -329,7 +330,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertNotEqual(idle_user_msg_list[-1], sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 7)
+        self.assert_length(queries, 2)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 1)
         self.assertEqual(idle_user_msg_list[-1], sent_message)
@@ -354,7 +355,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 2)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 2)
         for sent_message in sent_message_list:
@@ -386,7 +387,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 2)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 2)
         for sent_message in sent_message_list:
@@ -412,9 +413,9 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         self.assertEqual(idle_user_msg_list[-1].id, sent_message_id)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        # There are no streams to fetch missing messages from, so
-        # the Message.objects query will be avoided.
-        self.assert_length(queries, 4)
+        # The user was unsubscribed the whole time, so there's
+        # nothing to create, but it takes the same queries to tell.
+        self.assert_length(queries, 2)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         # No new UserMessage rows should have been created.
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count)
@@ -441,7 +442,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
             self.assertNotEqual(idle_user_msg_list.pop(), sent_message)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 6)
+        self.assert_length(queries, 2)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + 2)
         for sent_message in sent_message_list:
@@ -449,7 +450,7 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         long_term_idle_user.refresh_from_db()
         self.assertEqual(long_term_idle_user.last_active_message_id, sent_message_list[0].id)
 
-    @mock.patch('zerver.lib.soft_deactivation.BULK_CREATE_BATCH_SIZE', 2)
+    @mock.patch('zerver.lib.soft_deactivation.CATCH_UP_MESSAGES_PER_ROUND', 2)
     def test_add_missing_messages_pagination(self) -> None:
         recipient_list  = [self.example_user("hamlet"), self.example_user("iago")]
         stream_name = 'Denmark'
@@ -471,12 +472,65 @@ class SoftDeactivationMessageTest(ZulipTestCase):
         idle_user_msg_count = len(idle_user_msg_list)
         with queries_captured() as queries:
             add_missing_messages(long_term_idle_user)
-        self.assert_length(queries, 10)
+        # A query for where each round of 2 messages ends, and one to
+        # create the round's rows.
+        self.assert_length(queries, 6)
         idle_user_msg_list = get_user_messages(long_term_idle_user)
         self.assertEqual(len(idle_user_msg_list), idle_user_msg_count + num_new_messages)
         long_term_idle_user.refresh_from_db()
         self.assertEqual(long_term_idle_user.last_active_message_id, message_ids[-1])
 
+    @mock.patch('zerver.lib.soft_deactivation.CATCH_UP_MESSAGES_PER_ROUND', 1)
+    def test_add_missing_messages_for_users(self) -> None:
+        stream_name = 'Denmark'
+        sender = self.example_user('iago')
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        for user_profile in [sender, hamlet, cordelia]:
+            self.subscribe(user_profile, stream_name)
+        self.unsubscribe(othello, stream_name)
+        # So that all three were last active at the same message.
+        self.send_huddle_message(sender, [hamlet, cordelia, othello])
+        with mock.patch('logging.info'):
+            do_soft_deactivate_users([hamlet, cordelia, othello])
+
+        # Hamlet is subscribed throughout, Cordelia until the third
+        # message, and Othello from the fourth on; Cordelia was also
+        # mentioned in the first, so she already has that one.
+        message_ids = [self.send_stream_message(sender, stream_name, '@**Cordelia Lear**')]
+        message_ids += [self.send_stream_message(sender, stream_name) for i in range(2)]
+        self.unsubscribe(cordelia, stream_name)
+        self.subscribe(othello, stream_name)
+        message_ids += [self.send_stream_message(sender, stream_name) for i in range(3)]
+        expected_message_ids = {
+            hamlet.id: message_ids,
+            cordelia.id: message_ids[:3],
+            othello.id: message_ids[3:],
+        }
+        self.assertTrue(UserMessage.objects.filter(user_profile=cordelia, message_id=message_ids[0],
+                                                   flags=UserMessage.flags.mentioned).exists())
+
+        # Three queries to set up and drop the table of subscription
+        # ranges, and two for each round of a message.
+        with queries_captured() as queries:
+            add_missing_messages_for_users([hamlet, cordelia, othello])
+        self.assert_length(queries, 3 + 2 * (len(message_ids) + 1))
+
+        for user_profile in [hamlet, cordelia, othello]:
+            self.assertEqual(
+                list(UserMessage.objects.filter(user_profile=user_profile, message_id__in=message_ids)
+                     .order_by('message_id').values_list('message_id', flat=True)),
+                expected_message_ids[user_profile.id],
+            )
+            # The in-memory objects are kept up to date, too.
+            last_active_message_id = user_profile.last_active_message_id
+            user_profile.refresh_from_db()
+            self.assertEqual(user_profile.last_active_message_id, last_active_message_id)
+        self.assertEqual(hamlet.last_active_message_id, message_ids[-1])
+        self.assertEqual(othello.last_active_message_id, message_ids[-1])
+        self.assertEqual(cordelia.last_active_message_id, message_ids[2])
+
     def test_user_message_filter(self) -> None:
         # In this test we are basically testing out the logic used out in
         # do_send_messages() in action.py for filtering the messages for which
@@ -1,6 +1,9 @@
 import logging
+import tempfile
 from unittest.mock import Mock, patch
 
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
 from django.conf import settings
 from moto import mock_s3
 
@@ -14,7 +17,7 @@ from zerver.lib.transfer import (
     transfer_message_files_to_s3,
     transfer_uploads_to_s3,
 )
-from zerver.lib.upload import resize_emoji, upload_message_file
+from zerver.lib.upload import S3Transfer, resize_emoji, upload_files_to_s3, upload_message_file
 from zerver.models import Attachment, RealmEmoji
 
 
@@ -29,7 +32,7 @@ class TransferUploadsToS3Test(ZulipTestCase):
         transfer_uploads_to_s3(4)
 
         m1.assert_called_with(4)
-        m2.assert_called_with(4)
+        m2.assert_called_with(4, None)
         m3.assert_called_with(4)
 
     @mock_s3
@@ -101,3 +104,79 @@ class TransferUploadsToS3Test(ZulipTestCase):
 
         self.assertEqual(image_data, original_key.get()['Body'].read())
         self.assertEqual(resized_image_data, resized_key.get()['Body'].read())
+
+    @mock_s3
+    def test_transfer_message_files_resumes_from_manifest(self) -> None:
+        bucket = create_s3_buckets(settings.S3_AUTH_UPLOADS_BUCKET)[0]
+        hamlet = self.example_user('hamlet')
+        upload_message_file('dummy1.txt', len(b'zulip1!'), 'text/plain', b'zulip1!', hamlet)
+        upload_message_file('dummy2.zip', len(b'zulip2!'), 'application/zip', b'zulip2!', hamlet)
+        first_attachment, second_attachment = Attachment.objects.order_by('id')
+
+        with tempfile.NamedTemporaryFile('w') as manifest:
+            # We died after uploading the first file.
+            manifest.write(first_attachment.path_id + '\n')
+            manifest.flush()
+            transfer_message_files_to_s3(1, manifest.name)
+
+            self.assertEqual([key.key for key in bucket.objects.all()], [second_attachment.path_id])
+            key = bucket.Object(second_attachment.path_id)
+            self.assertEqual(key.get()['Body'].read(), b'zulip2!')
+            self.assertEqual(key.content_type, 'application/zip')
+            self.assertEqual(key.content_disposition, 'attachment')
+            self.assertEqual(key.metadata, {'user_profile_id': str(hamlet.id),
+                                            'realm_id': str(hamlet.realm_id)})
+            with open(manifest.name) as f:
+                self.assertEqual(f.read().split(), [first_attachment.path_id,
+                                                    second_attachment.path_id])
+
+            # A re-run has nothing left to do.
+            bucket.Object(second_attachment.path_id).delete()
+            transfer_message_files_to_s3(1, manifest.name)
+            self.assertEqual(list(bucket.objects.all()), [])
+
+    def test_upload_files_to_s3_retries(self) -> None:
+        error = ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+        client = Mock()
+        client.upload_file.side_effect = [error, error, None]
+        transfers = [S3Transfer(key='1/ab/file.txt', filename='/tmp/file.txt')]
+        with patch('zerver.lib.upload.get_s3_transfer_client', return_value=client), \
+                patch('zerver.lib.upload.time.sleep') as mock_sleep, \
+                patch('zerver.lib.upload.random.uniform', return_value=1), \
+                patch('logging.warning') as mock_warning:
+            upload_files_to_s3('bucket', transfers)
+        self.assertEqual(client.upload_file.call_count, 3)
+        self.assertEqual(mock_warning.call_count, 2)
+        # We back off exponentially.
+        self.assertEqual([call[0][0] for call in mock_sleep.call_args_list], [0.5, 1.0])
+
+        client.upload_file.side_effect = error
+        with patch('zerver.lib.upload.get_s3_transfer_client', return_value=client), \
+                patch('zerver.lib.upload.time.sleep'), patch('logging.warning'), \
+                self.assertRaises(ClientError):
+            upload_files_to_s3('bucket', transfers)
+
+        # Errors which will just happen again aren't retried.
+        client.reset_mock()
+        upload_failed_error = S3UploadFailedError('Failed to upload')
+        upload_failed_error.__context__ = ClientError({'Error': {'Code': 'NoSuchBucket'}}, 'PutObject')
+        for error in [ClientError({'Error': {'Code': 'AccessDenied'},
+                                   'ResponseMetadata': {'HTTPStatusCode': 403}}, 'PutObject'),
+                      upload_failed_error]:
+            client.upload_file.side_effect = error
+            with patch('zerver.lib.upload.get_s3_transfer_client', return_value=client), \
+                    patch('zerver.lib.upload.time.sleep') as mock_sleep, \
+                    self.assertRaises(type(error)):
+                upload_files_to_s3('bucket', transfers)
+            mock_sleep.assert_not_called()
+        self.assertEqual(client.upload_file.call_count, 2)
+
+        # A 5xx is retried.
+        client.reset_mock()
+        client.upload_file.side_effect = [
+            ClientError({'Error': {'Code': 'NotImplemented'},
+                         'ResponseMetadata': {'HTTPStatusCode': 503}}, 'PutObject'), None]
+        with patch('zerver.lib.upload.get_s3_transfer_client', return_value=client), \
+                patch('zerver.lib.upload.time.sleep'), patch('logging.warning'):
+            upload_files_to_s3('bucket', transfers)
+        self.assertEqual(client.upload_file.call_count, 2)
@@ -55,7 +55,11 @@ from zerver.lib.actions import (
 from zerver.lib.bot_lib import EmbeddedBotHandler, EmbeddedBotQuitException, get_bot_handler
 from zerver.lib.context_managers import lockfile
 from zerver.lib.db import reset_queries
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import handle_digest_email, handle_digest_emails
+from zerver.lib.duplicate_queries import (
+    finish_duplicate_query_detection,
+    start_duplicate_query_detection,
+)
 from zerver.lib.email_mirror import decode_stream_email_address, is_missed_message_address
 from zerver.lib.email_mirror import process_message as mirror_email
 from zerver.lib.email_mirror import rate_limit_mirror_by_realm
@@ -214,6 +218,7 @@ class QueueProcessingWorker(ABC):
                    events: List[Dict[str, Any]]) -> None:
         try:
             time_start = time.time()
+            start_duplicate_query_detection()
             consume_func(events)
             consume_time_seconds: Optional[float] = time.time() - time_start
             self.consumed_since_last_emptied += len(events)
@@ -221,6 +226,7 @@ class QueueProcessingWorker(ABC):
             self._handle_consume_exception(events)
             consume_time_seconds = None
         finally:
+            finish_duplicate_query_detection(f"queue {self.queue_name}")
             flush_per_request_caches()
             reset_queries()
 
@@ -562,7 +568,12 @@ class DigestWorker(QueueProcessingWorker):  # nocoverage
     # management command, not here.
     def consume(self, event: Mapping[str, Any]) -> None:
         logging.info("Received digest event: %s", event)
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+        # Events queued before users were queued in batches name a
+        # single user.
+        if "user_profile_id" in event:
+            handle_digest_email(event["user_profile_id"], event["cutoff"])
+            return
+        handle_digest_emails(event["user_ids"], event["cutoff"])
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
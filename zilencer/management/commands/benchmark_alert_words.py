@@ -0,0 +1,60 @@
+import pickle
+import random
+import time
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.alert_words import RealmAlertWordAutomaton
+
+WORDS = ['deploy', 'outage', 'release', 'postgres', 'billing', 'security', 'oncall',
+         'rollback', 'incident', 'migration', 'latency', 'customer', 'pagerduty']
+
+def make_alert_words(users: int) -> Dict[int, List[str]]:
+    rng = random.Random(42)
+    return {user_id: [f'{word}{rng.randrange(users)}' for word in rng.sample(WORDS, 3)] +
+            [rng.choice(WORDS)]
+            for user_id in range(users)}
+
+class Command(BaseCommand):
+    help = """
+    Benchmark what each process does after a user in a large realm
+    changes their alert words: previously, fetching and unpickling the
+    whole realm's automaton from memcached; now, fetching the realm's
+    alert words and updating the process's automaton with the change.
+    Usage: ./manage.py benchmark_alert_words [--users=50000]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--users', default=50000, type=int,
+                            help='Number of users with alert words in the realm')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        alert_words = make_alert_words(options['users'])
+
+        start = time.perf_counter()
+        realm_automaton = RealmAlertWordAutomaton()
+        realm_automaton.update(alert_words)
+        build_time = time.perf_counter() - start
+
+        pickled_automaton = pickle.dumps(realm_automaton.automaton)
+        start = time.perf_counter()
+        pickle.loads(pickled_automaton)
+        unpickle_time = time.perf_counter() - start
+
+        pickled_words = pickle.dumps(alert_words)
+        start = time.perf_counter()
+        pickle.loads(pickled_words)
+        words_unpickle_time = time.perf_counter() - start
+
+        alert_words[0] = alert_words[0][1:] + ['newword']
+        start = time.perf_counter()
+        realm_automaton.update(alert_words)
+        update_time = time.perf_counter() - start
+
+        self.stdout.write(f'Building the automaton from scratch: {build_time * 1000:.1f}ms')
+        self.stdout.write(f'Before: {len(pickled_automaton) / 1024:.0f} KiB from memcached, '
+                          f'{unpickle_time * 1000:.1f}ms to unpickle')
+        self.stdout.write(f'After: {len(pickled_words) / 1024:.0f} KiB from memcached, '
+                          f'{(words_unpickle_time + update_time) * 1000:.1f}ms to unpickle '
+                          f'and update')
@@ -0,0 +1,128 @@
+import random
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Sequence, TypeVar
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.bulk_create import bulk_create_streams, bulk_create_users
+from zerver.lib.digest import handle_digest_email, handle_digest_emails
+from zerver.models import (
+    Message,
+    Realm,
+    ScheduledEmail,
+    Stream,
+    Subscription,
+    UserProfile,
+    get_client,
+    get_realm,
+)
+
+BATCH_SIZE = 10000
+
+T = TypeVar('T')
+
+def skewed_choice(rng: random.Random, items: Sequence[T]) -> T:
+    # Pareto-distributed, so the first few items are much more likely
+    # to be picked than the rest.
+    return items[(int(rng.paretovariate(1)) - 1) % len(items)]
+
+class Command(BaseCommand):
+    help = """
+    Benchmark computing digest emails.  Generates a set of users in a
+    realm, subscribed to some of a set of streams, and a week of
+    traffic in those streams; then computes the users' digests a user
+    at a time, as DigestWorker used to, and in batches of users.  A user
+    at a time is slow enough that it is only timed for a sample of the
+    users, and extrapolated.  Everything is rolled back afterwards.
+    Usage: ./manage.py benchmark_digest --realm=zulip [--users=10000] [--batch-size=1000]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', required=True,
+                            help='String ID of the realm to generate the users in')
+        parser.add_argument('--users', default=10000, type=int,
+                            help='Number of users')
+        parser.add_argument('--streams', default=100, type=int,
+                            help='Number of streams')
+        parser.add_argument('--streams-per-user', default=20, type=int,
+                            help='Number of streams each user is subscribed to')
+        parser.add_argument('--messages', default=20000, type=int,
+                            help='Number of messages sent to the streams over the week')
+        parser.add_argument('--topics-per-stream', default=20, type=int,
+                            help='Number of topics in each stream')
+        parser.add_argument('--batch-size', default=1000, type=int,
+                            help='Number of users to compute digests for at once')
+        parser.add_argument('--sample', default=500, type=int,
+                            help='Number of users to compute digests for a user at a time')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        with transaction.atomic():
+            user_ids = self.generate(realm, options)
+            cutoff = (timezone_now() - timedelta(days=7)).timestamp()
+
+            sample = user_ids[:options['sample']]
+            elapsed = self.benchmark(lambda: [handle_digest_email(user_id, cutoff)
+                                              for user_id in sample])
+            self.stdout.write(f'a user at a time: {len(sample)} digests in {elapsed:.1f}s '
+                              f'({len(sample) / elapsed:.0f} digests/s, '
+                              f'~{elapsed * len(user_ids) / len(sample):.0f}s for all {len(user_ids)})')
+
+            batch_size = options['batch_size']
+            elapsed = self.benchmark(lambda: [handle_digest_emails(user_ids[i:i + batch_size], cutoff)
+                                              for i in range(0, len(user_ids), batch_size)])
+            self.stdout.write(f'{batch_size} users at a time: {len(user_ids)} digests in {elapsed:.1f}s '
+                              f'({len(user_ids) / elapsed:.0f} digests/s)')
+            transaction.set_rollback(True)
+
+    def benchmark(self, compute_digests: Callable[[], Any]) -> float:
+        with transaction.atomic():
+            start = time.perf_counter()
+            compute_digests()
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'  ({ScheduledEmail.objects.count()} digests sent)')
+            transaction.set_rollback(True)
+        return elapsed
+
+    def generate(self, realm: Realm, options: Dict[str, Any]) -> List[int]:
+        rng = random.Random(42)
+        self.stdout.write(f'Generating {options["users"]} users and '
+                          f'{options["messages"]} messages...')
+
+        emails = [f'benchmark-digest-{i}@{realm.host}' for i in range(options['users'])]
+        bulk_create_users(realm, {(email, email.split('@')[0], True) for email in emails})
+        users = list(UserProfile.objects.filter(realm=realm, delivery_email__in=emails))
+        stream_names = [f'benchmark-digest-{i}' for i in range(options['streams'])]
+        bulk_create_streams(realm, {name: {'description': ''} for name in stream_names})
+        streams = list(Stream.objects.filter(realm=realm, name__in=stream_names))
+
+        subscriptions = []
+        for user_profile in users:
+            for stream in rng.sample(streams, min(options['streams_per_user'], len(streams))):
+                subscriptions.append(Subscription(user_profile=user_profile,
+                                                  recipient_id=stream.recipient_id))
+        Subscription.objects.bulk_create(subscriptions, batch_size=BATCH_SIZE)
+
+        # Traffic is uneven: a few senders, streams, and topics are
+        # much busier than the rest.
+        sending_client = get_client('benchmark_digest')
+        start_time = timezone_now() - timedelta(days=7)
+        topic_names = [f'topic {i}' for i in range(options['topics_per_stream'])]
+        messages = []
+        for i in range(options['messages']):
+            message = Message(
+                sender=skewed_choice(rng, users),
+                recipient_id=skewed_choice(rng, streams).recipient_id,
+                content='Hello',
+                rendered_content='<p>Hello</p>',
+                date_sent=start_time + timedelta(days=7 * (i + 1) / (options['messages'] + 1)),
+                sending_client=sending_client,
+            )
+            message.set_topic_name(skewed_choice(rng, topic_names))
+            messages.append(message)
+        Message.objects.bulk_create(messages, batch_size=BATCH_SIZE)
+
+        return [user.id for user in users]
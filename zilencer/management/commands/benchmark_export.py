@@ -0,0 +1,89 @@
+import glob
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Callable
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection
+
+from zerver.lib.export import (
+    TableData,
+    export_from_config,
+    export_partial_message_files,
+    export_partial_message_shards,
+    export_usermessages_batch,
+    export_usermessages_shard,
+    fetch_reaction_data,
+    get_realm_config,
+    write_message_shard_manifest,
+)
+from zerver.models import Message, Realm, get_realm
+
+
+def export_messages_json(realm: Realm, output_dir: str) -> None:
+    response = get_realm_data(realm)
+    message_ids = export_partial_message_files(realm, response, output_dir=output_dir)
+    fetch_reaction_data(response={}, message_ids=message_ids)
+    for partial_path in glob.glob(os.path.join(output_dir, 'messages-*.json.partial')):
+        export_usermessages_batch(partial_path, partial_path[:-len('.partial')])
+
+def export_messages_streaming(realm: Realm, output_dir: str) -> None:
+    response = get_realm_data(realm)
+    export_partial_message_shards(realm, response, output_dir=output_dir)
+    for partial_path in glob.glob(os.path.join(output_dir, 'messages-*.jsonl.gz.partial')):
+        export_usermessages_shard(partial_path, partial_path[:-len('.partial')])
+    write_message_shard_manifest(output_dir)
+
+def get_realm_data(realm: Realm) -> TableData:
+    response: TableData = {}
+    export_from_config(response=response, config=get_realm_config(), seed_object=realm,
+                       context=dict(realm=realm, exportable_user_ids=None))
+    return response
+
+class Command(BaseCommand):
+    help = """
+    Benchmark exporting a realm's messages (with their UserMessage and
+    Reaction rows) as JSON files, and as the streaming export's
+    compressed shards: the time taken, the peak memory used, and the
+    size of the output.  Each export runs in a fresh child process, so
+    that its peak RSS can be measured on its own.
+    Usage: ./manage.py benchmark_export --realm=zulip
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', required=True,
+                            help='String ID of the realm whose messages to export')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        messages = Message.objects.filter(sender__realm=realm).count()
+        self.stdout.write(f'Exporting about {messages} messages')
+        for name, export in [('JSON', export_messages_json),
+                             ('streaming', export_messages_streaming)]:
+            self.benchmark(name, export, realm)
+
+    def benchmark(self, name: str, export: Callable[[Realm, str], None], realm: Realm) -> None:
+        output_dir = tempfile.mkdtemp(prefix='zulip-benchmark-export-')
+        # The child must open its own database connection.
+        connection.close()
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:  # nocoverage
+            exit_code = 1
+            try:
+                export(realm, output_dir)
+                exit_code = 0
+            finally:
+                os._exit(exit_code)
+        _, status, rusage = os.wait4(pid, 0)
+        elapsed = time.perf_counter() - start
+        assert status == 0
+
+        output_size = sum(os.path.getsize(path) for path in
+                          glob.glob(os.path.join(output_dir, 'messages-*')))
+        shutil.rmtree(output_dir)
+        # ru_maxrss is in KiB on Linux.
+        self.stdout.write(f'{name}: {elapsed:.1f}s, peak RSS {rusage.ru_maxrss / 1024:.0f} MiB, '
+                          f'{output_size / 1024 / 1024:.1f} MiB of message files')
@@ -0,0 +1,113 @@
+import gzip
+import io
+import itertools
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.export import Record, read_message_shard, write_shard_rows
+from zerver.lib.import_realm import (
+    ID_MAP,
+    MESSAGE_SHARD_IMPORT_CHUNK_SIZE,
+    UserMessageColumns,
+    copy_text,
+)
+
+
+def generate_user_messages(rows: int, messages: int, users: int) -> Iterator[Record]:
+    rng = random.Random(42)
+    for i in range(rows):
+        yield {
+            'id': i + 1,
+            'user_profile': rng.randrange(1, users + 1),
+            'message': i * messages // rows + 1,
+            'flags_mask': rng.choice([0, 1, 3, 8, 9, 33]),
+        }
+
+def remap_rows(rows: List[Record]) -> io.StringIO:
+    """How UserMessage rows were imported before they were held as
+    columns: a dict lookup and key rename per field of each row, then
+    a COPY line per row."""
+    for field_name, related_table in [('message', 'message'), ('user_profile', 'user_profile')]:
+        lookup_table = ID_MAP[related_table]
+        for item in rows:
+            old_id = item[field_name]
+            item[field_name + '_id'] = lookup_table[old_id] if old_id in lookup_table else old_id
+            del item[field_name]
+    for item in rows:
+        item['flags'] = item['flags_mask']
+        del item['flags_mask']
+    buf = io.StringIO()
+    for item in rows:
+        buf.write('\t'.join(copy_text(item[column])
+                            for column in ['user_profile_id', 'message_id', 'flags']))
+        buf.write('\n')
+    return buf
+
+def remap_columns(rows: List[Record]) -> io.StringIO:
+    columns = UserMessageColumns(rows)
+    columns.re_map_foreign_keys()
+    buf = io.StringIO()
+    columns.write_copy_text(buf)
+    return buf
+
+class Command(BaseCommand):
+    help = """
+    Benchmark remapping the foreign keys of imported UserMessage rows,
+    and formatting them for COPY, a dict per row at a time (as the
+    importer used to) and a column at a time (as it does now), on a
+    generated message shard.  Writing to the database isn't included.
+    Usage: ./manage.py benchmark_import_remap [--rows=10000000]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--rows', default=10000000, type=int,
+                            help='Number of UserMessage rows in the shard')
+        parser.add_argument('--users', default=1000, type=int,
+                            help='Number of users the rows belong to')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        rows = options['rows']
+        messages = max(rows // 10, 1)
+        fd, shard_path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        try:
+            self.stdout.write(f'Generating a shard of {rows} UserMessage rows...')
+            with gzip.open(shard_path, 'wt') as shard_file:
+                write_shard_rows(shard_file, 'zerver_usermessage',
+                                 generate_user_messages(rows, messages, options['users']))
+
+            # The new IDs are as for an import into a server with
+            # other realms already on it.
+            id_maps: Dict[str, Dict[int, int]] = {
+                'message': {old_id: old_id + 10 ** 8 for old_id in range(1, messages + 1)},
+                'user_profile': {old_id: old_id + 10 ** 5
+                                 for old_id in range(1, options['users'] + 1)},
+            }
+            with patch.dict(ID_MAP, id_maps):
+                for name, remap in [('per row', remap_rows), ('per column', remap_columns)]:
+                    self.benchmark(name, remap, shard_path, rows)
+        finally:
+            os.remove(shard_path)
+
+    def benchmark(self, name: str, remap: Callable[[List[Record]], io.StringIO],
+                  shard_path: str, rows: int) -> None:
+        parse_time = 0.0
+        remap_time = 0.0
+        shard_rows = (row for table, row in read_message_shard(shard_path))
+        while True:
+            start = time.perf_counter()
+            chunk = list(itertools.islice(shard_rows, MESSAGE_SHARD_IMPORT_CHUNK_SIZE))
+            parse_time += time.perf_counter() - start
+            if not chunk:
+                break
+            start = time.perf_counter()
+            remap(chunk)
+            remap_time += time.perf_counter() - start
+        self.stdout.write(f'{name}: remapped in {remap_time:.1f}s ({rows / remap_time:.0f} rows/s); '
+                          f'parsing the shard took another {parse_time:.1f}s')
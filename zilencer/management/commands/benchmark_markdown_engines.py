@@ -0,0 +1,73 @@
+import time
+import tracemalloc
+from typing import Any, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.markdown import (
+    MARKDOWN_RENDER_TIMEOUT,
+    MarkdownRenderRequest,
+    build_engine,
+    md_engines,
+    run_md_engine,
+)
+
+# Used as the realm_filters_key of the benchmark's engines, so they
+# can't collide with a real realm's.
+BENCHMARK_MARKDOWN_KEY = -200
+
+CONTENT = "Deployed the fix for PROJ7-1234 to **staging**; see https://example.com/builds/99."
+
+def make_realm_filters(count: int) -> List[Tuple[str, str, int]]:
+    return [(fr'PROJ{i}-(?P<id>[0-9]+)', f'https://tracker.example.com/proj{i}/%(id)s', i)
+            for i in range(count)]
+
+class Command(BaseCommand):
+    help = """
+    Benchmark the memory used by a realm's markdown engine, and the
+    latency of a realm's first render (which builds its engine)
+    compared to later renders.
+    Usage: ./manage.py benchmark_markdown_engines [--realms=20] [--filters=10]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realms', default=20, type=int,
+                            help='Number of realms to build engines for')
+        parser.add_argument('--filters', default=10, type=int,
+                            help='Number of realm filters in each realm')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realms = options['realms']
+        realm_filters = make_realm_filters(options['filters'])
+
+        # Build one engine first, so that imports and module-level
+        # regexes aren't counted against the engines we measure.
+        build_engine(realm_filters, BENCHMARK_MARKDOWN_KEY, False)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        engines = [build_engine(realm_filters, BENCHMARK_MARKDOWN_KEY - i, False)
+                   for i in range(realms)]
+        per_engine = (tracemalloc.get_traced_memory()[0] - before) / len(engines)
+        tracemalloc.stop()
+        del engines
+
+        cold_times = []
+        warm_times = []
+        for i in range(realms):
+            request = MarkdownRenderRequest(
+                content=CONTENT, realm_filters_key=BENCHMARK_MARKDOWN_KEY - i,
+                email_gateway=False, realm_filters=realm_filters, realm=None,
+                db_data=None, image_preview_enabled=False,
+                url_embed_preview_enabled=False, logging_message_id='benchmark')
+            start = time.perf_counter()
+            run_md_engine(request, None, MARKDOWN_RENDER_TIMEOUT)
+            cold_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            run_md_engine(request, None, MARKDOWN_RENDER_TIMEOUT)
+            warm_times.append(time.perf_counter() - start)
+        md_engines.clear()
+
+        self.stdout.write(f'Memory per engine: {per_engine / 1024:.1f} KiB')
+        self.stdout.write(f'First render (building the engine): '
+                          f'{sum(cold_times) / realms * 1000:.2f}ms')
+        self.stdout.write(f'Later renders: {sum(warm_times) / realms * 1000:.2f}ms')
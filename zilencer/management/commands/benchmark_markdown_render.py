@@ -0,0 +1,60 @@
+import time
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.markdown import (
+    MARKDOWN_RENDER_TIMEOUT,
+    prepare_markdown_render,
+    run_md_engine,
+)
+from zerver.lib.markdown.render_pool import MarkdownRenderPool
+from zerver.models import Message
+
+
+class Command(BaseCommand):
+    help = """
+    Benchmark rendering the most recent messages on this server, which
+    are a realistic mix of content, in this process (as do_convert does
+    by default) and with a pool of render worker processes.
+    Usage: ./manage.py benchmark_markdown_render [--amount=2000] [--processes=4]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--amount', default=2000, type=int,
+                            help='Number of recent messages to render')
+        parser.add_argument('--processes', default=4, type=int,
+                            help='Number of render worker processes')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        messages = Message.objects.select_related('sending_client').order_by(
+            '-id')[:options['amount']]
+        requests = []
+        for message in messages:
+            request = prepare_markdown_render(message.content, message_realm=message.get_realm())
+            # We're measuring rendering, not the render cache.
+            request.render_cache_key = None
+            requests.append(request)
+        if not requests:
+            self.stdout.write('No messages to benchmark with.')
+            return
+
+        start = time.perf_counter()
+        for request in requests:
+            run_md_engine(request, None, MARKDOWN_RENDER_TIMEOUT)
+        self.report('in-process', len(requests), time.perf_counter() - start)
+
+        pool = MarkdownRenderPool(options['processes'], MARKDOWN_RENDER_TIMEOUT)
+        try:
+            start = time.perf_counter()
+            results = pool.render_many([(request, None) for request in requests])
+            self.report(f'{options["processes"]} workers', len(requests),
+                        time.perf_counter() - start)
+        finally:
+            pool.stop()
+        failures = sum(1 for result in results if isinstance(result, Exception))
+        if failures:
+            self.stdout.write(f'{failures} messages failed to render in the pool')
+
+    def report(self, name: str, count: int, elapsed: float) -> None:
+        self.stdout.write(f'{name:>12}: {count / elapsed:8.1f} messages/sec')
@@ -0,0 +1,60 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from zerver.lib.cache import flush_realm_mention_index
+from zerver.lib.markdown import MentionData, get_possible_mentions_info
+from zerver.models import UserGroup, UserProfile, get_realm
+
+
+class Command(BaseCommand):
+    help = """
+    Benchmark resolving the mentions in a chatty realm's messages, with
+    the realm's mention index already built and with it rebuilt for
+    every message (the worst case, a realm whose users change constantly).
+    Usage: ./manage.py benchmark_mentions [--realm=zulip] [--messages=1000]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', default='zulip',
+                            help='The string_id of the realm to benchmark with')
+        parser.add_argument('--messages', default=1000, type=int,
+                            help='Number of messages to resolve mentions for')
+
+    def make_contents(self, realm_id: int, count: int) -> List[str]:
+        # Chatty messages: each mentions a few users and maybe a group.
+        names = list(UserProfile.objects.filter(
+            realm_id=realm_id, is_active=True).values_list('full_name', flat=True)[:200])
+        groups = list(UserGroup.objects.filter(realm_id=realm_id).values_list('name', flat=True))
+        contents = []
+        for i in range(count):
+            mentions = [f'@**{names[(i + j) % len(names)]}**' for j in range(3)]
+            if groups:
+                mentions.append(f'@*{groups[i % len(groups)]}*')
+            contents.append(' '.join(mentions) + ' can you take a look?')
+        return contents
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        contents = self.make_contents(realm.id, options['messages'])
+
+        def run(rebuild: bool) -> None:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                for content in contents:
+                    if rebuild:
+                        flush_realm_mention_index(realm.id)
+                    MentionData(realm.id, content)
+                elapsed = time.perf_counter() - start
+            label = 'rebuilding the index' if rebuild else 'with the index built'
+            self.stdout.write(
+                f'{label}: {elapsed / len(contents) * 1000:.3f}ms and '
+                f'{len(queries) / len(contents):.1f} queries per message')
+
+        # Build the index, then measure with it built.
+        get_possible_mentions_info(realm.id, {'warm up'})
+        run(rebuild=False)
+        run(rebuild=True)
@@ -0,0 +1,58 @@
+import time
+from typing import Any, Dict, List
+
+import ujson
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.message import MESSAGE_CACHE_CODECS, MessageDict
+from zerver.models import Message
+
+
+class Command(BaseCommand):
+    help = """
+    Benchmark the formats available for storing message dictionaries
+    in the to_dict cache, using the most recent messages on this server.
+    Usage: ./manage.py benchmark_message_cache_codec [--amount=5000] [--rounds=5]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--amount', default=5000, type=int,
+                            help='Number of recent messages to benchmark with')
+        parser.add_argument('--rounds', default=5, type=int,
+                            help='Number of times to encode and decode each message')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        message_ids = list(Message.objects.order_by('-id').values_list(
+            'id', flat=True)[:options['amount']])
+        rows = MessageDict.get_raw_db_rows(message_ids)
+        message_dicts: List[Dict[str, Any]] = [
+            MessageDict.build_dict_from_raw_db_row(row) for row in rows
+        ]
+        if not message_dicts:
+            self.stdout.write('No messages to benchmark with.')
+            return
+        count = len(message_dicts) * options['rounds']
+
+        # Both timings include the JSON step, so that they reflect the
+        # full cost of stringify_message_dict and extract_message_dict.
+        self.stdout.write(f'{len(message_dicts)} messages, {options["rounds"]} rounds')
+        for codec in MESSAGE_CACHE_CODECS.values():
+            start = time.perf_counter()
+            for _ in range(options['rounds']):
+                encoded = [codec.encode(ujson.dumps(message_dict).encode())
+                           for message_dict in message_dicts]
+            encode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(options['rounds']):
+                for item in encoded:
+                    ujson.loads(codec.decode(item).decode('utf-8'))
+            decode_time = time.perf_counter() - start
+
+            average_size = sum(len(item) for item in encoded) / len(encoded)
+            self.stdout.write(
+                f'{codec.name:>6}: '
+                f'encode {count / encode_time:10.0f} msgs/sec, '
+                f'decode {count / decode_time:10.0f} msgs/sec, '
+                f'{average_size:8.1f} bytes/msg',
+            )
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Type
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.rate_limiter import (
+    RateLimiterBackend,
+    RedisRateLimiterBackend,
+    SharedMemoryRateLimiterBackend,
+)
+
+RULES = [(1, 200), (60, 1000)]
+
+BACKENDS: Dict[str, Type[RateLimiterBackend]] = {
+    'redis': RedisRateLimiterBackend,
+    'shared-memory': SharedMemoryRateLimiterBackend,
+}
+
+class Command(BaseCommand):
+    help = """
+    Benchmark the rate limiter backends: the latency of each rate
+    limiting decision, i.e. the overhead rate limiting adds to every API
+    request, and the throughput with several threads hammering the same
+    entities, which is where the old WATCH/MULTI Redis implementation
+    had to retry (and eventually gave up with a "Deadlock" warning).
+    Usage: ./manage.py benchmark_rate_limiter [--backend=redis] [--requests=5000] [--threads=8] [--entities=4]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--backend', choices=list(BACKENDS), action='append',
+                            help='Backend to benchmark; by default, all of them')
+        parser.add_argument('--requests', default=5000, type=int,
+                            help='Number of requests made by each thread')
+        parser.add_argument('--threads', default=8, type=int,
+                            help='Number of threads making requests concurrently')
+        parser.add_argument('--entities', default=4, type=int,
+                            help='Number of rate limited entities the threads share')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        temporary_path = None
+        if settings.RATE_LIMITING_SHARED_MEMORY_PATH is None:
+            fd, temporary_path = tempfile.mkstemp()
+            os.close(fd)
+            settings.RATE_LIMITING_SHARED_MEMORY_PATH = temporary_path
+        try:
+            for backend_name in options['backend'] or BACKENDS:
+                self.stdout.write(f'{backend_name}:')
+                self.benchmark(BACKENDS[backend_name], options)
+        finally:
+            if temporary_path is not None:
+                os.remove(temporary_path)
+
+    def benchmark(self, backend: Type[RateLimiterBackend], options: Dict[str, Any]) -> None:
+        entity_keys = [f'benchmark_rate_limiter:{i}' for i in range(options['entities'])]
+        for entity_key in entity_keys:
+            backend.clear_history(entity_key)
+
+        def make_requests(thread: int) -> List[float]:
+            latencies = []
+            for i in range(options['requests']):
+                entity_key = entity_keys[(thread + i) % len(entity_keys)]
+                start = time.perf_counter()
+                backend.rate_limit_entity(entity_key, RULES, 1000, 60)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            latencies = sorted(latency for thread_latencies in
+                               executor.map(make_requests, range(options['threads']))
+                               for latency in thread_latencies)
+        elapsed = time.perf_counter() - start
+
+        for entity_key in entity_keys:
+            backend.clear_history(entity_key)
+
+        def percentile(p: float) -> float:
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+        self.stdout.write(f'  {len(latencies)} decisions in {elapsed:.2f}s '
+                          f'({len(latencies) / elapsed:.0f}/s) with {options["threads"]} threads')
+        self.stdout.write(f'  Latency: p50 {percentile(0.5):.3f}ms, p95 {percentile(0.95):.3f}ms, '
+                          f'p99 {percentile(0.99):.3f}ms, max {latencies[-1] * 1000:.3f}ms')
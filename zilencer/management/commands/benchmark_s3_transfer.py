@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, List
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand, CommandParser
+from moto import mock_s3
+
+import zerver.lib.upload
+from zerver.lib.test_helpers import create_s3_buckets
+from zerver.lib.upload import S3Transfer, download_files_from_s3, upload_files_to_s3
+
+BUCKET_NAME = 'benchmark-s3-transfer'
+
+class Command(BaseCommand):
+    help = """
+    Benchmark the bulk S3 transfer engine used by imports, exports, and
+    transfer_uploads_to_s3, uploading and downloading a set of files
+    with different numbers of threads.  It runs against moto's
+    in-process S3 stand-in, with a simulated round-trip latency added
+    to every request, since it's S3's latency that bulk transfers are
+    bound by.
+    Usage: ./manage.py benchmark_s3_transfer [--files=1000] [--size=65536] [--latency=20] [--threads=1 --threads=32]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--files', default=1000, type=int,
+                            help='Number of files to transfer')
+        parser.add_argument('--size', default=64 * 1024, type=int,
+                            help='Size of each file, in bytes')
+        parser.add_argument('--latency', default=20, type=float,
+                            help='Simulated latency of each S3 request, in milliseconds')
+        parser.add_argument('--threads', type=int, action='append',
+                            help='Number of threads to use; by default, 1, 8, and 32')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        source_dir = tempfile.mkdtemp(prefix='zulip-benchmark-s3-')
+        try:
+            for i in range(options['files']):
+                with open(os.path.join(source_dir, f'{i}.bin'), 'wb') as f:
+                    f.write(os.urandom(options['size']))
+            with mock_s3():
+                bucket = create_s3_buckets(BUCKET_NAME)[0]
+                for threads in options['threads'] or [1, 8, 32]:
+                    self.benchmark(bucket, source_dir, threads, options)
+        finally:
+            shutil.rmtree(source_dir)
+
+    def benchmark(self, bucket: Any, source_dir: str, threads: int, options: Any) -> None:
+        get_s3_transfer_client = zerver.lib.upload.get_s3_transfer_client
+
+        def get_slow_client(threads: int) -> Any:
+            client = get_s3_transfer_client(threads)
+
+            def add_latency(**kwargs: Any) -> None:
+                time.sleep(options['latency'] / 1000)
+            # Before moto answers the request.
+            client.meta.events.register_first('before-send.s3', add_latency)
+            return client
+
+        uploads = [S3Transfer(key=f'benchmark/{i}.bin',
+                              filename=os.path.join(source_dir, f'{i}.bin'))
+                   for i in range(options['files'])]
+        download_dir = tempfile.mkdtemp(prefix='zulip-benchmark-s3-')
+        downloads = [S3Transfer(key=f'benchmark/{i}.bin',
+                                filename=os.path.join(download_dir, f'{i}.bin'))
+                     for i in range(options['files'])]
+        megabytes = options['files'] * options['size'] / 1024 / 1024
+
+        with patch('zerver.lib.upload.get_s3_transfer_client', side_effect=get_slow_client):
+            timings: List[float] = []
+            start = time.perf_counter()
+            upload_files_to_s3(BUCKET_NAME, uploads, threads=threads)
+            timings.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for transfer, head in download_files_from_s3(BUCKET_NAME, downloads, threads=threads):
+                pass
+            timings.append(time.perf_counter() - start)
+
+        shutil.rmtree(download_dir)
+        bucket.objects.all().delete()
+
+        for direction, elapsed in zip(['upload', 'download'], timings):
+            self.stdout.write(f'{threads} threads, {direction}: {elapsed:.2f}s, '
+                              f'{options["files"] / elapsed:.0f} files/s, '
+                              f'{megabytes / elapsed:.1f} MiB/s')
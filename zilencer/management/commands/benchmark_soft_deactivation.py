@@ -0,0 +1,136 @@
+import random
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.db.models import Max
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.bulk_create import bulk_create_streams, bulk_create_users
+from zerver.lib.soft_deactivation import add_missing_messages, do_catch_up_soft_deactivated_users
+from zerver.models import (
+    Message,
+    Realm,
+    RealmAuditLog,
+    Stream,
+    Subscription,
+    UserMessage,
+    UserProfile,
+    get_client,
+    get_realm,
+)
+
+BATCH_SIZE = 10000
+
+def catch_up_one_at_a_time(users: List[UserProfile]) -> None:
+    for user_profile in users:
+        add_missing_messages(user_profile)
+
+class Command(BaseCommand):
+    help = """
+    Benchmark catching up soft-deactivated users on the UserMessage
+    rows they missed.  Generates a set of users in a realm, subscribed
+    to some of a set of streams, soft-deactivates them, and adds some
+    months of traffic to those streams, with some of the users
+    unsubscribing and resubscribing along the way; then catches them
+    up a user at a time, and all at once, as the nightly job does.
+    Everything is rolled back afterwards.
+    Usage: ./manage.py benchmark_soft_deactivation --realm=zulip [--users=1000] [--days=180] [--messages-per-day=100]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', required=True,
+                            help='String ID of the realm to generate the users in')
+        parser.add_argument('--users', default=1000, type=int,
+                            help='Number of soft-deactivated users')
+        parser.add_argument('--streams', default=50, type=int,
+                            help='Number of streams')
+        parser.add_argument('--streams-per-user', default=10, type=int,
+                            help='Number of streams each user is subscribed to')
+        parser.add_argument('--days', default=180, type=int,
+                            help='Number of days of traffic the users missed')
+        parser.add_argument('--messages-per-day', default=100, type=int,
+                            help='Number of messages sent to the streams each day')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        with transaction.atomic():
+            user_ids = self.generate(realm, options)
+            for name, catch_up in [('a user at a time', catch_up_one_at_a_time),
+                                   ('all at once', do_catch_up_soft_deactivated_users)]:
+                self.benchmark(name, catch_up, user_ids)
+            transaction.set_rollback(True)
+
+    def benchmark(self, name: str, catch_up: Callable[[List[UserProfile]], Any],
+                  user_ids: List[int]) -> None:
+        with transaction.atomic():
+            users = list(UserProfile.objects.filter(id__in=user_ids))
+            start = time.perf_counter()
+            catch_up(users)
+            elapsed = time.perf_counter() - start
+            rows = UserMessage.objects.filter(user_profile_id__in=user_ids).count()
+            transaction.set_rollback(True)
+        self.stdout.write(f'{name}: created {rows} UserMessage rows in {elapsed:.1f}s '
+                          f'({rows / elapsed:.0f} rows/s)')
+
+    def generate(self, realm: Realm, options: Dict[str, Any]) -> List[int]:
+        rng = random.Random(42)
+        self.stdout.write(f'Generating {options["users"]} users and '
+                          f'{options["days"] * options["messages_per_day"]} messages...')
+
+        emails = [f'benchmark-soft-deactivation-{i}@{realm.host}' for i in range(options['users'])]
+        bulk_create_users(realm, {(email, email.split('@')[0], True) for email in emails})
+        users = list(UserProfile.objects.filter(realm=realm, delivery_email__in=emails))
+        stream_names = [f'benchmark-soft-deactivation-{i}' for i in range(options['streams'])]
+        bulk_create_streams(realm, {name: {'description': ''} for name in stream_names})
+        streams = list(Stream.objects.filter(realm=realm, name__in=stream_names))
+
+        # Everyone subscribes, and goes quiet, before the traffic starts.
+        last_message_id = Message.objects.aggregate(Max('id'))['id__max'] or 0
+        subscriptions = []
+        subscription_logs = []
+        for user_profile in users:
+            for stream in rng.sample(streams, min(options['streams_per_user'], len(streams))):
+                subscriptions.append(Subscription(user_profile=user_profile,
+                                                  recipient_id=stream.recipient_id))
+                subscription_logs.append(RealmAuditLog(
+                    realm=realm, modified_user=user_profile, modified_stream=stream,
+                    event_type=RealmAuditLog.SUBSCRIPTION_CREATED,
+                    event_last_message_id=last_message_id, event_time=timezone_now()))
+        Subscription.objects.bulk_create(subscriptions, batch_size=BATCH_SIZE)
+        UserProfile.objects.filter(id__in=[user.id for user in users]).update(
+            long_term_idle=True, last_active_message_id=last_message_id)
+
+        sending_client = get_client('benchmark_soft_deactivation')
+        message_count = options['days'] * options['messages_per_day']
+        start_time = timezone_now() - timedelta(days=options['days'])
+        messages = []
+        for i in range(message_count):
+            message = Message(
+                sender=rng.choice(users),
+                recipient_id=rng.choice(streams).recipient_id,
+                content='Hello',
+                rendered_content='<p>Hello</p>',
+                date_sent=start_time + timedelta(days=options['days'] * i / message_count),
+                sending_client=sending_client,
+            )
+            message.set_topic_name('benchmark')
+            messages.append(message)
+        Message.objects.bulk_create(messages, batch_size=BATCH_SIZE)
+        message_ids = list(Message.objects.filter(id__gt=last_message_id).values_list('id', flat=True))
+
+        # A tenth of the subscriptions lapse for a while.
+        for log in subscription_logs[:]:
+            if rng.random() < 0.1:
+                unsubscribed, resubscribed = sorted(rng.sample(message_ids, 2))
+                for event_type, event_last_message_id in [
+                        (RealmAuditLog.SUBSCRIPTION_DEACTIVATED, unsubscribed),
+                        (RealmAuditLog.SUBSCRIPTION_ACTIVATED, resubscribed)]:
+                    subscription_logs.append(RealmAuditLog(
+                        realm=realm, modified_user=log.modified_user,
+                        modified_stream=log.modified_stream, event_type=event_type,
+                        event_last_message_id=event_last_message_id, event_time=timezone_now()))
+        RealmAuditLog.objects.bulk_create(subscription_logs, batch_size=BATCH_SIZE)
+        return [user.id for user in users]
@@ -0,0 +1,44 @@
+import time
+from typing import Any, Callable, List, Optional
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.tex import katex_server, render_tex_subprocess
+
+FORMULAS = [
+    r'x^2 + y^2 = z^2',
+    r'\frac{-b \pm \sqrt{b^2 - 4ac}}{2a}',
+    r'\int_0^\infty e^{-x^2} \, dx = \frac{\sqrt{\pi}}{2}',
+    r'\sum_{n=1}^{\infty} \frac{1}{n^2} = \frac{\pi^2}{6}',
+    r'\begin{pmatrix} a & b \\ c & d \end{pmatrix}',
+    r'\lim_{h \to 0} \frac{f(x + h) - f(x)}{h}',
+]
+
+class Command(BaseCommand):
+    help = """
+    Benchmark rendering TeX with a fresh KaTeX process per formula
+    against the persistent KaTeX server used by render_tex.
+    Usage: ./manage.py benchmark_tex [--amount=200]
+    """
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--amount', default=200, type=int,
+                            help='Number of formulas to render with each approach')
+
+    def benchmark(self, name: str, render: Callable[[str, bool], Optional[str]],
+                  formulas: List[str]) -> None:
+        start = time.perf_counter()
+        for formula in formulas:
+            render(formula, True)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'{name:>10}: {len(formulas) / elapsed:8.1f} formulas/sec')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        # We make each formula distinct, and bypass render_tex's
+        # cache, so that we're measuring the cost of rendering.
+        formulas = [f'{FORMULAS[i % len(FORMULAS)]} + {i}'
+                    for i in range(options['amount'])]
+        # Don't count the server's startup time.
+        katex_server.render('1', True)
+        self.benchmark('subprocess', render_tex_subprocess, formulas)
+        self.benchmark('server', katex_server.render, formulas)
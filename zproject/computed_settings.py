@@ -668,6 +668,7 @@ ERROR_FILE_LOG_PATH = zulip_path("/var/log/zulip/errors.log")
 MANAGEMENT_LOG_PATH = zulip_path("/var/log/zulip/manage.log")
 WORKER_LOG_PATH = zulip_path("/var/log/zulip/workers.log")
 SLOW_QUERIES_LOG_PATH = zulip_path("/var/log/zulip/slow_queries.log")
+REQUEST_PROFILING_LOG_PATH = zulip_path("/var/log/zulip/request_profiles.log")
 JSON_PERSISTENT_QUEUE_FILENAME_PATTERN = zulip_path("/home/zulip/tornado/event_queues%s.json")
 EMAIL_LOG_PATH = zulip_path("/var/log/zulip/send_email.log")
 EMAIL_MIRROR_LOG_PATH = zulip_path("/var/log/zulip/email_mirror.log")
@@ -686,6 +687,7 @@ SOFT_DEACTIVATION_LOG_PATH = zulip_path("/var/log/zulip/soft_deactivation.log")
 TRACEMALLOC_DUMP_DIR = zulip_path("/var/log/zulip/tracemalloc")
 SCHEDULED_MESSAGE_DELIVERER_LOG_PATH = zulip_path("/var/log/zulip/scheduled_message_deliverer.log")
 RETENTION_LOG_PATH = zulip_path("/var/log/zulip/message_retention.log")
+RETENTION_PROGRESS_DIR = zulip_path("/var/lib/zulip/retention-progress")
 AUTH_LOG_PATH = zulip_path("/var/log/zulip/auth.log")
 
 # The EVENT_LOGS feature is an ultra-legacy piece of code, which
@@ -920,6 +922,10 @@ LOGGING: Dict[str, Any] = {
         'zulip.queue': {
             'level': 'WARNING',
         },
+        'zulip.request_profiles': {
+            # Written to REQUEST_PROFILING_LOG_PATH; see zerver/middleware.py.
+            'propagate': False,
+        },
         'zulip.retention': {
             'handlers': ['file', 'errors_file'],
             'propagate': False,
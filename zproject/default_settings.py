@@ -343,6 +343,46 @@ FIRST_TIME_TOS_TEMPLATE: Optional[str] = None
 # Hostname used for Zulip's statsd logging integration.
 STATSD_HOST = ''
 
+# Fraction of requests for which to record each database query and
+# remote cache call, for debugging slow requests; see
+# zerver/lib/request_profiling.py.  Sampled requests taking at least
+# REQUEST_PROFILING_LOG_THRESHOLD seconds are logged.
+REQUEST_PROFILING_SAMPLE_RATE = 0.0
+REQUEST_PROFILING_LOG_THRESHOLD = 1.0
+
+# Whether to log a warning, with a stack trace, when a request or
+# queue event runs the same SQL query (modulo parameters) at least
+# DUPLICATE_QUERY_THRESHOLD times; see zerver/lib/duplicate_queries.py.
+DETECT_DUPLICATE_QUERIES = False
+DUPLICATE_QUERY_THRESHOLD = 10
+
+# How message dictionaries are stored in the to_dict cache.  Messages
+# whose JSON is shorter than MESSAGE_CACHE_COMPRESSION_THRESHOLD bytes
+# are stored uncompressed; larger ones use MESSAGE_CACHE_CODEC (see
+# MESSAGE_CACHE_CODECS in zerver/lib/message.py).  Changing these is
+# safe at any time, since cache entries record their own format.
+MESSAGE_CACHE_CODEC = 'zlib'
+MESSAGE_CACHE_COMPRESSION_LEVEL = 6
+MESSAGE_CACHE_COMPRESSION_THRESHOLD = 512
+
+# Whether to cache the rendered HTML for message content that doesn't
+# mention users, groups or streams, so that identical content (e.g.
+# from bots) isn't rendered again; see do_convert.
+MARKDOWN_RENDER_CACHE = True
+
+# If set, markdown is rendered by a pool of this many worker processes
+# per server process, which enforce the render timeout by killing the
+# worker, rather than in the calling process; see
+# zerver/lib/markdown/render_pool.py.
+MARKDOWN_RENDER_PROCESSES = 0
+
+# If set, rate limits are kept in a file at this path (ideally under
+# /dev/shm) that all of the server's processes map into memory, rather
+# than in Redis; see SharedMemoryRateLimiterBackend.  Only for
+# deployments with a single application server: with several, leave
+# this unset, so that they share rate limits through Redis.
+RATE_LIMITING_SHARED_MEMORY_PATH: Optional[str] = None
+
 # Configuration for JWT auth.
 if TYPE_CHECKING:
     class JwtAuthKey(TypedDict):
@@ -397,6 +437,19 @@ OFFLINE_THRESHOLD_SECS = 5 * 60
 # permanently deleted.
 ARCHIVED_DATA_VACUUMING_DELAY_DAYS = 7
 
+# Retention policy archiving (see zerver/lib/retention.py) sizes its
+# chunks of messages so that each transaction takes about this long,
+# runs up to RETENTION_ARCHIVING_PROCESSES realms at once, and, if
+# RETENTION_MAX_REPLICATION_LAG_SECONDS is set, pauses between chunks
+# while any replica is further behind than that.
+RETENTION_TARGET_TRANSACTION_SECONDS = 1.0
+RETENTION_ARCHIVING_PROCESSES = 1
+RETENTION_MAX_REPLICATION_LAG_SECONDS: Optional[float] = None
+
+# update_analytics_counts fills up to this many stats, or stretches of
+# a stat's missing hours, at once (see analytics/lib/counts.py).
+ANALYTICS_FILL_PROCESSES = 1
+
 # Enables billing pages and plan-based feature gates. If False, all features
 # are available to all realms.
 BILLING_ENABLED = False
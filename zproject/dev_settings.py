@@ -100,6 +100,9 @@ SENDFILE_BACKEND = 'django_sendfile.backends.development'
 # Set this True to send all hotspots in development
 ALWAYS_SEND_ALL_HOTSPOTS = False
 
+# Log likely N+1 query patterns in development.
+DETECT_DUPLICATE_QUERIES = True
+
 # FAKE_LDAP_MODE supports using a fake LDAP database in the
 # development environment, without needing an LDAP server!
 #
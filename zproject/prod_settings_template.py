@@ -637,6 +637,22 @@ CAMO_URI = '/external_content/'
 
 # Controls whether Zulip will rate-limit user requests.
 # RATE_LIMITING = True
+#
+# If this is your only Zulip application server, rate limits can be
+# kept in shared memory rather than in redis, which saves a redis
+# round trip on every API request.
+# RATE_LIMITING_SHARED_MEMORY_PATH = '/dev/shm/zulip-rate-limits'
+
+# Message retention policies are applied by a nightly archiving job.
+# On a server with several large realms, it can archive a few realms
+# at once; if you have database replicas, it can pause whenever one
+# falls more than a given number of seconds behind.
+# RETENTION_ARCHIVING_PROCESSES = 4
+# RETENTION_MAX_REPLICATION_LAG_SECONDS = 30
+
+# The hourly analytics job can catch up on several stats at once,
+# which helps it recover quickly after downtime.
+# ANALYTICS_FILL_PROCESSES = 4
 
 # By default, Zulip connects to the thumbor (the thumbnailing software
 # we use) service running locally on the machine.  If you're running
@@ -82,6 +82,10 @@ AUTH_LDAP_REVERSE_EMAIL_SEARCH = LDAPSearch("ou=users,dc=zulip,dc=com",
                                             "(mail=%(email)s)")
 
 TEST_SUITE = True
+# The test suite checks query counts via assert_query_count_baseline instead.
+DETECT_DUPLICATE_QUERIES = False
+# Many markdown tests mock parts of the renderer and expect it to run.
+MARKDOWN_RENDER_CACHE = False
 RATE_LIMITING = False
 RATE_LIMITING_AUTHENTICATE = False
 # Don't use rabbitmq from the test suite -- the user_profile_ids for